@@ -2,6 +2,7 @@ import base64
 import logging
 from datetime import UTC, datetime
 from pprint import pformat
+from typing import Annotated, Optional
 
 from copilotkit.langgraph import copilotkit_customize_config, copilotkit_emit_message, copilotkit_emit_tool_call
 from langchain.chains import TransformChain
@@ -10,6 +11,7 @@ from langchain.tools import tool
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.runnables import RunnableConfig, chain
+from langchain_core.tools import InjectedToolArg
 from langgraph.graph import START, StateGraph
 from langgraph.types import Command, interrupt
 from pdfminer.high_level import extract_text
@@ -19,8 +21,9 @@ from pdfminer.layout import LAParams
 from agents.models import OpenAIModel
 from agents.receiptanalyzer.receiptanalyzerprompt import ReceiptAnalyzerPrompt
 from agents.receiptanalyzer.receiptstate import Receipt, ReceiptState
-from common.repository_factory import get_receipt_repository
+from common.repository_factory import get_async_receipt_repository
 from common.server.utils import get_uploads_folder
+from common.uploads import upload_content_hash
 
 logger = logging.getLogger(__name__)
 
@@ -58,7 +61,7 @@ def receipt_analyzer_tool(image_path: str) -> Receipt:
 
 
 @tool
-def persist_receipt_tool(receipt: Receipt) -> dict:
+async def persist_receipt_tool(receipt: Receipt, content_hash: Annotated[Optional[str], InjectedToolArg] = None) -> dict:
     """
     Persist the receipt data to a database or file.
 
@@ -66,16 +69,42 @@ def persist_receipt_tool(receipt: Receipt) -> dict:
     - receipt (Receipt): The receipt data to be persisted.
 
     Returns:
-    - dict: A dictionary containing the status of the persistence operation.
+    - dict: A dictionary containing the status of the persistence operation. If a receipt with the
+      same date, store and total was already saved, the receipt is still saved, as it can be another
+      purchase, and the dictionary has a warning with the id of the earlier receipt in possible_duplicate_of.
     """
     logger.info(f"persist_receipt_tool called: {receipt}")
 
     # Convert receipt data to JSON string and save it to the data store
-    receipt_repo = get_receipt_repository()
-    metadata = {"timestamp": datetime.now(UTC).isoformat()}
-    success = receipt_repo.save_receipt(receipt.model_dump_json(), metadata)
+    receipt_repo = get_async_receipt_repository()
+    receipt_json = receipt.model_dump_json()
+
+    # the same purchase photographed again has another file hash, but the same date, store and total;
+    # two purchases can match on those too, so the receipt is saved and the user is told about the other one
+    existing = await receipt_repo.find_similar_receipt(receipt_json)
+
+    metadata = {"timestamp": datetime.now(UTC).isoformat(), "content_hash": content_hash}
+    success = await receipt_repo.save_receipt(receipt_json, metadata)
+
+    result = {"success": success}
+    if existing:
+        logger.info(f"Receipt persisted, it may be a duplicate of receipt {existing['id']}")
+        result["possible_duplicate_of"] = existing["id"]
+        result["warning"] = (
+            f"A receipt with the same date, store and total was saved on {existing['created_at'][:10]}. "
+            "If it is the same purchase, the user can delete one of them."
+        )
+    return result
+
 
-    return {"success": success}
+def already_saved_message(receipt: dict) -> str:
+    """Message for a receipt file whose receipt was extracted and saved before."""
+    receipt_data = receipt["data"]["receipt_data"]
+    return (
+        f"This receipt was already processed and saved on {receipt['created_at'][:10]}: "
+        f"{receipt_data.get('place') or 'unknown store'}, {receipt_data.get('date') or 'unknown date'}, "
+        f"total {receipt_data.get('total')} €, {len(receipt['data']['items'])} items. It was not saved again."
+    )
 
 
 def setup_chain():
@@ -198,6 +227,20 @@ class ReceiptAnalysisFlow:
         full_image_path = get_uploads_folder() / state["receipt_image_path"]
         state["receipt_image_path"] = str(full_image_path)
 
+        # a file that was already extracted and saved is not sent to the model again
+        if state.get("content_hash") is None:
+            state["content_hash"] = await upload_content_hash(state["receipt_image_path"])
+            existing = None
+            if state["content_hash"]:
+                existing = await get_async_receipt_repository().get_receipt_by_content_hash(state["content_hash"])
+            if existing:
+                logger.info(f"Receipt file {state['receipt_image_path']} was already saved as receipt {existing['id']}")
+                message = already_saved_message(existing)
+                await copilotkit_emit_message(config, message)
+                return Command(
+                    goto="__end__", update={"messages": AIMessage(content=message), "content_hash": state["content_hash"]}
+                )
+
         prompt_template = ChatPromptTemplate.from_messages(
             [
                 SystemMessage(
@@ -215,6 +258,8 @@ class ReceiptAnalysisFlow:
                     - the number of items in the receipt
                     - the date of the receipt
                     - the store name
+
+                    If the tool call to persist the receipt returns a warning, include the warning in the analysis.
                     """
                 ),
                 (
@@ -234,7 +279,7 @@ class ReceiptAnalysisFlow:
 
         if response.tool_calls:
             # Emit a status message before processing tools
-            return Command(goto="tool_node", update={"messages": response})
+            return Command(goto="tool_node", update={"messages": response, "content_hash": state["content_hash"]})
 
         # reset a key part of the state
         state["image_file_path"] = None
@@ -251,7 +296,12 @@ class ReceiptAnalysisFlow:
             # Emit a tool call so that the user interface shows that there is some progress happening
             await copilotkit_emit_tool_call(config, name=tool_call["name"], args={})
 
-            tool_msg = tool.invoke(tool_call["args"])
+            args = tool_call["args"]
+            if tool is persist_receipt_tool:
+                # the file hash is not known to the model, it is passed on from the state
+                args = {**args, "content_hash": state.get("content_hash")}
+
+            tool_msg = await tool.ainvoke(args)
             logger.debug(f"Tool call {tool_call['name']}, result: {tool_msg}")
             state["messages"].append(ToolMessage(content=tool_msg, tool_call_id=tool_call["id"]))
 
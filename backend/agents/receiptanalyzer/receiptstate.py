@@ -75,6 +75,9 @@ class ReceiptState(CopilotKitState):
 
     receipt_image_path: Optional[str] = None
 
+    # content hash of the receipt file, to recognise files whose receipt was already extracted
+    content_hash: Optional[str] = None
+
     # receipt
     receipt: Optional[Receipt] = None
 
@@ -97,6 +100,7 @@ class ReceiptState(CopilotKitState):
         return ReceiptState(
             receipt_image_path=None,
             receipt_image=None,
+            content_hash=None,
             receipt={},
             messages=[],
             persistence_status=None,
@@ -259,8 +259,7 @@ class RecipeFlow:
         return {"recipe": recipe, "description": description}
 
     @tool
-    @staticmethod
-    def save_recipe_tool(recipe: Recipe) -> dict:
+    async def save_recipe_tool(recipe: Recipe) -> dict:
         """
         This tool persists a Recipe object to the data store.
 
@@ -271,13 +270,13 @@ class RecipeFlow:
         - A dictionary with state updates
         """
         try:
-            from common.repository_factory import get_recipe_repository
+            from common.repository_factory import get_async_recipe_repository
 
             # Get the recipe repository instance
-            recipe_repo = get_recipe_repository()
+            recipe_repo = get_async_recipe_repository()
 
             # Save the recipe to the database
-            recipe_id = recipe_repo.save_recipe(recipe)
+            recipe_id = await recipe_repo.save_recipe(recipe)
 
             if not recipe_id:
                 return {"description": "Failed to save recipe to the database.", "success": False}
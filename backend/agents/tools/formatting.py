@@ -0,0 +1,34 @@
+"""
+Compact serialization of tool results for the LLM context.
+
+Lists of records are rendered as pipe-separated tables, with the column names once in a header line,
+which takes a fraction of the tokens of the same records as JSON objects.
+"""
+
+from datetime import datetime
+from typing import Any, Iterable, List
+
+
+def format_value(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, float):
+        return f"{round(value, 3):g}"
+    if isinstance(value, datetime):
+        return value.date().isoformat() if value == datetime(value.year, value.month, value.day) else value.isoformat()
+    # the separators cannot appear inside values
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def format_table(columns: List[str], rows: Iterable[Iterable[Any]]) -> str:
+    """
+    Render rows as a table with one line per row and the values separated by |, e.g.
+
+        date|store|total
+        02.01.2025|Prisma|42.5
+    """
+    lines = ["|".join(columns)]
+    lines.extend("|".join(format_value(value) for value in row) for row in rows)
+    return "\n".join(lines)
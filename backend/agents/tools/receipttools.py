@@ -1,10 +1,11 @@
 import json
 import logging
-from typing import List
+from typing import List, Optional
 
 from langchain_core.tools import tool
 
-from common.repository_factory import get_receipt_repository
+from agents.tools.formatting import format_table
+from common.repository_factory import get_async_receipt_repository
 
 logger = logging.getLogger(__name__)
 
@@ -28,63 +29,84 @@ def mongo_json_default(obj):
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
+# receipt and line item fields returned by get_receipts_by_date, as (field, column) pairs
+RECEIPT_COLUMNS = [("date", "date"), ("place", "store"), ("total", "total"), ("total_savings", "savings")]
+ITEM_COLUMNS = [
+    ("name_en", "name"),
+    ("quantity", "quantity"),
+    ("unit_of_measure", "unit"),
+    ("unit_price", "unit_price"),
+    ("total_price", "total_price"),
+    ("loyalty_discount", "discount"),
+]
+
+
 @tool
-def get_receipts_by_date(start_date: str, end_date: str, store: None) -> str:
+async def get_receipts_by_date(
+    start_date: str, end_date: str, store: Optional[str] = None, include_items: bool = False
+) -> str:
     """
-    Get the receipts and their associated items for a given period of time, including all receipt data.
+    Get the receipts for a given period of time, optionally only from one store, and optionally with their items.
+    Only ask for the items when the question is about what was bought; totals per receipt are enough for spend questions.
 
     Example prompts:
     - how much did we spend on groceries in 2025 so far?
     - how much did we pay for the last groceries?
     - how much do we usually spend on groceries in store K-Citymarket?
+    - what did we buy in Prisma last week? (include_items)
 
     Args:
         start_date (str): The start date of the period as YYYY-MM-DD.
         end_date (str): The end date of the period as YYYY-MM-DD.
+        store (str): Only receipts from stores whose name has this text at the start of a word, e.g. "Citymarket"
+            for K-Citymarket Espoo. All stores if not given.
+        include_items (bool): Also return the items of each receipt.
 
     Returns:
-        str: A list of receipts and their associated items. The response string includes:
-            - Total price of the receipt. Currency is always €.
-            - Date of the receipt.
-            - Store where the receipt was issued.
-            - List of items in the receipt, including:
-                - Date when the item was purchased specified as YYYY-MM-DD
-                - Price of the item
-                - Store where the item was purchased
-                - Price per unit of the item
-                - Quantity of the item purchased, must always use €
-                - Level 1 item type (food/household/other)
-                - Level 2 item type (meat/vegetable/fruit/other)
-                - Level 3 item type (specific type such as chicken or fish, if applicable; otherwise None)
+        str: Tables with one line per row and values separated by |, the first line of each table has the column names.
+            The receipts table has, per receipt:
+                - receipt: number of the receipt, to match its items
+                - date: date of the receipt as DD.MM.YYYY
+                - store: store where the receipt was issued
+                - total: total price of the receipt. Currency is always €.
+                - savings: loyalty card savings, if any
+            With include_items, the items table has, per item:
+                - receipt: number of the receipt the item belongs to
+                - name, quantity, unit of measure, unit price and total price of the item (€), loyalty discount
+                - level_1: level 1 item type (food/household/other)
+                - level_2: level 2 item type (meat/vegetable/fruit/other)
+                - level_3: level 3 item type (specific type such as chicken or fish, if applicable; otherwise empty)
     """
-    logger.info(f"Getting groceries from {start_date} to {end_date}")
-
-    receipt_repo = get_receipt_repository()
-    receipts = receipt_repo.get_receipts_by_date(start_date, end_date)
-
-    return json.dumps(receipts, default=mongo_json_default)
-
-
-def is_correct_item_type(item, item_type):
-    category = item["item_category"]
-    if not category:
-        return False
-
-    if not isinstance(category, dict):
-        return False
-
-    if item_type.lower() in (category.get("level_1") or "__not_defined__").lower():
-        return True
-    if item_type.lower() in (category.get("level_2") or "__not_defined__").lower():
-        return True
-    if item_type.lower() in (category.get("level_3") or "__not_defined__").lower():
-        return True
-
-    return False
+    logger.info(f"Getting groceries from {start_date} to {end_date}{f' in {store}' if store else ''}")
+
+    fields = [f"receipt_data.{field}" for field, _ in RECEIPT_COLUMNS]
+    if include_items:
+        fields += [f"items.{field}" for field, _ in ITEM_COLUMNS] + ["items.item_category"]
+
+    receipt_repo = get_async_receipt_repository()
+    receipts = await receipt_repo.get_receipts_by_date(start_date, end_date, store=store, fields=fields)
+    if receipts is None:
+        return "Error: the receipts could not be retrieved."
+
+    receipt_rows = []
+    item_rows = []
+    for number, receipt in enumerate(receipts, start=1):
+        receipt_data = receipt["data"]["receipt_data"]
+        receipt_rows.append([number, *(receipt_data.get(field) for field, _ in RECEIPT_COLUMNS)])
+        for item in receipt["data"]["items"]:
+            category = item.get("item_category") or {}
+            levels = [category.get(level) for level in ("level_1", "level_2", "level_3")]
+            item_rows.append([number, *(item.get(field) for field, _ in ITEM_COLUMNS), *levels])
+
+    response = "Receipts:\n" + format_table(["receipt", *(column for _, column in RECEIPT_COLUMNS)], receipt_rows)
+    if include_items:
+        columns = ["receipt", *(column for _, column in ITEM_COLUMNS), "level_1", "level_2", "level_3"]
+        response += "\n\nItems:\n" + format_table(columns, item_rows)
+    return response
 
 
 @tool
-def get_items_per_item_type(item_type: str) -> str:
+async def get_items_per_item_type(item_type: str) -> str:
     """
     Retrieves a list of items based on their item type based on existing categorization in receipts.
     For each item, it will provide the date when it was purchased, the price, the store, price per unit and the quantity.
@@ -114,24 +136,8 @@ def get_items_per_item_type(item_type: str) -> str:
     """
     logger.info(f"Getting groceries for {item_type}")
 
-    receipt_repo = get_receipt_repository()
-    receipts = receipt_repo.get_items_per_item_type(item_type)
-    logger.info(f"Found {len(receipts)} receipts for {item_type}")
-    response_data = []
-
-    for receipt in receipts:
-        for item in receipt["items"]:
-            if is_correct_item_type(item, item_type):
-                """
-                response_data.append(
-                    f"Name: {item['name_fi']}, \
-                    Quantity: {item['quantity']}, \
-                    Total price: {item['total_price']}, \
-                    Price per unit: {item['unit_price']}, \
-                    Store: {receipt['receipt_data']['place']}, \
-                    Purchased on: {receipt['receipt_data']['date'].isoformat() if receipt['receipt_data']['date'] else 'Unknown'}"
-                )
-                """
-                response_data.append(item)
-
-    return json.dumps(response_data)
+    receipt_repo = get_async_receipt_repository()
+    items = await receipt_repo.get_items_per_item_type(item_type)
+    logger.info(f"Found {len(items)} items for {item_type}")
+
+    return json.dumps(items, default=mongo_json_default)
@@ -10,7 +10,8 @@ from typing import Any, Dict, List
 from langchain_core.tools import tool
 
 from agents.recipes.recipeflow import Recipe
-from common.repository_factory import get_recipe_repository
+from common.recipe_recommender import RECOMMENDER_MAX_DAYS
+from common.repository_factory import get_async_recipe_repository
 
 logger = logging.getLogger(__name__)
 
@@ -19,11 +20,18 @@ def get_tools() -> List:
     """
     Returns a list of tools that can be used in the chat.
     """
-    return [get_recipe_by_id, search_recipes, get_recipes_by_tags, get_recipes_by_ingredients]
+    return [
+        get_recipe_by_id,
+        search_recipes,
+        semantic_search_recipes,
+        get_recipes_by_tags,
+        get_recipes_by_ingredients,
+        recommend_recipes_from_purchases,
+    ]
 
 
 @tool
-def get_recipe_by_id(recipe_id: str) -> str:
+async def get_recipe_by_id(recipe_id: str) -> str:
     """
     Get a recipe from the database by its ID.
 
@@ -35,8 +43,8 @@ def get_recipe_by_id(recipe_id: str) -> str:
     """
     logger.info(f"Getting recipe with ID {recipe_id}")
 
-    recipe_repo = get_recipe_repository()
-    recipe = recipe_repo.get_recipe_by_id(recipe_id)
+    recipe_repo = get_async_recipe_repository()
+    recipe = await recipe_repo.get_recipe_by_id(recipe_id)
 
     if recipe:
         return json.dumps({"success": True, "recipe": recipe.model_dump(), "recipe_id": recipe_id})
@@ -45,7 +53,7 @@ def get_recipe_by_id(recipe_id: str) -> str:
 
 
 @tool
-def search_recipes(query: str) -> str:
+async def search_recipes(query: str) -> str:
     """
     This tool can be used to search for recipes based on a string. The search can include keywords, ingredients, the name of the
     recipe, or tags associated with the recipe. This recipe can be used by a user to find recipes that match their interests or dietary preferences.
@@ -60,8 +68,8 @@ def search_recipes(query: str) -> str:
     """
     logger.info(f"Searching recipes with query: {query}")
 
-    recipe_repo = get_recipe_repository()
-    recipes = recipe_repo.search_recipes(query)
+    recipe_repo = get_async_recipe_repository()
+    recipes = await recipe_repo.search_recipes(query)
 
     # Convert Recipe objects to dictionaries for JSON serialization
     recipe_dicts = [recipe.model_dump() for recipe in recipes]
@@ -70,7 +78,32 @@ def search_recipes(query: str) -> str:
 
 
 @tool
-def get_recipes_by_tags(tags: str) -> str:
+async def semantic_search_recipes(query: str) -> str:
+    """
+    This tool can be used to find recipes that match a description rather than exact keywords, e.g. when the user asks for
+    "something warm and quick with chickpeas" or "a light summer dinner". Use search_recipes for names and keywords, and this
+    tool when that finds nothing or the request describes the kind of dish. The tool will return a list of the most similar
+    recipes, including their names, descriptions, ingredients, and steps.
+
+    Args:
+        query (str): Description of the recipes to find.
+
+    Returns:
+        str: A JSON string containing a list of matching recipes, most similar first.
+    """
+    logger.info(f"Searching recipes semantically with query: {query}")
+
+    recipe_repo = get_async_recipe_repository()
+    recipes = await recipe_repo.semantic_search_recipes(query)
+
+    # Convert Recipe objects to dictionaries for JSON serialization
+    recipe_dicts = [recipe.model_dump() for recipe in recipes]
+
+    return json.dumps({"success": True, "results": recipe_dicts, "count": len(recipes)})
+
+
+@tool
+async def get_recipes_by_tags(tags: str) -> str:
     """
     This tool can be used to find recipes that are categorized under specific tags, such as "vegan", "gluten-free", "meat", "pasta", etc.
     This is useful for users who want to filter recipes based on dietary preferences or specific themes. This tool can be called when
@@ -87,8 +120,8 @@ def get_recipes_by_tags(tags: str) -> str:
     tag_list = [tag.strip() for tag in tags.split(",")]
     logger.info(f"Getting recipes with tags: {tag_list}")
 
-    recipe_repo = get_recipe_repository()
-    recipes = recipe_repo.get_recipes_by_tags(tag_list)
+    recipe_repo = get_async_recipe_repository()
+    recipes = await recipe_repo.get_recipes_by_tags(tag_list)
 
     # Convert Recipe objects to dictionaries for JSON serialization
     recipe_dicts = [recipe.model_dump() for recipe in recipes]
@@ -97,21 +130,23 @@ def get_recipes_by_tags(tags: str) -> str:
 
 
 @tool
-def get_recipes_by_ingredients(ingredients: str) -> str:
+async def get_recipes_by_ingredients(ingredients: str, match_all: bool = False) -> str:
     """
-    Get recipes that contain any of the specified ingredients.
+    Get recipes that contain any of the specified ingredients. Ingredients can be given in English or
+    Finnish, without quantities, e.g. "minced beef, onion".
 
     Args:
         ingredients (str): Comma-separated list of ingredients.
+        match_all (bool): If true, only get recipes that must contain all of the ingredients.
 
     Returns:
         str: A JSON string containing a list of matching recipes.
     """
     ingredient_list = [ingredient.strip() for ingredient in ingredients.split(",")]
-    logger.info(f"Getting recipes with ingredients: {ingredient_list}")
+    logger.info(f"Getting recipes with ingredients: {ingredient_list}, match_all: {match_all}")
 
-    recipe_repo = get_recipe_repository()
-    recipes = recipe_repo.get_recipes_by_ingredients(ingredient_list)
+    recipe_repo = get_async_recipe_repository()
+    recipes = await recipe_repo.get_recipes_by_ingredients(ingredient_list, match_all)
 
     # Convert Recipe objects to dictionaries for JSON serialization
     recipe_dicts = [recipe.model_dump() for recipe in recipes]
@@ -120,7 +155,39 @@ def get_recipes_by_ingredients(ingredients: str) -> str:
 
 
 @tool
-def fetch_and_store_recipe(recipe_data: Dict[str, Any]) -> str:
+async def recommend_recipes_from_purchases(days: int = 14) -> str:
+    """
+    This tool can be used to suggest what to cook with the groceries the user bought recently, e.g. when the user asks
+    "what can I cook with what I bought?" or "any recipe ideas for the stuff I got this week?". Recipes are ranked by the
+    share of their ingredients found on the receipts of the last days, and each result lists the matched and missing
+    ingredients, so that the user knows what else to buy.
+
+    Args:
+        days (int): Number of days of receipts to consider, 14 by default and at most 90.
+
+    Returns:
+        str: A JSON string containing a list of recommended recipes, best covered first.
+    """
+    logger.info(f"Recommending recipes from the purchases of the last {days} days")
+
+    recipe_repo = get_async_recipe_repository()
+    recommendations = await recipe_repo.recommend_recipes(min(max(days, 1), RECOMMENDER_MAX_DAYS))
+
+    results = [
+        {
+            "recipe": recommendation["recipe"].model_dump(),
+            "coverage": recommendation["coverage"],
+            "matched_ingredients": recommendation["matched"],
+            "missing_ingredients": recommendation["missing"],
+        }
+        for recommendation in recommendations
+    ]
+
+    return json.dumps({"success": True, "results": results, "count": len(results)})
+
+
+@tool
+async def fetch_and_store_recipe(recipe_data: Dict[str, Any]) -> str:
     """
     Store a recipe in the database.
 
@@ -148,12 +215,12 @@ def fetch_and_store_recipe(recipe_data: Dict[str, Any]) -> str:
             recipe.preparation_time = recipe_data["preparation_time"]
 
         # Store the recipe in the database
-        recipe_repo = get_recipe_repository()
-        recipe_id = recipe_repo.save_recipe(recipe)
+        recipe_repo = get_async_recipe_repository()
+        recipe_id = await recipe_repo.save_recipe(recipe)
 
         if recipe_id:
             # Fetch the stored recipe to return
-            stored_recipe = recipe_repo.get_recipe_by_id(recipe_id)
+            stored_recipe = await recipe_repo.get_recipe_by_id(recipe_id)
             if stored_recipe:
                 return json.dumps({"success": True, "recipe": stored_recipe.model_dump(), "recipe_id": recipe_id})
             else:
@@ -0,0 +1,24 @@
+import unittest
+from datetime import datetime
+
+from agents.tools.formatting import format_table, format_value
+
+
+class TestFormatting(unittest.TestCase):
+    """Test cases for the compact tool output."""
+
+    def test_format_value(self):
+        """Test that values are written as short as possible without losing information."""
+        self.assertEqual(format_value(None), "")
+        self.assertEqual(format_value(1.2000001), "1.2")
+        self.assertEqual(format_value(True), "yes")
+        self.assertEqual(format_value(datetime(2025, 1, 2)), "2025-01-02")
+        self.assertEqual(format_value("a|b\nc"), "a/b c")
+
+    def test_format_table(self):
+        """Test that tables have a header line and one line per row."""
+        self.assertEqual(format_table(["a", "b"], [[1, None], ["x", 2.5]]), "a|b\n1|\nx|2.5")
+
+
+if __name__ == "__main__":
+    unittest.main()
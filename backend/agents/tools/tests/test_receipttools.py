@@ -1,66 +1,61 @@
+import json
 import unittest
+from datetime import datetime
+from unittest.mock import AsyncMock, Mock, patch
 
-from agents.tools.receipttools import is_correct_item_type
+from agents.tools.receipttools import get_items_per_item_type, get_receipts_by_date
 
 
-class TestReceiptTools(unittest.TestCase):
+class TestReceiptTools(unittest.IsolatedAsyncioTestCase):
     """Test cases for the receipttools module."""
 
-    def test_is_correct_item_type_with_matching_level1(self):
-        """Test is_correct_item_type when level_1 matches the item_type."""
-        item = {"item_category": {"level_1": "Food", "level_2": "Grains & Pasta", "level_3": "Rice"}}
-        self.assertTrue(is_correct_item_type(item, "food"))
-        self.assertTrue(is_correct_item_type(item, "FOOD"))  # Case insensitive
-        self.assertTrue(is_correct_item_type(item, "Food"))  # Case insensitive
-
-    def test_is_correct_item_type_with_matching_level2(self):
-        """Test is_correct_item_type when level_2 matches the item_type."""
-        item = {"item_category": {"level_1": "Food", "level_2": "Grains & Pasta", "level_3": "Rice"}}
-        self.assertTrue(is_correct_item_type(item, "pasta"))
-        self.assertTrue(is_correct_item_type(item, "PASTA"))  # Case insensitive
-        self.assertTrue(is_correct_item_type(item, "Pasta"))  # Case insensitive
-
-    def test_is_correct_item_type_with_matching_level3(self):
-        """Test is_correct_item_type when level_3 matches the item_type."""
-        item = {"item_category": {"level_1": "Food", "level_2": "Grains & Pasta", "level_3": "Rice"}}
-        self.assertTrue(is_correct_item_type(item, "rice"))
-        self.assertTrue(is_correct_item_type(item, "RICE"))  # Case insensitive
-        self.assertTrue(is_correct_item_type(item, "Rice"))  # Case insensitive
-
-    def test_is_correct_item_type_with_no_match(self):
-        """Test is_correct_item_type when there's no match."""
-        item = {"item_category": {"level_1": "Food", "level_2": "Grains & Pasta", "level_3": "Rice"}}
-        self.assertFalse(is_correct_item_type(item, "vegetable"))
-        self.assertFalse(is_correct_item_type(item, "dairy"))
-        self.assertFalse(is_correct_item_type(item, "fish"))
-
-    def test_is_correct_item_type_with_missing_levels(self):
-        """Test is_correct_item_type with missing category levels."""
-        # Only level_1 defined
-        item = {"item_category": {"level_1": "Food"}}
-        self.assertTrue(is_correct_item_type(item, "food"))
-        self.assertFalse(is_correct_item_type(item, "meat"))
-
-        # Only level_1 and level_2 defined
-        item = {
-            "item_category": {
-                "level_1": "Food",
-                "level_2": "Grains & Pasta",
-            }
+    async def test_get_items_per_item_type_returns_the_matching_items(self):
+        """Test that the items found by the repository are returned with their receipt date and store."""
+        repository = Mock(
+            get_items_per_item_type=AsyncMock(
+                return_value=[{"name_en": "Spaghetti", "total_price": 1.5, "date": datetime(2025, 1, 2), "store": "Prisma"}]
+            )
+        )
+        with patch("agents.tools.receipttools.get_async_receipt_repository", return_value=repository):
+            response = await get_items_per_item_type.ainvoke({"item_type": "pasta"})
+
+        repository.get_items_per_item_type.assert_awaited_once_with("pasta")
+        self.assertEqual(
+            json.loads(response),
+            [{"name_en": "Spaghetti", "total_price": 1.5, "date": "2025-01-02T00:00:00", "store": "Prisma"}],
+        )
+
+    async def test_get_receipts_by_date_returns_compact_tables(self):
+        """Test that only the needed fields are requested, filtered by store, and returned as tables."""
+        receipt = {
+            "id": "1",
+            "data": {
+                "receipt_data": {"date": "02.01.2025", "place": "K-Citymarket", "total": 12.5},
+                "items": [{"name_en": "Milk", "quantity": 2.0, "total_price": 2.4, "item_category": {"level_1": "Food"}}],
+            },
         }
-        self.assertTrue(is_correct_item_type(item, "food"))
-        self.assertTrue(is_correct_item_type(item, "pasta"))
-        self.assertFalse(is_correct_item_type(item, "chicken"))
-
-    def test_is_correct_item_type_with_none_category(self):
-        """Test is_correct_item_type when item_category is None."""
-        item = {"item_category": None}
-        self.assertFalse(is_correct_item_type(item, "food"))
-
-    def test_is_correct_item_type_with_non_dict_category(self):
-        """Test is_correct_item_type when item_category is not a dict."""
-        item = {"item_category": "food"}
-        self.assertFalse(is_correct_item_type(item, "food"))
+        repository = Mock(get_receipts_by_date=AsyncMock(return_value=[receipt]))
+        with patch("agents.tools.receipttools.get_async_receipt_repository", return_value=repository):
+            response = await get_receipts_by_date.ainvoke(
+                {"start_date": "2025-01-01", "end_date": "2025-01-31", "store": "citymarket", "include_items": True}
+            )
+
+        kwargs = repository.get_receipts_by_date.call_args.kwargs
+        self.assertEqual(kwargs["store"], "citymarket")
+        self.assertIn("receipt_data.total", kwargs["fields"])
+        self.assertNotIn("items", kwargs["fields"])
+        self.assertEqual(
+            response.splitlines(),
+            [
+                "Receipts:",
+                "receipt|date|store|total|savings",
+                "1|02.01.2025|K-Citymarket|12.5|",
+                "",
+                "Items:",
+                "receipt|name|quantity|unit|unit_price|total_price|discount|level_1|level_2|level_3",
+                "1|Milk|2|||2.4||Food||",
+            ],
+        )
 
 
 if __name__ == "__main__":
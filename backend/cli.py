@@ -12,6 +12,7 @@ Usage:
 Commands:
     /help           - Display help information
     /upload <path>  - Set image path for receipt processing
+    /import <path>  - Import receipts from a JSON or JSON Lines export file
     /save [file]    - Save conversation to file (default: conversation.json)
     /load [file]    - Load conversation from file (default: conversation.json)
     /clear          - Clear conversation history
@@ -43,6 +44,8 @@ from rich.pretty import Pretty
 from rich.table import Table
 
 from agents.maingraph import GlobalState, MainGraph
+from common.receipt_repository import load_receipts_export
+from common.repository_factory import get_async_receipt_repository
 
 # Load environment variables
 load_dotenv(verbose=True)
@@ -71,6 +74,7 @@ def print_help():
     commands = [
         ("/help", "Display this help information"),
         ("/upload <path>", "Set image path for receipt processing"),
+        ("/import <path>", "Import receipts from a JSON or JSON Lines export file"),
         ("/save [file]", "Save conversation to JSON file (default: conversation.json)"),
         ("/load [file]", "Load conversation from JSON file (default: conversation.json)"),
         ("/clear", "Clear conversation history"),
@@ -113,6 +117,26 @@ def load_conversation(filename: str = "conversation.json") -> List:
         return []
 
 
+async def import_receipts(filename: str):
+    """Import the receipts of an export file and print the import report"""
+    try:
+        with open(filename, "r") as f:
+            receipts = load_receipts_export(f.read())
+    except (OSError, ValueError) as e:
+        console.print(f"[bold red]Error reading receipts: {str(e)}[/bold red]")
+        return
+
+    with console.status(f"[bold green]Importing {len(receipts)} receipts...[/bold green]"):
+        report = await get_async_receipt_repository().save_receipts_bulk(receipts)
+
+    console.print(
+        f"[bold green]Imported {report['inserted']} of {report['received']} receipts "
+        f"({report['duplicates']} duplicates skipped)[/bold green]"
+    )
+    for failure in report["failed"]:
+        console.print(f"[bold red]Receipt {failure['index']} not imported: {failure['error']}[/bold red]")
+
+
 def format_message(message: Dict[str, Any]) -> str:
     """Format a message for display"""
     role = message.get("role", "unknown")
@@ -235,7 +259,20 @@ async def main():
 
     # Initialize command session with history
     command_completer = WordCompleter(
-        ["/help", "/upload", "/save", "/load", "/clear", "/debug", "/fulldebug", "/loglevel", "/state", "/exit", "/quit"]
+        [
+            "/help",
+            "/upload",
+            "/import",
+            "/save",
+            "/load",
+            "/clear",
+            "/debug",
+            "/fulldebug",
+            "/loglevel",
+            "/state",
+            "/exit",
+            "/quit",
+        ]
     )
     session = PromptSession(
         history=FileHistory(".chat_history"), auto_suggest=AutoSuggestFromHistory(), completer=command_completer
@@ -299,6 +336,15 @@ async def main():
                     console.print(f"[bold green]Image path set to: {path}[/bold green]")
                     continue
 
+                # Import receipts from an export file
+                elif command == "/import":
+                    if not args:
+                        console.print("[bold red]Please specify a file path.[/bold red]")
+                        continue
+
+                    await import_receipts(os.path.expanduser(args.strip()))
+                    continue
+
                 # Save conversation command
                 elif command == "/save":
                     filename = args if args else "conversation.json"
@@ -1,560 +1,1127 @@
+import asyncio
 import logging
 import os
-from datetime import datetime
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+from common.analytics_cube import line_item_cube
+from common.mongo_clients import mongo_clients
+from common.receipt_repository import RECEIPT_ITEMS_COLLECTION
+from common.recipe_recommender import RECIPE_RECOMMENDER_ENABLED, recipe_recommender
 
-MONGO_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
-DB_NAME = os.environ.get("MONGODB_DATABASE", "receipts")
 RECEIPTS_COLLECTION = "receipts"
 AGGREGATES_COLLECTION = "aggregates"
+ANALYTICS_STATE_COLLECTION = "analytics_state"
+SPEND_DAILY_COLLECTION = "spend_daily"
+
+# When enabled, change events are applied as deltas to the affected buckets instead of recomputing everything
+ANALYTICS_INCREMENTAL = os.environ.get("ANALYTICS_INCREMENTAL", "true").lower() == "true"
+
+# Change events are collected for this long (or until this many arrive) and then applied in one go
+ANALYTICS_COALESCE_WINDOW_SECONDS = float(os.environ.get("ANALYTICS_COALESCE_WINDOW_SECONDS", "2.0"))
+ANALYTICS_COALESCE_MAX_EVENTS = int(os.environ.get("ANALYTICS_COALESCE_MAX_EVENTS", "500"))
+
+# Number of aggregate document upserts sent to MongoDB per bulk write
+ANALYTICS_WRITE_BATCH_SIZE = int(os.environ.get("ANALYTICS_WRITE_BATCH_SIZE", "500"))
+
+# Delay before reconnecting the change listener after an error, doubled on every failed attempt
+ANALYTICS_LISTENER_BACKOFF_SECONDS = float(os.environ.get("ANALYTICS_LISTENER_BACKOFF_SECONDS", "1.0"))
+ANALYTICS_LISTENER_MAX_BACKOFF_SECONDS = float(os.environ.get("ANALYTICS_LISTENER_MAX_BACKOFF_SECONDS", "60.0"))
 
-client = AsyncIOMotorClient(MONGO_URI)
-db = client[DB_NAME]
+# Keep every receipt line item in an in-memory columnar cube for ad hoc group-by queries, reloaded every so often
+ANALYTICS_CUBE_ENABLED = os.environ.get("ANALYTICS_CUBE_ENABLED", "true").lower() == "true"
+ANALYTICS_CUBE_RELOAD_SECONDS = float(os.environ.get("ANALYTICS_CUBE_RELOAD_SECONDS", "3600"))
+
+db = mongo_clients.async_db
 
 logger = logging.getLogger(__name__)
 
-logger.info(f"Async MongoDB client connected to {MONGO_URI} and database {DB_NAME}")
 
+#
+# Aggregates are kept in the aggregates collection, one document per bucket:
+#
+# - daily_spend: one document per (year, month) with entries per day
+# - weekly_spend: one document per ISO (year, week)
+# - monthly_spend: one document per (year, month)
+# - yearly_spend: one document per year
+# - yearly_monthly_spend: one document per (year, month) with the overall spend and level_1 breakdown
+#
+# Next to them, the spend_daily collection holds one row per (date, store, level_1, level_2, level_3)
+# with the item total, the receipt totals and the number of items; arbitrary date ranges and
+# granularities are answered by rolling these rows up instead of scanning the receipts.
+#
+# The daily, weekly, monthly and yearly documents hold four lists of entries: overall (the receipt
+# totals) and level_1/level_2/level_3 (the item totals per category), each entry shaped like
+# { "_id": { <time fields>, <category fields> }, "total_spend": 100 }.
+#
+# Both the full rebuild and the incremental (delta-based) maintenance roll receipts up into these
+# buckets with SpendDelta below, so both paths produce identical documents. A full rebuild is simply
+# the delta of every receipt against an empty collection.
+#
 
-async def calculate_monthly_spend():
-    logger.info("Calculating monthly spend...")
-    # Project receipt_data.date and receipt_data.total to root for grouping
-    overall_pipeline = [
-        {"$project": {"date": "$receipt_data.date", "total": "$receipt_data.total"}},
-        {"$group": {"_id": {"year": {"$year": "$date"}, "month": {"$month": "$date"}}, "total_spend": {"$sum": "$total"}}},
-        {"$sort": {"_id.year": 1, "_id.month": 1}},
-    ]
-    overall = await db[RECEIPTS_COLLECTION].aggregate(overall_pipeline).to_list(length=None)
 
-    level1_pipeline = [
-        {"$unwind": "$items"},
-        {"$project": {"date": "$receipt_data.date", "level_1": "$items.item_category.level_1", "total": "$items.total_price"}},
-        {
-            "$group": {
-                "_id": {"year": {"$year": "$date"}, "month": {"$month": "$date"}, "level_1": "$level_1"},
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.level_1": 1}},
-    ]
-    level1 = await db[RECEIPTS_COLLECTION].aggregate(level1_pipeline).to_list(length=None)
+class AggregatesVersion:
+    """
+    Bumped after every write to the aggregates or the spend_daily rows, so that responses computed
+    from them can be cached until the data changes. Changes made before the process started are
+    not known, so last_updated starts out as the start time.
+    """
 
-    level2_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "level_1": "$items.item_category.level_1",
-                "level_2": "$items.item_category.level_2",
-                "total": "$items.total_price",
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": {"$year": "$date"},
-                    "month": {"$month": "$date"},
-                    "level_1": "$level_1",
-                    "level_2": "$level_2",
-                },
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.level_1": 1, "_id.level_2": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_1": "$__id.level_1", "level_2": "$__id.level_2"}},
-    ]
-    level2 = await db[RECEIPTS_COLLECTION].aggregate(level2_pipeline).to_list(length=None)
+    def __init__(self):
+        self.version = 0
+        self.last_updated = datetime.now(timezone.utc).replace(microsecond=0)
 
-    level3_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "level_2": "$items.item_category.level_2",
-                "level_3": "$items.item_category.level_3",
-                "total": "$items.total_price",
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": {"$year": "$date"},
-                    "month": {"$month": "$date"},
-                    "level_2": "$level_2",
-                    "level_3": "$level_3",
-                },
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.level_2": 1, "_id.level_3": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_2": "$__id.level_2", "level_3": "$__id.level_3"}},
-    ]
-    level3 = await db[RECEIPTS_COLLECTION].aggregate(level3_pipeline).to_list(length=None)
-
-    # Organize by (year, month)
-    from collections import defaultdict
-
-    monthly_data = defaultdict(lambda: {"overall": [], "level_1": [], "level_2": [], "level_3": []})
-    for entry in overall:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        monthly_data[(y, m)]["overall"].append(entry)
-    for entry in level1:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        monthly_data[(y, m)]["level_1"].append(entry)
-    for entry in level2:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        monthly_data[(y, m)]["level_2"].append(entry)
-    for entry in level3:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        monthly_data[(y, m)]["level_3"].append(entry)
-
-    # Store or update one document per (year, month)
-    for (y, m), data in monthly_data.items():
-        await db[AGGREGATES_COLLECTION].update_one(
-            {"type": "monthly_spend", "year": y, "month": m},
-            {"$set": {"data": data, "last_updated": datetime.utcnow()}},
-            upsert=True,
+    def bump(self):
+        self.version += 1
+        self.last_updated = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+aggregates_version = AggregatesVersion()
+
+# analytics_state document recording the layout of the aggregates the last full rebuild wrote
+AGGREGATES_LAYOUT_STATE_ID = "aggregates_layout"
+# raised when the aggregate documents change shape, so that databases built before are rebuilt once:
+# 1 split yearly_spend per year, 2 added the spend_daily rows
+AGGREGATES_LAYOUT_VERSION = 2
+
+
+class AggregatesLayout:
+    """
+    Whether the aggregates and the spend_daily rows were built in the current layout. A database built
+    by an earlier version is rebuilt at startup; until then change events are not applied as deltas,
+    which would create documents and rows holding only the receipts changed since the upgrade.
+    """
+
+    def __init__(self):
+        self.current = False
+
+
+aggregates_layout = AggregatesLayout()
+
+SPEND_AGGREGATE_TYPES = ("daily_spend", "weekly_spend", "monthly_spend", "yearly_spend")
+AGGREGATE_TYPES = (*SPEND_AGGREGATE_TYPES, "yearly_monthly_spend")
+
+# category fields that make up the _id of each level, in the order they appear in the _id
+CATEGORY_LEVEL_FIELDS = {
+    "level_1": ("level_1",),
+    "level_2": ("level_1", "level_2"),
+    "level_3": ("level_2", "level_3"),
+}
+
+# category levels of the spend_daily rows
+SPEND_DAILY_LEVELS = ("level_1", "level_2", "level_3")
+
+# entries whose total drops below this after a subtraction are considered gone
+ZERO_SPEND_EPSILON = 1e-6
+
+
+def _amount(value) -> float:
+    """Mimic $sum, which ignores anything that is not a number."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0.0
+    return float(value)
+
+
+def _time_keys(aggregate_type: str, date: datetime):
+    """
+    Returns the bucket (document selector), the leading _id fields and the trailing _id fields
+    for a date in the given aggregate type.
+    """
+    if aggregate_type == "daily_spend":
+        return {"year": date.year, "month": date.month}, {"year": date.year, "month": date.month, "day": date.day}, {}
+    if aggregate_type == "monthly_spend":
+        return {"year": date.year, "month": date.month}, {"year": date.year, "month": date.month}, {}
+    if aggregate_type == "yearly_spend":
+        return {"year": date.year}, {"year": date.year}, {}
+    if aggregate_type == "weekly_spend":
+        iso_year, iso_week, _ = date.isocalendar()
+        first_day_of_week = datetime.fromisocalendar(iso_year, iso_week, 1)
+        return (
+            {"year": iso_year, "week": iso_week},
+            {"year": iso_year, "week": iso_week},
+            {"first_day_of_week": first_day_of_week},
         )
-    logger.info("Monthly spend calculation complete.")
+    raise ValueError(f"Unknown aggregate type: {aggregate_type}")
 
 
-async def calculate_daily_spend():
-    logger.info("Calculating daily spend...")
-    # Overall daily totals
-    overall_pipeline = [
-        {"$project": {"date": "$receipt_data.date", "total": "$receipt_data.total"}},
-        {
-            "$group": {
-                "_id": {"year": {"$year": "$date"}, "month": {"$month": "$date"}, "day": {"$dayOfMonth": "$date"}},
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.day": 1}},
-    ]
-    overall = await db[RECEIPTS_COLLECTION].aggregate(overall_pipeline).to_list(length=None)
+def _freeze(document: dict) -> tuple:
+    return tuple(document.items())
 
-    # Daily totals per level_1 item type
-    level1_pipeline = [
-        {"$unwind": "$items"},
-        {"$project": {"date": "$receipt_data.date", "level_1": "$items.item_category.level_1", "total": "$items.total_price"}},
-        {
-            "$group": {
-                "_id": {
-                    "year": {"$year": "$date"},
-                    "month": {"$month": "$date"},
-                    "day": {"$dayOfMonth": "$date"},
-                    "level_1": "$level_1",
-                },
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.day": 1, "_id.level_1": 1}},
-    ]
-    level1 = await db[RECEIPTS_COLLECTION].aggregate(level1_pipeline).to_list(length=None)
 
-    # Daily totals per level_2 item type
-    level2_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "level_1": "$items.item_category.level_1",
-                "level_2": "$items.item_category.level_2",
-                "total": "$items.total_price",
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": {"$year": "$date"},
-                    "month": {"$month": "$date"},
-                    "day": {"$dayOfMonth": "$date"},
-                    "level_1": "$level_1",
-                    "level_2": "$level_2",
-                },
-                "total_spend": {"$sum": "$total"},
+def _sort_key(entry_key) -> tuple:
+    """Sort entries like MongoDB sorts them on their _id fields, with nulls first."""
+    values = [value for _, value in entry_key] if isinstance(entry_key, tuple) else [entry_key]
+    return tuple((value is not None, value if value is not None else 0) for value in values)
+
+
+class SpendDelta:
+    """
+    Accumulates signed spend changes per aggregate bucket so that they can be applied with a
+    single update per affected aggregate document.
+    """
+
+    def __init__(self):
+        # (aggregate type, frozen bucket) -> {"bucket": dict, "levels": {level: {frozen id: [id, extra, amount]}}}
+        self.buckets = {}
+        # (day, store, level_1, level_2, level_3) -> [items_total, receipts_total, item_count]
+        self.daily_rows = {}
+
+    def add_receipt(self, receipt: dict, sign: int):
+        """Add (sign=1) or subtract (sign=-1) a receipt document to the affected buckets."""
+        receipt_data = receipt.get("receipt_data") or {}
+        date = receipt_data.get("date")
+        if not isinstance(date, datetime):
+            # the aggregation pipelines cannot bucket these either
+            logger.warning(f"Receipt {receipt.get('_id')} has no usable date, skipping it in the analytics delta")
+            return
+
+        store = receipt_data.get("place")
+        receipt_total = sign * _amount(receipt_data.get("total"))
+        self.add_receipt_total(date, receipt_total)
+        items = receipt.get("items") or []
+        for line, item in enumerate(items):
+            category = item.get("item_category")
+            category = category if isinstance(category, dict) else {}
+            amount = sign * _amount(item.get("total_price"))
+            self.add_item_spend(date, category, amount)
+            # like SPEND_ROWS_PIPELINE, the receipt total goes with the first line
+            self.add_daily_row(date, store, category, amount, receipt_total if line == 0 else 0.0, sign)
+        if not items:
+            self.add_daily_row(date, store, {}, 0.0, receipt_total, 0)
+
+    def add_receipt_total(self, date: datetime, amount: float):
+        """Add to the overall spend of every bucket the date falls into."""
+        for aggregate_type in SPEND_AGGREGATE_TYPES:
+            bucket, prefix, suffix = _time_keys(aggregate_type, date)
+            self._add(aggregate_type, bucket, "overall", {**prefix, **suffix}, {}, amount)
+
+        # yearly_monthly_spend keeps a scalar overall and level_1 entries keyed by the category name
+        self._add("yearly_monthly_spend", {"year": date.year, "month": date.month}, "overall_spend", None, {}, amount)
+
+    def add_item_spend(self, date: datetime, category: dict, amount: float):
+        """Add to the category spend of every bucket the date falls into."""
+        for aggregate_type in SPEND_AGGREGATE_TYPES:
+            bucket, prefix, suffix = _time_keys(aggregate_type, date)
+            for level, fields in CATEGORY_LEVEL_FIELDS.items():
+                levels = {field: category.get(field) for field in fields}
+                # level_1 entries only carry the category in the _id, the deeper levels duplicate it at the top
+                extra = levels if level != "level_1" else {}
+                self._add(aggregate_type, bucket, level, {**prefix, **levels, **suffix}, extra, amount)
+
+        bucket = {"year": date.year, "month": date.month}
+        self._add("yearly_monthly_spend", bucket, "level_1", category.get("level_1"), {}, amount)
+
+    def add_daily_row(self, date: datetime, store, category: dict, items_total: float, receipts_total: float, count: int):
+        """Add to the spend_daily row of the day, store and category."""
+        key = (datetime(date.year, date.month, date.day), store, *(category.get(field) for field in SPEND_DAILY_LEVELS))
+        row = self.daily_rows.setdefault(key, [0.0, 0.0, 0])
+        row[0] += items_total
+        row[1] += receipts_total
+        row[2] += count
+
+    def _add(self, aggregate_type: str, bucket: dict, level: str, entry_id, extra: dict, amount: float):
+        key = (aggregate_type, _freeze(bucket))
+        target = self.buckets.setdefault(key, {"bucket": bucket, "levels": {}})
+        entries = target["levels"].setdefault(level, {})
+        frozen_id = _freeze(entry_id) if isinstance(entry_id, dict) else entry_id
+        entry = entries.setdefault(frozen_id, [entry_id, extra, 0.0])
+        entry[2] += amount
+
+    def updates(self):
+        """
+        Yields (aggregate type, bucket, {level: [(entry id, extra fields, amount)]}) for every bucket
+        with a non-zero net change.
+        """
+        for (aggregate_type, _), target in self.buckets.items():
+            levels = {}
+            for level, entries in target["levels"].items():
+                changed = [tuple(entry) for entry in entries.values() if abs(entry[2]) > ZERO_SPEND_EPSILON]
+                if changed:
+                    levels[level] = changed
+            if levels:
+                yield aggregate_type, target["bucket"], levels
+
+    def documents(self):
+        """
+        Yields (aggregate type, bucket, {level: [(entry id, extra fields, amount)]}) for every bucket,
+        including zero entries, with the entries in _id order.
+        """
+        for (aggregate_type, _), target in self.buckets.items():
+            levels = {
+                level: [tuple(entries[key]) for key in sorted(entries, key=_sort_key)]
+                for level, entries in target["levels"].items()
             }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.day": 1, "_id.level_1": 1, "_id.level_2": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_1": "$_id.level_1", "level_2": "$_id.level_2"}},
-    ]
-    level2 = await db[RECEIPTS_COLLECTION].aggregate(level2_pipeline).to_list(length=None)
+            yield aggregate_type, target["bucket"], levels
 
-    # Daily totals per level_3 item type
-    level3_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
+    def daily_updates(self):
+        """Yields (row key fields, [items_total, receipts_total, item_count]) for every changed spend_daily row."""
+        for (day, store, *levels), row in self.daily_rows.items():
+            if abs(row[0]) > ZERO_SPEND_EPSILON or abs(row[1]) > ZERO_SPEND_EPSILON or row[2]:
+                yield {"date": day, "store": store, **dict(zip(SPEND_DAILY_LEVELS, levels))}, row
+
+    def is_empty(self) -> bool:
+        return next(self.updates(), None) is None and next(self.daily_updates(), None) is None
+
+
+#
+# Full rebuild.
+#
+# A single pass over the receipts groups the line items on the finest grain (day, store and the
+# three category levels); these rows are the spend_daily rows and everything coarser is rolled up
+# in Python. The receipt total is attributed to
+# the first line of each receipt so that it is counted exactly once per receipt.
+#
+SPEND_ROWS_PIPELINE = [
+    # receipts whose date could not be parsed cannot be bucketed
+    {"$match": {"receipt_data.date": {"$type": "date"}}},
+    {"$project": {"date": "$receipt_data.date", "store": "$receipt_data.place", "total": "$receipt_data.total", "items": 1}},
+    {"$unwind": {"path": "$items", "includeArrayIndex": "line", "preserveNullAndEmptyArrays": True}},
+    {
+        "$group": {
+            "_id": {
+                "year": {"$year": "$date"},
+                "month": {"$month": "$date"},
+                "day": {"$dayOfMonth": "$date"},
+                "store": "$store",
+                "level_1": "$items.item_category.level_1",
                 "level_2": "$items.item_category.level_2",
                 "level_3": "$items.item_category.level_3",
-                "total": "$items.total_price",
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": {"$year": "$date"},
-                    "month": {"$month": "$date"},
-                    "day": {"$dayOfMonth": "$date"},
-                    "level_2": "$level_2",
-                    "level_3": "$level_3",
-                },
-                "total_spend": {"$sum": "$total"},
+            },
+            "items_total": {"$sum": "$items.total_price"},
+            "item_count": {"$sum": {"$cond": [{"$eq": [{"$type": "$items"}, "object"]}, 1, 0]}},
+            "receipts_total": {"$sum": {"$cond": [{"$lte": [{"$ifNull": ["$line", 0]}, 0]}, "$total", 0]}},
+        }
+    },
+]
+
+
+def rollup_spend_rows(rows) -> SpendDelta:
+    """Roll the finest-grain rows of SPEND_ROWS_PIPELINE up into every aggregate bucket."""
+    totals = SpendDelta()
+    for row in rows:
+        key = row["_id"]
+        date = datetime(key["year"], key["month"], key["day"])
+        totals.add_receipt_total(date, _amount(row.get("receipts_total")))
+        # rows without line items only carry the totals of receipts that have no items
+        if row.get("item_count"):
+            category = {field: key.get(field) for field in ("level_1", "level_2", "level_3")}
+            totals.add_item_spend(date, category, _amount(row.get("items_total")))
+    return totals
+
+
+def spend_daily_documents(rows) -> list:
+    """spend_daily rows out of the finest-grain rows of SPEND_ROWS_PIPELINE."""
+    documents = []
+    for row in rows:
+        key = row["_id"]
+        documents.append(
+            {
+                "date": datetime(key["year"], key["month"], key["day"]),
+                "store": key.get("store"),
+                **{field: key.get(field) for field in SPEND_DAILY_LEVELS},
+                "items_total": _amount(row.get("items_total")),
+                "receipts_total": _amount(row.get("receipts_total")),
+                "item_count": row.get("item_count", 0),
             }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.day": 1, "_id.level_2": 1, "_id.level_3": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_2": "$_id.level_2", "level_3": "$_id.level_3"}},
+        )
+    return documents
+
+
+async def write_spend_daily_rows(documents: list, start: datetime = None, end: datetime = None) -> int:
+    """Replace the spend_daily rows, or only those from start (inclusive) to end (exclusive)."""
+    selector = {"date": {"$gte": start, "$lt": end}} if start is not None else {}
+    await db[SPEND_DAILY_COLLECTION].delete_many(selector)
+    for offset in range(0, len(documents), ANALYTICS_WRITE_BATCH_SIZE):
+        await db[SPEND_DAILY_COLLECTION].insert_many(documents[offset : offset + ANALYTICS_WRITE_BATCH_SIZE], ordered=False)
+    return len(documents)
+
+
+def _document_fields(aggregate_type: str, levels: dict) -> dict:
+    """Fields of a fully rebuilt aggregate document."""
+    if aggregate_type == "yearly_monthly_spend":
+        overall = levels.get("overall_spend", [])
+        return {
+            "overall_spend": overall[0][2] if overall else 0,
+            "level_1": [{"level_1": level_1, "total_spend": amount} for level_1, _, amount in levels.get("level_1", [])],
+        }
+
+    data = {"overall": [], "level_1": [], "level_2": [], "level_3": []}
+    for level, entries in levels.items():
+        data[level] = [{"_id": entry_id, "total_spend": amount, **extra} for entry_id, extra, amount in entries]
+    return {"data": data}
+
+
+async def write_aggregate_updates(operations: list, batch_size: int = ANALYTICS_WRITE_BATCH_SIZE) -> dict:
+    """
+    Persist aggregate document upserts with unordered bulk writes of at most batch_size operations,
+    instead of one round trip per document. Returns the document counts and the time spent writing.
+    """
+    stats = {"documents": len(operations), "upserted": 0, "modified": 0, "batches": 0, "write_seconds": 0.0}
+    started = time.perf_counter()
+    for start in range(0, len(operations), batch_size):
+        result = await db[AGGREGATES_COLLECTION].bulk_write(operations[start : start + batch_size], ordered=False)
+        stats["upserted"] += result.upserted_count
+        stats["modified"] += result.modified_count
+        stats["batches"] += 1
+    stats["write_seconds"] = round(time.perf_counter() - started, 4)
+    return stats
+
+
+def years_date_range(years) -> tuple:
+    """
+    Date range covering the given years, widened to whole ISO weeks so that the weeks crossing the
+    year boundaries are rebuilt from complete data as well.
+    """
+    first_week = datetime(min(years), 1, 1).isocalendar()
+    last_week = datetime(max(years), 12, 31).isocalendar()
+    start = datetime.fromisocalendar(first_week[0], first_week[1], 1)
+    end = datetime.fromisocalendar(last_week[0], last_week[1], 1) + timedelta(days=7)
+    return start, end
+
+
+def _bucket_in_range(aggregate_type: str, bucket: dict, years: list) -> bool:
+    """Whether every day of the bucket was part of the rebuild of the given years."""
+    if aggregate_type == "weekly_spend":
+        start, end = years_date_range(years)
+        first_day = datetime.fromisocalendar(bucket["year"], bucket["week"], 1)
+        return start <= first_day and first_day + timedelta(days=7) <= end
+    return min(years) <= bucket["year"] <= max(years)
+
+
+def _bucket_key(bucket: dict) -> tuple:
+    return tuple(bucket.get(field) for field in ("year", "month", "week"))
+
+
+async def delete_emptied_buckets(aggregate_type: str, rebuilt: set, years: list) -> int:
+    """
+    Delete the documents of the rebuilt years that the rebuild did not produce: their receipts were
+    deleted or moved, and upserting the buckets that still have receipts would leave their totals.
+    rebuilt holds the _bucket_key of every document the rebuild wrote.
+    """
+    # weeks of the first and last year may be numbered in the years around them
+    selector = {"type": aggregate_type, "year": {"$gte": min(years) - 1, "$lte": max(years) + 1}}
+    projection = {"year": 1, "month": 1, "week": 1}
+    documents = await db[AGGREGATES_COLLECTION].find(selector, projection).to_list(length=None)
+    emptied = [
+        document["_id"]
+        for document in documents
+        if _bucket_in_range(aggregate_type, document, years) and _bucket_key(document) not in rebuilt
     ]
-    level3 = await db[RECEIPTS_COLLECTION].aggregate(level3_pipeline).to_list(length=None)
-
-    # Organize by (year, month)
-    from collections import defaultdict
-
-    daily_data = defaultdict(lambda: {"overall": [], "level_1": [], "level_2": [], "level_3": []})
-    for entry in overall:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        daily_data[(y, m)]["overall"].append(entry)
-    for entry in level1:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        daily_data[(y, m)]["level_1"].append(entry)
-    for entry in level2:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        daily_data[(y, m)]["level_2"].append(entry)
-    for entry in level3:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        daily_data[(y, m)]["level_3"].append(entry)
-
-    # Store or update one document per (year, month)
-    for (y, m), data in daily_data.items():
-        await db[AGGREGATES_COLLECTION].update_one(
-            {"type": "daily_spend", "year": y, "month": m},
-            {"$set": {"data": data, "last_updated": datetime.utcnow()}},
+    if emptied:
+        await db[AGGREGATES_COLLECTION].delete_many({"_id": {"$in": emptied}})
+    return len(emptied)
+
+
+async def rebuild_aggregates(years: list = None, progress=None) -> dict:
+    """
+    Full rebuild of every aggregate type from a single aggregation pass over the receipts. This is
+    also the repair path for the incremental maintenance below. When years is given, only the
+    buckets of those years are recomputed, and those of them left without receipts are deleted.
+    Returns statistics of the rebuild.
+
+    progress, if given, is called with the name of every completed step (aggregation, each
+    aggregate type and spend_daily) and its statistics.
+    """
+    progress = progress or (lambda step, stats: None)
+    logger.info(f"Rebuilding analytics aggregates{f' for {years}' if years else ''}...")
+    pipeline = SPEND_ROWS_PIPELINE
+    start = end = None
+    if years:
+        start, end = years_date_range(years)
+        years = list(range(min(years), max(years) + 1))
+        pipeline = [{"$match": {"receipt_data.date": {"$gte": start, "$lt": end}}}, *SPEND_ROWS_PIPELINE]
+
+    started = time.perf_counter()
+    rows = await db[RECEIPTS_COLLECTION].aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+    aggregation_seconds = round(time.perf_counter() - started, 4)
+    progress("aggregation", {"rows": len(rows), "aggregation_seconds": aggregation_seconds})
+
+    now = datetime.utcnow()
+    operations = {aggregate_type: [] for aggregate_type in AGGREGATE_TYPES}
+    rebuilt = {aggregate_type: set() for aggregate_type in AGGREGATE_TYPES}
+    for aggregate_type, bucket, levels in rollup_spend_rows(rows).documents():
+        if years and not _bucket_in_range(aggregate_type, bucket, years):
+            continue
+        selector = {"type": aggregate_type, **bucket}
+        update = {"$set": {**bucket, **_document_fields(aggregate_type, levels), "last_updated": now}}
+        operations[aggregate_type].append(UpdateOne(selector, update, upsert=True))
+        rebuilt[aggregate_type].add(_bucket_key(bucket))
+
+    # written one aggregate type at a time so that progress can be reported per granularity
+    stats = {"rows": len(rows), "aggregation_seconds": aggregation_seconds}
+    for aggregate_type in AGGREGATE_TYPES:
+        type_stats = await write_aggregate_updates(operations[aggregate_type])
+        if years:
+            type_stats["deleted"] = await delete_emptied_buckets(aggregate_type, rebuilt[aggregate_type], years)
+        for key, value in type_stats.items():
+            stats[key] = stats.get(key, 0) + value
+        progress(aggregate_type, type_stats)
+    stats["write_seconds"] = round(stats["write_seconds"], 4)
+
+    if not years:
+        # the single yearly_spend document holding all years, from before they were split per year
+        await db[AGGREGATES_COLLECTION].delete_many({"type": "yearly_spend", "year": {"$exists": False}})
+        await db[ANALYTICS_STATE_COLLECTION].update_one(
+            {"_id": AGGREGATES_LAYOUT_STATE_ID},
+            {"$set": {"version": AGGREGATES_LAYOUT_VERSION, "rebuilt_at": datetime.utcnow()}},
             upsert=True,
         )
-    logger.info("Daily spend calculation complete.")
+        aggregates_layout.current = True
 
+    stats["spend_daily_rows"] = await write_spend_daily_rows(spend_daily_documents(rows), start, end)
+    progress("spend_daily", {"rows": stats["spend_daily_rows"]})
+    aggregates_version.bump()
 
-async def calculate_yearly_spend():
-    logger.info("Calculating yearly spend...")
-    # Overall yearly totals
-    overall_pipeline = [
-        {"$project": {"year": {"$year": "$receipt_data.date"}, "total": "$receipt_data.total"}},
-        {"$group": {"_id": {"year": "$year"}, "total_spend": {"$sum": "$total"}}},
-        {"$sort": {"_id.year": 1}},
-    ]
-    overall = await db[RECEIPTS_COLLECTION].aggregate(overall_pipeline).to_list(length=None)
+    logger.info(f"Analytics aggregates rebuilt: {stats}")
+    return stats
 
-    # Yearly totals per level_1 item type
-    level1_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "year": {"$year": "$receipt_data.date"},
-                "level_1": "$items.item_category.level_1",
-                "total": "$items.total_price",
-            }
-        },
-        {"$group": {"_id": {"year": "$year", "level_1": "$level_1"}, "total_spend": {"$sum": "$total"}}},
-        {"$sort": {"_id.year": 1, "_id.level_1": 1}},
-    ]
-    level1 = await db[RECEIPTS_COLLECTION].aggregate(level1_pipeline).to_list(length=None)
 
-    # Yearly totals per level_2 item type
-    level2_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "year": {"$year": "$receipt_data.date"},
-                "level_1": "$items.item_category.level_1",
-                "level_2": "$items.item_category.level_2",
-                "total": "$items.total_price",
-            }
-        },
-        {
-            "$group": {
-                "_id": {"year": "$year", "level_1": "$level_1", "level_2": "$level_2"},
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.level_1": 1, "_id.level_2": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_1": "$_id.level_1", "level_2": "$_id.level_2"}},
+async def find_yearly_spend(year: int = None, levels: list = None) -> dict:
+    """
+    Entries of the yearly_spend documents of one year, or of all years in order, limited to the
+    given levels (overall, level_1, level_2, level_3) by projection. A year without receipts has empty
+    entries; returns None if there are no yearly_spend documents at all.
+    """
+    levels = levels or ["overall", "level_1", "level_2", "level_3"]
+    selector = {"type": "yearly_spend", "year": year if year is not None else {"$exists": True}}
+    projection = {"_id": 0, **{f"data.{level}": 1 for level in levels}}
+    documents = await db[AGGREGATES_COLLECTION].find(selector, projection).sort("year", 1).to_list(length=None)
+    if not documents and (year is None or not await db[AGGREGATES_COLLECTION].find_one({"type": "yearly_spend"})):
+        return None
+    return {level: [entry for document in documents for entry in document.get("data", {}).get(level, [])] for level in levels}
+
+
+# Held while aggregates are written, by both the change listener and full recalculations, so that
+# they never overlap
+aggregates_lock = asyncio.Lock()
+
+RECALCULATION_STEPS = ("aggregation", *AGGREGATE_TYPES, "spend_daily")
+
+
+async def aggregates_rebuild_reason() -> Optional[str]:
+    """Why the aggregates must be fully rebuilt before deltas can be applied to them, None if they need not be."""
+    state = await db[ANALYTICS_STATE_COLLECTION].find_one({"_id": AGGREGATES_LAYOUT_STATE_ID}) or {}
+    if await db[AGGREGATES_COLLECTION].find_one({"type": "yearly_spend", "year": {"$exists": False}}, {"_id": 1}):
+        return "the yearly_spend document of all years is from before the per-year layout"
+    if state.get("version", 0) < AGGREGATES_LAYOUT_VERSION:
+        return f"the aggregates were not built in layout version {AGGREGATES_LAYOUT_VERSION}"
+    if not await db[SPEND_DAILY_COLLECTION].find_one({}, {"_id": 1}) and await db[RECEIPTS_COLLECTION].find_one(
+        {"receipt_data.date": {"$type": "date"}}, {"_id": 1}
+    ):
+        return "spend_daily is empty while there are receipts"
+    return None
+
+
+async def upgrade_aggregates():
+    """
+    Rebuild the aggregates once at startup if they were built by an earlier version, retrying with
+    backoff on errors. Change events are applied as deltas once this has completed.
+    """
+    backoff = ANALYTICS_LISTENER_BACKOFF_SECONDS
+    while not aggregates_layout.current:
+        try:
+            async with aggregates_lock:
+                reason = await aggregates_rebuild_reason()
+                if reason:
+                    logger.warning(f"Rebuilding all analytics aggregates: {reason}")
+                    await rebuild_aggregates()
+                aggregates_layout.current = True
+        except Exception as e:
+            logger.error(f"Error upgrading the analytics aggregates, retrying in {backoff} seconds: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, ANALYTICS_LISTENER_MAX_BACKOFF_SECONDS)
+
+
+class RecalculationJob:
+    """A full recalculation running in the background, with its progress per step."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "pending"
+        self.started_at = datetime.utcnow()
+        self.finished_at = None
+        self.progress = {step: {"status": "pending"} for step in RECALCULATION_STEPS}
+        self.stats = None
+        self.error = None
+        self.task = None
+
+    def report(self, step: str, stats: dict):
+        self.progress[step] = {"status": "done", **stats}
+
+    async def run(self):
+        async with aggregates_lock:
+            self.status = "running"
+            try:
+                self.stats = await rebuild_aggregates(progress=self.report)
+                self.status = "completed"
+            except Exception as e:
+                logger.error(f"Recalculation {self.id} failed: {e}")
+                self.status = "failed"
+                self.error = str(e)
+            finally:
+                self.finished_at = datetime.utcnow()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "progress": self.progress,
+            "stats": self.stats,
+            "error": self.error,
+        }
+
+
+class RecalculationJobs:
+    """
+    Starts recalculations in the background, one at a time: a request arriving while a job is
+    pending or running gets that job instead of a new one. The last max_jobs jobs are kept.
+    """
+
+    def __init__(self, max_jobs: int = 20):
+        self.max_jobs = max_jobs
+        self.jobs = {}
+
+    @property
+    def current(self):
+        return next((job for job in reversed(self.jobs.values()) if not job.done), None)
+
+    def start(self) -> tuple:
+        """Returns the job and whether it was started by this call."""
+        job = self.current
+        if job is not None:
+            return job, False
+
+        job = RecalculationJob()
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_jobs:
+            del self.jobs[next(iter(self.jobs))]
+        job.task = asyncio.get_running_loop().create_task(job.run())
+        return job, True
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+
+recalculation_jobs = RecalculationJobs()
+
+
+#
+# Arbitrary ranges and granularities, rolled up from the spend_daily rows.
+#
+
+SPEND_GRANULARITIES = ("day", "week", "month", "quarter", "year")
+
+
+def spend_query_pipeline(
+    start: datetime, end: datetime, granularity: str, level: str = None, categories: dict = None, store: str = None
+) -> list:
+    """
+    Aggregation over spend_daily returning the spend per period from start to end (both inclusive),
+    optionally broken down by a category level and filtered by category values and store. The
+    overall spend is the sum of the receipt totals; as soon as categories are involved it is the
+    sum of the matching item totals instead.
+    """
+    if granularity not in SPEND_GRANULARITIES:
+        raise ValueError(f"Unknown granularity: {granularity}")
+    if level is not None and level not in CATEGORY_LEVEL_FIELDS:
+        raise ValueError(f"Unknown category level: {level}")
+
+    match = {"date": {"$gte": start, "$lte": end}}
+    if store is not None:
+        match["store"] = store
+    for field, value in (categories or {}).items():
+        if field not in SPEND_DAILY_LEVELS:
+            raise ValueError(f"Unknown category level: {field}")
+        match[field] = value
+
+    period = {"$dateTrunc": {"date": "$date", "unit": granularity}}
+    if granularity == "week":
+        period["$dateTrunc"]["startOfWeek"] = "monday"
+    group_id = {"period": period, **{field: "$" + field for field in CATEGORY_LEVEL_FIELDS.get(level, ())}}
+    spend_field = "$receipts_total" if level is None and not categories else "$items_total"
+
+    return [
+        {"$match": match},
+        {"$group": {"_id": group_id, "total_spend": {"$sum": spend_field}, "item_count": {"$sum": "$item_count"}}},
+        {"$sort": {"_id.period": 1, **{f"_id.{field}": 1 for field in CATEGORY_LEVEL_FIELDS.get(level, ())}}},
+        {"$replaceWith": {"$mergeObjects": ["$_id", {"total_spend": "$total_spend", "item_count": "$item_count"}]}},
     ]
-    level2 = await db[RECEIPTS_COLLECTION].aggregate(level2_pipeline).to_list(length=None)
 
-    # Yearly totals per level_3 item type
-    level3_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "year": {"$year": "$receipt_data.date"},
-                "level_2": "$items.item_category.level_2",
-                "level_3": "$items.item_category.level_3",
-                "total": "$items.total_price",
-            }
-        },
-        {
-            "$group": {
-                "_id": {"year": "$year", "level_2": "$level_2", "level_3": "$level_3"},
-                "total_spend": {"$sum": "$total"},
+
+async def query_spend(
+    start: datetime, end: datetime, granularity: str, level: str = None, categories: dict = None, store: str = None
+) -> list:
+    pipeline = spend_query_pipeline(start, end, granularity, level, categories, store)
+    return await db[SPEND_DAILY_COLLECTION].aggregate(pipeline).to_list(length=None)
+
+
+#
+# Incremental (delta-based) maintenance.
+#
+# Instead of re-running the aggregation when a receipt changes, the change event's post-image
+# (fullDocument) is added to and its pre-image (fullDocumentBeforeChange) is subtracted from the
+# buckets it falls into.
+#
+
+
+def _add_to_entry_stage(path: str, key_field: str, key, amount: float, new_entry: dict) -> dict:
+    """
+    Update pipeline stage that adds amount to the entry of the array at path whose key_field equals
+    key, appending new_entry when there is no such entry yet.
+    """
+    entries = {"$ifNull": ["$" + path, []]}
+    key = {"$literal": key}
+    incremented = {
+        "$map": {
+            "input": entries,
+            "as": "entry",
+            "in": {
+                "$cond": [
+                    {"$eq": ["$$entry." + key_field, key]},
+                    {"$mergeObjects": ["$$entry", {"total_spend": {"$add": ["$$entry.total_spend", amount]}}]},
+                    "$$entry",
+                ]
+            },
+        }
+    }
+    exists = {"$in": [key, {"$map": {"input": entries, "as": "entry", "in": "$$entry." + key_field}}]}
+    appended = {"$concatArrays": [entries, [{"$literal": new_entry}]]}
+    return {"$set": {path: {"$cond": [exists, incremented, appended]}}}
+
+
+def _prune_entries_stage(path: str) -> dict:
+    """Update pipeline stage that drops entries whose total went back to zero."""
+    return {
+        "$set": {
+            path: {
+                "$filter": {
+                    "input": "$" + path,
+                    "as": "entry",
+                    "cond": {"$gt": [{"$abs": "$$entry.total_spend"}, ZERO_SPEND_EPSILON]},
+                }
             }
-        },
-        {"$sort": {"_id.year": 1, "_id.level_2": 1, "_id.level_3": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_2": "$_id.level_2", "level_3": "$_id.level_3"}},
-    ]
-    level3 = await db[RECEIPTS_COLLECTION].aggregate(level3_pipeline).to_list(length=None)
+        }
+    }
 
-    # Store or update the aggregates in a separate collection
-    await db[AGGREGATES_COLLECTION].update_one(
-        {"type": "yearly_spend"},
+
+def _spend_update_pipeline(levels: dict) -> list:
+    pipeline = []
+    for level, entries in levels.items():
+        path = f"data.{level}"
+        for entry_id, extra, amount in entries:
+            pipeline.append(
+                _add_to_entry_stage(path, "_id", entry_id, amount, {"_id": entry_id, "total_spend": amount, **extra})
+            )
+        pipeline.append(_prune_entries_stage(path))
+    return pipeline
+
+
+def _yearly_monthly_update_pipeline(levels: dict) -> list:
+    pipeline = []
+    for _, _, amount in levels.get("overall_spend", []):
+        pipeline.append({"$set": {"overall_spend": {"$add": [{"$ifNull": ["$overall_spend", 0]}, amount]}}})
+    if "level_1" in levels:
+        for level_1, _, amount in levels["level_1"]:
+            pipeline.append(
+                _add_to_entry_stage("level_1", "level_1", level_1, amount, {"level_1": level_1, "total_spend": amount})
+            )
+        pipeline.append(_prune_entries_stage("level_1"))
+    return pipeline
+
+
+async def apply_spend_delta(delta: SpendDelta) -> dict:
+    """Apply the accumulated changes, one pipeline update per affected aggregate document."""
+    now = datetime.utcnow()
+    operations = []
+    for aggregate_type, bucket, levels in delta.updates():
+        if aggregate_type == "yearly_monthly_spend":
+            pipeline = _yearly_monthly_update_pipeline(levels)
+        else:
+            pipeline = _spend_update_pipeline(levels)
+        pipeline.append({"$set": {"last_updated": now}})
+        operations.append(UpdateOne({"type": aggregate_type, **bucket}, pipeline, upsert=True))
+
+    stats = await write_aggregate_updates(operations)
+    stats["spend_daily_rows"] = await apply_spend_daily_delta(delta)
+    aggregates_version.bump()
+    return stats
+
+
+async def apply_spend_daily_delta(delta: SpendDelta) -> int:
+    """Increment the changed spend_daily rows and drop the ones that became empty."""
+    operations = []
+    dates = set()
+    for key, (items_total, receipts_total, item_count) in delta.daily_updates():
+        increments = {"items_total": items_total, "receipts_total": receipts_total, "item_count": item_count}
+        operations.append(UpdateOne(key, {"$inc": increments}, upsert=True))
+        dates.add(key["date"])
+    if not operations:
+        return 0
+
+    for offset in range(0, len(operations), ANALYTICS_WRITE_BATCH_SIZE):
+        await db[SPEND_DAILY_COLLECTION].bulk_write(operations[offset : offset + ANALYTICS_WRITE_BATCH_SIZE], ordered=False)
+    await db[SPEND_DAILY_COLLECTION].delete_many(
         {
-            "$set": {
-                "data": {"overall": overall, "level_1": level1, "level_2": level2, "level_3": level3},
-                "last_updated": datetime.utcnow(),
-            }
-        },
-        upsert=True,
+            "date": {"$in": sorted(dates)},
+            "item_count": {"$lte": 0},
+            "items_total": {"$gt": -ZERO_SPEND_EPSILON, "$lt": ZERO_SPEND_EPSILON},
+            "receipts_total": {"$gt": -ZERO_SPEND_EPSILON, "$lt": ZERO_SPEND_EPSILON},
+        }
     )
-    logger.info("Yearly spend calculation complete.")
+    return len(operations)
 
 
-async def calculate_weekly_spend():
-    logger.info("Calculating weekly spend...")
-    # Overall weekly totals
-    overall_pipeline = [
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "total": "$receipt_data.total",
-                "year": {"$isoWeekYear": "$receipt_data.date"},
-                "week": {"$isoWeek": "$receipt_data.date"},
-                "first_day_of_week": {
-                    "$dateFromParts": {
-                        "isoWeekYear": {"$isoWeekYear": "$receipt_data.date"},
-                        "isoWeek": {"$isoWeek": "$receipt_data.date"},
-                        "isoDayOfWeek": 1,
-                    }
-                },
-            }
-        },
-        {
-            "$group": {
-                "_id": {"year": "$year", "week": "$week", "first_day_of_week": "$first_day_of_week"},
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.week": 1}},
-    ]
-    overall = await db[RECEIPTS_COLLECTION].aggregate(overall_pipeline).to_list(length=None)
+def add_change_to_delta(delta: SpendDelta, change: dict) -> bool:
+    """
+    Add a receipts change stream event to the delta. Returns False when the event cannot be
+    applied incrementally (e.g. no pre-image is available) and a full recompute is needed.
+    """
+    operation = change.get("operationType")
+    if operation not in ("insert", "update", "replace", "delete"):
+        return False
 
-    # Weekly totals per level_1 item type
-    level1_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "level_1": "$items.item_category.level_1",
-                "total": "$items.total_price",
-                "year": {"$isoWeekYear": "$receipt_data.date"},
-                "week": {"$isoWeek": "$receipt_data.date"},
-                "first_day_of_week": {
-                    "$dateFromParts": {
-                        "isoWeekYear": {"$isoWeekYear": "$receipt_data.date"},
-                        "isoWeek": {"$isoWeek": "$receipt_data.date"},
-                        "isoDayOfWeek": 1,
-                    }
-                },
-            }
-        },
-        {
-            "$group": {
-                "_id": {"year": "$year", "week": "$week", "level_1": "$level_1", "first_day_of_week": "$first_day_of_week"},
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.week": 1, "_id.level_1": 1}},
-    ]
-    level1 = await db[RECEIPTS_COLLECTION].aggregate(level1_pipeline).to_list(length=None)
+    if operation != "insert":
+        before = change.get("fullDocumentBeforeChange")
+        if before is None:
+            return False
+        delta.add_receipt(before, -1)
 
-    # Weekly totals per level_2 item type
-    level2_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "level_1": "$items.item_category.level_1",
-                "level_2": "$items.item_category.level_2",
-                "total": "$items.total_price",
-                "year": {"$isoWeekYear": "$receipt_data.date"},
-                "week": {"$isoWeek": "$receipt_data.date"},
-                "first_day_of_week": {
-                    "$dateFromParts": {
-                        "isoWeekYear": {"$isoWeekYear": "$receipt_data.date"},
-                        "isoWeek": {"$isoWeek": "$receipt_data.date"},
-                        "isoDayOfWeek": 1,
-                    }
-                },
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": "$year",
-                    "week": "$week",
-                    "level_1": "$level_1",
-                    "level_2": "$level_2",
-                    "first_day_of_week": "$first_day_of_week",
-                },
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.week": 1, "_id.level_1": 1, "_id.level_2": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_1": "$_id.level_1", "level_2": "$_id.level_2"}},
-    ]
-    level2 = await db[RECEIPTS_COLLECTION].aggregate(level2_pipeline).to_list(length=None)
+    if operation != "delete":
+        after = change.get("fullDocument")
+        if after is None:
+            return False
+        delta.add_receipt(after, 1)
+
+    return True
+
+
+async def enable_receipt_pre_images() -> bool:
+    """
+    Pre-images are needed to subtract the previous version of updated and deleted receipts.
+    They require MongoDB 6.0 or later; returns False when they cannot be enabled.
+    """
+    try:
+        await db.command("collMod", RECEIPTS_COLLECTION, changeStreamPreAndPostImages={"enabled": True})
+        return True
+    except PyMongoError as e:
+        logger.warning(f"Could not enable change stream pre-images, analytics will be fully recomputed on changes: {e}")
+        return False
 
-    # Weekly totals per level_3 item type
-    level3_pipeline = [
-        {"$unwind": "$items"},
-        {
-            "$project": {
-                "date": "$receipt_data.date",
-                "level_2": "$items.item_category.level_2",
-                "level_3": "$items.item_category.level_3",
-                "total": "$items.total_price",
-                "year": {"$isoWeekYear": "$receipt_data.date"},
-                "week": {"$isoWeek": "$receipt_data.date"},
-                "first_day_of_week": {
-                    "$dateFromParts": {
-                        "isoWeekYear": {"$isoWeekYear": "$receipt_data.date"},
-                        "isoWeek": {"$isoWeek": "$receipt_data.date"},
-                        "isoDayOfWeek": 1,
-                    }
-                },
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": "$year",
-                    "week": "$week",
-                    "level_2": "$level_2",
-                    "level_3": "$level_3",
-                    "first_day_of_week": "$first_day_of_week",
-                },
-                "total_spend": {"$sum": "$total"},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.week": 1, "_id.level_2": 1, "_id.level_3": 1}},
-        {"$project": {"_id": 1, "total_spend": 1, "level_2": "$_id.level_2", "level_3": "$_id.level_3"}},
-    ]
-    level3 = await db[RECEIPTS_COLLECTION].aggregate(level3_pipeline).to_list(length=None)
-
-    # Organize by (year, week)
-    from collections import defaultdict
-
-    weekly_data = defaultdict(lambda: {"overall": [], "level_1": [], "level_2": [], "level_3": []})
-    for entry in overall:
-        y, w = entry["_id"]["year"], entry["_id"]["week"]
-        weekly_data[(y, w)]["overall"].append(entry)
-    for entry in level1:
-        y, w = entry["_id"]["year"], entry["_id"]["week"]
-        weekly_data[(y, w)]["level_1"].append(entry)
-    for entry in level2:
-        y, w = entry["_id"]["year"], entry["_id"]["week"]
-        weekly_data[(y, w)]["level_2"].append(entry)
-    for entry in level3:
-        y, w = entry["_id"]["year"], entry["_id"]["week"]
-        weekly_data[(y, w)]["level_3"].append(entry)
-
-    # Store or update one document per (year, week)
-    for (y, w), data in weekly_data.items():
-        await db[AGGREGATES_COLLECTION].update_one(
-            {"type": "weekly_spend", "year": y, "week": w},
-            {"$set": {"data": data, "last_updated": datetime.utcnow()}},
-            upsert=True,
-        )
-    logger.info("Weekly spend calculation complete.")
+
+async def apply_receipt_changes(changes: list):
+    """
+    Update the aggregates for a burst of change events. The events are merged into a single delta,
+    so every affected bucket is written once; if any of them cannot be applied incrementally, one
+    full recompute covers the whole burst.
+    """
+    if not aggregates_layout.current:
+        # upgrade_aggregates rebuilds them from the receipts, these changes included
+        logger.info(f"Skipping {len(changes)} receipt change(s) until the aggregates are upgraded")
+        return
+    delta = SpendDelta()
+    if ANALYTICS_INCREMENTAL and all(add_change_to_delta(delta, change) for change in changes):
+        await apply_spend_delta(delta)
+    else:
+        await rebuild_aggregates()
 
 
 #
-# Generates the following document:
+# Change listener state.
 #
-# - year
-# - month
-# - overall_spend
-# - list of level_1 data
-# { "level_1", "Groceries", "total_spend": 100 }
-# { "level_1", "Household items", "total_spend": 50 }
-# (for as many level_1 items as we have)
+# The resume token of the last applied change is persisted after every burst, so that a restart or
+# a reconnect continues where the listener left off instead of missing the changes in between.
 #
-async def calculate_yearly_monthly_spend():
-    logger.info("Calculating yearly-monthly spend...")
-    # Overall monthly totals per year
-    overall_pipeline = [
-        {"$project": {"date": "$receipt_data.date", "total": "$receipt_data.total"}},
-        {"$group": {"_id": {"year": {"$year": "$date"}, "month": {"$month": "$date"}}, "total_spend": {"$sum": "$total"}}},
-        {"$sort": {"_id.year": 1, "_id.month": 1}},
-    ]
-    overall = await db[RECEIPTS_COLLECTION].aggregate(overall_pipeline).to_list(length=None)
 
-    # Monthly totals per level_1 per year
-    level1_pipeline = [
-        {"$unwind": "$items"},
-        {"$project": {"date": "$receipt_data.date", "level_1": "$items.item_category.level_1", "total": "$items.total_price"}},
+RECEIPTS_LISTENER_STATE_ID = "receipts_listener"
+
+# CappedPositionLost, ChangeStreamFatalError and ChangeStreamHistoryLost: the oplog no longer has the resume point
+CHANGE_STREAM_HISTORY_LOST_CODES = (136, 280, 286)
+
+# receipts written this long before the last applied change are included in the recovery recompute
+LOST_HISTORY_SAFETY_MARGIN = timedelta(minutes=5)
+
+
+async def load_listener_state() -> dict:
+    return await db[ANALYTICS_STATE_COLLECTION].find_one({"_id": RECEIPTS_LISTENER_STATE_ID}) or {}
+
+
+async def save_listener_checkpoint(change: dict):
+    """Persist the resume token and cluster time of the last applied change."""
+    await db[ANALYTICS_STATE_COLLECTION].update_one(
+        {"_id": RECEIPTS_LISTENER_STATE_ID},
         {
-            "$group": {
-                "_id": {"year": {"$year": "$date"}, "month": {"$month": "$date"}, "level_1": "$level_1"},
-                "total_spend": {"$sum": "$total"},
+            "$set": {
+                "resume_token": change["_id"],
+                "cluster_time": change.get("clusterTime"),
+                "last_updated": datetime.utcnow(),
             }
         },
-        {"$sort": {"_id.year": 1, "_id.month": 1, "_id.level_1": 1}},
-    ]
-    level1 = await db[RECEIPTS_COLLECTION].aggregate(level1_pipeline).to_list(length=None)
-
-    # Organize by (year, month)
-    from collections import defaultdict
-
-    monthly_docs = defaultdict(lambda: {"overall_spend": 0, "level_1": []})
-    for entry in overall:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        monthly_docs[(y, m)]["overall_spend"] = entry["total_spend"]
-    for entry in level1:
-        y, m = entry["_id"]["year"], entry["_id"]["month"]
-        monthly_docs[(y, m)]["level_1"].append({"level_1": entry["_id"]["level_1"], "total_spend": entry["total_spend"]})
-
-    # Store or update one document per (year, month)
-    for (y, m), data in monthly_docs.items():
-        await db[AGGREGATES_COLLECTION].update_one(
-            {"type": "yearly_monthly_spend", "year": y, "month": m},
-            {
-                "$set": {
-                    "year": y,
-                    "month": m,
-                    "overall_spend": data["overall_spend"],
-                    "level_1": data["level_1"],
-                    "last_updated": datetime.utcnow(),
-                }
-            },
-            upsert=True,
-        )
-    logger.info("Yearly-monthly spend calculation complete.")
+        upsert=True,
+    )
+
+
+# reloads of the in-memory consumers scheduled after a failure, referenced so that they are not garbage collected
+_reload_tasks = set()
+
+
+async def _reload(name: str, load):
+    try:
+        await load()
+    except Exception as e:
+        logger.error(f"Error reloading the {name}: {e}")
+
+
+def reload_in_background(name: str, load):
+    """Reload an in-memory consumer of the receipt changes that could not apply them."""
+    task = asyncio.create_task(_reload(name, load))
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+
+async def apply_receipt_changes_in_memory(changes: list):
+    """
+    Bring the line item cube and the recipe recommender up to date with the changes. They are not
+    part of the checkpointed state, so a failure only reloads them instead of failing the burst.
+    """
+    if ANALYTICS_CUBE_ENABLED:
+        try:
+            await line_item_cube.apply_changes(changes, db[RECEIPTS_COLLECTION])
+        except Exception as e:
+            logger.error(f"Error applying receipt changes to the line item cube, reloading it: {e}")
+            reload_in_background("line item cube", lambda: line_item_cube.load(db[RECEIPTS_COLLECTION]))
+    if RECIPE_RECOMMENDER_ENABLED:
+        try:
+            await recipe_recommender.apply_changes(changes, db[RECEIPT_ITEMS_COLLECTION])
+        except Exception as e:
+            logger.error(f"Error applying receipt changes to the recipe recommender, reloading it: {e}")
+            reload_in_background(
+                "recipe recommender", lambda: recipe_recommender.load(db[RECEIPT_ITEMS_COLLECTION], db["recipes"])
+            )
+
+
+def changed_years(changes: list) -> Optional[list]:
+    """
+    Years of the receipts the changes touch, before and after them. None if that is not known for
+    every change, e.g. an update without its pre-image.
+    """
+    needed = {"insert": ("fullDocument",), "delete": ("fullDocumentBeforeChange",)}
+    years = set()
+    for change in changes:
+        fields = needed.get(change.get("operationType"), ("fullDocument", "fullDocumentBeforeChange"))
+        for field in fields:
+            if change.get(field) is None:
+                return None
+            date = (change[field].get("receipt_data") or {}).get("date")
+            if isinstance(date, datetime):
+                years.add(date.year)
+    return sorted(years)
+
+
+async def recompute_receipt_changes(changes: list):
+    """
+    Recompute the years a burst of changes touches. Used for a burst whose deltas failed: some of them
+    may have been written already, and a recompute gives the same result however much of it was.
+    """
+    years = changed_years(changes)
+    if years is None:
+        await rebuild_aggregates()
+    elif years:
+        await rebuild_aggregates(years)
+
+
+async def recompute_and_checkpoint_receipt_changes(changes: list):
+    await recompute_receipt_changes(changes)
+    await save_listener_checkpoint(changes[-1])
+    await apply_receipt_changes_in_memory(changes)
+
+
+async def apply_and_checkpoint_receipt_changes(changes: list):
+    # the checkpoint follows the aggregate writes immediately: the deltas are not idempotent, so events
+    # delivered again after a restart must not be applied a second time
+    await apply_receipt_changes(changes)
+    await save_listener_checkpoint(changes[-1])
+    await apply_receipt_changes_in_memory(changes)
+
+
+async def recover_lost_history(state: dict) -> dict:
+    """
+    The resume token has expired, so the changes since the last checkpoint are not available
+    anymore. Recompute the years of the receipts written since then instead of everything; receipts
+    deleted during the gap are only accounted for by a full recalculation. The expired resume token
+    is dropped once the recompute is done, so that a failed recovery is attempted again.
+    """
+    cluster_time = state.get("cluster_time")
+    if cluster_time is None:
+        logger.warning("Change stream history lost without a checkpoint, rebuilding all analytics aggregates")
+        stats = await rebuild_aggregates()
+    else:
+        since = cluster_time.as_datetime().replace(tzinfo=None) - LOST_HISTORY_SAFETY_MARGIN
+        dates = await db[RECEIPTS_COLLECTION].distinct("receipt_data.date", {"updated_at": {"$gte": since}})
+        years = sorted({date.year for date in dates if isinstance(date, datetime)})
+        logger.warning(f"Change stream history lost since {since}, recomputing analytics for years {years}")
+        stats = await rebuild_aggregates(years) if years else {}
+
+    await db[ANALYTICS_STATE_COLLECTION].update_one({"_id": RECEIPTS_LISTENER_STATE_ID}, {"$unset": {"resume_token": ""}})
+    return stats
+
+
+class ChangeCoalescer:
+    """
+    Collects change events and hands them over in bursts, so that a backfill of hundreds of receipts
+    results in a handful of recalculations instead of one per receipt. A burst is closed when the
+    window since its first event expires or when max_events have been collected.
+
+    A burst that fails is not dropped: its events go back in front of the pending ones and are retried
+    after the window, with recover_changes if given, so that no later checkpoint skips past them. The
+    events are taken under the lock, so bursts are applied one after the other and in order, and no
+    burst is closed early while a failed one waits for its retry.
+    """
+
+    def __init__(
+        self,
+        apply_changes=apply_receipt_changes,
+        window_seconds: float = ANALYTICS_COALESCE_WINDOW_SECONDS,
+        max_events: int = ANALYTICS_COALESCE_MAX_EVENTS,
+        lock: asyncio.Lock = None,
+        recover_changes=None,
+    ):
+        self.apply_changes = apply_changes
+        self.recover_changes = recover_changes or apply_changes
+        self.window_seconds = window_seconds
+        self.max_events = max_events
+
+        self._pending = []
+        self._flush_task = None
+        self._lock = lock or asyncio.Lock()
+        # whether the pending events include a burst that failed
+        self._recovering = False
+
+        self.events_seen = 0
+        self.events_merged = 0
+        self.recomputes_run = 0
+        self.failures = 0
+
+    async def submit(self, change: dict):
+        self.events_seen += 1
+        self._pending.append(change)
+
+        if len(self._pending) >= self.max_events and not self._recovering:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window_seconds)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Apply everything collected so far."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        async with self._lock:
+            changes, self._pending = self._pending, []
+            if not changes:
+                return
+            recovering, self._recovering = self._recovering, False
+            try:
+                await (self.recover_changes if recovering else self.apply_changes)(changes)
+                self.recomputes_run += 1
+                self.events_merged += len(changes) - 1
+                logger.info(f"Applied {len(changes)} receipt change(s) to the analytics aggregates")
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Error applying {len(changes)} receipt change(s), retrying in {self.window_seconds}s: {e}")
+                self._pending = changes + self._pending
+                self._recovering = True
+                if self._flush_task is None:
+                    self._flush_task = asyncio.create_task(self._flush_after_window())
+
+    def stats(self) -> dict:
+        return {
+            "events_seen": self.events_seen,
+            "events_merged": self.events_merged,
+            "recomputes_run": self.recomputes_run,
+            "failures": self.failures,
+            "pending_events": len(self._pending),
+            "window_seconds": self.window_seconds,
+            "max_events": self.max_events,
+        }
+
+
+receipt_change_coalescer = ChangeCoalescer(
+    apply_and_checkpoint_receipt_changes, lock=aggregates_lock, recover_changes=recompute_and_checkpoint_receipt_changes
+)
+
+
+async def _watch_options() -> dict:
+    if ANALYTICS_INCREMENTAL and await enable_receipt_pre_images():
+        return {"full_document": "whenAvailable", "full_document_before_change": "whenAvailable"}
+    return {}
 
 
 async def listen_for_receipt_changes():
+    """
+    Feed the receipts change stream into the coalescer, resuming from the persisted resume token
+    and reconnecting with exponential backoff on errors.
+    """
     logger.info("Listening for changes in the receipts collection...")
-    try:
-        async with db[RECEIPTS_COLLECTION].watch() as change_stream:
-            async for change in change_stream:
-                logger.info(f"Change detected in receipts collection: {change}")
+    backoff = ANALYTICS_LISTENER_BACKOFF_SECONDS
+    while True:
+        state = {}
+        try:
+            state = await load_listener_state()
+            resume_token = state.get("resume_token")
+            async with db[RECEIPTS_COLLECTION].watch(resume_after=resume_token, **await _watch_options()) as change_stream:
+                logger.info(f"Receipts change stream opened{' from the persisted resume token' if resume_token else ''}")
+                backoff = ANALYTICS_LISTENER_BACKOFF_SECONDS
+                async for change in change_stream:
+                    logger.debug(
+                        f"Change detected in receipts collection: {change.get('operationType')} {change.get('documentKey')}"
+                    )
+                    await receipt_change_coalescer.submit(change)
+        except OperationFailure as e:
+            if e.code not in CHANGE_STREAM_HISTORY_LOST_CODES:
+                logger.error(f"Error in listen_for_receipt_changes: {e}")
+            else:
+                await receipt_change_coalescer.flush()
                 try:
-                    await calculate_monthly_spend()
-                    await calculate_daily_spend()
-                    await calculate_yearly_spend()
-                    await calculate_weekly_spend()
-                    await calculate_yearly_monthly_spend()
-                except Exception as e:
-                    logger.error(f"Error in aggregation functions: {e}")
-    except Exception as e:
-        logger.error(f"Error in listen_for_receipt_changes: {e}")
+                    async with aggregates_lock:
+                        await recover_lost_history(state)
+                    continue
+                except Exception as recovery_error:
+                    # the resume token is kept, so the recovery is attempted again after the backoff
+                    logger.error(f"Error recovering the analytics from lost change stream history: {recovery_error}")
+        except Exception as e:
+            logger.error(f"Error in listen_for_receipt_changes: {e}")
+
+        # apply (and checkpoint) what was received before reconnecting, so it is not delivered twice
+        await receipt_change_coalescer.flush()
+        logger.info(f"Reconnecting to the receipts change stream in {backoff} seconds")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, ANALYTICS_LISTENER_MAX_BACKOFF_SECONDS)
+
+
+async def keep_line_item_cube_loaded():
+    """Load the line item cube and reload it periodically, in case an event was missed."""
+    if not ANALYTICS_CUBE_ENABLED:
+        return
+    while True:
+        try:
+            await line_item_cube.load(db[RECEIPTS_COLLECTION])
+        except Exception as e:
+            logger.error(f"Error loading the line item cube: {e}")
+        await asyncio.sleep(ANALYTICS_CUBE_RELOAD_SECONDS)
@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import sys
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#
+# In-memory columnar cube of receipt line items.
+#
+# Every line item is one row across a set of NumPy columns: the receipt date as days since the
+# epoch, dictionary-encoded category levels and store, and the price, quantity and discount. Any
+# group-by/filter combination is then answered with a boolean mask, np.unique and np.bincount,
+# without going to MongoDB or being limited to the pre-baked aggregate documents.
+#
+# The cube is loaded once from the receipts collection and kept current with the same change
+# events that maintain the aggregates; rows of updated or deleted receipts are marked dead and
+# dropped by a compaction once they make up a large enough share of the cube.
+#
+
+CATEGORY_COLUMNS = ("level_1", "level_2", "level_3")
+DIMENSION_COLUMNS = (*CATEGORY_COLUMNS, "store")
+MEASURE_COLUMNS = ("total_price", "quantity", "discount")
+TIME_GRAINS = ("day", "week", "month", "year")
+
+# dead rows are dropped once they make up this share of the cube
+COMPACTION_DEAD_RATIO = 0.25
+
+EPOCH = date(1970, 1, 1)
+
+
+class Dictionary:
+    """Maps the distinct values of a string column to integer codes; code 0 is reserved for null."""
+
+    def __init__(self):
+        self.values = [None]
+        self.codes = {None: 0}
+
+    def encode(self, value) -> int:
+        if value is not None and not isinstance(value, str):
+            value = str(value)
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value) -> int:
+        """Code of an existing value, or -1 so that filtering on an unknown value matches nothing."""
+        return self.codes.get(value, -1)
+
+    def decode(self, code: int):
+        return self.values[code]
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self.values) + sys.getsizeof(self.codes) + sum(sys.getsizeof(value) for value in self.values)
+
+
+def _amount(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _empty_columns() -> dict:
+    return {
+        "date": np.empty(0, dtype=np.int32),
+        **{column: np.empty(0, dtype=np.int32) for column in DIMENSION_COLUMNS},
+        **{column: np.empty(0, dtype=np.float64) for column in MEASURE_COLUMNS},
+        "alive": np.empty(0, dtype=bool),
+    }
+
+
+def _time_codes(days: np.ndarray, grain: str) -> np.ndarray:
+    """Bucket days since the epoch into days, ISO weeks (keyed on their Monday), months or years."""
+    if grain == "day":
+        return days.astype(np.int64)
+    if grain == "week":
+        # 1970-01-01 was a Thursday
+        return (days - (days + 3) % 7).astype(np.int64)
+    if grain == "month":
+        return days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    if grain == "year":
+        return days.astype("datetime64[D]").astype("datetime64[Y]").astype(np.int64)
+    raise ValueError(f"Unknown time grain: {grain}")
+
+
+def _decode_time(code: int, grain: str):
+    if grain in ("day", "week"):
+        return str(np.datetime64(code, "D"))
+    if grain == "month":
+        return str(np.datetime64(code, "M"))
+    return int(code) + 1970
+
+
+def _to_days(value) -> int:
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+class LineItemCube:
+    """Columnar, in-memory copy of all receipt line items."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._reset()
+        self.loaded = False
+        self.loaded_at = None
+        self.load_seconds = None
+        self.changes_applied = 0
+        self.reloads = 0
+
+    def _reset(self):
+        self.columns = _empty_columns()
+        self.dictionaries = {column: Dictionary() for column in DIMENSION_COLUMNS}
+        # row indices of each receipt, so that updates and deletes can retire them
+        self.receipt_rows = {}
+
+    def __len__(self) -> int:
+        """Number of rows, including the dead ones."""
+        return len(self.columns["alive"])
+
+    def _receipt_rows(self, receipt: dict) -> list:
+        receipt_data = receipt.get("receipt_data") or {}
+        receipt_date = receipt_data.get("date")
+        if not isinstance(receipt_date, (datetime, date)):
+            return []
+
+        days = _to_days(receipt_date)
+        store = self.dictionaries["store"].encode(receipt_data.get("place") or None)
+        rows = []
+        for item in receipt.get("items") or []:
+            # like receipt_items, line items that are not objects are skipped
+            if not isinstance(item, dict):
+                continue
+            category = item.get("item_category")
+            category = category if isinstance(category, dict) else {}
+            rows.append(
+                (
+                    days,
+                    *(self.dictionaries[column].encode(category.get(column)) for column in CATEGORY_COLUMNS),
+                    store,
+                    _amount(item.get("total_price")),
+                    _amount(item.get("quantity")),
+                    _amount(item.get("loyalty_discount")),
+                )
+            )
+        return rows
+
+    def _append(self, receipts: dict):
+        """Append the rows of {receipt_id: receipt} to the columns in a single concatenation."""
+        rows = []
+        start = len(self)
+        for receipt_id, receipt in receipts.items():
+            receipt_rows = self._receipt_rows(receipt)
+            if not receipt_rows:
+                continue
+            self.receipt_rows[receipt_id] = np.arange(start + len(rows), start + len(rows) + len(receipt_rows))
+            rows.extend(receipt_rows)
+        if not rows:
+            return
+
+        values = list(zip(*rows))
+        new_columns = {
+            "date": np.array(values[0], dtype=np.int32),
+            **{column: np.array(values[1 + i], dtype=np.int32) for i, column in enumerate(DIMENSION_COLUMNS)},
+            **{
+                column: np.array(values[1 + len(DIMENSION_COLUMNS) + i], dtype=np.float64)
+                for i, column in enumerate(MEASURE_COLUMNS)
+            },
+            "alive": np.ones(len(rows), dtype=bool),
+        }
+        self.columns = {column: np.concatenate((self.columns[column], new_columns[column])) for column in self.columns}
+
+    def _retire(self, receipt_id):
+        rows = self.receipt_rows.pop(receipt_id, None)
+        if rows is not None:
+            self.columns["alive"][rows] = False
+
+    def _compact(self):
+        alive = self.columns["alive"]
+        dead = len(alive) - int(alive.sum())
+        if not dead or dead < COMPACTION_DEAD_RATIO * len(alive):
+            return
+
+        new_index = np.cumsum(alive) - 1
+        self.columns = {column: values[alive] for column, values in self.columns.items()}
+        self.receipt_rows = {receipt_id: new_index[rows] for receipt_id, rows in self.receipt_rows.items()}
+        logger.debug(f"Compacted the line item cube, {dead} dead row(s) dropped")
+
+    async def load(self, collection):
+        """(Re)load all line items from the receipts collection."""
+        async with self._lock:
+            start = time.perf_counter()
+            receipts = {}
+            projection = {"receipt_data.date": 1, "receipt_data.place": 1, "items": 1}
+            async for receipt in collection.find({"receipt_data.date": {"$type": "date"}}, projection):
+                receipts[receipt["_id"]] = receipt
+            # swapped in without awaiting in between, so queries never see a half loaded cube
+            self._reset()
+            self._append(receipts)
+
+            self.loaded = True
+            self.loaded_at = datetime.utcnow()
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            self.reloads += 1
+            logger.info(f"Loaded {len(self)} line item(s) into the analytics cube in {self.load_seconds} seconds")
+
+    async def apply_changes(self, changes: list, collection):
+        """
+        Bring the cube up to date with a burst of receipt change events. Events that do not carry the
+        new version of the receipt (updates without a post-image, drops, invalidations) trigger a reload.
+        """
+        if not self.loaded:
+            return
+
+        upserts = {}
+        deletes = set()
+        for change in changes:
+            operation = change.get("operationType")
+            receipt_id = (change.get("documentKey") or {}).get("_id")
+            if operation == "delete" and receipt_id is not None:
+                deletes.add(receipt_id)
+                upserts.pop(receipt_id, None)
+            elif operation in ("insert", "update", "replace") and change.get("fullDocument") is not None:
+                upserts[receipt_id] = change["fullDocument"]
+                deletes.discard(receipt_id)
+            else:
+                await self.load(collection)
+                return
+
+        async with self._lock:
+            for receipt_id in deletes | upserts.keys():
+                self._retire(receipt_id)
+            self._append(upserts)
+            self._compact()
+            self.changes_applied += len(changes)
+
+    def query(
+        self,
+        group_by: list = None,
+        measures: list = None,
+        date_from: date = None,
+        date_to: date = None,
+        filters: dict = None,
+    ) -> list:
+        """
+        Aggregate the live line items.
+
+        Args:
+            group_by: dimensions (level_1, level_2, level_3, store) and/or one time grain (day, week, month, year)
+            measures: columns to sum (total_price, quantity, discount); the number of items is always included
+            date_from: first day to include
+            date_to: last day to include
+            filters: {dimension: value or list of values}
+
+        Returns:
+            one row per group, sorted by the group key, e.g.
+            { "month": "2025-01", "level_1": "Food", "total_price": 123.4, "items": 42 }
+        """
+        group_by = list(group_by or [])
+        measures = list(measures or ["total_price"])
+        for field in group_by:
+            if field not in DIMENSION_COLUMNS and field not in TIME_GRAINS:
+                raise ValueError(f"Unknown group by field: {field}")
+        if len([field for field in group_by if field in TIME_GRAINS]) > 1:
+            raise ValueError("Only one time grain can be grouped by")
+        for measure in measures:
+            if measure not in MEASURE_COLUMNS:
+                raise ValueError(f"Unknown measure: {measure}")
+
+        columns = self.columns
+        mask = columns["alive"].copy()
+        if date_from is not None:
+            mask &= columns["date"] >= _to_days(date_from)
+        if date_to is not None:
+            mask &= columns["date"] <= _to_days(date_to)
+        for field, value in (filters or {}).items():
+            if field not in DIMENSION_COLUMNS:
+                raise ValueError(f"Unknown filter field: {field}")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            codes = [self.dictionaries[field].lookup(v) for v in values]
+            mask &= np.isin(columns[field], codes)
+
+        selected = np.flatnonzero(mask)
+        if not group_by:
+            if not len(selected):
+                return []
+            row = {measure: float(columns[measure][selected].sum()) for measure in measures}
+            row["items"] = int(len(selected))
+            return [row]
+
+        keys = np.empty((len(selected), len(group_by)), dtype=np.int64)
+        for i, field in enumerate(group_by):
+            if field in TIME_GRAINS:
+                keys[:, i] = _time_codes(columns["date"][selected], field)
+            else:
+                keys[:, i] = columns[field][selected]
+
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength=len(groups))
+        sums = {
+            measure: np.bincount(inverse, weights=columns[measure][selected], minlength=len(groups)) for measure in measures
+        }
+
+        result = []
+        for g, group in enumerate(groups):
+            row = {}
+            for i, field in enumerate(group_by):
+                if field in TIME_GRAINS:
+                    row[field] = _decode_time(int(group[i]), field)
+                else:
+                    row[field] = self.dictionaries[field].decode(int(group[i]))
+            for measure in measures:
+                row[measure] = round(float(sums[measure][g]), 2)
+            row["items"] = int(counts[g])
+            result.append(row)
+        return result
+
+    def memory_bytes(self) -> int:
+        columns = sum(values.nbytes for values in self.columns.values())
+        dictionaries = sum(dictionary.memory_bytes() for dictionary in self.dictionaries.values())
+        receipt_rows = sys.getsizeof(self.receipt_rows) + sum(rows.nbytes for rows in self.receipt_rows.values())
+        return columns + dictionaries + receipt_rows
+
+    def stats(self) -> dict:
+        live_rows = int(self.columns["alive"].sum())
+        return {
+            "loaded": self.loaded,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "load_seconds": self.load_seconds,
+            "reloads": self.reloads,
+            "changes_applied": self.changes_applied,
+            "receipts": len(self.receipt_rows),
+            "rows": len(self),
+            "live_rows": live_rows,
+            "dead_rows": len(self) - live_rows,
+            "distinct_values": {column: len(dictionary.values) - 1 for column, dictionary in self.dictionaries.items()},
+            "memory_bytes": self.memory_bytes(),
+        }
+
+
+line_item_cube = LineItemCube()
@@ -0,0 +1,103 @@
+"""
+Async MongoDB connection utility for the AI Agent Vision application.
+This module provides the motor-based counterpart of MongoConnection, for code running on the event loop.
+"""
+
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo.errors import PyMongoError
+
+from common.indexes import create_declared_indexes_async
+from common.mongo_clients import mongo_clients
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMongoConnection:
+    """
+    Utility class for managing async MongoDB connections.
+    This class provides methods to connect to and interact with a MongoDB database without blocking the event loop.
+    """
+
+    _instance = None
+    _client = None
+    _db = None
+
+    def __new__(cls, *args, **kwargs):
+        """Implement singleton pattern to reuse the same connection."""
+        if cls._instance is None:
+            cls._instance = super(AsyncMongoConnection, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, connection_params: Optional[Dict[str, Any]] = None):
+        """
+        Initialize the MongoDB connection with connection parameters.
+
+        Args:
+            connection_params: Dictionary containing MongoDB connection parameters
+                               (uri, database)
+        """
+        # Only initialize once (singleton pattern)
+        if self._client is not None or hasattr(self, "connection_params"):
+            return
+
+        self.connection_params = connection_params or {
+            "uri": os.environ.get("MONGODB_URI", "mongodb://localhost:27017"),
+            "database": os.environ.get("MONGODB_DATABASE", "receipts"),
+        }
+        self.initialized_collections = set()
+
+        logger.info(
+            f"Async MongoDB connection initialized with URI: {self.connection_params.get('uri')}, "
+            f"database: {self.connection_params.get('database')}"
+        )
+
+    def get_database(self) -> AsyncIOMotorDatabase:
+        """
+        Get a connection to the MongoDB database. The client connects lazily on the first operation.
+
+        Returns:
+            Motor database object
+        """
+        if self._client is None:
+            # the process-wide client is shared unless another server is asked for
+            uri = self.connection_params.get("uri")
+            self._client = mongo_clients.get_async_client() if uri == mongo_clients.uri else AsyncIOMotorClient(uri)
+            self._db = self._client[self.connection_params.get("database")]
+            logger.info("Async MongoDB client created")
+
+        return self._db
+
+    async def initialize_collection(self, collection_name: str):
+        """
+        Set up the indexes of a collection, as declared in common.indexes, once per connection.
+
+        Args:
+            collection_name: Name of the collection to initialize
+        """
+        if collection_name in self.initialized_collections:
+            return
+
+        try:
+            collection = self.get_database()[collection_name]
+            await create_declared_indexes_async(collection)
+
+            self.initialized_collections.add(collection_name)
+            logger.info(f"MongoDB collection '{collection_name}' initialized successfully")
+        except PyMongoError as e:
+            logger.error(f"Error initializing MongoDB collection '{collection_name}': {str(e)}")
+            raise
+
+    def close(self):
+        """Close the MongoDB connection."""
+        if self._client:
+            # the shared client stays open for the other users, mongo_clients closes it
+            if not mongo_clients.is_shared(self._client):
+                self._client.close()
+            self._client = None
+            self._db = None
+            self.initialized_collections = set()
+            logger.info("Async MongoDB connection closed")
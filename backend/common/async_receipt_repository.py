@@ -0,0 +1,436 @@
+"""
+Async receipt repository implementation for the AI Agent Vision application.
+This module provides a motor-based MongoDB implementation for storing and retrieving receipts,
+with the same methods as ReceiptRepository, for callers running on the event loop.
+"""
+
+import copy
+import json
+import logging
+from datetime import UTC, datetime
+from typing import Any, Dict, List, Optional
+
+import pymongo
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from common.async_mongo_connection import AsyncMongoConnection
+from common.receipt_repository import (
+    RECEIPT_ITEMS_COLLECTION,
+    RECEIPT_ITEMS_PIPELINE,
+    RECEIPTS_IMPORT_CHUNK_SIZE,
+    RECEIPTS_PAGE_SORT,
+    STALE_RECEIPT_ITEMS_PIPELINE,
+    add_category_tokens,
+    backfill_category_tokens_query,
+    category_tokens_update,
+    chunked,
+    is_same_place,
+    items_per_item_type_query,
+    parse_receipt_date,
+    prepare_receipts_import,
+    receipt_fingerprint,
+    receipt_from_document,
+    receipt_item_documents,
+    receipts_by_date_query,
+    receipts_page,
+    receipts_page_query,
+    receipts_projection,
+    record_bulk_write_error,
+    similar_receipts_query,
+    store_keys,
+    without_existing_receipts,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def merge_receipt_items(database):
+    """Derive receipt_items again from all the receipts, and remove the rows of deleted receipts and lines"""
+    await database["receipts"].aggregate(RECEIPT_ITEMS_PIPELINE, allowDiskUse=True).to_list(length=None)
+    items = database[RECEIPT_ITEMS_COLLECTION]
+    stale = [row["_id"] async for row in items.aggregate(STALE_RECEIPT_ITEMS_PIPELINE, allowDiskUse=True)]
+    for chunk in chunked(stale, RECEIPTS_IMPORT_CHUNK_SIZE):
+        await items.delete_many({"_id": {"$in": chunk}})
+    return len(stale)
+
+
+class AsyncReceiptRepository:
+    """
+    Async MongoDB implementation for storing and retrieving receipts.
+    This class provides methods to store and retrieve receipt data from a MongoDB database without blocking the event loop.
+    """
+
+    def __init__(self, connection_params: Dict[str, Any] = None):
+        """
+        Initialize the receipt repository with MongoDB connection parameters
+
+        Args:
+            connection_params: Dictionary containing MongoDB connection parameters
+                               (uri, database)
+        """
+        self.mongo_connection = AsyncMongoConnection(connection_params)
+
+    async def initialize(self):
+        """Set up the indexes of the receipts collection, once per connection"""
+        await self.mongo_connection.initialize_collection("receipts")
+        await self.mongo_connection.initialize_collection(RECEIPT_ITEMS_COLLECTION)
+
+    async def get_receipts_collection(self):
+        """Get the receipts collection from the MongoDB database, initializing it on first use"""
+        await self.initialize()
+        return self.mongo_connection.get_database().receipts
+
+    async def get_receipt_items_collection(self):
+        """Get the receipt_items collection from the MongoDB database, initializing it on first use"""
+        await self.initialize()
+        return self.mongo_connection.get_database()[RECEIPT_ITEMS_COLLECTION]
+
+    async def replace_receipt_items(self, receipt_id: ObjectId, receipt: Dict[str, Any] = None):
+        """
+        Keep receipt_items in sync with a receipt: replace the line items of the receipt with those of
+        the given receipt, or remove them when the receipt is None (deleted)
+        """
+        collection = await self.get_receipt_items_collection()
+        await collection.delete_many({"receipt_id": receipt_id})
+        documents = receipt_item_documents(receipt_id, receipt) if receipt else []
+        if documents:
+            await collection.insert_many(documents)
+
+    async def save_receipt(self, receipt_data: str, metadata: dict) -> bool:
+        """
+        Save receipt data to MongoDB
+
+        Args:
+            receipt_data: JSON string containing receipt data
+            metadata: Dictionary with additional metadata; content_hash, the hash of the uploaded receipt
+                      file, is stored with the receipt and a second receipt with the same hash is rejected
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            current_time = datetime.now(UTC)
+
+            # Convert string to dict if it's a JSON string
+            if isinstance(receipt_data, str):
+                receipt_data = json.loads(receipt_data)
+
+            parse_receipt_date(receipt_data)
+            add_category_tokens(receipt_data)
+
+            document = {
+                "receipt_data": receipt_data["receipt_data"],
+                "items": receipt_data["items"],
+                "fingerprint": receipt_fingerprint(receipt_data),
+                "store_keys": store_keys(receipt_data),
+                "created_at": current_time,
+                "updated_at": current_time,
+            }
+            if metadata and metadata.get("content_hash"):
+                document["content_hash"] = metadata["content_hash"]
+
+            collection = await self.get_receipts_collection()
+            result = await collection.insert_one(document)
+            items = receipt_item_documents(result.inserted_id, document)
+            if items:
+                await (await self.get_receipt_items_collection()).insert_many(items)
+            logger.info(f"Receipt saved to MongoDB successfully with ID: {result.inserted_id}")
+            return True
+        except DuplicateKeyError:
+            logger.warning(
+                f"Receipt not saved, a receipt from file {metadata and metadata.get('content_hash')} is already saved"
+            )
+            return False
+        except Exception as e:
+            logger.error(f"Error saving receipt to MongoDB: {str(e)}")
+            return False
+
+    async def save_receipts_bulk(self, receipts: List[Any], chunk_size: int = RECEIPTS_IMPORT_CHUNK_SIZE) -> Dict[str, Any]:
+        """
+        Save a batch of receipts, e.g. a backfill from an export, with unordered insert_many calls of chunk_size
+        receipts. Receipts already stored, or repeated in the batch, are skipped; a receipt that cannot be read
+        or written is reported without aborting the rest of the batch.
+
+        Args:
+            receipts: Receipt dictionaries or JSON strings, each with receipt_data and items
+            chunk_size: Number of receipts per insert_many call
+
+        Returns:
+            Import report with the number of receipts received, inserted and skipped as duplicates,
+            and the position in the batch and error of each failed receipt
+        """
+        documents, report = prepare_receipts_import(receipts, datetime.now(UTC))
+        collection = await self.get_receipts_collection()
+        items_collection = await self.get_receipt_items_collection()
+
+        existing_fingerprints = set()
+        for chunk in chunked([document["fingerprint"] for _, document in documents], chunk_size):
+            cursor = collection.find({"fingerprint": {"$in": chunk}}, {"fingerprint": 1})
+            existing_fingerprints.update([document["fingerprint"] async for document in cursor])
+        documents = without_existing_receipts(documents, existing_fingerprints, report)
+
+        for chunk in chunked(documents, chunk_size):
+            try:
+                result = await collection.insert_many([document for _, document in chunk], ordered=False)
+                report["inserted"] += len(result.inserted_ids)
+            except PyMongoError as e:
+                chunk = record_bulk_write_error(report, chunk, e)
+
+            items = [item for _, document in chunk for item in receipt_item_documents(document["_id"], document)]
+            if items:
+                await items_collection.insert_many(items, ordered=False)
+
+        logger.info(
+            f"Imported {report['inserted']} of {report['received']} receipts, {report['duplicates']} duplicates, "
+            f"{len(report['failed'])} failed"
+        )
+        return report
+
+    async def get_receipt_by_content_hash(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve the receipt extracted from the uploaded file with the given content hash
+
+        Returns:
+            Receipt dictionary with id, created_at, updated_at, and data fields, or None if not found
+        """
+        collection = await self.get_receipts_collection()
+        document = await collection.find_one({"content_hash": content_hash})
+        return receipt_from_document(document) if document else None
+
+    async def find_similar_receipt(self, receipt_data: Any) -> Optional[Dict[str, Any]]:
+        """
+        Find a saved receipt for the same purchase as the given receipt, e.g. the same receipt photographed
+        again: same date, same total and the same known store. Two purchases can match too, so this only
+        flags a possible duplicate
+
+        Args:
+            receipt_data: Receipt dictionary or JSON string with receipt_data and items
+
+        Returns:
+            Receipt dictionary with id, created_at, updated_at, and data fields, or None if not found
+        """
+        receipt = json.loads(receipt_data) if isinstance(receipt_data, str) else copy.deepcopy(receipt_data)
+        query = similar_receipts_query(parse_receipt_date(receipt))
+        if query is None:
+            return None
+        place = receipt["receipt_data"].get("place")
+        collection = await self.get_receipts_collection()
+        async for document in collection.find(query):
+            if is_same_place(place, document["receipt_data"].get("place")):
+                return receipt_from_document(document)
+        return None
+
+    async def get_all_receipts(self) -> List[Dict[str, Any]]:
+        """
+        Retrieve all receipts from the database
+
+        Returns:
+            List of receipt dictionaries with id, created_at, updated_at, and data fields
+        """
+        try:
+            collection = await self.get_receipts_collection()
+            cursor = collection.find().sort("created_at", pymongo.DESCENDING)
+            return [receipt_from_document(document) async for document in cursor]
+        except Exception as e:
+            logger.error(f"Error retrieving receipts from MongoDB: {str(e)}")
+            return []
+
+    async def get_receipt_by_id(self, receipt_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve a specific receipt by ID
+
+        Args:
+            receipt_id: The ID of the receipt to retrieve (string representation of ObjectId)
+
+        Returns:
+            Receipt dictionary or None if not found
+        """
+        try:
+            collection = await self.get_receipts_collection()
+            document = await collection.find_one({"_id": ObjectId(receipt_id)})
+
+            if document:
+                return receipt_from_document(document)
+            return None
+        except Exception as e:
+            logger.error(f"Error retrieving receipt {receipt_id} from MongoDB: {str(e)}")
+            return None
+
+    async def update_receipt(self, receipt_id: str, receipt_data: str, metadata: dict) -> bool:
+        """
+        Update an existing receipt
+
+        Args:
+            receipt_id: The ID of the receipt to update (string representation of ObjectId)
+            receipt_data: JSON string containing updated receipt data
+            metadata: Dictionary with additional metadata
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            current_time = datetime.now(UTC)
+
+            # Convert string to dict if it's a JSON string
+            if isinstance(receipt_data, str):
+                receipt_data = json.loads(receipt_data)
+
+            parse_receipt_date(receipt_data)
+            add_category_tokens(receipt_data)
+
+            update_data = {
+                "receipt_data": receipt_data["receipt_data"],
+                "items": receipt_data["items"],
+                "fingerprint": receipt_fingerprint(receipt_data),
+                "store_keys": store_keys(receipt_data),
+                "updated_at": current_time,
+            }
+
+            collection = await self.get_receipts_collection()
+            result = await collection.update_one({"_id": ObjectId(receipt_id)}, {"$set": update_data})
+            if result.matched_count:
+                await self.replace_receipt_items(ObjectId(receipt_id), update_data)
+
+            return result.modified_count > 0
+        except Exception as e:
+            logger.error(f"Error updating receipt {receipt_id} in MongoDB: {str(e)}")
+            return False
+
+    async def delete_receipt(self, receipt_id: str) -> bool:
+        """
+        Delete a receipt from the database
+
+        Args:
+            receipt_id: The ID of the receipt to delete (string representation of ObjectId)
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            collection = await self.get_receipts_collection()
+            result = await collection.delete_one({"_id": ObjectId(receipt_id)})
+            await self.replace_receipt_items(ObjectId(receipt_id))
+            return result.deleted_count > 0
+        except Exception as e:
+            logger.error(f"Error deleting receipt {receipt_id} from MongoDB: {str(e)}")
+            return False
+
+    async def get_receipts_by_date(
+        self, start_date: str, end_date: str, store: str = None, fields: List[str] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the receipts and their associated items for a given period of time, including all metadata.
+
+        Args:
+            start_date (str): The start date of the period as YYYY-MM-DD.
+            end_date (str): The end date of the period as YYYY-MM-DD.
+            store (str): Only receipts from this store, matched as described in store_condition.
+            fields (List[str]): Fields to return (see receipts_projection), all fields if None.
+
+        Returns:
+            List of dictionaries containing receipt data for the specified period.
+        """
+        try:
+            collection = await self.get_receipts_collection()
+            cursor = collection.find(receipts_by_date_query(start_date, end_date, store), receipts_projection(fields)).sort(
+                "receipt_data.date", pymongo.DESCENDING
+            )
+            return [receipt_from_document(document) async for document in cursor]
+        except Exception as e:
+            logger.error(f"Error retrieving receipts by date from MongoDB: {str(e)}")
+            return None
+
+    async def get_receipts_page(
+        self,
+        limit: int = 50,
+        cursor: str = None,
+        fields: List[str] = None,
+        start_date: str = None,
+        end_date: str = None,
+        store: str = None,
+    ) -> Dict[str, Any]:
+        """
+        Retrieve one page of receipts, newest first, using keyset pagination on created_at and _id
+
+        Args:
+            limit: Maximum number of receipts in the page
+            cursor: next_cursor of the previous page, None for the first page
+            fields: Fields to return (see receipts_projection), all fields if None
+            start_date: Only receipts dated on or after this day (YYYY-MM-DD)
+            end_date: Only receipts dated on or before this day (YYYY-MM-DD)
+            store: Only receipts from this store, matched as described in store_condition
+
+        Returns:
+            Dictionary with the receipts of the page and next_cursor, which is None on the last page
+
+        Raises:
+            ValueError: if the cursor or the fields are invalid
+        """
+        query = receipts_page_query(cursor, start_date, end_date, store)
+        collection = await self.get_receipts_collection()
+        documents = (
+            await collection.find(query, receipts_projection(fields))
+            .sort(RECEIPTS_PAGE_SORT)
+            .limit(limit + 1)
+            .to_list(length=limit + 1)
+        )
+        return receipts_page(documents, limit, fields)
+
+    async def get_items_per_item_type(self, item_type: str) -> List[Dict[str, Any]]:
+        """
+        Get items per item type from the database, matching the item type against the category levels.
+
+        Args:
+            item_type (str): The item type to filter by.
+
+        Returns:
+            List of the matching line items from receipt_items, newest first, each with the receipt_id,
+            date and store of its receipt.
+        """
+        query = items_per_item_type_query(item_type)
+        if query is None:
+            return []
+        try:
+            collection = await self.get_receipt_items_collection()
+            return await collection.find(query, {"_id": 0}).sort("date", pymongo.DESCENDING).to_list(length=None)
+        except Exception as e:
+            logging.error(f"Error searching items by category value: {str(e)}")
+            return []
+
+    async def backfill_category_tokens(self) -> int:
+        """
+        Add the category tokens to the items of receipts saved before they were maintained on write
+
+        Returns:
+            Number of receipts updated
+        """
+        collection = await self.get_receipts_collection()
+        cursor = collection.find(backfill_category_tokens_query(), {"items": 1})
+        updates = [category_tokens_update(document) async for document in cursor]
+        updated = 0
+        for chunk in chunked(updates, RECEIPTS_IMPORT_CHUNK_SIZE):
+            updated += (await collection.bulk_write(chunk, ordered=False)).modified_count
+        logger.info(f"Category tokens added to {updated} receipts")
+        return updated
+
+    async def rebuild_receipt_items(self):
+        """Derive receipt_items again from all the receipts, keeping the rows written meanwhile"""
+        await self.initialize()
+        stale = await merge_receipt_items(self.mongo_connection.get_database())
+        logger.info(f"receipt_items rebuilt from the receipts, {stale} stale rows removed")
+
+    async def backfill(self):
+        """
+        Bring the derived data of receipts saved by earlier versions up to date, called when the server
+        starts: category tokens are added to their items, and receipt_items is rebuilt when tokens were
+        added or it is empty while there are receipts
+        """
+        try:
+            updated = await self.backfill_category_tokens()
+            receipts = await self.get_receipts_collection()
+            items = await self.get_receipt_items_collection()
+            if updated or (await items.find_one() is None and await receipts.find_one({"items.0": {"$exists": True}})):
+                await self.rebuild_receipt_items()
+        except PyMongoError as e:
+            logger.error(f"Error backfilling receipt derived data: {str(e)}")
@@ -0,0 +1,316 @@
+"""
+Async recipe repository implementation for the AI Agent Vision application.
+This module provides a motor-based MongoDB implementation for storing and retrieving recipes,
+with the same methods as RecipeRepository, for callers running on the event loop.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+import pymongo
+from bson import ObjectId
+
+from agents.recipes.recipeflow import Recipe
+from common.async_mongo_connection import AsyncMongoConnection
+from common.recipe_recommender import RECOMMENDER_DEFAULT_DAYS, RECOMMENDER_DEFAULT_LIMIT, recipe_recommender
+from common.recipe_repository import (
+    canonical_tags,
+    document_to_recipe,
+    recipe_to_document,
+    recipes_by_ingredients_query,
+)
+from common.recipe_search import recipe_search_index
+from common.recipe_vectors import SEMANTIC_SEARCH_LIMIT, recipe_vector_index, semantic_search
+
+logger = logging.getLogger(__name__)
+
+# recipes returned by a free text search at most
+RECIPE_SEARCH_LIMIT = 20
+
+
+class AsyncRecipeRepository:
+    """
+    Async MongoDB implementation for storing and retrieving recipes.
+    This class provides methods to store and retrieve recipe data from a MongoDB database without blocking the event loop.
+    """
+
+    def __init__(self, connection_params: Dict[str, Any] = None):
+        """
+        Initialize the recipe repository with MongoDB connection parameters
+
+        Args:
+            connection_params: Dictionary containing MongoDB connection parameters
+                               (uri, database)
+        """
+        self.mongo_connection = AsyncMongoConnection(connection_params)
+
+    async def initialize(self):
+        """Set up the indexes of the recipes collection, once per connection"""
+        await self.mongo_connection.initialize_collection("recipes")
+
+    async def get_recipes_collection(self):
+        """Get the recipes collection from the MongoDB database, initializing it on first use"""
+        await self.initialize()
+        return self.mongo_connection.get_database().recipes
+
+    async def save_recipe(self, recipe: Recipe) -> Optional[str]:
+        """
+        Save recipe to MongoDB
+
+        Args:
+            recipe: Recipe model instance
+
+        Returns:
+            Recipe ID if successful, None otherwise
+        """
+        try:
+            collection = await self.get_recipes_collection()
+            document = recipe_to_document(recipe)
+            result = await collection.insert_one(document)
+            recipe_search_index.upsert(result.inserted_id, document)
+            recipe_vector_index.upsert(result.inserted_id, document["embedding"])
+            recipe_recommender.upsert_recipe(result.inserted_id, document)
+            recipe_id = str(result.inserted_id)
+            logger.info(f"Recipe saved to MongoDB successfully with ID: {recipe_id}")
+            return recipe_id
+        except Exception as e:
+            logger.error(f"Error saving recipe to MongoDB: {str(e)}")
+            return None
+
+    async def get_all_recipes(self) -> List[Recipe]:
+        """
+        Retrieve all recipes from the database
+
+        Returns:
+            List of Recipe model objects
+        """
+        try:
+            collection = await self.get_recipes_collection()
+            cursor = collection.find().sort("created_at", pymongo.DESCENDING)
+            return [document_to_recipe(document) async for document in cursor]
+        except Exception as e:
+            logger.error(f"Error retrieving recipes from MongoDB: {str(e)}")
+            return []
+
+    async def get_recipe_by_id(self, recipe_id: str) -> Optional[Recipe]:
+        """
+        Retrieve a specific recipe by ID
+
+        Args:
+            recipe_id: The ID of the recipe to retrieve (string representation of ObjectId)
+
+        Returns:
+            Recipe model object or None if not found
+        """
+        try:
+            collection = await self.get_recipes_collection()
+            document = await collection.find_one({"_id": ObjectId(recipe_id)})
+
+            if document:
+                return document_to_recipe(document)
+            return None
+        except Exception as e:
+            logger.error(f"Error retrieving recipe {recipe_id} from MongoDB: {str(e)}")
+            return None
+
+    async def update_recipe(self, recipe_id: str, recipe: Recipe) -> bool:
+        """
+        Update an existing recipe
+
+        Args:
+            recipe_id: The ID of the recipe to update (string representation of ObjectId)
+            recipe: Recipe model object with updated data
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            collection = await self.get_recipes_collection()
+
+            # Get existing document to maintain created_at and other fields
+            existing_doc = await collection.find_one({"_id": ObjectId(recipe_id)})
+
+            if not existing_doc:
+                logger.error(f"Recipe {recipe_id} not found for update")
+                return False
+
+            # Convert Recipe model to MongoDB document format, preserving fields not in model
+            update_data = recipe_to_document(recipe, existing_doc)
+
+            # Remove _id to avoid update error
+            update_data.pop("_id", None)
+
+            result = await collection.update_one({"_id": ObjectId(recipe_id)}, {"$set": update_data})
+            recipe_search_index.upsert(existing_doc["_id"], {**existing_doc, **update_data})
+            recipe_vector_index.upsert(existing_doc["_id"], update_data["embedding"])
+            recipe_recommender.upsert_recipe(existing_doc["_id"], update_data)
+
+            return result.modified_count > 0
+        except Exception as e:
+            logger.error(f"Error updating recipe {recipe_id} in MongoDB: {str(e)}")
+            return False
+
+    async def delete_recipe(self, recipe_id: str) -> bool:
+        """
+        Delete a recipe from the database
+
+        Args:
+            recipe_id: The ID of the recipe to delete (string representation of ObjectId)
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            collection = await self.get_recipes_collection()
+            result = await collection.delete_one({"_id": ObjectId(recipe_id)})
+            recipe_search_index.remove(ObjectId(recipe_id))
+            recipe_vector_index.remove(ObjectId(recipe_id))
+            recipe_recommender.remove_recipe(ObjectId(recipe_id))
+            return result.deleted_count > 0
+        except Exception as e:
+            logger.error(f"Error deleting recipe {recipe_id} from MongoDB: {str(e)}")
+            return False
+
+    async def get_recipes_by_ids(self, recipe_ids: List[ObjectId]) -> List[Recipe]:
+        """
+        Retrieve recipes by id in a single query
+
+        Args:
+            recipe_ids: ObjectIds of the recipes, e.g. as ranked by the search index
+
+        Returns:
+            List of Recipe model objects, in the order of recipe_ids
+        """
+        if not recipe_ids:
+            return []
+        collection = await self.get_recipes_collection()
+        documents = {document["_id"]: document async for document in collection.find({"_id": {"$in": list(recipe_ids)}})}
+        return [document_to_recipe(documents[recipe_id]) for recipe_id in recipe_ids if recipe_id in documents]
+
+    async def search_recipes(self, query: str, limit: int = RECIPE_SEARCH_LIMIT) -> List[Recipe]:
+        """
+        Search for recipes by name, tags, ingredients and steps, best matches first. Answered from the
+        in-memory search index once loaded, and with the $text index on name and tags until then.
+
+        Args:
+            query: The search query
+            limit: Maximum number of recipes returned
+
+        Returns:
+            List of matching Recipe model objects
+        """
+        try:
+            if recipe_search_index.loaded:
+                return await self.get_recipes_by_ids([recipe_id for recipe_id, _ in recipe_search_index.search(query, limit)])
+
+            collection = await self.get_recipes_collection()
+
+            # Sort by relevance score
+            cursor = (
+                collection.find({"$text": {"$search": query}}, {"score": {"$meta": "textScore"}})
+                .sort([("score", {"$meta": "textScore"})])
+                .limit(limit)
+            )
+            return [document_to_recipe(document) async for document in cursor]
+        except Exception as e:
+            logger.error(f"Error searching recipes in MongoDB: {str(e)}")
+            return []
+
+    async def semantic_search_recipes(self, query: str, limit: int = SEMANTIC_SEARCH_LIMIT) -> List[Recipe]:
+        """
+        Search for recipes similar in meaning to a description, such as "something warm and quick with
+        chickpeas", most similar first, by the cosine similarity of the recipe vectors
+
+        Args:
+            query: Description of the recipes to find
+            limit: Maximum number of recipes returned
+
+        Returns:
+            List of matching Recipe model objects
+        """
+        try:
+            collection = await self.get_recipes_collection()
+            ranked = await semantic_search(collection, query, limit)
+            return await self.get_recipes_by_ids([ObjectId(recipe_id) for recipe_id, _ in ranked])
+        except Exception as e:
+            logger.error(f"Error searching recipes semantically: {str(e)}")
+            return []
+
+    async def recommend_recipes(
+        self, days: int = RECOMMENDER_DEFAULT_DAYS, limit: int = RECOMMENDER_DEFAULT_LIMIT
+    ) -> List[Dict[str, Any]]:
+        """
+        Recipes that can be cooked with the ingredients bought in the last days, best covered first
+
+        Args:
+            days: Number of days of receipts to consider
+            limit: Maximum number of recipes returned
+
+        Returns:
+            List of recommendations, each with the Recipe model object, the share of its ingredients
+            that were bought and the names of the matched and missing ingredients
+        """
+        try:
+            recommendations = recipe_recommender.recommend(days, limit)
+            if not recommendations:
+                return []
+            collection = await self.get_recipes_collection()
+            ids = [recommendation["recipe_id"] for recommendation in recommendations]
+            documents = {document["_id"]: document async for document in collection.find({"_id": {"$in": ids}})}
+            return [
+                {**recommendation, "recipe": document_to_recipe(documents[recommendation["recipe_id"]])}
+                for recommendation in recommendations
+                if recommendation["recipe_id"] in documents
+            ]
+        except Exception as e:
+            logger.error(f"Error recommending recipes: {str(e)}")
+            return []
+
+    async def get_recipes_by_tags(self, tags: List[str]) -> List[Recipe]:
+        """
+        Find recipes that match any of the specified tags
+
+        Args:
+            tags: List of tags to search for
+
+        Returns:
+            List of matching Recipe model objects
+        """
+        try:
+            if recipe_search_index.loaded:
+                return await self.get_recipes_by_ids(recipe_search_index.search_tags(canonical_tags(tags)))
+
+            collection = await self.get_recipes_collection()
+            cursor = collection.find({"tags": {"$in": canonical_tags(tags)}}).sort("created_at", pymongo.DESCENDING)
+            return [document_to_recipe(document) async for document in cursor]
+        except Exception as e:
+            logger.error(f"Error retrieving recipes by tags from MongoDB: {str(e)}")
+            return []
+
+    async def get_recipes_by_ingredients(self, ingredients: List[str], match_all: bool = False) -> List[Recipe]:
+        """
+        Find recipes that contain any of the specified ingredients, with the ingredient_keys index, best
+        matches first once the search index is loaded and newest first otherwise
+
+        Args:
+            ingredients: List of ingredients to search for
+            match_all: Only find recipes that contain all of the ingredients
+
+        Returns:
+            List of matching Recipe model objects
+        """
+        try:
+            collection = await self.get_recipes_collection()
+            cursor = collection.find(recipes_by_ingredients_query(ingredients, match_all)).sort(
+                "created_at", pymongo.DESCENDING
+            )
+            documents = [document async for document in cursor]
+            if recipe_search_index.loaded:
+                # the query decides what matches, so recipes written by other processes are found before the
+                # search index reloads; it only ranks them, and those it does not know yet stay last, newest first
+                scores = dict(recipe_search_index.search_ingredients(ingredients, match_all=match_all))
+                documents.sort(key=lambda document: -scores.get(document["_id"], 0.0))
+            return [document_to_recipe(document) for document in documents]
+        except Exception as e:
+            logger.error(f"Error retrieving recipes by ingredients from MongoDB: {str(e)}")
+            return []
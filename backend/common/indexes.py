@@ -0,0 +1,356 @@
+"""
+Declarative registry of the MongoDB indexes of the AI Agent Vision application.
+
+Every index of every collection is declared here. The server reconciles the database with the registry
+when it starts, creating missing indexes and recreating those declared with other options; indexes
+that are not declared, e.g. created by hand, are only reported, and dropped by the reconcile command
+with --drop-undeclared. The repositories create the indexes of their collections on first use. The hot queries of the application
+are listed as well, so that their plans can be checked with explain() for collection scans:
+
+    python -m common.indexes reconcile [--drop-undeclared]
+    python -m common.indexes verify
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import pymongo
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+from common.mongo_clients import mongo_clients
+
+logger = logging.getLogger(__name__)
+
+# default of the reconcile command for dropping the indexes of registered collections that are not declared
+# here; the server never drops them when it starts
+MONGODB_DROP_UNDECLARED_INDEXES = os.environ.get("MONGODB_DROP_UNDECLARED_INDEXES", "false").lower() == "true"
+
+# create_index options compared when reconciling; other options reported by list_indexes are ignored
+COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+# create_index error codes for an index that already exists with other options or another name
+INDEX_CONFLICT_CODES = (85, 86)
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """One index: its collection, its keys as (field, direction) pairs, and create_index options."""
+
+    collection: str
+    keys: tuple
+    options: dict = field(default_factory=dict, hash=False)
+    name: Optional[str] = None
+    # why the index exists, shown by the verification report
+    reason: str = ""
+
+    @property
+    def index_name(self) -> str:
+        # MongoDB's default name, so that indexes created before the registry are recognised
+        return self.name or "_".join(f"{key}_{direction}" for key, direction in self.keys)
+
+    def is_text(self) -> bool:
+        return any(direction == pymongo.TEXT for _, direction in self.keys)
+
+    def model(self) -> IndexModel:
+        return IndexModel(list(self.keys), name=self.index_name, **self.options)
+
+    def matches(self, info: Dict[str, Any]) -> bool:
+        """Whether an index reported by list_indexes is this index, with the same keys and options."""
+        if self.is_text():
+            # text indexes are reported with internal keys, their fields are in the weights
+            fields = {key for key, direction in self.keys if direction == pymongo.TEXT}
+            return set(info.get("weights", {})) == fields
+        if list(info["key"].items()) != [(key, direction) for key, direction in self.keys]:
+            return False
+        return all(info.get(option) == self.options.get(option) for option in COMPARED_OPTIONS)
+
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+INDEXES = [
+    # receipts
+    IndexSpec(
+        "receipts",
+        (("created_at", DESC), ("_id", DESC)),
+        reason="receipts listed newest first, keyset pagination, _id breaks created_at ties",
+    ),
+    IndexSpec("receipts", (("fingerprint", ASC),), reason="bulk imports skip receipts already stored"),
+    IndexSpec("receipts", (("items.category_tokens", ASC),), reason="finds receipts saved before category tokens"),
+    IndexSpec(
+        "receipts",
+        (("content_hash", ASC),),
+        {"unique": True, "partialFilterExpression": {"content_hash": {"$type": "string"}}},
+        reason="a receipt file is only saved once; receipts without a file hash are not constrained",
+    ),
+    IndexSpec(
+        "receipts",
+        (("receipt_data.date", ASC), ("receipt_data.total", ASC)),
+        reason="receipts by date range and re-photographed receipts by date and total",
+    ),
+    IndexSpec(
+        "receipts",
+        (("store_keys", ASC), ("receipt_data.date", ASC)),
+        reason="receipts by an anchored prefix of their store keys, multikey, and date range",
+    ),
+    # receipt_items, one document per line item
+    IndexSpec(
+        "receipt_items",
+        (("receipt_id", ASC), ("line", ASC)),
+        {"unique": True},
+        reason="kept in sync with their receipt, rebuilds merge on it",
+    ),
+    IndexSpec("receipt_items", (("category_tokens", ASC), ("date", DESC)), reason="items by category, newest first"),
+    IndexSpec("receipt_items", (("store", ASC), ("date", DESC)), reason="items by store, newest first"),
+    IndexSpec("receipt_items", (("date", DESC),), reason="items by date range"),
+    # recipes; MongoDB allows one text index per collection, so name and tags share it
+    IndexSpec(
+        "recipes",
+        (("created_at", DESC), ("_id", DESC)),
+        reason="recipes listed newest first, keyset pagination, _id breaks created_at ties",
+    ),
+    IndexSpec("recipes", (("name", pymongo.TEXT), ("tags", pymongo.TEXT)), reason="recipe search"),
+    IndexSpec("recipes", (("ingredient_keys", ASC),), reason="recipes by canonical ingredient, multikey"),
+    # uploads
+    IndexSpec("uploads", (("content_hash", ASC),), {"unique": True}, reason="the same file is stored once"),
+    # analytics
+    IndexSpec(
+        "aggregates",
+        (("type", ASC), ("year", ASC), ("month", ASC), ("week", ASC)),
+        name="aggregates_bucket",
+        reason="dashboard lookups and rebuild upserts by type and bucket",
+    ),
+    IndexSpec(
+        "spend_daily",
+        (("date", ASC), ("store", ASC), ("level_1", ASC), ("level_2", ASC), ("level_3", ASC)),
+        {"unique": True},
+        name="spend_daily_key",
+        reason="one row per day, store and category; date ranges use its first field",
+    ),
+]
+
+
+def indexes_for(collection: str) -> List[IndexSpec]:
+    return [spec for spec in INDEXES if spec.collection == collection]
+
+
+def registered_collections() -> List[str]:
+    return list(dict.fromkeys(spec.collection for spec in INDEXES))
+
+
+def index_diff(collection: str, existing: List[Dict[str, Any]], drop_undeclared: bool = False) -> Dict[str, list]:
+    """
+    Indexes to drop and to create so that a collection has the declared indexes.
+
+    Args:
+        collection: Name of the collection
+        existing: Indexes of the collection as reported by list_indexes
+        drop_undeclared: Also drop the indexes that are not declared, instead of only reporting them
+
+    Returns:
+        Dictionary with the names of the indexes to drop (declared with other keys or options, and
+        undeclared ones with drop_undeclared), the IndexSpecs to create and the names of the undeclared
+        indexes that are kept
+    """
+    declared = {spec.index_name: spec for spec in indexes_for(collection)}
+    drop = []
+    undeclared = []
+    present = set()
+    for info in existing:
+        if info["name"] == "_id_":
+            continue
+        spec = declared.get(info["name"])
+        if spec is None:
+            # an index with declared keys under another name is replaced by the declared one
+            same_keys = any(s.matches(info) for s in declared.values())
+            if same_keys or drop_undeclared:
+                drop.append(info["name"])
+            else:
+                undeclared.append(info["name"])
+        elif spec.matches(info):
+            present.add(info["name"])
+        else:
+            drop.append(info["name"])
+    create = [spec for name, spec in declared.items() if name not in present]
+    return {"drop": drop, "create": create, "undeclared": undeclared}
+
+
+async def reconcile_indexes(database=None, drop_undeclared: bool = False) -> Dict[str, Dict[str, list]]:
+    """
+    Create the declared indexes that are missing or declared with other options, in every registered
+    collection, and report the ones that are not declared, dropping them only with drop_undeclared.
+    Called when the server starts, without dropping. Returns the changes per collection.
+    """
+    database = database if database is not None else mongo_clients.async_db
+    changes = {}
+    for collection in registered_collections():
+        try:
+            existing = await database[collection].list_indexes().to_list(length=None)
+            diff = index_diff(collection, existing, drop_undeclared)
+            if diff["undeclared"]:
+                logger.warning(f"Indexes of {collection} not declared in common.indexes, kept: {diff['undeclared']}")
+            for name in diff["drop"]:
+                await database[collection].drop_index(name)
+            if diff["create"]:
+                await database[collection].create_indexes([spec.model() for spec in diff["create"]])
+            if diff["drop"] or diff["create"]:
+                changes[collection] = {"dropped": diff["drop"], "created": [spec.index_name for spec in diff["create"]]}
+                logger.info(f"Indexes of {collection} reconciled: {changes[collection]}")
+        except PyMongoError as e:
+            logger.error(f"Error reconciling the indexes of {collection}: {str(e)}")
+            changes[collection] = {"error": str(e)}
+    return changes
+
+
+def create_declared_indexes(collection) -> None:
+    """
+    Create the declared indexes of a pymongo collection, leaving alone indexes that conflict with
+    existing ones until the server reconciles them.
+    """
+    for spec in indexes_for(collection.name):
+        try:
+            collection.create_indexes([spec.model()])
+        except OperationFailure as e:
+            if e.code not in INDEX_CONFLICT_CODES:
+                raise
+            logger.warning(f"Index {spec.index_name} of {collection.name} conflicts with an existing index: {str(e)}")
+
+
+async def create_declared_indexes_async(collection) -> None:
+    """Motor counterpart of create_declared_indexes."""
+    for spec in indexes_for(collection.name):
+        try:
+            await collection.create_indexes([spec.model()])
+        except OperationFailure as e:
+            if e.code not in INDEX_CONFLICT_CODES:
+                raise
+            logger.warning(f"Index {spec.index_name} of {collection.name} conflicts with an existing index: {str(e)}")
+
+
+#
+# Verification: the hot queries of the application, with representative values, explained to check
+# that none of them scans a whole collection.
+#
+SAMPLE_DAY = datetime(2025, 1, 1)
+SAMPLE_NEXT_DAY = datetime(2025, 1, 2)
+
+HOT_QUERIES = [
+    {
+        "name": "receipts by date",
+        "collection": "receipts",
+        "filter": {"receipt_data.date": {"$gte": SAMPLE_DAY, "$lte": SAMPLE_NEXT_DAY}},
+        "sort": {"receipt_data.date": DESC},
+    },
+    {"name": "receipts page", "collection": "receipts", "filter": {}, "sort": {"created_at": DESC, "_id": DESC}},
+    {
+        "name": "receipts by store",
+        "collection": "receipts",
+        "filter": {"store_keys": {"$regex": "^prisma"}, "receipt_data.date": {"$gte": SAMPLE_DAY, "$lte": SAMPLE_NEXT_DAY}},
+    },
+    {"name": "receipt by file hash", "collection": "receipts", "filter": {"content_hash": "0" * 64}},
+    {"name": "receipts by fingerprint", "collection": "receipts", "filter": {"fingerprint": {"$in": ["0" * 40]}}},
+    {
+        "name": "items by category",
+        "collection": "receipt_items",
+        "filter": {"category_tokens": {"$all": [{"$regex": "^pasta"}]}},
+        "sort": {"date": DESC},
+    },
+    {"name": "items of a receipt", "collection": "receipt_items", "filter": {"receipt_id": None}},
+    {"name": "monthly spend", "collection": "aggregates", "filter": {"type": "monthly_spend", "year": 2025, "month": 1}},
+    {"name": "weekly spend", "collection": "aggregates", "filter": {"type": "weekly_spend", "year": 2025, "week": 1}},
+    {"name": "yearly spend", "collection": "aggregates", "filter": {"type": "yearly_spend", "year": 2025}},
+    {
+        "name": "spend by period",
+        "collection": "spend_daily",
+        "filter": {"date": {"$gte": SAMPLE_DAY, "$lte": SAMPLE_NEXT_DAY}},
+    },
+    {"name": "upload by file hash", "collection": "uploads", "filter": {"content_hash": "0" * 64}},
+    {"name": "recipes page", "collection": "recipes", "filter": {}, "sort": {"created_at": DESC, "_id": DESC}},
+    {"name": "recipe search", "collection": "recipes", "filter": {"$text": {"$search": "pasta"}}},
+    {"name": "recipes by ingredients", "collection": "recipes", "filter": {"ingredient_keys": {"$all": ["onion", "garlic"]}}},
+]
+
+
+def winning_plan_stages(explain: Any) -> List[str]:
+    """Stages of the winning plans found anywhere in an explain() result, including nested pipelines."""
+    stages = []
+
+    def collect(node):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            for value in node.values():
+                collect(value)
+        elif isinstance(node, list):
+            for value in node:
+                collect(value)
+
+    def find_plans(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "winningPlan":
+                    collect(value)
+                else:
+                    find_plans(value)
+        elif isinstance(node, list):
+            for value in node:
+                find_plans(value)
+
+    find_plans(explain)
+    return stages
+
+
+async def verify_hot_queries(database=None) -> List[Dict[str, Any]]:
+    """
+    Explain every hot query and report the stages of its winning plan. A query whose plan has a
+    COLLSCAN stage is flagged, as it reads the whole collection.
+    """
+    database = database if database is not None else mongo_clients.async_db
+    results = []
+    for query in HOT_QUERIES:
+        command = {"find": query["collection"], "filter": query["filter"]}
+        if query.get("sort"):
+            command["sort"] = query["sort"]
+        try:
+            explain = await database.command({"explain": command, "verbosity": "queryPlanner"})
+            stages = winning_plan_stages(explain)
+            results.append({"query": query["name"], "stages": stages, "collection_scan": "COLLSCAN" in stages})
+        except PyMongoError as e:
+            results.append({"query": query["name"], "error": str(e), "collection_scan": None})
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Reconcile the MongoDB indexes with the registry, or verify the hot queries")
+    parser.add_argument("command", choices=["reconcile", "verify"])
+    parser.add_argument(
+        "--drop-undeclared",
+        action=argparse.BooleanOptionalAction,
+        default=MONGODB_DROP_UNDECLARED_INDEXES,
+        help="reconcile also drops the indexes that are not declared (default: MONGODB_DROP_UNDECLARED_INDEXES)",
+    )
+    args = parser.parse_args()
+
+    try:
+        if args.command == "reconcile":
+            print(json.dumps(await reconcile_indexes(drop_undeclared=args.drop_undeclared), indent=2))
+            return 0
+
+        results = await verify_hot_queries()
+        for result in results:
+            status = "ERROR" if result["collection_scan"] is None else "COLLSCAN" if result["collection_scan"] else "ok"
+            print(f"{status:8} {result['query']}: {result.get('error') or ' > '.join(result['stages'])}")
+        return 1 if any(result["collection_scan"] is not False for result in results) else 0
+    finally:
+        mongo_clients.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main()))
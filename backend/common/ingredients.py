@@ -0,0 +1,161 @@
+"""
+Ingredient normalization for the AI Agent Vision application.
+
+Recipe ingredients are free text such as "500 g naudan jauhelihaa" or "2 onions, finely chopped".
+canonical_ingredient reduces them to a canonical English name ("minced beef", "onion") by dropping
+quantities, units, preparation notes and descriptors, singularizing English words and translating
+Finnish names through a synonym table. Recipes store the canonical names and their words as
+ingredient_keys, a multikey indexed array, so that ingredient lookups are exact $in/$all queries.
+"""
+
+import re
+from typing import List, Optional
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+# fmt: off
+UNITS = {
+    "g", "gr", "gram", "grams", "kg", "mg", "l", "dl", "cl", "ml", "litre", "liter", "litres", "liters",
+    "tl", "rkl", "kpl", "pkt", "prk", "pss", "ripaus", "nippu", "tlk", "kuppi",
+    "tsp", "tbsp", "teaspoon", "teaspoons", "tablespoon", "tablespoons", "cup", "cups", "oz", "ounce",
+    "ounces", "lb", "lbs", "pound", "pounds", "pinch", "handful", "clove", "cloves", "can", "cans", "tin",
+    "tins", "package", "packages", "pack", "bunch", "slice", "slices", "piece", "pieces", "pcs",
+}
+
+# preparation and size words that do not change the ingredient
+DESCRIPTORS = {
+    "a", "an", "of", "the", "and", "or", "to", "taste", "about", "approx", "optional", "some", "few",
+    "fresh", "freshly", "chopped", "finely", "roughly", "diced", "sliced", "grated", "peeled", "crushed",
+    "large", "small", "medium", "ripe", "whole", "cooked", "raw", "frozen", "dried", "leaf", "leaves",
+    "noin", "tuore", "tuoretta", "hienonnettu", "hienonnettua", "pilkottu", "pilkottua", "raastettu",
+    "raastettua", "kuorittu", "kuorittua", "iso", "isoa", "pieni", "pientä", "tai", "ja", "maun", "mukaan",
+    "lehti", "lehtiä",
+}
+
+# Finnish and alternative names of ingredients, by word or whole phrase, to canonical English names
+SYNONYMS = {
+    # phrases
+    "naudan jauheliha": "minced beef", "ground beef": "minced beef", "beef mince": "minced beef",
+    "sian jauheliha": "minced pork", "ground pork": "minced pork", "garbanzo bean": "chickpea",
+    "scallion": "spring onion", "kevätsipuli": "spring onion",
+    "green onion": "spring onion", "cilantro": "coriander", "yogurt": "yoghurt",
+    "all purpose flour": "flour", "plain flour": "flour",
+    # Finnish words
+    "jauheliha": "minced meat", "nauta": "beef", "naudanliha": "beef", "sika": "pork", "porsas": "pork",
+    "possu": "pork", "kana": "chicken", "broileri": "chicken", "kalkkuna": "turkey", "kananmuna": "egg",
+    "muna": "egg", "sipuli": "onion", "punasipuli": "red onion", "valkosipuli": "garlic",
+    "peruna": "potato", "porkkana": "carrot", "tomaatti": "tomato", "kurkku": "cucumber",
+    "kerma": "cream", "ruokakerma": "cream", "kuohukerma": "cream", "maito": "milk", "voi": "butter",
+    "juusto": "cheese", "jogurtti": "yoghurt", "rahka": "quark", "riisi": "rice", "kikherne": "chickpea",
+    "kikherneet": "chickpea", "linssi": "lentil", "linssit": "lentil", "herne": "pea", "herneet": "pea",
+    "papu": "bean", "pavut": "bean", "lohi": "salmon", "tonnikala": "tuna", "katkarapu": "shrimp",
+    "sokeri": "sugar", "suola": "salt", "pippuri": "pepper", "jauhot": "flour", "vehnäjauho": "flour",
+    "vehnäjauhot": "flour", "öljy": "oil", "oliiviöljy": "olive oil", "rypsiöljy": "rapeseed oil",
+    "sitruuna": "lemon", "limetti": "lime", "sieni": "mushroom", "sienet": "mushroom",
+    "herkkusieni": "mushroom", "kaali": "cabbage", "pinaatti": "spinach", "parsakaali": "broccoli",
+    "kukkakaali": "cauliflower", "kesäkurpitsa": "zucchini", "courgette": "zucchini",
+    "aubergine": "eggplant", "munakoiso": "eggplant", "leipä": "bread", "kookosmaito": "coconut milk",
+    "inkivääri": "ginger", "persilja": "parsley", "korianteri": "coriander", "basilika": "basil",
+    "tilli": "dill", "kaneli": "cinnamon", "hunaja": "honey", "omena": "apple", "banaani": "banana",
+}
+# fmt: on
+
+# Finnish partitive endings, singular and plural, as in "400 g jauhelihaa" or "kikherneitä"
+PARTITIVE_ENDINGS = ("itä", "ita", "tta", "ttä", "ta", "tä", "a", "ä")
+
+
+def singular(word: str) -> str:
+    """English singular of a word: tomatoes -> tomato, berries -> berry, onions -> onion"""
+    if len(word) <= 3 or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("oes", "ches", "shes", "sses", "xes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def synonym_form(word: str) -> str:
+    """The word as found in the synonyms, without a Finnish partitive ending, or the word itself"""
+    if word in SYNONYMS:
+        return word
+    for ending in PARTITIVE_ENDINGS:
+        if word.endswith(ending) and word[: -len(ending)] in SYNONYMS:
+            return word[: -len(ending)]
+    return word
+
+
+def canonical_word(word: str) -> str:
+    """Canonical name of a single word, through the synonyms, or else its singular"""
+    base = synonym_form(word)
+    return SYNONYMS[base] if base in SYNONYMS else singular(word)
+
+
+def ingredient_words(text: str) -> List[str]:
+    """Lowercased words of an ingredient line, without quantities, units, descriptors and preparation notes"""
+    # notes in parentheses and after a comma are preparation instructions
+    text = re.sub(r"\([^)]*\)", " ", str(text or "").lower()).split(",")[0]
+    return [word for word in WORD_PATTERN.findall(text) if word not in UNITS and word not in DESCRIPTORS]
+
+
+def canonical_ingredient(text: str) -> Optional[str]:
+    """
+    Canonical name of an ingredient line, e.g. "minced beef" for "500 g naudan jauhelihaa" or
+    "onion" for "2 onions, finely chopped". None if nothing but quantities and units is left.
+    """
+    words = ingredient_words(text)
+    if not words:
+        return None
+    phrase = " ".join(words)
+    # phrases may be inflected in their last word only, e.g. "naudan jauhelihaa"
+    for candidate in (phrase, " ".join(words[:-1] + [synonym_form(words[-1])])):
+        if candidate in SYNONYMS:
+            return SYNONYMS[candidate]
+    phrase = " ".join(canonical_word(word) for word in words)
+    return SYNONYMS.get(phrase, phrase)
+
+
+def ingredient_keys(ingredients: List[str]) -> List[str]:
+    """
+    ingredient_keys of a recipe: the canonical name of every ingredient and, for names of several
+    words, each word, so that "beef" also finds the recipes with minced beef
+    """
+    keys = []
+    for ingredient in ingredients or []:
+        name = canonical_ingredient(ingredient)
+        if name is None:
+            continue
+        for key in [name, *(name.split() if " " in name else [])]:
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def ingredient_query_keys(ingredients: List[str]) -> List[str]:
+    """Canonical names of the ingredients asked for, to match against ingredient_keys"""
+    keys = []
+    for ingredient in ingredients or []:
+        name = canonical_ingredient(ingredient)
+        if name is not None and name not in keys:
+            keys.append(name)
+    return keys
+
+
+def product_keys(name: str) -> List[str]:
+    """
+    Canonical ingredient names found in a product name from a receipt, such as "Pirkka naudan
+    jauheliha 10% 400g": the whole name, every two word phrase with a synonym, e.g. "minced beef",
+    and the canonical name of each word
+    """
+    words = ingredient_words(name)
+    if not words:
+        return []
+    keys = [canonical_ingredient(name)]
+    for first, second in zip(words, words[1:]):
+        for phrase in (f"{first} {second}", f"{first} {synonym_form(second)}", f"{first} {singular(second)}"):
+            if phrase in SYNONYMS:
+                keys.append(SYNONYMS[phrase])
+    keys.extend(canonical_word(word) for word in words)
+    return list(dict.fromkeys(keys))
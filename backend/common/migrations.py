@@ -0,0 +1,330 @@
+"""
+Online data migrations for the AI Agent Vision application.
+
+A migration transforms the documents of a collection in batches, in _id order, pausing between
+batches so that it does not compete with the application for the database. The progress of every
+migration is checkpointed in the migrations collection after each batch, so that a migration
+interrupted by a restart resumes after the last document it read. Migrations are idempotent: they
+select the documents that may need them and only write the ones they change, and a document updated
+by the application while its batch was being migrated is left alone, as the application writes it
+in the canonical form already.
+
+The server runs the pending migrations when it starts; they can also be run and inspected with:
+
+    python -m common.migrations run [name ...]
+    python -m common.migrations status
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from common.async_receipt_repository import merge_receipt_items
+from common.indexes import create_declared_indexes_async
+from common.ingredients import ingredient_keys
+from common.mongo_clients import mongo_clients
+from common.receipt_repository import (
+    RECEIPT_ITEMS_COLLECTION,
+    add_category_tokens,
+    parse_date_string,
+    receipt_fingerprint,
+    store_keys,
+)
+from common.recipe_repository import canonical_tags
+from common.recipe_vectors import EMBEDDING_MODEL, FIELD_WEIGHTS, recipe_vector_fields
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_COLLECTION = "migrations"
+
+MIGRATIONS_ENABLED = os.environ.get("MIGRATIONS_ENABLED", "true").lower() == "true"
+# documents read and written per batch, and the pause between batches
+MIGRATIONS_BATCH_SIZE = int(os.environ.get("MIGRATIONS_BATCH_SIZE", "200"))
+MIGRATIONS_BATCH_PAUSE_SECONDS = float(os.environ.get("MIGRATIONS_BATCH_PAUSE_SECONDS", "0.2"))
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    One migration: the documents of a collection it selects, the fields it reads, and the transform
+    returning the fields to $set on a document, or None when the document does not need to change.
+    """
+
+    name: str
+    collection: str
+    description: str
+    query: Dict[str, Any]
+    projection: Dict[str, Any]
+    transform: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+    # run once the migration has changed documents, e.g. to rebuild data derived from them
+    after: Optional[Callable[[Any], Awaitable[None]]] = None
+
+
+def normalize_receipt_date(document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Receipt date strings, left as strings when save_receipt could not parse them, as dates"""
+    receipt = {"receipt_data": dict(document.get("receipt_data") or {}), "items": document.get("items") or []}
+    date = parse_date_string(receipt["receipt_data"].get("date") or "")
+    if date is None:
+        return None
+    receipt["receipt_data"]["date"] = date
+    # the fingerprint of a receipt covers its parsed date
+    return {"receipt_data.date": date, "fingerprint": receipt_fingerprint(receipt)}
+
+
+def canonicalize_receipt_categories(document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Category values of the receipt items in the spelling of the taxonomy, e.g. Food rather than food"""
+    items = copy.deepcopy(document.get("items") or [])
+    add_category_tokens({"items": items})
+    return None if items == document.get("items") else {"items": items}
+
+
+def canonicalize_recipe_tags(document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Recipe tags lowercased and without repeats"""
+    tags = canonical_tags(document.get("tags"))
+    return None if tags == document.get("tags") else {"tags": tags}
+
+
+def add_receipt_fingerprint(document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Fingerprints of receipts saved before they were stored, so that imports skip them too"""
+    return {"fingerprint": receipt_fingerprint(document)}
+
+
+def add_receipt_store_keys(document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Store keys of receipts saved before store_keys was stored, for the store filter of the listings"""
+    return {"store_keys": store_keys(document)}
+
+
+def add_recipe_ingredient_keys(document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Canonical ingredient names of recipes saved before ingredient_keys was stored"""
+    return {"ingredient_keys": ingredient_keys(document.get("ingredients"))}
+
+
+async def rebuild_receipt_items(database):
+    """receipt_items copies the date and categories of the receipts"""
+    # the rows are merged on their unique receipt_id and line index
+    await create_declared_indexes_async(database[RECEIPT_ITEMS_COLLECTION])
+    stale = await merge_receipt_items(database)
+    logger.info(f"receipt_items rebuilt from the migrated receipts, {stale} stale rows removed")
+
+
+# run in this order; a migration is never run again once completed, so new ones are added at the end
+MIGRATIONS = [
+    Migration(
+        "receipts_date_normalization",
+        "receipts",
+        "receipt_data.date stored as a date instead of a string",
+        {"receipt_data.date": {"$type": "string"}},
+        {"receipt_data": 1, "items": 1, "updated_at": 1},
+        normalize_receipt_date,
+        after=rebuild_receipt_items,
+    ),
+    Migration(
+        "receipts_category_canonicalization",
+        "receipts",
+        "item category levels in the spelling of the taxonomy",
+        {"items.item_category": {"$type": "object"}},
+        {"items": 1, "updated_at": 1},
+        canonicalize_receipt_categories,
+        after=rebuild_receipt_items,
+    ),
+    Migration(
+        "recipes_tags_canonicalization",
+        "recipes",
+        "recipe tags lowercased and without repeats",
+        {"tags.0": {"$exists": True}},
+        {"tags": 1, "updated_at": 1},
+        canonicalize_recipe_tags,
+    ),
+    Migration(
+        "recipes_ingredient_keys",
+        "recipes",
+        "canonical ingredient names stored as ingredient_keys",
+        {"ingredient_keys": {"$exists": False}},
+        {"ingredients": 1, "updated_at": 1},
+        add_recipe_ingredient_keys,
+    ),
+    Migration(
+        "recipes_embedding_hashing_v1",
+        "recipes",
+        f"recipe vectors for the semantic search, embedded with {EMBEDDING_MODEL}",
+        {"embedding_model": {"$ne": EMBEDDING_MODEL}},
+        {"cooking_time": 1, "preparation_time": 1, "updated_at": 1, **{field: 1 for field in FIELD_WEIGHTS}},
+        recipe_vector_fields,
+    ),
+    Migration(
+        "receipts_store_keys",
+        "receipts",
+        "words of the receipt place stored as store_keys",
+        {"store_keys": {"$exists": False}},
+        {"receipt_data.place": 1, "updated_at": 1},
+        add_receipt_store_keys,
+    ),
+    Migration(
+        "receipts_fingerprint",
+        "receipts",
+        "content fingerprint stored for the receipts saved before imports deduplicated them",
+        {"fingerprint": {"$exists": False}},
+        {"receipt_data": 1, "items": 1, "updated_at": 1},
+        add_receipt_fingerprint,
+    ),
+]
+
+
+def get_migration(name: str) -> Migration:
+    for migration in MIGRATIONS:
+        if migration.name == name:
+            return migration
+    raise ValueError(f"Unknown migration: {name}")
+
+
+def migration_updates(migration: Migration, documents: List[Dict[str, Any]]) -> List[UpdateOne]:
+    """
+    Updates for the documents of a batch that the migration changes. Each update only applies if the
+    document was not updated since it was read, and sets updated_at so that readers of recently
+    updated documents see the migrated ones too.
+    """
+    now = datetime.now(UTC)
+    updates = []
+    for document in documents:
+        fields = migration.transform(document)
+        if fields:
+            updates.append(
+                UpdateOne(
+                    {"_id": document["_id"], "updated_at": document.get("updated_at")},
+                    {"$set": {**fields, "updated_at": now}},
+                )
+            )
+    return updates
+
+
+def batch_query(migration: Migration, last_id: Any) -> Dict[str, Any]:
+    """Query for the documents after the checkpoint"""
+    if last_id is None:
+        return migration.query
+    return {"$and": [migration.query, {"_id": {"$gt": last_id}}]}
+
+
+async def run_migration(
+    migration: Migration,
+    database=None,
+    batch_size: int = MIGRATIONS_BATCH_SIZE,
+    pause_seconds: float = MIGRATIONS_BATCH_PAUSE_SECONDS,
+) -> Dict[str, Any]:
+    """
+    Run a migration from its checkpoint until no documents are left, checkpointing after every batch.
+
+    Returns:
+        The checkpoint of the migration: status (completed or failed), last_id, and the number of
+        documents scanned and modified
+    """
+    database = database if database is not None else mongo_clients.async_db
+    checkpoints = database[MIGRATIONS_COLLECTION]
+    collection = database[migration.collection]
+
+    state = await checkpoints.find_one({"_id": migration.name}) or {}
+    if state.get("status") == "completed":
+        return state
+
+    state = {
+        "_id": migration.name,
+        "status": "running",
+        "last_id": state.get("last_id"),
+        "scanned": state.get("scanned", 0),
+        "modified": state.get("modified", 0),
+        "started_at": state.get("started_at") or datetime.now(UTC),
+        "error": None,
+    }
+
+    async def checkpoint(**fields):
+        state.update(fields, updated_at=datetime.now(UTC))
+        await checkpoints.replace_one({"_id": migration.name}, state, upsert=True)
+
+    try:
+        await checkpoint()
+        if state["last_id"] is not None:
+            logger.info(f"Migration {migration.name} resuming after {state['last_id']}")
+        while True:
+            cursor = collection.find(batch_query(migration, state["last_id"]), migration.projection)
+            documents = await cursor.sort("_id", pymongo.ASCENDING).limit(batch_size).to_list(length=batch_size)
+            if not documents:
+                break
+            updates = migration_updates(migration, documents)
+            modified = (await collection.bulk_write(updates, ordered=False)).modified_count if updates else 0
+            await checkpoint(
+                last_id=documents[-1]["_id"], scanned=state["scanned"] + len(documents), modified=state["modified"] + modified
+            )
+            await asyncio.sleep(pause_seconds)
+
+        if migration.after and state["modified"]:
+            await migration.after(database)
+        await checkpoint(status="completed", completed_at=datetime.now(UTC))
+        logger.info(f"Migration {migration.name} completed: {state['scanned']} scanned, {state['modified']} modified")
+    except PyMongoError as e:
+        logger.error(f"Migration {migration.name} failed, it resumes from its checkpoint on the next run: {str(e)}")
+        try:
+            await checkpoint(status="failed", error=str(e))
+        except PyMongoError:
+            pass
+    return state
+
+
+async def run_migrations(names: List[str] = None, database=None) -> List[Dict[str, Any]]:
+    """
+    Run the pending migrations in order, or the named ones, called when the server starts. A failed
+    migration stops the ones after it, as they may depend on it.
+    """
+    migrations = [get_migration(name) for name in names] if names else MIGRATIONS
+    results = []
+    for migration in migrations:
+        state = await run_migration(migration, database)
+        results.append(state)
+        if state.get("status") != "completed":
+            break
+    return results
+
+
+async def migrations_status(database=None) -> List[Dict[str, Any]]:
+    """The checkpoint of every migration, pending for the ones that never ran"""
+    database = database if database is not None else mongo_clients.async_db
+    checkpoints = {state["_id"]: state async for state in database[MIGRATIONS_COLLECTION].find()}
+    return [
+        {
+            "name": migration.name,
+            "collection": migration.collection,
+            "description": migration.description,
+            **{key: value for key, value in checkpoints.get(migration.name, {"status": "pending"}).items() if key != "_id"},
+        }
+        for migration in MIGRATIONS
+    ]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run the data migrations, or show their progress")
+    parser.add_argument("command", choices=["run", "status"])
+    parser.add_argument("names", nargs="*", help="migrations to run, all the pending ones by default")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "run":
+            results = await run_migrations(args.names or None)
+            print(json.dumps(results, indent=2, default=str))
+            return 0 if all(result.get("status") == "completed" for result in results) else 1
+
+        print(json.dumps(await migrations_status(), indent=2, default=str))
+        return 0
+    finally:
+        mongo_clients.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main()))
@@ -0,0 +1,206 @@
+"""
+Process-wide MongoDB clients for the AI Agent Vision application.
+
+A single async (motor) client and a single synchronous (pymongo) client are shared by all modules,
+so that each worker keeps one connection pool per flavour. Clients are created on first use, or
+when the server starts them from its lifespan, and never at import time.
+"""
+
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, monitoring
+
+logger = logging.getLogger(__name__)
+
+MONGO_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("MONGODB_DATABASE", "receipts")
+
+# Connection pool settings shared by both clients
+MONGODB_MAX_POOL_SIZE = int(os.environ.get("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.environ.get("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_MAX_IDLE_TIME_MS = int(os.environ.get("MONGODB_MAX_IDLE_TIME_MS", "0"))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGODB_CONNECT_TIMEOUT_MS", "20000"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "0"))
+
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": MONGODB_MIN_POOL_SIZE,
+        "connectTimeoutMS": MONGODB_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    # zero means no limit, which is the driver default but not an accepted value
+    if MONGODB_MAX_IDLE_TIME_MS:
+        options["maxIdleTimeMS"] = MONGODB_MAX_IDLE_TIME_MS
+    if MONGODB_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = MONGODB_WAIT_QUEUE_TIMEOUT_MS
+    return options
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool counters per server address: open and checked out connections, and the number
+    and duration of checkouts, including how long callers waited for a connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = defaultdict(
+            lambda: {
+                "open_connections": 0,
+                "checked_out": 0,
+                "max_checked_out": 0,
+                "checkouts": 0,
+                "failed_checkouts": 0,
+                "total_wait_seconds": 0.0,
+                "max_wait_seconds": 0.0,
+                "pool_cleared": 0,
+            }
+        )
+
+    def _pool(self, event) -> dict:
+        return self._pools[f"{event.address[0]}:{event.address[1]}"]
+
+    def _wait(self, pool: dict, duration):
+        if duration is not None:
+            pool["total_wait_seconds"] += duration
+            pool["max_wait_seconds"] = max(pool["max_wait_seconds"], duration)
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event)["open_connections"] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._pool(event)["open_connections"] -= 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            pool = self._pool(event)
+            pool["checkouts"] += 1
+            pool["checked_out"] += 1
+            pool["max_checked_out"] = max(pool["max_checked_out"], pool["checked_out"])
+            self._wait(pool, event.duration)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            pool = self._pool(event)
+            pool["failed_checkouts"] += 1
+            self._wait(pool, event.duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event)["checked_out"] -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event)["pool_cleared"] += 1
+
+    # the remaining pool events are not tracked
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = {}
+            for address, pool in self._pools.items():
+                average_wait = pool["total_wait_seconds"] / pool["checkouts"] if pool["checkouts"] else 0.0
+                pools[address] = {
+                    **pool,
+                    "total_wait_seconds": round(pool["total_wait_seconds"], 6),
+                    "max_wait_seconds": round(pool["max_wait_seconds"], 6),
+                    "average_wait_seconds": round(average_wait, 6),
+                }
+            return pools
+
+
+class LazyDatabase:
+    """Stand-in for a database at module level, resolving the shared client on every access."""
+
+    def __init__(self, get_database):
+        self._get_database = get_database
+
+    def __getitem__(self, name):
+        """Get a collection, like Database[name]."""
+        return self._get_database()[name]
+
+    def __getattr__(self, name):
+        """Delegate collections and database methods to the shared database."""
+        return getattr(self._get_database(), name)
+
+
+class MongoClients:
+    """Owns the process-wide async and synchronous MongoDB clients and their pool metrics."""
+
+    def __init__(self, uri: str = MONGO_URI, database: str = DB_NAME):
+        self.uri = uri
+        self.database = database
+        self._async_client = None
+        self._sync_client = None
+        self.async_metrics = PoolMetrics()
+        self.sync_metrics = PoolMetrics()
+        self.async_db = LazyDatabase(self.get_async_database)
+        self.sync_db = LazyDatabase(self.get_sync_database)
+
+    def get_async_client(self) -> AsyncIOMotorClient:
+        if self._async_client is None:
+            self._async_client = AsyncIOMotorClient(self.uri, event_listeners=[self.async_metrics], **client_options())
+            logger.info(f"Async MongoDB client created for {self.uri} with {client_options()}")
+        return self._async_client
+
+    def get_sync_client(self) -> MongoClient:
+        if self._sync_client is None:
+            self._sync_client = MongoClient(self.uri, event_listeners=[self.sync_metrics], **client_options())
+            logger.info(f"MongoDB client created for {self.uri} with {client_options()}")
+        return self._sync_client
+
+    def get_async_database(self, name: str = None):
+        return self.get_async_client()[name or self.database]
+
+    def get_sync_database(self, name: str = None):
+        return self.get_sync_client()[name or self.database]
+
+    def is_shared(self, client) -> bool:
+        return client is not None and (client is self._async_client or client is self._sync_client)
+
+    def start(self):
+        """Create the async client up front, called from the server lifespan."""
+        self.get_async_client()
+
+    def close(self):
+        """Close both clients; they are created again on next use."""
+        if self._async_client is not None:
+            self._async_client.close()
+            self._async_client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+        logger.info("MongoDB clients closed")
+
+    def stats(self) -> dict:
+        return {
+            "options": client_options(),
+            "async": {"started": self._async_client is not None, "pools": self.async_metrics.stats()},
+            "sync": {"started": self._sync_client is not None, "pools": self.sync_metrics.stats()},
+        }
+
+
+mongo_clients = MongoClients()
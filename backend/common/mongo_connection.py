@@ -11,6 +11,9 @@ from pymongo import MongoClient
 from pymongo.database import Database
 from pymongo.errors import ConnectionFailure, PyMongoError
 
+from common.indexes import create_declared_indexes
+from common.mongo_clients import mongo_clients
+
 logger = logging.getLogger(__name__)
 
 
@@ -61,7 +64,9 @@ class MongoConnection:
         """
         if self._client is None:
             try:
-                self._client = MongoClient(self.connection_params.get("uri"))
+                # the process-wide client is shared unless another server is asked for
+                uri = self.connection_params.get("uri")
+                self._client = mongo_clients.get_sync_client() if uri == mongo_clients.uri else MongoClient(uri)
                 # Test the connection
                 self._client.admin.command("ping")
                 self._db = self._client[self.connection_params.get("database")]
@@ -72,13 +77,12 @@ class MongoConnection:
 
         return self._db
 
-    def initialize_collection(self, collection_name: str, indexes=None):
+    def initialize_collection(self, collection_name: str):
         """
-        Create a collection if it doesn't exist and set up indexes.
+        Create a collection if it doesn't exist and set up its indexes, as declared in common.indexes.
 
         Args:
             collection_name: Name of the collection to initialize
-            indexes: List of index specifications to create
         """
         try:
             db = self.get_database()
@@ -87,23 +91,7 @@ class MongoConnection:
             # We can create indexes to optimize queries
             collection = db[collection_name]
 
-            # Create indexes if specified
-            if indexes:
-                for index_spec in indexes:
-                    try:
-                        # Check if this is a compound text index format: ([('field1', 'text'), ('field2', 'text')],)
-                        if isinstance(index_spec, tuple) and len(index_spec) == 1 and isinstance(index_spec[0], list):
-                            collection.create_index(index_spec[0])
-                        # Check if this is a standard single field index: (('field_name', 1),)
-                        elif isinstance(index_spec, tuple) and len(index_spec) == 1 and isinstance(index_spec[0], tuple):
-                            field_name, direction = index_spec[0]
-                            collection.create_index([(field_name, direction)])
-                        # Default case: just pass the index specification directly
-                        else:
-                            collection.create_index(index_spec)
-                    except Exception as ex:
-                        logger.error(f"Error creating index {index_spec}: {str(ex)}")
-                        raise
+            create_declared_indexes(collection)
 
             logger.info(f"MongoDB collection '{collection_name}' initialized successfully")
         except PyMongoError as e:
@@ -113,7 +101,9 @@ class MongoConnection:
     def close(self):
         """Close the MongoDB connection."""
         if self._client:
-            self._client.close()
+            # the shared client stays open for the other users, mongo_clients closes it
+            if not mongo_clients.is_shared(self._client):
+                self._client.close()
             self._client = None
             self._db = None
             logger.info("MongoDB connection closed")
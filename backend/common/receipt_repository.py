@@ -3,20 +3,568 @@ Receipt repository implementation for the AI Agent Vision application.
 This module provides a MongoDB implementation for storing and retrieving receipts.
 """
 
+import base64
+import copy
+import hashlib
 import json
 import logging
+import os
 import re
-from datetime import UTC, datetime
+import string
+from datetime import UTC, datetime, timedelta
 from typing import Any, Dict, List, Optional
 
 import pymongo
 from bson import ObjectId
-from pymongo.errors import PyMongoError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
 from common.mongo_connection import MongoConnection
 
 logger = logging.getLogger(__name__)
 
+# receipts on the same day whose totals differ by less than this are considered the same purchase
+RECEIPT_TOTAL_TOLERANCE = 0.01
+
+# one document per line item, derived from the receipts, see receipt_item_documents
+RECEIPT_ITEMS_COLLECTION = "receipt_items"
+
+# line item fields copied to the receipt_items documents
+RECEIPT_ITEM_FIELDS = (
+    "name_fi",
+    "name_en",
+    "unit_of_measure",
+    "unit_price",
+    "total_price",
+    "quantity",
+    "loyalty_discount",
+    "has_loyalty_discount",
+)
+
+CATEGORY_LEVELS = ("level_1", "level_2", "level_3")
+
+# formats of receipt dates, tried in order: the receipt analysis is asked for YYYY-MM-DD, receipts print DD.MM.YYYY
+RECEIPT_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%d.%m.%Y",
+    "%d.%m.%y",
+    "%d.%m.%Y %H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y",
+    "%Y/%m/%d",
+)
+
+# number of receipts written per insert_many call by save_receipts_bulk
+RECEIPTS_IMPORT_CHUNK_SIZE = int(os.environ.get("RECEIPTS_IMPORT_CHUNK_SIZE", "500"))
+
+# top-level receipt fields that can be requested from the paginated listing
+RECEIPT_FIELDS = ("receipt_data", "items")
+
+RECEIPTS_PAGE_SORT = [("created_at", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+
+
+def parse_receipt_date(receipt_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convert the date string of a receipt to a MongoDB Date object if it exists, in place
+
+    Args:
+        receipt_data: Receipt dictionary with receipt_data and items
+
+    Returns:
+        The same receipt dictionary
+    """
+    if "receipt_data" in receipt_data and "date" in receipt_data["receipt_data"]:
+        date_str = receipt_data["receipt_data"]["date"]
+        if date_str and isinstance(date_str, str):
+            date = parse_date_string(date_str)
+            if date is None:
+                # Keep original string if parsing fails
+                logger.warning(f"Could not parse date: {date_str}, keeping as string")
+            else:
+                receipt_data["receipt_data"]["date"] = date
+    return receipt_data
+
+
+def parse_date_string(date_str: str) -> Optional[datetime]:
+    """Day of a receipt date string in one of RECEIPT_DATE_FORMATS, or None if it has none of them"""
+    for date_format in RECEIPT_DATE_FORMATS:
+        try:
+            date = datetime.strptime(date_str.strip(), date_format)
+        except ValueError:
+            continue
+        return datetime(date.year, date.month, date.day)
+    return None
+
+
+def canonical_category_value(value: Any) -> Any:
+    """
+    Spelling of a category value as in the taxonomy of the receipt analysis, e.g. Fish & Seafood for
+    "fish &  SEAFOOD": words capitalized and whitespace collapsed. Empty values become None.
+    """
+    if not isinstance(value, str):
+        return value
+    return string.capwords(value) or None
+
+
+def canonicalize_category(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Canonicalize the category levels of an item in place, see canonical_category_value"""
+    category = item.get("item_category")
+    if isinstance(category, dict):
+        for level in CATEGORY_LEVELS:
+            if level in category:
+                category[level] = canonical_category_value(category[level])
+    return item
+
+
+def category_tokens(item: Dict[str, Any]) -> List[str]:
+    """Lowercased words of the category levels of an item, e.g. ["food", "grains", "pasta"] for Food / Grains & Pasta"""
+    category = item.get("item_category")
+    if not isinstance(category, dict):
+        return []
+
+    tokens = []
+    for level in CATEGORY_LEVELS:
+        for token in re.findall(r"\w+", str(category.get(level) or "").lower()):
+            if token not in tokens:
+                tokens.append(token)
+    return tokens
+
+
+def add_category_tokens(receipt_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Canonicalize the category of every item of a receipt and store its tokens in items.category_tokens,
+    in place, so that items can be looked up by category through an index
+
+    Args:
+        receipt_data: Receipt dictionary with receipt_data and items
+
+    Returns:
+        The same receipt dictionary
+    """
+    for item in receipt_data.get("items") or []:
+        if isinstance(item, dict):
+            item["category_tokens"] = category_tokens(canonicalize_category(item))
+    return receipt_data
+
+
+def parse_receipt_dates(receipts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Convert the date strings of a batch of receipts in place, like parse_receipt_date, parsing each
+    distinct date string only once
+
+    Args:
+        receipts: List of receipt dictionaries with receipt_data and items
+
+    Returns:
+        The same list of receipts
+    """
+    parsed_dates = {}
+    for receipt in receipts:
+        date_str = receipt.get("receipt_data", {}).get("date")
+        if not isinstance(date_str, str) or not date_str:
+            continue
+        if date_str not in parsed_dates:
+            parsed_dates[date_str] = parse_receipt_date({"receipt_data": {"date": date_str}})["receipt_data"]["date"]
+        receipt["receipt_data"]["date"] = parsed_dates[date_str]
+    return receipts
+
+
+def receipt_fingerprint(receipt: Dict[str, Any]) -> str:
+    """
+    Fingerprint of the content of a receipt, after date parsing: date, place, total and the items with their prices.
+    The same purchase imported twice, or imported after being uploaded, has the same fingerprint.
+    """
+    receipt_data = receipt.get("receipt_data") or {}
+    date = receipt_data.get("date")
+    items = sorted(
+        [str(item.get("name_fi") or item.get("name_en") or "").strip().lower(), item.get("total_price")]
+        for item in receipt.get("items") or []
+    )
+    content = [
+        date.date().isoformat() if isinstance(date, datetime) else date,
+        str(receipt_data.get("place") or "").strip().lower(),
+        receipt_data.get("total"),
+        items,
+    ]
+    return hashlib.sha1(json.dumps(content, default=str).encode()).hexdigest()
+
+
+def similar_receipts_query(receipt: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Query for the receipts with the same date and total as the given receipt, after date parsing.
+    None if the receipt has no parsed date or no total to compare.
+    """
+    receipt_data = receipt.get("receipt_data") or {}
+    date, total = receipt_data.get("date"), receipt_data.get("total")
+    if not isinstance(date, datetime) or not isinstance(total, (int, float)):
+        return None
+
+    day = datetime(date.year, date.month, date.day)
+    return {
+        "receipt_data.date": {"$gte": day, "$lt": day + timedelta(days=1)},
+        "receipt_data.total": {"$gte": total - RECEIPT_TOTAL_TOLERANCE, "$lte": total + RECEIPT_TOTAL_TOLERANCE},
+    }
+
+
+def store_keys(receipt: Dict[str, Any]) -> List[str]:
+    """
+    Keys of the place of a receipt matched by the store filter of the receipt listings: its lowercased words
+    from each word on, e.g. ["k citymarket espoo", "citymarket espoo", "espoo"] for K-Citymarket Espoo
+    """
+    words = re.findall(r"\w+", str((receipt.get("receipt_data") or {}).get("place") or "").lower())
+    return [" ".join(words[start:]) for start in range(len(words))]
+
+
+def store_condition(store: str) -> Optional[Dict[str, Any]]:
+    """
+    Condition of the receipt listings for the receipts of a store. The words of store must start a word of
+    the place and follow on from it, ignoring case and punctuation: "Citymarket" and "k-citymarket espoo"
+    match K-Citymarket Espoo, "market" does not. The condition is an anchored prefix of the stored
+    store_keys, so that it is answered from their index. None if store has no words, which filters nothing.
+    """
+    # words and single spaces only, so there is nothing to escape
+    key = " ".join(re.findall(r"\w+", str(store or "").lower()))
+    if not key:
+        return None
+    return {"store_keys": {"$regex": f"^{key}"}}
+
+
+def is_same_place(place: Optional[str], other: Optional[str]) -> bool:
+    """
+    Whether two receipt places name the same store, ignoring case and punctuation, and allowing one to be
+    a shorter form of the other (K-Citymarket and K-Citymarket Espoo Sello). An unknown place matches no place,
+    as nothing tells two purchases of the same day and total apart then.
+    """
+    words = " ".join(re.findall(r"\w+", str(place or "").lower()))
+    other_words = " ".join(re.findall(r"\w+", str(other or "").lower()))
+    return bool(words and other_words) and (words in other_words or other_words in words)
+
+
+def receipt_from_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Format a MongoDB document into a receipt dictionary with id, created_at, updated_at, and data fields
+
+    Args:
+        document: MongoDB document
+
+    Returns:
+        Receipt dictionary ready for JSON serialization
+    """
+    # Convert MongoDB date objects to ISO format strings for JSON serialization
+    receipt_data = document.get("receipt_data", {})
+    # category tokens are only used for lookups
+    items = [
+        {key: value for key, value in item.items() if key != "category_tokens"} if isinstance(item, dict) else item
+        for item in document.get("items", [])
+    ]
+
+    # Convert MongoDB date to string if it's a datetime object
+    if "date" in receipt_data and isinstance(receipt_data["date"], datetime):
+        receipt_data["date"] = receipt_data["date"].strftime("%d.%m.%Y")
+
+    return {
+        "id": str(document["_id"]),
+        "created_at": document["created_at"].isoformat(),
+        "updated_at": document["updated_at"].isoformat(),
+        "data": {"receipt_data": receipt_data, "items": items},
+    }
+
+
+def receipts_by_date_query(start_date: str, end_date: str, store: str = None) -> Dict[str, Any]:
+    """
+    Query for receipts dated from start_date to end_date (both YYYY-MM-DD, inclusive), optionally only
+    from the stores whose name contains store, ignoring case (e.g. "citymarket" for K-Citymarket Sello)
+    """
+    start_date_dt = datetime.strptime(start_date, "%Y-%m-%d")
+    end_date_dt = datetime.strptime(end_date, "%Y-%m-%d")
+
+    # Adjust end_date to include the entire day
+    end_date_dt = datetime(end_date_dt.year, end_date_dt.month, end_date_dt.day, 23, 59, 59)
+
+    # Query using receipt_data.date field instead of created_at
+    query = {"receipt_data.date": {"$gte": start_date_dt, "$lte": end_date_dt}}
+    query.update(store_condition(store) or {})
+    return query
+
+
+def encode_receipts_cursor(document: Dict[str, Any]) -> str:
+    """Opaque cursor pointing right after the given document in the paginated listing"""
+    position = json.dumps({"created_at": document["created_at"].isoformat(), "id": str(document["_id"])})
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_receipts_cursor(cursor: str) -> Dict[str, Any]:
+    """
+    Keyset condition for the documents after the cursor
+
+    Raises:
+        ValueError: if the cursor is not one returned by encode_receipts_cursor
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = datetime.fromisoformat(position["created_at"])
+        receipt_id = ObjectId(position["id"])
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+    return {"$or": [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "_id": {"$lt": receipt_id}}]}
+
+
+def receipts_page_query(cursor: str = None, start_date: str = None, end_date: str = None, store: str = None) -> Dict[str, Any]:
+    """Query for one page of the receipts listing, optionally filtered by date (YYYY-MM-DD, inclusive) and store"""
+    conditions = []
+    if cursor:
+        conditions.append(decode_receipts_cursor(cursor))
+    if start_date:
+        conditions.append({"receipt_data.date": {"$gte": datetime.strptime(start_date, "%Y-%m-%d")}})
+    if end_date:
+        # include the entire end day
+        end_date_dt = datetime.strptime(end_date, "%Y-%m-%d")
+        end_date_dt = datetime(end_date_dt.year, end_date_dt.month, end_date_dt.day, 23, 59, 59)
+        conditions.append({"receipt_data.date": {"$lte": end_date_dt}})
+    store_filter = store_condition(store)
+    if store_filter:
+        conditions.append(store_filter)
+    return {"$and": conditions} if conditions else {}
+
+
+def receipts_projection(fields: List[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Projection for the requested fields, e.g. ["receipt_data"] for the receipt headers without items,
+    or ["receipt_data.date", "receipt_data.total"]. created_at and updated_at are always included.
+
+    Raises:
+        ValueError: if a field is not part of a receipt
+    """
+    if not fields:
+        return None
+    for field in fields:
+        if field.split(".")[0] not in RECEIPT_FIELDS:
+            raise ValueError(f"Unknown receipt field: {field}")
+    return {"created_at": 1, "updated_at": 1, **{field: 1 for field in fields}}
+
+
+def receipts_page(documents: List[Dict[str, Any]], limit: int, fields: List[str] = None) -> Dict[str, Any]:
+    """Format up to limit + 1 documents into a page of receipts and the cursor of the next page"""
+    next_cursor = encode_receipts_cursor(documents[limit - 1]) if len(documents) > limit else None
+    receipts = []
+    for document in documents[:limit]:
+        receipt = receipt_from_document(document)
+        # items sub-fields, such as items.name_en, keep the items with just those fields
+        if fields and not any(field == "items" or field.startswith("items.") for field in fields):
+            del receipt["data"]["items"]
+        receipts.append(receipt)
+    return {"receipts": receipts, "next_cursor": next_cursor}
+
+
+def receipt_item_documents(receipt_id: ObjectId, receipt: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    receipt_items documents of a receipt: one per line item, with the date and store of the receipt,
+    the category levels and tokens and the prices of the item
+
+    Args:
+        receipt_id: _id of the receipt document
+        receipt: Receipt dictionary with receipt_data and items, after date parsing
+    """
+    receipt_data = receipt.get("receipt_data") or {}
+    documents = []
+    for line, item in enumerate(receipt.get("items") or []):
+        if not isinstance(item, dict):
+            continue
+        category = item.get("item_category") if isinstance(item.get("item_category"), dict) else {}
+        documents.append(
+            {
+                "receipt_id": receipt_id,
+                "line": line,
+                "date": receipt_data.get("date"),
+                "store": receipt_data.get("place"),
+                **{field: item.get(field) for field in RECEIPT_ITEM_FIELDS},
+                **{level: category.get(level) for level in CATEGORY_LEVELS},
+                "category_tokens": item.get("category_tokens") or category_tokens(item),
+            }
+        )
+    return documents
+
+
+# Rebuilds receipt_items from the receipts, with the same documents as receipt_item_documents. The
+# rows are merged by receipt and line rather than replacing the collection, so that the rows of
+# receipts written while it runs are kept; STALE_RECEIPT_ITEMS_PIPELINE finds the rows left over.
+RECEIPT_ITEMS_PIPELINE = [
+    {"$unwind": {"path": "$items", "includeArrayIndex": "line"}},
+    {"$match": {"items": {"$type": "object"}}},
+    {
+        "$project": {
+            "_id": 0,
+            "receipt_id": "$_id",
+            "line": 1,
+            "date": "$receipt_data.date",
+            "store": "$receipt_data.place",
+            **{field: f"$items.{field}" for field in RECEIPT_ITEM_FIELDS},
+            **{level: f"$items.item_category.{level}" for level in CATEGORY_LEVELS},
+            "category_tokens": {"$ifNull": ["$items.category_tokens", []]},
+        }
+    },
+    {
+        "$merge": {
+            "into": RECEIPT_ITEMS_COLLECTION,
+            "on": ["receipt_id", "line"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }
+    },
+]
+
+# receipt_items rows whose receipt was deleted, or whose line is past the items of their receipt
+STALE_RECEIPT_ITEMS_PIPELINE = [
+    {
+        "$lookup": {
+            "from": "receipts",
+            "localField": "receipt_id",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {"lines": {"$size": {"$cond": [{"$isArray": "$items"}, "$items", []]}}}}],
+            "as": "receipt",
+        }
+    },
+    {"$match": {"$expr": {"$gte": ["$line", {"$ifNull": [{"$first": "$receipt.lines"}, 0]}]}}},
+    {"$project": {"_id": 1}},
+]
+
+
+def items_per_item_type_query(item_type: str) -> Optional[Dict[str, Any]]:
+    """
+    receipt_items query for the items whose category matches the item type at any level. Every word of
+    the item type must start one of the category tokens of the item, so "vegetable" matches Vegetables
+    and "pasta" matches Grains & Pasta. The anchored patterns use the category_tokens index.
+    None if the item type has no words.
+    """
+    tokens = re.findall(r"\w+", item_type.lower())
+    if not tokens:
+        return None
+    return {"category_tokens": {"$all": [re.compile(f"^{re.escape(token)}") for token in tokens]}}
+
+
+def backfill_category_tokens_query() -> Dict[str, Any]:
+    """Query for the receipts saved before items had category tokens"""
+    return {"items": {"$elemMatch": {"category_tokens": {"$exists": False}}}}
+
+
+def category_tokens_update(document: Dict[str, Any]) -> UpdateOne:
+    """Update adding the category tokens to the items of a receipt document"""
+    items = add_category_tokens({"items": document["items"]})["items"]
+    return UpdateOne({"_id": document["_id"]}, {"$set": {"items": items}})
+
+
+def load_receipts_export(text: str) -> List[Any]:
+    """
+    Read the receipts of an export file: a JSON list of receipts, an object with a receipts list,
+    or one receipt per line (JSON Lines). Each receipt has receipt_data and items, as saved by save_receipt.
+
+    Raises:
+        ValueError: if the text is not in any of these formats
+    """
+    try:
+        content = json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Receipts export is neither JSON nor JSON Lines: {str(e)}") from e
+
+    if isinstance(content, dict) and isinstance(content.get("receipts"), list):
+        return content["receipts"]
+    if isinstance(content, dict):
+        return [content]
+    if isinstance(content, list):
+        return content
+    raise ValueError("Receipts export must contain a list of receipts")
+
+
+def prepare_receipts_import(receipts: List[Any], current_time: datetime) -> tuple:
+    """
+    Validate and normalize a batch of receipts for save_receipts_bulk, dropping repeats within the batch
+
+    Args:
+        receipts: Receipt dictionaries or JSON strings, each with receipt_data and items
+        current_time: created_at and updated_at of the new documents
+
+    Returns:
+        Tuple of the (position in batch, document) pairs to insert and the import report, with
+        the receipts that could not be read already counted as failed
+    """
+    report = {"received": len(receipts), "inserted": 0, "duplicates": 0, "failed": []}
+    valid = []
+    for index, receipt in enumerate(receipts):
+        try:
+            if isinstance(receipt, str):
+                receipt = json.loads(receipt)
+            if not isinstance(receipt, dict) or not isinstance(receipt.get("receipt_data"), dict):
+                raise ValueError("receipt_data is missing")
+            if not isinstance(receipt.get("items"), list):
+                raise ValueError("items is missing")
+            valid.append((index, receipt))
+        except ValueError as e:
+            report["failed"].append({"index": index, "error": str(e)})
+
+    parse_receipt_dates([receipt for _, receipt in valid])
+    for _, receipt in valid:
+        add_category_tokens(receipt)
+
+    documents = []
+    fingerprints = set()
+    for index, receipt in valid:
+        fingerprint = receipt_fingerprint(receipt)
+        if fingerprint in fingerprints:
+            report["duplicates"] += 1
+            continue
+        fingerprints.add(fingerprint)
+        documents.append(
+            (
+                index,
+                {
+                    "receipt_data": receipt["receipt_data"],
+                    "items": receipt["items"],
+                    "fingerprint": fingerprint,
+                    "store_keys": store_keys(receipt),
+                    "created_at": current_time,
+                    "updated_at": current_time,
+                },
+            )
+        )
+    return documents, report
+
+
+def without_existing_receipts(documents: List[tuple], existing_fingerprints: set, report: Dict[str, Any]) -> List[tuple]:
+    """Drop the documents whose fingerprint is already stored, counting them as duplicates in the report"""
+    new_documents = [
+        (index, document) for index, document in documents if document["fingerprint"] not in existing_fingerprints
+    ]
+    report["duplicates"] += len(documents) - len(new_documents)
+    return new_documents
+
+
+def record_bulk_write_error(report: Dict[str, Any], chunk: List[tuple], error: PyMongoError) -> List[tuple]:
+    """
+    Count the outcome of an unordered insert_many that raised: with a BulkWriteError the other documents
+    of the chunk were inserted and only the failed ones are reported, otherwise the whole chunk failed.
+    Returns the (position in batch, document) pairs of the chunk that were inserted.
+    """
+    if not isinstance(error, BulkWriteError):
+        report["failed"].extend({"index": index, "error": str(error)} for index, _ in chunk)
+        return []
+
+    report["inserted"] += error.details.get("nInserted", 0)
+    failed = set()
+    for write_error in error.details.get("writeErrors", []):
+        failed.add(write_error["index"])
+        index, _ = chunk[write_error["index"]]
+        report["failed"].append({"index": index, "error": write_error.get("errmsg", "write error")})
+    return [pair for offset, pair in enumerate(chunk) if offset not in failed]
+
+
+def chunked(sequence: List[Any], size: int) -> List[List[Any]]:
+    return [sequence[start : start + size] for start in range(0, len(sequence), size)]
+
 
 class ReceiptRepository:
     """
@@ -39,7 +587,8 @@ class ReceiptRepository:
         """Create the receipts collection if it doesn't exist and set up indexes"""
         try:
             # Create the collection with a descending index on created_at
-            self.mongo_connection.initialize_collection("receipts", indexes=[(("created_at", pymongo.DESCENDING),)])
+            self.mongo_connection.initialize_collection("receipts")
+            self.mongo_connection.initialize_collection(RECEIPT_ITEMS_COLLECTION)
             logger.info("Receipt repository initialized successfully")
         except PyMongoError as e:
             logger.error(f"Error initializing receipt repository: {str(e)}")
@@ -50,13 +599,29 @@ class ReceiptRepository:
         """Get the receipts collection from the MongoDB database"""
         return self.mongo_connection.get_database().receipts
 
+    @property
+    def receipt_items_collection(self):
+        """Get the receipt_items collection from the MongoDB database"""
+        return self.mongo_connection.get_database()[RECEIPT_ITEMS_COLLECTION]
+
+    def replace_receipt_items(self, receipt_id: ObjectId, receipt: Dict[str, Any] = None):
+        """
+        Keep receipt_items in sync with a receipt: replace the line items of the receipt with those of
+        the given receipt, or remove them when the receipt is None (deleted)
+        """
+        self.receipt_items_collection.delete_many({"receipt_id": receipt_id})
+        documents = receipt_item_documents(receipt_id, receipt) if receipt else []
+        if documents:
+            self.receipt_items_collection.insert_many(documents)
+
     def save_receipt(self, receipt_data: str, metadata: dict) -> bool:
         """
         Save receipt data to MongoDB
 
         Args:
             receipt_data: JSON string containing receipt data
-            metadata: Dictionary with additional metadata
+            metadata: Dictionary with additional metadata; content_hash, the hash of the uploaded receipt
+                      file, is stored with the receipt and a second receipt with the same hash is rejected
 
         Returns:
             True if successful, False otherwise
@@ -68,36 +633,106 @@ class ReceiptRepository:
             if isinstance(receipt_data, str):
                 receipt_data = json.loads(receipt_data)
 
-            # Convert date string to MongoDB Date object if it exists
-            if "receipt_data" in receipt_data and "date" in receipt_data["receipt_data"]:
-                date_str = receipt_data["receipt_data"]["date"]
-                if date_str and isinstance(date_str, str):
-                    try:
-                        # Try to parse date in DD.MM.YYYY format
-                        if "." in date_str:
-                            day, month, year = date_str.split(".")
-                            receipt_data["receipt_data"]["date"] = datetime(int(year), int(month), int(day))
-                        # Try to parse date in YYYY-MM-DD format
-                        elif "-" in date_str:
-                            receipt_data["receipt_data"]["date"] = datetime.strptime(date_str, "%Y-%m-%d")
-                    except (ValueError, TypeError):
-                        # Keep original string if parsing fails
-                        logger.warning(f"Could not parse date: {date_str}, keeping as string")
+            parse_receipt_date(receipt_data)
+            add_category_tokens(receipt_data)
 
             document = {
                 "receipt_data": receipt_data["receipt_data"],
                 "items": receipt_data["items"],
+                "fingerprint": receipt_fingerprint(receipt_data),
+                "store_keys": store_keys(receipt_data),
                 "created_at": current_time,
                 "updated_at": current_time,
             }
+            if metadata and metadata.get("content_hash"):
+                document["content_hash"] = metadata["content_hash"]
 
             result = self.receipts_collection.insert_one(document)
+            items = receipt_item_documents(result.inserted_id, document)
+            if items:
+                self.receipt_items_collection.insert_many(items)
             logger.info(f"Receipt saved to MongoDB successfully with ID: {result.inserted_id}")
             return True
+        except DuplicateKeyError:
+            logger.warning(
+                f"Receipt not saved, a receipt from file {metadata and metadata.get('content_hash')} is already saved"
+            )
+            return False
         except Exception as e:
             logger.error(f"Error saving receipt to MongoDB: {str(e)}")
             return False
 
+    def save_receipts_bulk(self, receipts: List[Any], chunk_size: int = RECEIPTS_IMPORT_CHUNK_SIZE) -> Dict[str, Any]:
+        """
+        Save a batch of receipts, e.g. a backfill from an export, with unordered insert_many calls of chunk_size
+        receipts. Receipts already stored, or repeated in the batch, are skipped; a receipt that cannot be read
+        or written is reported without aborting the rest of the batch.
+
+        Args:
+            receipts: Receipt dictionaries or JSON strings, each with receipt_data and items
+            chunk_size: Number of receipts per insert_many call
+
+        Returns:
+            Import report with the number of receipts received, inserted and skipped as duplicates,
+            and the position in the batch and error of each failed receipt
+        """
+        documents, report = prepare_receipts_import(receipts, datetime.now(UTC))
+
+        existing_fingerprints = set()
+        for chunk in chunked([document["fingerprint"] for _, document in documents], chunk_size):
+            cursor = self.receipts_collection.find({"fingerprint": {"$in": chunk}}, {"fingerprint": 1})
+            existing_fingerprints.update(document["fingerprint"] for document in cursor)
+        documents = without_existing_receipts(documents, existing_fingerprints, report)
+
+        for chunk in chunked(documents, chunk_size):
+            try:
+                result = self.receipts_collection.insert_many([document for _, document in chunk], ordered=False)
+                report["inserted"] += len(result.inserted_ids)
+            except PyMongoError as e:
+                chunk = record_bulk_write_error(report, chunk, e)
+
+            items = [item for _, document in chunk for item in receipt_item_documents(document["_id"], document)]
+            if items:
+                self.receipt_items_collection.insert_many(items, ordered=False)
+
+        logger.info(
+            f"Imported {report['inserted']} of {report['received']} receipts, {report['duplicates']} duplicates, "
+            f"{len(report['failed'])} failed"
+        )
+        return report
+
+    def get_receipt_by_content_hash(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve the receipt extracted from the uploaded file with the given content hash
+
+        Returns:
+            Receipt dictionary with id, created_at, updated_at, and data fields, or None if not found
+        """
+        document = self.receipts_collection.find_one({"content_hash": content_hash})
+        return receipt_from_document(document) if document else None
+
+    def find_similar_receipt(self, receipt_data: Any) -> Optional[Dict[str, Any]]:
+        """
+        Find a saved receipt for the same purchase as the given receipt, e.g. the same receipt photographed
+        again: same date, same total and the same known store. Two purchases can match too, so this only
+        flags a possible duplicate
+
+        Args:
+            receipt_data: Receipt dictionary or JSON string with receipt_data and items
+
+        Returns:
+            Receipt dictionary with id, created_at, updated_at, and data fields, or None if not found
+        """
+        receipt = json.loads(receipt_data) if isinstance(receipt_data, str) else copy.deepcopy(receipt_data)
+        query = similar_receipts_query(parse_receipt_date(receipt))
+        if query is None:
+            return None
+        place = receipt["receipt_data"].get("place")
+        for document in self.receipts_collection.find(query):
+            if is_same_place(place, document["receipt_data"].get("place")):
+                return receipt_from_document(document)
+        return None
+
     def get_all_receipts(self) -> List[Dict[str, Any]]:
         """
         Retrieve all receipts from the database
@@ -110,20 +745,7 @@ class ReceiptRepository:
 
             receipts = []
             for document in cursor:
-                # Convert MongoDB date objects to ISO format strings for JSON serialization
-                receipt_data = document.get("receipt_data", {})
-                items = document.get("items", [])
-
-                # Convert MongoDB date to string if it's a datetime object
-                if "date" in receipt_data and isinstance(receipt_data["date"], datetime):
-                    receipt_data["date"] = receipt_data["date"].strftime("%d.%m.%Y")
-
-                receipt = {
-                    "id": str(document["_id"]),
-                    "created_at": document["created_at"].isoformat(),
-                    "updated_at": document["updated_at"].isoformat(),
-                    "data": {"receipt_data": receipt_data, "items": items},
-                }
+                receipt = receipt_from_document(document)
                 receipts.append(receipt)
 
             return receipts
@@ -145,21 +767,7 @@ class ReceiptRepository:
             document = self.receipts_collection.find_one({"_id": ObjectId(receipt_id)})
 
             if document:
-                # Convert MongoDB date objects to ISO format strings for JSON serialization
-                receipt_data = document.get("receipt_data", {})
-                items = document.get("items", [])
-
-                # Convert MongoDB date to string if it's a datetime object
-                if "date" in receipt_data and isinstance(receipt_data["date"], datetime):
-                    receipt_data["date"] = receipt_data["date"].strftime("%d.%m.%Y")
-
-                receipt = {
-                    "id": str(document["_id"]),
-                    "created_at": document["created_at"].isoformat(),
-                    "updated_at": document["updated_at"].isoformat(),
-                    "data": {"receipt_data": receipt_data, "items": items},
-                }
-                return receipt
+                return receipt_from_document(document)
             return None
         except Exception as e:
             logger.error(f"Error retrieving receipt {receipt_id} from MongoDB: {str(e)}")
@@ -184,29 +792,20 @@ class ReceiptRepository:
             if isinstance(receipt_data, str):
                 receipt_data = json.loads(receipt_data)
 
-            # Convert date string to MongoDB Date object if it exists
-            if "receipt_data" in receipt_data and "date" in receipt_data["receipt_data"]:
-                date_str = receipt_data["receipt_data"]["date"]
-                if date_str and isinstance(date_str, str):
-                    try:
-                        # Try to parse date in DD.MM.YYYY format
-                        if "." in date_str:
-                            day, month, year = date_str.split(".")
-                            receipt_data["receipt_data"]["date"] = datetime(int(year), int(month), int(day))
-                        # Try to parse date in YYYY-MM-DD format
-                        elif "-" in date_str:
-                            receipt_data["receipt_data"]["date"] = datetime.strptime(date_str, "%Y-%m-%d")
-                    except (ValueError, TypeError):
-                        # Keep original string if parsing fails
-                        logger.warning(f"Could not parse date: {date_str}, keeping as string")
+            parse_receipt_date(receipt_data)
+            add_category_tokens(receipt_data)
 
             update_data = {
                 "receipt_data": receipt_data["receipt_data"],
                 "items": receipt_data["items"],
+                "fingerprint": receipt_fingerprint(receipt_data),
+                "store_keys": store_keys(receipt_data),
                 "updated_at": current_time,
             }
 
             result = self.receipts_collection.update_one({"_id": ObjectId(receipt_id)}, {"$set": update_data})
+            if result.matched_count:
+                self.replace_receipt_items(ObjectId(receipt_id), update_data)
 
             return result.modified_count > 0
         except Exception as e:
@@ -225,50 +824,35 @@ class ReceiptRepository:
         """
         try:
             result = self.receipts_collection.delete_one({"_id": ObjectId(receipt_id)})
+            self.replace_receipt_items(ObjectId(receipt_id))
             return result.deleted_count > 0
         except Exception as e:
             logger.error(f"Error deleting receipt {receipt_id} from MongoDB: {str(e)}")
             return False
 
-    def get_receipts_by_date(self, start_date: str, end_date: str) -> Optional[List[Dict[str, Any]]]:
+    def get_receipts_by_date(
+        self, start_date: str, end_date: str, store: str = None, fields: List[str] = None
+    ) -> Optional[List[Dict[str, Any]]]:
         """
         Get the receipts and their associated items for a given period of time, including all metadata.
 
         Args:
             start_date (str): The start date of the period as YYYY-MM-DD.
             end_date (str): The end date of the period as YYYY-MM-DD.
+            store (str): Only receipts from this store, matched as described in store_condition.
+            fields (List[str]): Fields to return (see receipts_projection), all fields if None.
 
         Returns:
             List of dictionaries containing receipt data for the specified period.
         """
         try:
-            start_date_dt = datetime.strptime(start_date, "%Y-%m-%d")
-            end_date_dt = datetime.strptime(end_date, "%Y-%m-%d")
-
-            # Adjust end_date to include the entire day
-            end_date_dt = datetime(end_date_dt.year, end_date_dt.month, end_date_dt.day, 23, 59, 59)
-
-            # Query using receipt_data.date field instead of created_at
-            cursor = self.receipts_collection.find({"receipt_data.date": {"$gte": start_date_dt, "$lte": end_date_dt}}).sort(
-                "receipt_data.date", pymongo.DESCENDING
-            )
+            cursor = self.receipts_collection.find(
+                receipts_by_date_query(start_date, end_date, store), receipts_projection(fields)
+            ).sort("receipt_data.date", pymongo.DESCENDING)
 
             receipts = []
             for document in cursor:
-                # Convert MongoDB date objects to ISO format strings for JSON serialization
-                receipt_data = document.get("receipt_data", {})
-                items = document.get("items", [])
-
-                # Convert MongoDB date to string if it's a datetime object
-                if "date" in receipt_data and isinstance(receipt_data["date"], datetime):
-                    receipt_data["date"] = receipt_data["date"].strftime("%d.%m.%Y")
-
-                receipt = {
-                    "id": str(document["_id"]),
-                    "created_at": document["created_at"].isoformat(),
-                    "updated_at": document["updated_at"].isoformat(),
-                    "data": {"receipt_data": receipt_data, "items": items},
-                }
+                receipt = receipt_from_document(document)
                 receipts.append(receipt)
 
             return receipts
@@ -276,46 +860,84 @@ class ReceiptRepository:
             logger.error(f"Error retrieving receipts by date from MongoDB: {str(e)}")
             return None
 
+    def get_receipts_page(
+        self,
+        limit: int = 50,
+        cursor: str = None,
+        fields: List[str] = None,
+        start_date: str = None,
+        end_date: str = None,
+        store: str = None,
+    ) -> Dict[str, Any]:
+        """
+        Retrieve one page of receipts, newest first, using keyset pagination on created_at and _id
+
+        Args:
+            limit: Maximum number of receipts in the page
+            cursor: next_cursor of the previous page, None for the first page
+            fields: Fields to return (see receipts_projection), all fields if None
+            start_date: Only receipts dated on or after this day (YYYY-MM-DD)
+            end_date: Only receipts dated on or before this day (YYYY-MM-DD)
+            store: Only receipts from this store, matched as described in store_condition
+
+        Returns:
+            Dictionary with the receipts of the page and next_cursor, which is None on the last page
+
+        Raises:
+            ValueError: if the cursor or the fields are invalid
+        """
+        query = receipts_page_query(cursor, start_date, end_date, store)
+        documents = list(
+            self.receipts_collection.find(query, receipts_projection(fields)).sort(RECEIPTS_PAGE_SORT).limit(limit + 1)
+        )
+        return receipts_page(documents, limit, fields)
+
     def get_items_per_item_type(self, item_type: str) -> List[Dict[str, Any]]:
         """
-        Get items per item type from the database.
+        Get items per item type from the database, matching the item type against the category levels.
 
         Args:
             item_type (str): The item type to filter by.
 
         Returns:
-            List of dictionaries containing items of the specified type.
+            List of the matching line items from receipt_items, newest first, each with the receipt_id,
+            date and store of its receipt.
 
         Mongosh query:
-            db.receipts.find({
-                "$or": [
-                    {"items.item_category.level_1": /poultry/i},
-                    {"items.item_category.level_2": /poultry/i},
-                    {"items.item_category.level_3": /poultry/i}
-                ]
-            })
-
-            db.receipts.find({
-                "$or": [
-                    {"items.item_category.level_1": /pasta/i},
-                    {"items.item_category.level_2": /pasta/i},
-                    {"items.item_category.level_3": /pasta/i}
-                ]
-            }).count()
+            db.receipt_items.find({"category_tokens": {"$all": [/^poultry/]}}).sort({"date": -1})
         """
+        query = items_per_item_type_query(item_type)
+        if query is None:
+            return []
         try:
-            pattern = re.compile(item_type, re.IGNORECASE)
-            query = {
-                "$or": [
-                    {"items.item_category.level_1": pattern},
-                    {"items.item_category.level_2": pattern},
-                    {"items.item_category.level_3": pattern},
-                ]
-            }
-
-            result = self.receipts_collection.find(query)
-            return list(result)
-
+            return list(self.receipt_items_collection.find(query, {"_id": 0}).sort("date", pymongo.DESCENDING))
         except Exception as e:
             logging.error(f"Error searching items by category value: {str(e)}")
             return []
+
+    def backfill_category_tokens(self) -> int:
+        """
+        Add the category tokens to the items of receipts saved before they were maintained on write
+
+        Returns:
+            Number of receipts updated
+        """
+        updates = [
+            category_tokens_update(document)
+            for document in self.receipts_collection.find(backfill_category_tokens_query(), {"items": 1})
+        ]
+        updated = 0
+        for chunk in chunked(updates, RECEIPTS_IMPORT_CHUNK_SIZE):
+            updated += self.receipts_collection.bulk_write(chunk, ordered=False).modified_count
+        logger.info(f"Category tokens added to {updated} receipts")
+        return updated
+
+    def rebuild_receipt_items(self):
+        """Derive receipt_items again from all the receipts, and remove the rows of deleted receipts and lines"""
+        self.receipts_collection.aggregate(RECEIPT_ITEMS_PIPELINE, allowDiskUse=True)
+        stale = [
+            row["_id"] for row in self.receipt_items_collection.aggregate(STALE_RECEIPT_ITEMS_PIPELINE, allowDiskUse=True)
+        ]
+        for chunk in chunked(stale, RECEIPTS_IMPORT_CHUNK_SIZE):
+            self.receipt_items_collection.delete_many({"_id": {"$in": chunk}})
+        logger.info(f"receipt_items rebuilt from the receipts, {len(stale)} stale rows removed")
@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from .analytics_cube import EPOCH, Dictionary
+from .ingredients import canonical_ingredient, product_keys
+from .receipt_repository import RECEIPT_ITEMS_COLLECTION, receipt_item_documents
+
+logger = logging.getLogger(__name__)
+
+#
+# "Cook with what I bought": recipes ranked by how many of their ingredients were bought recently.
+#
+# Both sides are reduced to the canonical ingredient names of ingredients.py, each encoded once as
+# an integer code. The line items of the receipts (their English and Finnish names and category) are
+# kept as columns of (name code, day) rows, one row per name a line item matches, and the recipes as a
+# sparse recipe x name matrix in CSR form, one entry per distinct ingredient of a recipe. A
+# recommendation marks the names bought in the last N days in a dense vector and scores every recipe
+# at once with a sparse matrix-vector product: the share of its ingredients that were bought.
+#
+# Both sides are loaded when the server starts and kept current as they change: receipts from the
+# change events that maintain the analytics, recipes from the recipe writes of this process. Changes
+# made while a load reads are applied again once it has swapped in what it read. Updated
+# or deleted receipts leave dead rows behind until a compaction; the CSR matrix is rebuilt from the
+# per-recipe rows on the first recommendation after a recipe change.
+#
+
+RECIPE_RECOMMENDER_ENABLED = os.environ.get("RECIPE_RECOMMENDER_ENABLED", "true").lower() == "true"
+RECIPE_RECOMMENDER_RELOAD_SECONDS = int(os.environ.get("RECIPE_RECOMMENDER_RELOAD_SECONDS", "3600"))
+
+# purchases older than this are not kept, so recommendations look back at most this many days
+RECOMMENDER_MAX_DAYS = 90
+RECOMMENDER_DEFAULT_DAYS = 14
+RECOMMENDER_DEFAULT_LIMIT = 10
+
+# ingredients assumed to be at hand, which neither count for nor against a recipe
+PANTRY_STAPLES = {"salt", "pepper", "black pepper", "water", "oil", "olive oil", "rapeseed oil", "sugar", "flour"}
+
+# credit for an ingredient when only its last word was bought, e.g. beef for minced beef
+PARTIAL_MATCH = 0.5
+
+# dead purchase rows are dropped once they make up this share of the rows
+COMPACTION_DEAD_RATIO = 0.25
+
+
+def _to_days(value) -> int:
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def item_names(item: dict) -> list:
+    """Canonical ingredient names a receipt line item matches, from its names and category"""
+    names = [*product_keys(item.get("name_en")), *product_keys(item.get("name_fi"))]
+    category = canonical_ingredient(item.get("level_3"))
+    if category:
+        names.append(category)
+    return list(dict.fromkeys(names))
+
+
+def recipe_names(document: dict) -> list:
+    """Distinct canonical names of the ingredients of a recipe, without the pantry staples"""
+    names = (canonical_ingredient(ingredient) for ingredient in document.get("ingredients") or [])
+    return list(dict.fromkeys(name for name in names if name and name not in PANTRY_STAPLES))
+
+
+class RecipeRecommender:
+    """Recently bought ingredients and the ingredients of every recipe, as name codes."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.names = Dictionary()
+        # code of the last word of every multi-word name, 0 for single words
+        self.heads = [0]
+        self._reset_purchases()
+        # name codes of each recipe, and the CSR matrix built from them
+        self.recipe_rows = {}
+        self._matrix = None
+        # while a load reads the recipes, the recipe writes made meanwhile, to apply again over what it
+        # read: recipe id -> document, or None when deleted
+        self.written = None
+        # receipt change events that arrived before the first load, to apply once it has swapped in
+        self.queued = []
+        self.loaded = False
+        self.loaded_at = None
+        self.load_seconds = None
+        self.reloads = 0
+        self.changes_applied = 0
+
+    def _reset_purchases(self):
+        self.purchase_names = np.empty(0, dtype=np.int32)
+        self.purchase_days = np.empty(0, dtype=np.int32)
+        self.purchase_alive = np.empty(0, dtype=bool)
+        # purchase rows of each receipt, so that updates and deletes can retire them
+        self.receipt_rows = {}
+
+    def _encode(self, name: str) -> int:
+        code = self.names.lookup(name)
+        if code >= 0:
+            return code
+        head = self._encode(name.rsplit(" ", 1)[1]) if " " in name else 0
+        code = self.names.encode(name)
+        self.heads.append(head)
+        return code
+
+    def _append_items(self, items: list):
+        """Append purchase rows for receipt_items documents, in a single concatenation."""
+        rows = {}
+        for item in items:
+            if not isinstance(item.get("date"), (datetime, date)):
+                continue
+            days = _to_days(item["date"])
+            rows.setdefault(item["receipt_id"], []).extend((self._encode(name), days) for name in item_names(item))
+
+        start = len(self.purchase_alive)
+        new_rows = []
+        for receipt_id, receipt_rows in rows.items():
+            self.receipt_rows[receipt_id] = np.arange(start + len(new_rows), start + len(new_rows) + len(receipt_rows))
+            new_rows.extend(receipt_rows)
+        if not new_rows:
+            return
+        names, days = zip(*new_rows)
+        self.purchase_names = np.concatenate((self.purchase_names, np.array(names, dtype=np.int32)))
+        self.purchase_days = np.concatenate((self.purchase_days, np.array(days, dtype=np.int32)))
+        self.purchase_alive = np.concatenate((self.purchase_alive, np.ones(len(new_rows), dtype=bool)))
+
+    def _retire(self, receipt_id):
+        rows = self.receipt_rows.pop(receipt_id, None)
+        if rows is not None:
+            self.purchase_alive[rows] = False
+
+    def _compact(self):
+        alive = self.purchase_alive
+        dead = len(alive) - int(alive.sum())
+        if not dead or dead < COMPACTION_DEAD_RATIO * len(alive):
+            return
+        new_index = np.cumsum(alive) - 1
+        self.purchase_names = self.purchase_names[alive]
+        self.purchase_days = self.purchase_days[alive]
+        self.purchase_alive = self.purchase_alive[alive]
+        self.receipt_rows = {receipt_id: new_index[rows] for receipt_id, rows in self.receipt_rows.items()}
+        logger.debug(f"Compacted the recommender purchases, {dead} dead row(s) dropped")
+
+    def upsert_recipe(self, recipe_id, document: dict):
+        """Take in the ingredients of a recipe that was saved or updated."""
+        if self.written is not None:
+            self.written[recipe_id] = document
+        codes = [self._encode(name) for name in recipe_names(document)]
+        if codes:
+            self.recipe_rows[recipe_id] = np.array(codes, dtype=np.int32)
+        else:
+            self.recipe_rows.pop(recipe_id, None)
+        self._matrix = None
+
+    def remove_recipe(self, recipe_id):
+        """Drop a deleted recipe."""
+        if self.written is not None:
+            self.written[recipe_id] = None
+        if self.recipe_rows.pop(recipe_id, None) is not None:
+            self._matrix = None
+
+    def _recipe_matrix(self) -> tuple:
+        """(recipe ids, indptr, indices) of the recipe x name matrix, in CSR form with all values 1"""
+        if self._matrix is None:
+            ids = list(self.recipe_rows)
+            rows = [self.recipe_rows[recipe_id] for recipe_id in ids]
+            indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum([len(row) for row in rows], out=indptr[1:])
+            indices = np.concatenate(rows) if rows else np.empty(0, dtype=np.int32)
+            self._matrix = (ids, indptr, indices)
+        return self._matrix
+
+    @staticmethod
+    async def _recent_items(receipt_items) -> list:
+        since = datetime.combine(date.today() - timedelta(days=RECOMMENDER_MAX_DAYS), datetime.min.time())
+        projection = {"receipt_id": 1, "date": 1, "name_en": 1, "name_fi": 1, "level_3": 1}
+        return [item async for item in receipt_items.find({"date": {"$gte": since}}, projection)]
+
+    async def load(self, receipt_items, recipes):
+        """(Re)load the recent line items from receipt_items and all recipes."""
+        async with self._lock:
+            start = time.perf_counter()
+            # the changes that arrived until now are part of what is read
+            self.queued = []
+            self.written = {}
+            try:
+                items = await self._recent_items(receipt_items)
+                documents = [document async for document in recipes.find({}, {"ingredients": 1})]
+                # the cursors may have read a recipe or receipt before it was written again, so the writes
+                # and changes made while they ran are applied over what they read
+                written, self.written = self.written, None
+                queued, self.queued = self.queued, []
+                # swapped in without awaiting in between, so recommendations never see a half loaded state
+                self._reset_purchases()
+                self._append_items(items)
+                self.recipe_rows = {}
+                for document in documents:
+                    self.upsert_recipe(document["_id"], document)
+                for recipe_id, document in written.items():
+                    if document is None:
+                        self.remove_recipe(recipe_id)
+                    else:
+                        self.upsert_recipe(recipe_id, document)
+                self.loaded = True
+            finally:
+                self.written = None
+            if queued:
+                await self._apply_changes(queued, receipt_items)
+
+            self.loaded_at = datetime.utcnow()
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            self.reloads += 1
+            logger.info(
+                f"Loaded {len(self.purchase_alive)} purchase(s) and {len(self.recipe_rows)} recipe(s) into the recommender "
+                f"in {self.load_seconds} seconds"
+            )
+
+    async def apply_changes(self, changes: list, receipt_items):
+        """
+        Bring the purchases up to date with a burst of receipt change events. Events that do not carry
+        the new version of the receipt trigger a reload of the purchases. Until the first load has
+        finished, the events are queued for it.
+        """
+        if not self.loaded:
+            self.queued.extend(changes)
+            return
+
+        async with self._lock:
+            await self._apply_changes(changes, receipt_items)
+
+    async def _apply_changes(self, changes: list, receipt_items):
+        upserts = {}
+        deletes = set()
+        for change in changes:
+            operation = change.get("operationType")
+            receipt_id = (change.get("documentKey") or {}).get("_id")
+            if operation == "delete" and receipt_id is not None:
+                deletes.add(receipt_id)
+                upserts.pop(receipt_id, None)
+            elif operation in ("insert", "update", "replace") and change.get("fullDocument") is not None:
+                upserts[receipt_id] = change["fullDocument"]
+                deletes.discard(receipt_id)
+            else:
+                await self._reload_purchases(receipt_items)
+                return
+
+        for receipt_id in deletes | upserts.keys():
+            self._retire(receipt_id)
+        self._append_items(
+            [item for receipt_id, receipt in upserts.items() for item in receipt_item_documents(receipt_id, receipt)]
+        )
+        self._compact()
+        self.changes_applied += len(changes)
+
+    async def reload_purchases(self, receipt_items):
+        """(Re)load the recent line items only, when receipt changes cannot be applied one by one."""
+        async with self._lock:
+            await self._reload_purchases(receipt_items)
+
+    async def _reload_purchases(self, receipt_items):
+        items = await self._recent_items(receipt_items)
+        self._reset_purchases()
+        self._append_items(items)
+
+    def bought(self, days: int = RECOMMENDER_DEFAULT_DAYS, today: date = None) -> np.ndarray:
+        """
+        Credit of every name code for the purchases of the last days: 1 for names bought, PARTIAL_MATCH
+        for names whose last word was bought, 0 otherwise
+        """
+        since = _to_days(today or date.today()) - days + 1
+        credit = np.zeros(len(self.heads), dtype=np.float32)
+        credit[self.purchase_names[self.purchase_alive & (self.purchase_days >= since)]] = 1.0
+        heads = np.array(self.heads, dtype=np.int64)
+        # code 0 is never bought, so single words get no partial credit
+        return np.where(credit == 0, PARTIAL_MATCH * credit[heads], credit)
+
+    def recommend(
+        self, days: int = RECOMMENDER_DEFAULT_DAYS, limit: int = RECOMMENDER_DEFAULT_LIMIT, today: date = None
+    ) -> list:
+        """
+        Recipes best covered by the ingredients bought in the last days.
+
+        Returns:
+            up to limit recommendations, best first, each with the recipe_id, the coverage (share of
+            the ingredients of the recipe that were bought, pantry staples aside) and the names of the
+            matched and missing ingredients
+        """
+        ids, indptr, indices = self._recipe_matrix()
+        if not ids:
+            return []
+        credit = self.bought(days, today)
+        # sparse matrix-vector product: every row sums the credit of its ingredients
+        covered = np.add.reduceat(credit[indices], indptr[:-1])
+        coverage = covered / np.diff(indptr)
+
+        candidates = np.flatnonzero(covered > 0)
+        # best coverage first, then the most ingredients bought
+        order = candidates[np.lexsort((-covered[candidates], -coverage[candidates]))][:limit]
+        recommendations = []
+        for row in order:
+            codes = indices[indptr[row] : indptr[row + 1]]
+            recommendations.append(
+                {
+                    "recipe_id": ids[row],
+                    "coverage": round(float(coverage[row]), 3),
+                    "matched": [self.names.decode(code) for code in codes if credit[code] > 0],
+                    "missing": [self.names.decode(code) for code in codes if credit[code] == 0],
+                }
+            )
+        return recommendations
+
+    def memory_bytes(self) -> int:
+        _, indptr, indices = self._recipe_matrix()
+        arrays = (self.purchase_names, self.purchase_days, self.purchase_alive, indptr, indices)
+        return sum(array.nbytes for array in arrays) + self.names.memory_bytes() + sys.getsizeof(self.heads)
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "load_seconds": self.load_seconds,
+            "reloads": self.reloads,
+            "changes_applied": self.changes_applied,
+            "purchases": int(self.purchase_alive.sum()),
+            "dead_purchases": int(len(self.purchase_alive) - self.purchase_alive.sum()),
+            "recipes": len(self.recipe_rows),
+            "names": len(self.heads) - 1,
+            "memory_bytes": self.memory_bytes(),
+        }
+
+
+recipe_recommender = RecipeRecommender()
+
+
+async def keep_recipe_recommender_loaded(database):
+    """Load the recommender and reload it periodically, for purchases that aged out and missed changes."""
+    if not RECIPE_RECOMMENDER_ENABLED:
+        return
+    while True:
+        try:
+            await recipe_recommender.load(database[RECEIPT_ITEMS_COLLECTION], database["recipes"])
+        except Exception as e:
+            logger.error(f"Error loading the recipe recommender: {e}")
+        await asyncio.sleep(RECIPE_RECOMMENDER_RELOAD_SECONDS)
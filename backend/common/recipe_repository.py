@@ -8,10 +8,160 @@ from pymongo.errors import PyMongoError
 
 from agents.recipes.recipeflow import Recipe
 
+from .ingredients import ingredient_keys, ingredient_query_keys
 from .mongo_connection import MongoConnection
+from .receipt_repository import decode_receipts_cursor, encode_receipts_cursor
+from .recipe_vectors import recipe_vector_fields
 
 logger = logging.getLogger(__name__)
 
+RECIPES_PAGE_SORT = [("created_at", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+
+# fields of the summary view of the recipes listing, the rest of a recipe is fetched by id
+RECIPE_SUMMARY_FIELDS = ("name", "tags", "cooking_time", "preparation_time", "yields", "created_at", "updated_at")
+
+RECIPE_VIEWS = ("summary", "full")
+
+# fields stored for the search indexes only, left out of the full view
+RECIPE_INTERNAL_FIELDS = ("embedding", "embedding_model")
+
+
+def canonical_tags(tags: List[str]) -> List[str]:
+    """Tags lowercased, with whitespace collapsed and without empty or repeated tags, in their original order"""
+    canonical = []
+    for tag in tags or []:
+        tag = " ".join(str(tag).lower().split())
+        if tag and tag not in canonical:
+            canonical.append(tag)
+    return canonical
+
+
+def recipes_projection(view: str = "full") -> Optional[Dict[str, Any]]:
+    """
+    Projection of the recipes listing for a view: the summary fields, or whole recipes without their
+    internal fields
+
+    Raises:
+        ValueError: if the view is not one of RECIPE_VIEWS
+    """
+    if view not in RECIPE_VIEWS:
+        raise ValueError(f"Unknown recipe view: {view}, expected one of {', '.join(RECIPE_VIEWS)}")
+    if view == "summary":
+        return {field: 1 for field in RECIPE_SUMMARY_FIELDS}
+    return {field: 0 for field in RECIPE_INTERNAL_FIELDS}
+
+
+def recipes_page_query(cursor: str = None) -> Dict[str, Any]:
+    """
+    Query for the recipes after the cursor, which is the same keyset cursor on created_at and _id as
+    in the receipts listing
+
+    Raises:
+        ValueError: if the cursor is invalid
+    """
+    return decode_receipts_cursor(cursor) if cursor else {}
+
+
+def recipes_next_cursor(documents: List[Dict[str, Any]], limit: int) -> Optional[str]:
+    """Cursor of the page after up to limit + 1 documents, None if there are no more"""
+    return encode_receipts_cursor(documents[limit - 1]) if len(documents) > limit else None
+
+
+def recipe_to_document(recipe: Recipe, existing_doc: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Convert Recipe model to MongoDB document format
+
+    Args:
+        recipe: Recipe model object
+        existing_doc: Optional existing MongoDB document to update
+
+    Returns:
+        MongoDB document dictionary
+    """
+    now = datetime.utcnow()
+
+    # Create the base document
+    document = {
+        "name": recipe.name or "",
+        "description": recipe.description or "",
+        "ingredients": recipe.ingredients or [],
+        # canonical ingredient names, for the indexed ingredient lookups
+        "ingredient_keys": ingredient_keys(recipe.ingredients),
+        "steps": recipe.steps or [],
+        "tags": canonical_tags(recipe.tags),
+        "updated_at": now,
+    }
+
+    # Handle optional time ranges
+    if recipe.cooking_time:
+        document["cooking_time"] = recipe.cooking_time
+
+    if recipe.preparation_time:
+        document["preparation_time"] = recipe.preparation_time
+
+    if recipe.yields:
+        document["yields"] = recipe.yields
+
+    if recipe.url:
+        document["url"] = recipe.url
+
+    # vector for the semantic search, from the fields above
+    document.update(recipe_vector_fields(document))
+
+    # For new documents, set created_at
+    if existing_doc is None:
+        document["created_at"] = now
+    else:
+        # For updates, preserve existing created_at and _id
+        document["created_at"] = existing_doc.get("created_at", now)
+        if "_id" in existing_doc:
+            document["_id"] = existing_doc["_id"]
+
+    return document
+
+
+def document_to_recipe(document: Dict[str, Any]) -> Recipe:
+    """
+    Convert MongoDB document to Recipe model
+
+    Args:
+        document: MongoDB document
+
+    Returns:
+        Recipe model object
+    """
+    # Extract the basic fields
+    recipe_data = {
+        "name": document.get("name", ""),
+        "description": document.get("description", ""),
+        "ingredients": document.get("ingredients", []),
+        "steps": document.get("steps", []),
+        "tags": document.get("tags", []),
+    }
+
+    # Handle optional time ranges
+    if "cooking_time" in document:
+        recipe_data["cooking_time"] = document["cooking_time"]
+
+    if "preparation_time" in document:
+        recipe_data["preparation_time"] = document["preparation_time"]
+
+    if "yields" in document:
+        recipe_data["yields"] = document["yields"]
+
+    if "url" in document:
+        recipe_data["url"] = document["url"]
+
+    return Recipe(**recipe_data)
+
+
+def recipes_by_ingredients_query(ingredients: List[str], match_all: bool = False) -> Dict[str, Any]:
+    """
+    Query for recipes that contain any of the ingredients, or all of them with match_all, by their
+    canonical names in ingredient_keys
+    """
+    return {"ingredient_keys": {"$all" if match_all else "$in": ingredient_query_keys(ingredients)}}
+
 
 class RecipeRepository:
     """
@@ -42,15 +192,8 @@ class RecipeRepository:
     def initialize(self):
         """Create the recipes collection if it doesn't exist and set up indexes"""
         try:
-            # Create the collection with a descending index on created_at
-            # For text indexes, MongoDB only allows one text index per collection, so create a compound text index
-            self.mongo_connection.initialize_collection(
-                "recipes",
-                indexes=[
-                    [("created_at", pymongo.DESCENDING)],
-                    [("name", pymongo.TEXT), ("tags", pymongo.TEXT)],  # Compound text index for both name and tags
-                ],
-            )
+            # Create the collection with the indexes declared for it in common.indexes
+            self.mongo_connection.initialize_collection("recipes")
             logger.info("Recipe repository initialized successfully")
         except PyMongoError as e:
             logger.error(f"Error initializing recipe repository: {str(e)}")
@@ -76,7 +219,7 @@ class RecipeRepository:
         """
         try:
             # Convert Recipe model to MongoDB document
-            document = self._recipe_to_document(recipe)
+            document = recipe_to_document(recipe)
 
             # Insert into database
             result = self.recipes_collection.insert_one(document)
@@ -99,7 +242,7 @@ class RecipeRepository:
 
             recipes = []
             for document in cursor:
-                recipe = self._document_to_recipe(document)
+                recipe = document_to_recipe(document)
                 recipes.append(recipe)
 
             return recipes
@@ -121,7 +264,7 @@ class RecipeRepository:
             document = self.recipes_collection.find_one({"_id": ObjectId(recipe_id)})
 
             if document:
-                return self._document_to_recipe(document)
+                return document_to_recipe(document)
             return None
         except Exception as e:
             logger.error(f"Error retrieving recipe {recipe_id} from MongoDB: {str(e)}")
@@ -147,7 +290,7 @@ class RecipeRepository:
                 return False
 
             # Convert Recipe model to MongoDB document format, preserving fields not in model
-            update_data = self._recipe_to_document(recipe, existing_doc)
+            update_data = recipe_to_document(recipe, existing_doc)
 
             # Remove _id to avoid update error
             if "_id" in update_data:
@@ -198,7 +341,7 @@ class RecipeRepository:
 
             recipes = []
             for document in cursor:
-                recipe = self._document_to_recipe(document)
+                recipe = document_to_recipe(document)
                 recipes.append(recipe)
 
             return recipes
@@ -217,12 +360,12 @@ class RecipeRepository:
             List of matching Recipe model objects
         """
         try:
-            query = {"tags": {"$in": tags}}
+            query = {"tags": {"$in": canonical_tags(tags)}}
             cursor = self.recipes_collection.find(query).sort("created_at", pymongo.DESCENDING)
 
             recipes = []
             for document in cursor:
-                recipe = self._document_to_recipe(document)
+                recipe = document_to_recipe(document)
                 recipes.append(recipe)
 
             return recipes
@@ -230,26 +373,25 @@ class RecipeRepository:
             logger.error(f"Error retrieving recipes by tags from MongoDB: {str(e)}")
             return []
 
-    def get_recipes_by_ingredients(self, ingredients: List[str]) -> List[Recipe]:
+    def get_recipes_by_ingredients(self, ingredients: List[str], match_all: bool = False) -> List[Recipe]:
         """
         Find recipes that contain any of the specified ingredients
 
         Args:
             ingredients: List of ingredients to search for
+            match_all: Only find recipes that contain all of the ingredients
 
         Returns:
             List of matching Recipe model objects
         """
         try:
-            # Create a regex pattern for each ingredient to enable partial matching
-            ingredient_patterns = [{"ingredients": {"$regex": ingredient, "$options": "i"}} for ingredient in ingredients]
-
-            query = {"$or": ingredient_patterns}
-            cursor = self.recipes_collection.find(query).sort("created_at", pymongo.DESCENDING)
+            cursor = self.recipes_collection.find(recipes_by_ingredients_query(ingredients, match_all)).sort(
+                "created_at", pymongo.DESCENDING
+            )
 
             recipes = []
             for document in cursor:
-                recipe = self._document_to_recipe(document)
+                recipe = document_to_recipe(document)
                 recipes.append(recipe)
 
             return recipes
@@ -284,84 +426,3 @@ class RecipeRepository:
             "updated_at": document["updated_at"].isoformat(),
         }
         return recipe
-
-    def _recipe_to_document(self, recipe: Recipe, existing_doc: Dict[str, Any] = None) -> Dict[str, Any]:
-        """
-        Convert Recipe model to MongoDB document format
-
-        Args:
-            recipe: Recipe model object
-            existing_doc: Optional existing MongoDB document to update
-
-        Returns:
-            MongoDB document dictionary
-        """
-        now = datetime.utcnow()
-
-        # Create the base document
-        document = {
-            "name": recipe.name or "",
-            "description": recipe.description or "",
-            "ingredients": recipe.ingredients or [],
-            "steps": recipe.steps or [],
-            "tags": recipe.tags or [],
-            "updated_at": now,
-        }
-
-        # Handle optional time ranges
-        if recipe.cooking_time:
-            document["cooking_time"] = recipe.cooking_time
-
-        if recipe.preparation_time:
-            document["preparation_time"] = recipe.preparation_time
-
-        if recipe.yields:
-            document["yields"] = recipe.yields
-
-        if recipe.url:
-            document["url"] = recipe.url
-
-        # For new documents, set created_at
-        if existing_doc is None:
-            document["created_at"] = now
-        else:
-            # For updates, preserve existing created_at and _id
-            document["created_at"] = existing_doc.get("created_at", now)
-            if "_id" in existing_doc:
-                document["_id"] = existing_doc["_id"]
-
-        return document
-
-    def _document_to_recipe(self, document: Dict[str, Any]) -> Recipe:
-        """
-        Convert MongoDB document to Recipe model
-
-        Args:
-            document: MongoDB document
-
-        Returns:
-            Recipe model object
-        """
-        # Extract the basic fields
-        recipe_data = {
-            "name": document.get("name", ""),
-            "description": document.get("description", ""),
-            "ingredients": document.get("ingredients", []),
-            "steps": document.get("steps", []),
-            "tags": document.get("tags", []),
-        }
-
-        # Handle optional time ranges
-        if "cooking_time" in document:
-            recipe_data["cooking_time"] = document["cooking_time"]
-
-        if "preparation_time" in document:
-            recipe_data["preparation_time"] = document["preparation_time"]
-
-        if "yields" in document:
-            recipe_data["yields"] = document["yields"]
-
-        if "url" in document:
-            recipe_data["url"] = document["url"]
-
-        return Recipe(**recipe_data)
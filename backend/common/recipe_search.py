@@ -0,0 +1,305 @@
+import asyncio
+import heapq
+import logging
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from .ingredients import ingredient_keys, ingredient_query_keys
+
+logger = logging.getLogger(__name__)
+
+#
+# In-memory inverted index of the recipes, ranked with BM25.
+#
+# The name, tags, ingredients and steps of every recipe are tokenized (lowercased words, English
+# and Finnish stop words dropped, common inflection endings stripped) into one posting list per
+# term, with each field counting with its own weight. Free text searches are scored with BM25 over
+# those postings; ingredient lookups (by canonical ingredient name, see ingredients.py) and tag
+# lookups use their own postings, so that none of the recipe
+# tools needs a $text or $regex query. MongoDB is only used to load the index and to fetch the
+# matching recipes, except for ingredient lookups, which MongoDB answers from its ingredient_keys
+# index and this index only ranks.
+#
+# The index is loaded when the server starts and reloaded periodically, to pick up recipes written
+# by other processes; the recipe writes of this process update it as they happen. Until the next
+# reload, up to RECIPE_SEARCH_RELOAD_SECONDS, free text and tag searches miss the recipes written
+# by other processes or with the sync RecipeRepository.
+#
+
+RECIPE_SEARCH_ENABLED = os.environ.get("RECIPE_SEARCH_ENABLED", "true").lower() == "true"
+RECIPE_SEARCH_RELOAD_SECONDS = int(os.environ.get("RECIPE_SEARCH_RELOAD_SECONDS", "3600"))
+
+# weight of a term occurrence in each field
+FIELD_WEIGHTS = {"name": 3.0, "tags": 2.0, "ingredients": 1.5, "steps": 1.0}
+
+# BM25 term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# fmt: off
+STOP_WORDS = {
+    # English
+    "a", "an", "and", "as", "at", "be", "by", "for", "from", "in", "into", "is", "it", "of", "on", "or",
+    "the", "then", "to", "until", "with", "your", "you",
+    # Finnish
+    "ja", "tai", "ei", "se", "ne", "kun", "kanssa", "sekä", "myös", "noin",
+    # units of measure
+    "g", "kg", "l", "dl", "cl", "ml", "tl", "rkl", "kpl", "tsp", "tbsp", "cup", "cups", "oz", "lb", "pcs",
+}
+# fmt: on
+
+# inflection endings, longest first: English plurals and verb forms, Finnish case endings
+STEM_ENDINGS = ("iden", "ing", "ssa", "ssä", "sta", "stä", "lla", "llä", "lta", "ltä", "ksi", "jen", "es", "ed", "s")
+MIN_STEM_LENGTH = 3
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+def stem(word: str) -> str:
+    """
+    Strip one inflection ending, or else a final e or doubled vowel, so that e.g. tomato and tomatoes,
+    sauce and sauces, or peruna, perunaa and perunassa share a term
+    """
+    if word.endswith("ies") and len(word) - 3 >= MIN_STEM_LENGTH:
+        return word[:-3] + "y"
+    for ending in STEM_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            if ending == "s" and word.endswith("ss"):
+                return word
+            return word[: -len(ending)]
+    if len(word) > MIN_STEM_LENGTH and (word.endswith("e") or word[-1] == word[-2] and word[-1] in "aeiouyäö"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> list:
+    """Terms of a text: lowercased words without digits, stop words dropped, stemmed"""
+    return [stem(word) for word in WORD_PATTERN.findall(str(text or "").lower()) if word not in STOP_WORDS]
+
+
+class RecipeSearchIndex:
+    """Inverted index of the recipes, with BM25 scoring."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._reset()
+        self.loaded = False
+        self.loaded_at = None
+        self.load_seconds = None
+        self.reloads = 0
+        self.updates = 0
+        # while a load reads the recipes, the writes made meanwhile, to apply again over what it read:
+        # recipe id -> document, or None when deleted
+        self.written = None
+
+    def _reset(self):
+        # term -> {recipe id: weighted term frequency}
+        self.postings = defaultdict(dict)
+        # canonical ingredient key -> recipe ids, and tag -> recipe ids
+        self.ingredient_postings = defaultdict(set)
+        self.tag_postings = defaultdict(set)
+        # per recipe: weighted length, terms, ingredient keys, tags and creation time
+        self.lengths = {}
+        self.total_length = 0.0
+        self.recipe_terms = {}
+        self.recipe_ingredient_keys = {}
+        self.recipe_tags = {}
+        self.created_at = {}
+
+    def __len__(self) -> int:
+        """Number of indexed recipes."""
+        return len(self.lengths)
+
+    def __contains__(self, recipe_id) -> bool:
+        """Whether a recipe is indexed."""
+        return recipe_id in self.lengths
+
+    def _add(self, recipe_id, document: dict):
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            value = document.get(field) or []
+            for text in [value] if isinstance(value, str) else value:
+                for term in tokenize(text):
+                    terms[term] += weight
+
+        keys = set(ingredient_keys(document.get("ingredients")))
+        tags = {str(tag).lower() for tag in document.get("tags") or []}
+        for term, frequency in terms.items():
+            self.postings[term][recipe_id] = frequency
+        for key in keys:
+            self.ingredient_postings[key].add(recipe_id)
+        for tag in tags:
+            self.tag_postings[tag].add(recipe_id)
+
+        length = sum(terms.values())
+        self.lengths[recipe_id] = length
+        self.total_length += length
+        self.recipe_terms[recipe_id] = list(terms)
+        self.recipe_ingredient_keys[recipe_id] = keys
+        self.recipe_tags[recipe_id] = tags
+        self.created_at[recipe_id] = document.get("created_at") or datetime.min
+
+    def _remove(self, recipe_id):
+        if recipe_id not in self.lengths:
+            return
+        for term in self.recipe_terms.pop(recipe_id):
+            self._discard(self.postings, term, recipe_id)
+        for key in self.recipe_ingredient_keys.pop(recipe_id):
+            self._discard(self.ingredient_postings, key, recipe_id)
+        for tag in self.recipe_tags.pop(recipe_id):
+            self._discard(self.tag_postings, tag, recipe_id)
+        self.total_length -= self.lengths.pop(recipe_id)
+        self.created_at.pop(recipe_id, None)
+
+    @staticmethod
+    def _discard(postings: dict, key, recipe_id):
+        entries = postings.get(key)
+        if entries is None:
+            return
+        if isinstance(entries, dict):
+            entries.pop(recipe_id, None)
+        else:
+            entries.discard(recipe_id)
+        if not entries:
+            del postings[key]
+
+    async def load(self, collection):
+        """(Re)load all recipes from the recipes collection."""
+        async with self._lock:
+            start = time.perf_counter()
+            projection = {"created_at": 1, **{field: 1 for field in FIELD_WEIGHTS}}
+            self.written = {}
+            try:
+                documents = [document async for document in collection.find({}, projection)]
+                # swapped in without awaiting in between, so searches never see a half loaded index; the
+                # cursor may have read a recipe before it was written again or deleted by this process,
+                # so the writes made while it ran are applied over what it read
+                written, self.written = self.written, None
+                self._reset()
+                for document in documents:
+                    self._add(document["_id"], document)
+                for recipe_id, document in written.items():
+                    self._remove(recipe_id)
+                    if document is not None:
+                        self._add(recipe_id, document)
+            finally:
+                self.written = None
+
+            self.loaded = True
+            self.loaded_at = datetime.utcnow()
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            self.reloads += 1
+            logger.info(f"Loaded {len(self)} recipe(s) into the search index in {self.load_seconds} seconds")
+
+    def upsert(self, recipe_id, document: dict):
+        """Index a recipe that was saved or updated, replacing what was indexed for it."""
+        self._remove(recipe_id)
+        self._add(recipe_id, document)
+        if self.written is not None:
+            self.written[recipe_id] = document
+        self.updates += 1
+
+    def remove(self, recipe_id):
+        """Drop a deleted recipe from the index."""
+        self._remove(recipe_id)
+        if self.written is not None:
+            self.written[recipe_id] = None
+        self.updates += 1
+
+    def _bm25(self, terms: list, candidates: set = None) -> dict:
+        """BM25 score of every recipe with at least one of the terms, optionally only among candidates"""
+        scores = defaultdict(float)
+        count = len(self)
+        if not count:
+            return scores
+        average_length = self.total_length / count or 1.0
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for recipe_id, frequency in postings.items():
+                if candidates is not None and recipe_id not in candidates:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[recipe_id] / average_length)
+                scores[recipe_id] += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return scores
+
+    @staticmethod
+    def _ranked(scores: dict, limit: int = None) -> list:
+        if limit is None:
+            return sorted(scores.items(), key=lambda entry: entry[1], reverse=True)
+        return heapq.nlargest(limit, scores.items(), key=lambda entry: entry[1])
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        Recipes matching a free text query, best first.
+
+        Returns:
+            (recipe id, score) pairs of at most limit recipes with at least one term of the query
+        """
+        return self._ranked(self._bm25(tokenize(query)), limit)
+
+    def search_ingredients(self, ingredients: list, limit: int = None, match_all: bool = False) -> list:
+        """
+        Recipes with any of the ingredients, or all of them with match_all, best first. Ingredients are
+        matched by their canonical names, e.g. "minced beef" matches "500 g naudan jauhelihaa" but not
+        "beef stock", while "beef" matches both.
+
+        Returns:
+            (recipe id, score) pairs
+        """
+        keys = ingredient_query_keys(ingredients)
+        if not keys:
+            return []
+        recipes = [self.ingredient_postings.get(key, set()) for key in keys]
+        candidates = set.intersection(*recipes) if match_all else set().union(*recipes)
+        # ranked by the words as given and as canonical names, as recipes may be written in either language
+        terms = [term for text in [*ingredients, *keys] for term in tokenize(text)]
+        scores = self._bm25(terms, candidates)
+        for recipe_id in candidates:
+            scores.setdefault(recipe_id, 0.0)
+        return self._ranked(scores, limit)
+
+    def search_tags(self, tags: list) -> list:
+        """Ids of the recipes with any of the tags, newest first"""
+        recipes = set().union(*(self.tag_postings.get(str(tag).lower(), set()) for tag in tags))
+        return sorted(recipes, key=lambda recipe_id: self.created_at[recipe_id], reverse=True)
+
+    def memory_bytes(self) -> int:
+        postings = sum(sys.getsizeof(entries) for entries in self.postings.values())
+        ingredient_postings = sum(sys.getsizeof(entries) for entries in self.ingredient_postings.values())
+        return sys.getsizeof(self.postings) + postings + ingredient_postings + sys.getsizeof(self.lengths)
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "load_seconds": self.load_seconds,
+            "reloads": self.reloads,
+            "updates": self.updates,
+            "recipes": len(self),
+            "terms": len(self.postings),
+            "tags": len(self.tag_postings),
+            "memory_bytes": self.memory_bytes(),
+        }
+
+
+recipe_search_index = RecipeSearchIndex()
+
+
+async def keep_recipe_search_index_loaded(collection):
+    """Load the recipe search index and reload it periodically, for recipes written by other processes."""
+    if not RECIPE_SEARCH_ENABLED:
+        return
+    while True:
+        try:
+            await recipe_search_index.load(collection)
+        except Exception as e:
+            logger.error(f"Error loading the recipe search index: {e}")
+        await asyncio.sleep(RECIPE_SEARCH_RELOAD_SECONDS)
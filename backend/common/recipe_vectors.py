@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import math
+import os
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from .ingredients import WORD_PATTERN, canonical_word, ingredient_keys
+from .recipe_search import tokenize
+
+logger = logging.getLogger(__name__)
+
+#
+# Offline vector index of the recipes, for semantic search.
+#
+# Every recipe is embedded locally, without any model download or network call, as a hashed bag of
+# features: its stemmed words and their character n-grams, the canonical English names of its
+# ingredients, and a "quick" feature for recipes done within QUICK_MINUTES. The features are hashed
+# into EMBEDDING_DIMENSIONS signed buckets and the vector is L2 normalized, so that the dot product of
+# two vectors is their cosine similarity. Queries are embedded the same way, with their words also
+# expanded to related terms, so that "something warm and quick with chickpeas" finds a chickpea curry.
+#
+# The vectors are stored with the recipes (embedding and embedding_model) and updated on save and
+# update. The index is a float32 matrix written to RECIPE_VECTORS_PATH and memory-mapped, so that the
+# server starts serving searches without reading the recipes; it is rebuilt from MongoDB periodically,
+# and the recipe writes of this process are kept aside and searched along with the matrix until then.
+#
+
+RECIPE_VECTORS_ENABLED = os.environ.get("RECIPE_VECTORS_ENABLED", "true").lower() == "true"
+RECIPE_VECTORS_PATH = os.environ.get("RECIPE_VECTORS_PATH", "./data/recipe_vectors")
+RECIPE_VECTORS_RELOAD_SECONDS = int(os.environ.get("RECIPE_VECTORS_RELOAD_SECONDS", "3600"))
+
+# stored with every vector; any change to the embedding needs a new name, so that stored vectors are recomputed
+EMBEDDING_MODEL = "hashing-v1"
+EMBEDDING_DIMENSIONS = 512
+
+# weight of a word in each field of a recipe
+FIELD_WEIGHTS = {"name": 3.0, "tags": 2.0, "description": 1.5, "ingredients": 1.5, "steps": 0.5}
+
+# character n-grams match inflected and compound words, e.g. kikherneitä and kikhernekeitto
+NGRAM_SIZE = 4
+NGRAM_WEIGHT = 0.5
+
+# recipes with a cooking and preparation time of at most this many minutes get the "quick" feature
+QUICK_MINUTES = 30
+
+# weight of the related terms a query word is expanded to
+RELATED_WEIGHT = 0.5
+
+# fmt: off
+RELATED_TERMS = {
+    "warm": ("soup", "stew", "curry", "roast", "baked", "casserole"),
+    "hot": ("soup", "stew", "curry", "chili", "spicy"),
+    "cold": ("salad", "smoothie", "ice"),
+    "fast": ("quick",), "easy": ("quick",), "simple": ("quick",),
+    "light": ("salad", "soup", "vegetable", "fish"),
+    "healthy": ("salad", "vegetable", "vegan", "lentil", "fish"),
+    "hearty": ("stew", "casserole", "potato", "meat", "pasta"),
+    "comfort": ("stew", "casserole", "pasta", "potato", "soup"),
+    "spicy": ("chili", "curry", "ginger", "pepper"),
+    "sweet": ("dessert", "cake", "sugar", "chocolate", "honey"),
+    "dessert": ("cake", "sugar", "chocolate", "pie"),
+    "vegetarian": ("vegan", "vegetable", "lentil", "bean", "chickpea"),
+    "breakfast": ("egg", "oat", "porridge", "yoghurt", "pancake"),
+    "winter": ("soup", "stew", "roast", "casserole"),
+    "summer": ("salad", "grill", "berry"),
+}
+# fmt: on
+
+# cosine similarity below which a recipe is not a match
+MIN_SCORE = 0.05
+
+# rows of the matrix scored at a time, bounding the memory of a search over a memory-mapped matrix
+SEARCH_BLOCK_ROWS = 4096
+
+# recipes returned by a semantic search at most
+SEMANTIC_SEARCH_LIMIT = 10
+
+
+def word_features(text: str, weight: float, features: Counter):
+    """Add the stemmed words of a text and their character n-grams to the features"""
+    for term in tokenize(text):
+        features[f"w:{term}"] += weight
+        padded = f"<{term}>"
+        grams = [padded[i : i + NGRAM_SIZE] for i in range(max(1, len(padded) - NGRAM_SIZE + 1))]
+        for gram in grams:
+            features[f"c:{gram}"] += weight * NGRAM_WEIGHT / len(grams)
+
+
+def hashed_vector(features: Counter) -> np.ndarray:
+    """
+    L2 normalized float32 vector of weighted features: each feature is hashed to a bucket and a sign,
+    with its weight dampened logarithmically so that long recipes are not dominated by repeated words
+    """
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for feature, weight in features.items():
+        digest = zlib.crc32(feature.encode())
+        vector[digest % EMBEDDING_DIMENSIONS] += math.log1p(weight) if digest & 0x80000000 else -math.log1p(weight)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def recipe_embedding(document: dict) -> np.ndarray:
+    """Vector of a recipe document, from its text fields, canonical ingredients and times"""
+    features = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        value = document.get(field) or []
+        for text in [value] if isinstance(value, str) else value:
+            word_features(text, weight, features)
+    # English names of the ingredients, so that recipes written in Finnish match English queries
+    for key in ingredient_keys(document.get("ingredients")):
+        word_features(key, FIELD_WEIGHTS["ingredients"], features)
+    minutes = (document.get("cooking_time") or 0) + (document.get("preparation_time") or 0)
+    if 0 < minutes <= QUICK_MINUTES:
+        word_features("quick", FIELD_WEIGHTS["tags"], features)
+    return hashed_vector(features)
+
+
+def query_embedding(query: str) -> np.ndarray:
+    """Vector of a search query, with its words translated and expanded to related terms"""
+    features = Counter()
+    word_features(query, 1.0, features)
+    for word in WORD_PATTERN.findall(str(query or "").lower()):
+        canonical = canonical_word(word)
+        if canonical != word:
+            word_features(canonical, 1.0, features)
+        for related in RELATED_TERMS.get(canonical, ()):
+            word_features(related, RELATED_WEIGHT, features)
+    return hashed_vector(features)
+
+
+def recipe_vector_fields(document: dict) -> dict:
+    """Fields storing the vector of a recipe document alongside it"""
+    return {"embedding": recipe_embedding(document).tolist(), "embedding_model": EMBEDDING_MODEL}
+
+
+def stored_embedding(document: dict) -> np.ndarray:
+    """Vector stored with a recipe document, or computed if it is missing or from another model"""
+    if document.get("embedding_model") == EMBEDDING_MODEL and len(document.get("embedding") or []) == EMBEDDING_DIMENSIONS:
+        return np.asarray(document["embedding"], dtype=np.float32)
+    return recipe_embedding(document)
+
+
+def top_k_cosine(queries: np.ndarray, blocks, k: int):
+    """
+    Top k rows by dot product for a batch of normalized query vectors, scanning the rows block by block.
+
+    Args:
+        queries: (queries, dimensions) matrix
+        blocks: iterable of (rows, labels) pairs, a (n, dimensions) matrix and the n integer labels of its
+            rows, -1 for rows to skip
+        k: rows returned per query at most
+
+    Returns:
+        (scores, labels) matrices of shape (queries, up to k), unsorted
+    """
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_labels = np.empty((len(queries), 0), dtype=np.int64)
+    for rows, labels in blocks:
+        if not len(rows):
+            continue
+        scores = queries @ np.asarray(rows, dtype=np.float32).T
+        scores[:, labels < 0] = -np.inf
+        scores = np.concatenate([best_scores, scores], axis=1)
+        labels = np.concatenate([best_labels, np.broadcast_to(labels, (len(queries), len(labels)))], axis=1)
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores, labels = np.take_along_axis(scores, top, axis=1), np.take_along_axis(labels, top, axis=1)
+        best_scores, best_labels = scores, labels
+    return best_scores, best_labels
+
+
+def ranked_matches(scores: np.ndarray, labels: np.ndarray, ids: list) -> list:
+    """(id, score) pairs of the matches of one query, best first"""
+    order = np.argsort(-scores)
+    return [(ids[labels[i]], float(scores[i])) for i in order if scores[i] >= MIN_SCORE and labels[i] >= 0]
+
+
+class RecipeVectorIndex:
+    """Memory-mapped matrix of recipe vectors, with the recipes written since it was built kept aside."""
+
+    def __init__(self, path: str = RECIPE_VECTORS_PATH):
+        self.path = Path(path)
+        self._lock = asyncio.Lock()
+        # ids of the rows of the matrix, and their row numbers
+        self.ids = []
+        self.rows = {}
+        self.vectors = np.empty((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        # rows of recipes deleted or updated since the matrix was built are skipped
+        self.live = np.empty(0, dtype=bool)
+        # vectors of the recipes saved or updated since the matrix was built
+        self.pending = {}
+        # while a load reads the recipes, the writes made meanwhile, to apply again over what it read:
+        # recipe id -> vector, or None when deleted
+        self.written = None
+        self.loaded = False
+        self.loaded_at = None
+        self.load_seconds = None
+        self.reloads = 0
+        self.updates = 0
+
+    @property
+    def vectors_file(self) -> Path:
+        # the model is part of the file name, so that a file of another model is never opened
+        return self.path.with_name(f"{self.path.name}.{EMBEDDING_MODEL}.npy")
+
+    @property
+    def ids_file(self) -> Path:
+        return self.path.with_name(f"{self.path.name}.{EMBEDDING_MODEL}.ids.npy")
+
+    def __len__(self) -> int:
+        """Number of indexed recipes."""
+        return int(self.live.sum()) + len(self.pending)
+
+    def _use(self, ids: list, vectors: np.ndarray):
+        self.ids = ids
+        self.rows = {recipe_id: row for row, recipe_id in enumerate(ids)}
+        self.vectors = vectors
+        self.live = np.ones(len(ids), dtype=bool)
+        self.pending = {}
+        self.loaded = True
+        self.loaded_at = datetime.utcnow()
+
+    def open(self) -> bool:
+        """Memory-map the matrix written by the last build, if there is one. Returns whether it was opened."""
+        if not self.vectors_file.exists() or not self.ids_file.exists():
+            return False
+        try:
+            vectors = np.load(self.vectors_file, mmap_mode="r")
+            ids = np.load(self.ids_file).tolist()
+        except (OSError, ValueError) as e:
+            logger.error(f"Error opening the recipe vectors in {self.vectors_file}: {e}")
+            return False
+        if vectors.shape != (len(ids), EMBEDDING_DIMENSIONS):
+            logger.error(f"Recipe vectors in {self.vectors_file} do not match their ids, ignoring them")
+            return False
+        self._use(ids, vectors)
+        logger.info(f"Opened {len(ids)} recipe vector(s) from {self.vectors_file}")
+        return True
+
+    def build(self, documents: list):
+        """Write the vectors of the recipe documents to disk and memory-map them."""
+        ids = [str(document["_id"]) for document in documents]
+        vectors = np.array([stored_embedding(document) for document in documents], dtype=np.float32)
+        vectors = vectors.reshape(len(ids), EMBEDDING_DIMENSIONS)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # written next to the files and renamed over them, so that readers never see a partial file
+        for file, array in ((self.vectors_file, vectors), (self.ids_file, np.array(ids, dtype=str))):
+            partial = file.with_name(file.name + ".partial")
+            with open(partial, "wb") as f:
+                np.save(f, array)
+            os.replace(partial, file)
+        self._use(ids, np.load(self.vectors_file, mmap_mode="r") if ids else vectors)
+
+    async def load(self, collection):
+        """(Re)build the index from the vectors stored with the recipes."""
+        async with self._lock:
+            start = time.perf_counter()
+            projection = {"embedding": 1, "embedding_model": 1, "cooking_time": 1, "preparation_time": 1}
+            projection.update({field: 1 for field in FIELD_WEIGHTS})
+            self.written = {}
+            try:
+                documents = [document async for document in collection.find({}, projection)]
+                # the cursor may have read a recipe before it was written again or deleted by this
+                # process, so the writes made while it ran are applied over the build
+                written, self.written = self.written, None
+                self.build(documents)
+                for recipe_id, vector in written.items():
+                    self._write(recipe_id, vector)
+            finally:
+                self.written = None
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            self.reloads += 1
+            logger.info(f"Built {len(self)} recipe vector(s) in {self.load_seconds} seconds")
+
+    def _write(self, recipe_id: str, vector: Optional[np.ndarray]):
+        if recipe_id in self.rows:
+            self.live[self.rows[recipe_id]] = False
+        if vector is None:
+            self.pending.pop(recipe_id, None)
+        else:
+            self.pending[recipe_id] = vector
+        if self.written is not None:
+            self.written[recipe_id] = vector
+
+    def upsert(self, recipe_id, vector):
+        """Index the vector of a recipe that was saved or updated."""
+        self._write(str(recipe_id), np.asarray(vector, dtype=np.float32))
+        self.updates += 1
+
+    def remove(self, recipe_id):
+        """Drop a deleted recipe from the index."""
+        self._write(str(recipe_id), None)
+        self.updates += 1
+
+    def _blocks(self):
+        for start in range(0, len(self.ids), SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, len(self.ids))
+            yield self.vectors[start:end], np.where(self.live[start:end], np.arange(start, end), -1)
+        if self.pending:
+            rows = np.stack(list(self.pending.values()))
+            yield rows, np.arange(len(self.ids), len(self.ids) + len(rows))
+
+    def search_many(self, queries: list, limit: int = SEMANTIC_SEARCH_LIMIT) -> list:
+        """
+        Recipes most similar to each of the queries, scored in one pass over the matrix.
+
+        Returns:
+            for every query, (recipe id, cosine similarity) pairs of at most limit recipes, best first
+        """
+        if not queries:
+            return []
+        vectors = np.stack([query_embedding(query) for query in queries])
+        scores, labels = top_k_cosine(vectors, self._blocks(), limit)
+        ids = self.ids + list(self.pending)
+        return [ranked_matches(scores[i], labels[i], ids) for i in range(len(queries))]
+
+    def search(self, query: str, limit: int = SEMANTIC_SEARCH_LIMIT) -> list:
+        """(recipe id, cosine similarity) pairs of the recipes most similar to the query, best first"""
+        return self.search_many([query], limit)[0]
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "load_seconds": self.load_seconds,
+            "reloads": self.reloads,
+            "updates": self.updates,
+            "recipes": len(self),
+            "pending": len(self.pending),
+            "model": EMBEDDING_MODEL,
+            "dimensions": EMBEDDING_DIMENSIONS,
+            "file": str(self.vectors_file),
+            "memory_mapped": isinstance(self.vectors, np.memmap),
+        }
+
+
+recipe_vector_index = RecipeVectorIndex()
+
+
+async def semantic_search(collection, query: str, limit: int = SEMANTIC_SEARCH_LIMIT) -> list:
+    """
+    (recipe id, cosine similarity) pairs of the recipes most similar to the query, best first: from the
+    index once loaded, and by scanning the vectors stored with the recipes until then
+    """
+    if recipe_vector_index.loaded:
+        return recipe_vector_index.search(query, limit)
+    documents = [document async for document in collection.find({}, {"embedding": 1, "embedding_model": 1})]
+    documents = [document for document in documents if document.get("embedding_model") == EMBEDDING_MODEL]
+    if not documents:
+        return []
+    rows = np.array([document["embedding"] for document in documents], dtype=np.float32)
+    scores, labels = top_k_cosine(query_embedding(query)[np.newaxis], [(rows, np.arange(len(rows)))], limit)
+    return ranked_matches(scores[0], labels[0], [str(document["_id"]) for document in documents])
+
+
+async def keep_recipe_vector_index_loaded(collection):
+    """
+    Open the recipe vectors written by the last run, so that semantic searches are served right away,
+    then rebuild them from MongoDB periodically, for recipes written by other processes.
+    """
+    if not RECIPE_VECTORS_ENABLED:
+        return
+    recipe_vector_index.open()
+    while True:
+        try:
+            await recipe_vector_index.load(collection)
+        except Exception as e:
+            logger.error(f"Error building the recipe vector index: {e}")
+        await asyncio.sleep(RECIPE_VECTORS_RELOAD_SECONDS)
@@ -1,12 +1,15 @@
 """
 Repository factory module for the AI Agent Vision application.
-This module provides factory functions to get repository instances.
+This module provides factory functions to get repository instances. The async flavours
+(get_async_*) are meant for code running on the event loop, such as graph nodes and tools.
 """
 
 import logging
 import os
 from typing import Any, Dict
 
+from .async_receipt_repository import AsyncReceiptRepository
+from .async_recipe_repository import AsyncRecipeRepository
 from .receipt_repository import ReceiptRepository
 from .recipe_repository import RecipeRepository
 
@@ -55,3 +58,47 @@ def get_recipe_repository(connection_params: Dict[str, Any] = None) -> RecipeRep
 
     logger.info("Creating recipe repository")
     return RecipeRepository(connection_params)
+
+
+def get_async_receipt_repository(connection_params: Dict[str, Any] = None) -> AsyncReceiptRepository:
+    """
+    Factory function to get an async receipt repository instance
+
+    Args:
+        connection_params: Dictionary containing MongoDB connection parameters
+                          (uri, database)
+
+    Returns:
+        AsyncReceiptRepository instance
+    """
+    # Use default connection params if not specified
+    if connection_params is None:
+        connection_params = {
+            "uri": os.environ.get("MONGODB_URI", "mongodb://localhost:27017"),
+            "database": os.environ.get("MONGODB_DATABASE", "receipts"),
+        }
+
+    logger.info("Creating async receipt repository")
+    return AsyncReceiptRepository(connection_params)
+
+
+def get_async_recipe_repository(connection_params: Dict[str, Any] = None) -> AsyncRecipeRepository:
+    """
+    Factory function to get an async recipe repository instance
+
+    Args:
+        connection_params: Dictionary containing MongoDB connection parameters
+                          (uri, database)
+
+    Returns:
+        AsyncRecipeRepository instance
+    """
+    # Use default connection params if not specified
+    if connection_params is None:
+        connection_params = {
+            "uri": os.environ.get("MONGODB_URI", "mongodb://localhost:27017"),
+            "database": os.environ.get("MONGODB_DATABASE", "receipts"),
+        }
+
+    logger.info("Creating async recipe repository")
+    return AsyncRecipeRepository(connection_params)
@@ -1,29 +1,37 @@
 import os
+from datetime import date, datetime
 
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Request
 from fastapi.responses import JSONResponse
-from motor.motor_asyncio import AsyncIOMotorClient
 
 from common.analytics import (
-    calculate_daily_spend,
-    calculate_monthly_spend,
-    calculate_weekly_spend,
-    calculate_yearly_monthly_spend,
-    calculate_yearly_spend,
+    RECEIPTS_COLLECTION,
+    aggregates_version,
+    find_yearly_spend,
+    query_spend,
+    recalculation_jobs,
+    receipt_change_coalescer,
 )
+from common.analytics_cube import DIMENSION_COLUMNS, line_item_cube
+from common.mongo_clients import mongo_clients
+from common.server.response_cache import ResponseCache
 
-MONGO_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
-DB_NAME = os.environ.get("MONGODB_DATABASE", "receipts")
 AGGREGATES_COLLECTION = "aggregates"
 
-mongo_client = AsyncIOMotorClient(MONGO_URI)
-db = mongo_client[DB_NAME]
+# Aggregate responses are cached in-process until the aggregates change, or for this long at most
+ANALYTICS_CACHE_TTL_SECONDS = float(os.environ.get("ANALYTICS_CACHE_TTL_SECONDS", "300"))
+ANALYTICS_CACHE_MAX_ENTRIES = int(os.environ.get("ANALYTICS_CACHE_MAX_ENTRIES", "1000"))
+
+db = mongo_clients.async_db
 
 analytics_router = APIRouter()
 
+analytics_cache = ResponseCache(aggregates_version, ANALYTICS_CACHE_TTL_SECONDS, ANALYTICS_CACHE_MAX_ENTRIES)
+
 
 @analytics_router.get("/analytics/monthly_spend")
-async def get_monthly_spend(year: int = Query(None), month: int = Query(None)):
+@analytics_cache.cached
+async def get_monthly_spend(request: Request, year: int = Query(None), month: int = Query(None)):
     """
     Returns monthly spend aggregates (overall, level_1, level_2, level_3) for a specific year and month.
     """
@@ -38,56 +46,41 @@ async def get_monthly_spend(year: int = Query(None), month: int = Query(None)):
         return JSONResponse(content={"error": "Both year and month must be specified."}, status_code=400)
 
 
+YEARLY_SPEND_LEVELS = ("overall", "level_1", "level_2", "level_3")
+
+
+async def _yearly_spend(year: int, levels: list):
+    if levels and any(level not in YEARLY_SPEND_LEVELS for level in levels):
+        return JSONResponse(content={"error": f"levels must be one of {', '.join(YEARLY_SPEND_LEVELS)}."}, status_code=400)
+    data = await find_yearly_spend(year, levels)
+    if data is None:
+        return JSONResponse(content={"error": "No yearly spend data found."}, status_code=404)
+    return {"yearly_spend": data}
+
+
 @analytics_router.get("/analytics/yearly_spend")
-async def get_yearly_spend(year: int = Query(None)):
+@analytics_cache.cached
+async def get_yearly_spend(request: Request, year: int = Query(None), levels: list[str] = Query(None)):
     """
     Returns yearly spend aggregates (overall, level_1, level_2, level_3) for all years or a specific year if provided.
+    Only the requested levels are returned when levels is given, e.g. ?year=2025&levels=overall&levels=level_1
     """
-    doc = await db[AGGREGATES_COLLECTION].find_one({"type": "yearly_spend"})
-    if not doc or "data" not in doc:
-        return JSONResponse(content={"error": "No yearly spend data found."}, status_code=404)
-    data = doc["data"]
-    # Optionally filter by year
-    if year is not None:
-
-        def filter_year(arr, key="year"):
-            return [d for d in arr if d["_id"].get(key) == year]
-
-        data = {
-            "overall": filter_year(data.get("overall", [])),
-            "level_1": filter_year(data.get("level_1", [])),
-            "level_2": filter_year(data.get("level_2", [])),
-            "level_3": filter_year(data.get("level_3", [])),
-        }
-    return {"yearly_spend": data}
+    return await _yearly_spend(year, levels)
 
 
 @analytics_router.get("/analytics/yearly_spend_full")
-async def get_yearly_spend_full(year: int = Query(None)):
+@analytics_cache.cached
+async def get_yearly_spend_full(request: Request, year: int = Query(None), levels: list[str] = Query(None)):
     """
     Returns yearly spend aggregates (overall, level_1, level_2, level_3) for all years or a specific year if provided.
+    Only the requested levels are returned when levels is given.
     """
-    doc = await db[AGGREGATES_COLLECTION].find_one({"type": "yearly_spend"})
-    if not doc or "data" not in doc:
-        return JSONResponse(content={"error": "No yearly spend data found."}, status_code=404)
-    data = doc["data"]
-    # Optionally filter by year
-    if year is not None:
-
-        def filter_year(arr, key="year"):
-            return [d for d in arr if d["_id"].get(key) == year]
-
-        data = {
-            "overall": filter_year(data.get("overall", [])),
-            "level_1": filter_year(data.get("level_1", [])),
-            "level_2": filter_year(data.get("level_2", [])),
-            "level_3": filter_year(data.get("level_3", [])),
-        }
-    return {"yearly_spend": data}
+    return await _yearly_spend(year, levels)
 
 
 @analytics_router.get("/analytics/weekly_spend")
-async def get_weekly_spend(year: int = Query(None), week: int = Query(None)):
+@analytics_cache.cached
+async def get_weekly_spend(request: Request, year: int = Query(None), week: int = Query(None)):
     """
     Returns weekly spend aggregates (overall, level_1, level_2, level_3) for a specific year and week.
     """
@@ -103,7 +96,8 @@ async def get_weekly_spend(year: int = Query(None), week: int = Query(None)):
 
 
 @analytics_router.get("/analytics/daily_spend")
-async def get_daily_spend(year: int = Query(None), month: int = Query(None)):
+@analytics_cache.cached
+async def get_daily_spend(request: Request, year: int = Query(None), month: int = Query(None)):
     """
     Returns daily spend aggregates (overall, level_1, level_2, level_3) for a specific year and month.
     """
@@ -119,7 +113,8 @@ async def get_daily_spend(year: int = Query(None), month: int = Query(None)):
 
 
 @analytics_router.get("/analytics/yearly_monthly_spend")
-async def get_yearly_monthly_spend(year: int = Query(...)):
+@analytics_cache.cached
+async def get_yearly_monthly_spend(request: Request, year: int = Query(...)):
     """
     Returns yearly spend per month (overall and level_1 breakdown) for a specific year.
     """
@@ -137,14 +132,120 @@ async def get_yearly_monthly_spend(year: int = Query(...)):
     return {"yearly_monthly_spend": result}
 
 
+@analytics_router.get("/analytics/spend")
+@analytics_cache.cached
+async def get_spend(
+    request: Request,
+    date_from: date = Query(..., alias="from"),
+    date_to: date = Query(..., alias="to"),
+    granularity: str = Query("month"),
+    level: str = Query(None),
+    level_1: str = Query(None),
+    level_2: str = Query(None),
+    level_3: str = Query(None),
+    store: str = Query(None),
+):
+    """
+    Returns the spend per day, week, month, quarter or year between two dates (both inclusive),
+    optionally broken down by a category level (level_1, level_2 or level_3) and filtered by
+    category values and store, e.g. /analytics/spend?from=2021-01-01&to=2025-12-31&granularity=quarter&level=level_1
+    """
+    if date_from > date_to:
+        return JSONResponse(content={"error": "from must not be after to."}, status_code=400)
+
+    values = {"level_1": level_1, "level_2": level_2, "level_3": level_3}
+    categories = {field: value for field, value in values.items() if value is not None}
+    start = datetime(date_from.year, date_from.month, date_from.day)
+    end = datetime(date_to.year, date_to.month, date_to.day)
+    try:
+        rows = await query_spend(start, end, granularity, level, categories, store)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    for row in rows:
+        row["period"] = row["period"].date().isoformat()
+    return {"spend": rows}
+
+
 @analytics_router.get("/analytics/recalculate")
 async def recalculate_aggregates():
     """
     Manually trigger recalculation of all analytics aggregates (yearly, monthly, daily, weekly, yearly_monthly).
+    The recalculation runs in the background; while one is running, the running job is returned instead of
+    starting another one. Its progress is available from /analytics/recalculate/{job_id}.
+    """
+    job, started = recalculation_jobs.start()
+    message = "Recalculation started." if started else "Recalculation already running."
+    return JSONResponse(content={"status": "ok", "message": message, "job": job.to_dict()}, status_code=202)
+
+
+@analytics_router.get("/analytics/recalculate/{job_id}")
+async def get_recalculation_job(job_id: str):
+    """
+    Returns the status and the progress per granularity of a recalculation job.
+    """
+    job = recalculation_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "No recalculation job found with the specified id."}, status_code=404)
+    return {"job": job.to_dict()}
+
+
+@analytics_router.get("/analytics/listener_stats")
+async def get_listener_stats():
+    """
+    Returns the counters of the receipts change listener: events seen, events merged into an earlier
+    recalculation of the same burst, and recalculations run.
+    """
+    return {"listener_stats": receipt_change_coalescer.stats()}
+
+
+@analytics_router.get("/analytics/cache_stats")
+async def get_cache_stats():
+    """
+    Returns the counters of the analytics response cache.
+    """
+    return {"cache_stats": analytics_cache.stats()}
+
+
+@analytics_router.get("/analytics/cube/query")
+async def query_line_item_cube(
+    group_by: list[str] = Query([]),
+    measures: list[str] = Query(["total_price"]),
+    date_from: date = Query(None),
+    date_to: date = Query(None),
+    level_1: list[str] = Query(None),
+    level_2: list[str] = Query(None),
+    level_3: list[str] = Query(None),
+    store: list[str] = Query(None),
+):
+    """
+    Aggregates the line items in the in-memory cube by any combination of category levels, store
+    and one time grain (day, week, month, year), e.g.
+    /analytics/cube/query?group_by=month&group_by=level_1&date_from=2025-01-01&store=K-Citymarket
+    """
+    if not line_item_cube.loaded:
+        return JSONResponse(content={"error": "The line item cube is not loaded."}, status_code=503)
+
+    values = {"level_1": level_1, "level_2": level_2, "level_3": level_3, "store": store}
+    filters = {field: values[field] for field in DIMENSION_COLUMNS if values[field]}
+    try:
+        rows = line_item_cube.query(group_by, measures, date_from, date_to, filters)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return {"rows": rows}
+
+
+@analytics_router.get("/analytics/cube/stats")
+async def get_line_item_cube_stats():
+    """
+    Returns the size and memory footprint of the line item cube and when it was last loaded.
+    """
+    return {"cube_stats": line_item_cube.stats()}
+
+
+@analytics_router.get("/analytics/cube/reload")
+async def reload_line_item_cube():
+    """
+    Manually reload the line item cube from the receipts collection.
     """
-    await calculate_yearly_spend()
-    await calculate_monthly_spend()
-    await calculate_daily_spend()
-    await calculate_weekly_spend()
-    await calculate_yearly_monthly_spend()
-    return {"status": "ok", "message": "Recalculation ok."}
+    await line_item_cube.load(db[RECEIPTS_COLLECTION])
+    return {"status": "ok", "message": "Reload ok.", "cube_stats": line_item_cube.stats()}
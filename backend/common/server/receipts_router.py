@@ -0,0 +1,60 @@
+from datetime import date
+
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import JSONResponse
+
+from common.receipt_repository import RECEIPTS_IMPORT_CHUNK_SIZE, load_receipts_export
+from common.repository_factory import get_async_receipt_repository
+
+RECEIPTS_PAGE_DEFAULT_LIMIT = 50
+RECEIPTS_PAGE_MAX_LIMIT = 200
+
+receipt_repository = get_async_receipt_repository()
+
+receipts_router = APIRouter()
+
+
+@receipts_router.get("/receipts")
+async def get_receipts(
+    limit: int = Query(RECEIPTS_PAGE_DEFAULT_LIMIT, ge=1, le=RECEIPTS_PAGE_MAX_LIMIT),
+    cursor: str = Query(None),
+    fields: list[str] = Query(None),
+    date_from: date = Query(None, alias="from"),
+    date_to: date = Query(None, alias="to"),
+    store: str = Query(None),
+):
+    """
+    Returns one page of receipts, newest first, and the cursor of the next page (null on the last page).
+    Pass next_cursor back as cursor to get the following page. fields limits what is returned, e.g.
+    /receipts?fields=receipt_data for the receipt headers without items; from/to (receipt date, inclusive)
+    and store filter the receipts.
+    """
+    if date_from and date_to and date_from > date_to:
+        return JSONResponse(content={"error": "from must not be after to."}, status_code=400)
+
+    try:
+        return await receipt_repository.get_receipts_page(
+            limit=limit,
+            cursor=cursor,
+            fields=fields,
+            start_date=date_from.isoformat() if date_from else None,
+            end_date=date_to.isoformat() if date_to else None,
+            store=store,
+        )
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+
+@receipts_router.post("/receipts/import")
+async def import_receipts(request: Request, chunk_size: int = Query(RECEIPTS_IMPORT_CHUNK_SIZE, ge=1)):
+    """
+    Imports a batch of receipts sent as the request body: a JSON list of receipts, an object with a
+    receipts list, or JSON Lines. Receipts that are already stored are skipped and receipts that cannot
+    be saved are listed in the report, by position in the batch, without failing the import.
+    """
+    try:
+        receipts = load_receipts_export((await request.body()).decode("utf-8"))
+    except (ValueError, UnicodeDecodeError) as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    return {"import": await receipt_repository.save_receipts_bulk(receipts, chunk_size=chunk_size)}
@@ -1,21 +1,51 @@
+import hashlib
+import json
 import logging
-import os
+from datetime import UTC, datetime
 from typing import Any, Dict
 
 from bson import ObjectId
-from fastapi import APIRouter, Body, HTTPException, status
-from fastapi.responses import JSONResponse
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi import APIRouter, Body, HTTPException, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from common.ingredients import ingredient_keys
+from common.mongo_clients import mongo_clients
+from common.recipe_recommender import (
+    RECOMMENDER_DEFAULT_DAYS,
+    RECOMMENDER_DEFAULT_LIMIT,
+    RECOMMENDER_MAX_DAYS,
+    recipe_recommender,
+)
+from common.recipe_repository import (
+    RECIPE_INTERNAL_FIELDS,
+    RECIPES_PAGE_SORT,
+    recipes_next_cursor,
+    recipes_page_query,
+    recipes_projection,
+)
+from common.recipe_search import recipe_search_index
+from common.recipe_vectors import (
+    SEMANTIC_SEARCH_LIMIT,
+    recipe_vector_fields,
+    recipe_vector_index,
+    semantic_search,
+)
+from common.server.response_cache import etag_matches, etag_response
 
 RECIPES_COLLECTION = "recipes"
 
-MONGO_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
-DB_NAME = os.environ.get("MONGODB_DATABASE", "receipts")
+RECIPES_PAGE_DEFAULT_LIMIT = 50
+RECIPES_PAGE_MAX_LIMIT = 200
+SEMANTIC_SEARCH_MAX_LIMIT = 50
+RECOMMENDATIONS_MAX_LIMIT = 50
+
+# recipes read from MongoDB per round trip while streaming the NDJSON export
+RECIPES_STREAM_BATCH_SIZE = 100
 
 logger = logging.getLogger(__name__)
 
-mongo_client = AsyncIOMotorClient(MONGO_URI)
-db = mongo_client[DB_NAME]
+db = mongo_clients.async_db
 
 recipes_router = APIRouter()
 
@@ -23,22 +53,146 @@ recipes_router = APIRouter()
 
 
 def recipe_to_dict(recipe: Dict[str, Any]) -> Dict[str, Any]:
-    recipe = dict(recipe)
+    recipe = {key: value for key, value in recipe.items() if key not in RECIPE_INTERNAL_FIELDS}
     recipe["id"] = str(recipe.pop("_id"))
     return recipe
 
 
+async def recipes_etag(view: str) -> str:
+    """
+    Weak ETag of the recipes collection, from its size and last update, for responses that are
+    streamed before their body is known
+    """
+    state = (
+        await db[RECIPES_COLLECTION]
+        .aggregate([{"$group": {"_id": None, "count": {"$sum": 1}, "updated_at": {"$max": "$updated_at"}}}])
+        .to_list(length=1)
+    )
+    content = json.dumps([view, state[0]["count"], state[0]["updated_at"]] if state else [view], default=str)
+    return f'W/"{hashlib.sha1(content.encode()).hexdigest()}"'
+
+
+async def stream_recipes(query: Dict[str, Any], projection: Dict[str, Any]):
+    cursor = db[RECIPES_COLLECTION].find(query, projection).sort(RECIPES_PAGE_SORT).batch_size(RECIPES_STREAM_BATCH_SIZE)
+    async for document in cursor:
+        yield json.dumps(jsonable_encoder(recipe_to_dict(document))) + "\n"
+
+
 @recipes_router.get("/recipes")
-async def get_all_recipes():
+async def get_recipes(
+    request: Request,
+    limit: int = Query(RECIPES_PAGE_DEFAULT_LIMIT, ge=1, le=RECIPES_PAGE_MAX_LIMIT),
+    cursor: str = Query(None),
+    view: str = Query("full"),
+    format: str = Query("json"),
+):
+    """
+    Returns one page of recipes, newest first, and the cursor of the next page (null on the last page).
+    Pass next_cursor back as cursor to get the following page. view=summary returns only the name, tags
+    and times of the recipes, the whole recipe is then fetched from /recipes/{recipe_id}.
+    format=ndjson streams all the recipes after the cursor instead, one JSON object per line, for export.
+    """
+    try:
+        query = recipes_page_query(cursor)
+        projection = recipes_projection(view)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    if format not in ("json", "ndjson"):
+        return JSONResponse(content={"error": "format must be json or ndjson."}, status_code=400)
+
     try:
-        cursor = db[RECIPES_COLLECTION].find()
-        recipes = [recipe_to_dict(doc) async for doc in cursor]
-        return {"recipes": recipes}
+        if format == "ndjson":
+            etag = await recipes_etag(view)
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if etag_matches(request, etag):
+                return Response(status_code=304, headers=headers)
+            return StreamingResponse(stream_recipes(query, projection), media_type="application/x-ndjson", headers=headers)
+
+        documents = (
+            await db[RECIPES_COLLECTION].find(query, projection).sort(RECIPES_PAGE_SORT).limit(limit + 1).to_list(length=None)
+        )
+        page = {
+            "recipes": [recipe_to_dict(doc) for doc in documents[:limit]],
+            "next_cursor": recipes_next_cursor(documents, limit),
+        }
+        return etag_response(request, page)
     except Exception as e:
         logger.error(f"Error fetching recipes: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch recipes.")
 
 
+@recipes_router.get("/recipes/semantic_search")
+async def semantic_search_recipes(
+    q: str = Query(..., min_length=1), limit: int = Query(SEMANTIC_SEARCH_LIMIT, ge=1, le=SEMANTIC_SEARCH_MAX_LIMIT)
+):
+    """
+    Returns the recipes most similar in meaning to a description, e.g. "something warm and quick with
+    chickpeas", most similar first, each with its cosine similarity to the description as score.
+    """
+    try:
+        ranked = await semantic_search(db[RECIPES_COLLECTION], q, limit)
+        ids = [ObjectId(recipe_id) for recipe_id, _ in ranked]
+        projection = {field: 0 for field in RECIPE_INTERNAL_FIELDS}
+        documents = {doc["_id"]: doc async for doc in db[RECIPES_COLLECTION].find({"_id": {"$in": ids}}, projection)}
+    except Exception as e:
+        logger.error(f"Error searching recipes semantically: {e}")
+        raise HTTPException(status_code=500, detail="Failed to search recipes.")
+    recipes = [
+        {**recipe_to_dict(documents[oid]), "score": round(score, 4)}
+        for oid, (_, score) in zip(ids, ranked)
+        if oid in documents
+    ]
+    return {"recipes": recipes}
+
+
+@recipes_router.get("/recipes/recommendations")
+async def get_recipe_recommendations(
+    days: int = Query(RECOMMENDER_DEFAULT_DAYS, ge=1, le=RECOMMENDER_MAX_DAYS),
+    limit: int = Query(RECOMMENDER_DEFAULT_LIMIT, ge=1, le=RECOMMENDATIONS_MAX_LIMIT),
+):
+    """
+    Returns the recipes that can best be cooked with the ingredients bought in the last days, best
+    covered first, each with its coverage (share of its ingredients that were bought, pantry staples
+    aside) and the matched and missing ingredients.
+    """
+    if not recipe_recommender.loaded:
+        return JSONResponse(content={"error": "The recipe recommender is not loaded."}, status_code=503)
+
+    recommendations = recipe_recommender.recommend(days, limit)
+    try:
+        ids = [recommendation["recipe_id"] for recommendation in recommendations]
+        projection = {field: 0 for field in RECIPE_INTERNAL_FIELDS}
+        documents = {doc["_id"]: doc async for doc in db[RECIPES_COLLECTION].find({"_id": {"$in": ids}}, projection)}
+    except Exception as e:
+        logger.error(f"Error fetching recommended recipes: {e}")
+        raise HTTPException(status_code=500, detail="Failed to recommend recipes.")
+    recipes = [
+        {
+            **recipe_to_dict(documents[recommendation["recipe_id"]]),
+            **{field: recommendation[field] for field in ("coverage", "matched", "missing")},
+        }
+        for recommendation in recommendations
+        if recommendation["recipe_id"] in documents
+    ]
+    return {"days": days, "recipes": recipes}
+
+
+@recipes_router.get("/recipes/{recipe_id}")
+async def get_recipe(request: Request, recipe_id: str):
+    try:
+        oid = ObjectId(recipe_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid recipe id.")
+    try:
+        recipe = await db[RECIPES_COLLECTION].find_one({"_id": oid}, {field: 0 for field in RECIPE_INTERNAL_FIELDS})
+    except Exception as e:
+        logger.error(f"Error fetching recipe {recipe_id}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch recipe.")
+    if recipe is None:
+        raise HTTPException(status_code=404, detail="Recipe not found.")
+    return etag_response(request, recipe_to_dict(recipe))
+
+
 @recipes_router.put("/recipes/{recipe_id}")
 async def update_recipe(recipe_id: str, data: Dict[str, Any] = Body(...)):
     try:
@@ -46,10 +200,21 @@ async def update_recipe(recipe_id: str, data: Dict[str, Any] = Body(...)):
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid recipe id.")
     try:
+        existing = await db[RECIPES_COLLECTION].find_one({"_id": oid})
+        if existing is None:
+            raise HTTPException(status_code=404, detail="Recipe not found.")
+        # updated_at is part of the ETag of the recipes export
+        data = {**data, "updated_at": datetime.now(UTC)}
+        if "ingredients" in data:
+            data["ingredient_keys"] = ingredient_keys(data["ingredients"])
+        data.update(recipe_vector_fields({**existing, **data}))
         result = await db[RECIPES_COLLECTION].update_one({"_id": oid}, {"$set": data})
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Recipe not found.")
-        updated = await db[RECIPES_COLLECTION].find_one({"_id": oid})
+        updated = {**existing, **data}
+        recipe_search_index.upsert(oid, updated)
+        recipe_vector_index.upsert(oid, updated["embedding"])
+        recipe_recommender.upsert_recipe(oid, updated)
         return recipe_to_dict(updated)
     except HTTPException:
         raise
@@ -68,6 +233,9 @@ async def delete_recipe(recipe_id: str):
         result = await db[RECIPES_COLLECTION].delete_one({"_id": oid})
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Recipe not found.")
+        recipe_search_index.remove(oid)
+        recipe_vector_index.remove(oid)
+        recipe_recommender.remove_recipe(oid)
         return JSONResponse(status_code=status.HTTP_200_OK, content={"message": f"Recipe {recipe_id} deleted successfully"})
     except HTTPException:
         raise
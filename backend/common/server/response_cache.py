@@ -0,0 +1,132 @@
+import functools
+import hashlib
+import logging
+import time
+from email.utils import format_datetime
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+
+def body_etag(body: bytes) -> str:
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the If-None-Match header of the request matches the ETag, weak or strong."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def etag_response(request: Request, content) -> Response:
+    """
+    JSON response with an ETag hashed from its body, or a 304 if the request already has that body.
+    Saves the transfer and the client work for responses that are not worth caching on the server.
+    """
+    body = JSONResponse(content=jsonable_encoder(content)).body
+    headers = {"ETag": body_etag(body), "Cache-Control": "no-cache"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+class ResponseCache:
+    """
+    In-process cache of JSON responses keyed by path and query parameters.
+
+    Entries are tagged with the version of the data they were computed from and dropped as soon
+    as that version changes or their TTL expires. Responses carry an ETag (a hash of the body) and
+    Last-Modified (when the data last changed); a request whose If-None-Match matches a cached
+    entry is answered with a 304 without computing anything.
+    """
+
+    def __init__(self, version, ttl_seconds: float = 300, max_entries: int = 1000):
+        """
+        Args:
+            version: object whose version and last_updated attributes describe the current data
+            ttl_seconds: how long an entry is served at most
+            max_entries: entries kept at most, the oldest are evicted first
+        """
+        self.version = version
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    def _headers(self, etag: str) -> dict:
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if self.version.last_updated is not None:
+            headers["Last-Modified"] = format_datetime(self.version.last_updated, usegmt=True)
+        return headers
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        version, expires, _, _ = entry
+        if version != self.version.version or expires < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def _store(self, key, etag: str, body: bytes):
+        self._entries.pop(key, None)
+        self._entries[key] = (self.version.version, time.monotonic() + self.ttl_seconds, etag, body)
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+    async def respond(self, request: Request, compute) -> Response:
+        """Serve the response for the request from the cache, or compute and cache it."""
+        key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+        entry = self._lookup(key)
+        if entry is not None:
+            _, _, etag, body = entry
+            if etag_matches(request, etag):
+                self.not_modified += 1
+                return Response(status_code=304, headers=self._headers(etag))
+            self.hits += 1
+            return Response(content=body, media_type="application/json", headers=self._headers(etag))
+
+        self.misses += 1
+        version = self.version.version
+        content = await compute()
+        if isinstance(content, Response):
+            # errors are not cached
+            return content
+
+        body = JSONResponse(content=jsonable_encoder(content)).body
+        etag = body_etag(body)
+        # the data may have changed while computing, in which case the response is not cached
+        if version == self.version.version:
+            self._store(key, etag, body)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=self._headers(etag))
+        return Response(content=body, media_type="application/json", headers=self._headers(etag))
+
+    def cached(self, endpoint):
+        """Decorator for endpoints that take the request as a keyword argument named request."""
+
+        @functools.wraps(endpoint)
+        async def cached_endpoint(*args, **kwargs):
+            return await self.respond(kwargs["request"], lambda: endpoint(*args, **kwargs))
+
+        return cached_endpoint
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "not_modified": self.not_modified,
+            "misses": self.misses,
+            "version": self.version.version,
+            "ttl_seconds": self.ttl_seconds,
+        }
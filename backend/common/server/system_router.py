@@ -0,0 +1,65 @@
+from fastapi import APIRouter
+
+from common.indexes import verify_hot_queries
+from common.migrations import migrations_status
+from common.mongo_clients import mongo_clients
+from common.recipe_recommender import recipe_recommender
+from common.recipe_search import recipe_search_index
+from common.recipe_vectors import recipe_vector_index
+
+system_router = APIRouter()
+
+
+@system_router.get("/system/mongo_pools")
+async def get_mongo_pool_stats():
+    """
+    Returns the settings of the shared MongoDB clients and the counters of their connection pools:
+    open and checked out connections, checkouts and the time spent waiting for a connection.
+    """
+    return {"mongo_pools": mongo_clients.stats()}
+
+
+@system_router.get("/system/indexes")
+async def verify_indexes():
+    """
+    Explains the hot queries of the application and returns the stages of their winning plans,
+    with collection_scan set for the queries that read a whole collection.
+    """
+    results = await verify_hot_queries()
+    return {"collection_scans": [result["query"] for result in results if result["collection_scan"]], "queries": results}
+
+
+@system_router.get("/system/migrations")
+async def get_migrations():
+    """
+    Returns the data migrations with their progress: status (pending, running, completed or failed),
+    the last migrated document and the number of documents scanned and modified.
+    """
+    return {"migrations": await migrations_status()}
+
+
+@system_router.get("/system/recipe_search")
+async def get_recipe_search_stats():
+    """
+    Returns the state of the in-memory recipe search index: recipes and terms indexed, when it
+    was last loaded and how long that took, and the updates applied since.
+    """
+    return {"recipe_search": recipe_search_index.stats()}
+
+
+@system_router.get("/system/recipe_vectors")
+async def get_recipe_vector_stats():
+    """
+    Returns the state of the recipe vector index: the embedding model, recipes indexed, the file the
+    vectors are memory-mapped from and when it was last built, and the recipe writes kept aside since.
+    """
+    return {"recipe_vectors": recipe_vector_index.stats()}
+
+
+@system_router.get("/system/recipe_recommender")
+async def get_recipe_recommender_stats():
+    """
+    Returns the state of the recipe recommender: purchases and recipes held, distinct ingredient
+    names, when it was last loaded and the receipt changes applied since.
+    """
+    return {"recipe_recommender": recipe_recommender.stats()}
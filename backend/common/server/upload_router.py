@@ -3,32 +3,28 @@ import os
 import uuid
 
 from fastapi import APIRouter, File, UploadFile
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.responses import JSONResponse
 
 from common.server.utils import get_uploads_folder
+from common.uploads import HASH_BLOCK_SIZE, find_upload_by_hash, new_content_hash, record_upload
 
 upload_router = APIRouter()
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-MONGO_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
-DB_NAME = os.environ.get("MONGODB_DATABASE", "receipts")
-AGGREGATES_COLLECTION = "aggregates"
-
-mongo_client = AsyncIOMotorClient(MONGO_URI)
-db = mongo_client[DB_NAME]
-
 
 @upload_router.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
-    def make_response(success: bool, file_id: str = None, error: str = None):
+    def make_response(success: bool, file_id: str = None, error: str = None, duplicate: bool = False):
         response = {}
         if success:
             response["status"] = "success"
             if file_id is None:
                 raise ValueError("file_id cannot be None if success is True")
             response["id"] = file_id
+            # the same content was uploaded before, and file_id is the id of that earlier upload
+            response["duplicate"] = duplicate
             return response
 
         if error:
@@ -46,11 +42,38 @@ async def upload_file(file: UploadFile = File(...)):
         file_ext = os.path.splitext(file.filename)[1]
         file_id = f"{uuid.uuid4()}{file_ext}"
         file_path = os.path.join(uploads_dir, file_id)
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
 
-        response = make_response(success=True, file_id=file_id)
+        # hash the content while receiving it, into a partial file until we know it is not a duplicate
+        partial_path = f"{file_path}.part"
+        digest = new_content_hash()
+        size = 0
+        with open(partial_path, "wb") as f:
+            while block := await file.read(HASH_BLOCK_SIZE):
+                digest.update(block)
+                size += len(block)
+                f.write(block)
+
+        upload = await find_upload_by_hash(digest.hexdigest())
+        if upload is None:
+            os.replace(partial_path, file_path)
+            # another request may have recorded the same content in the meantime
+            upload = await record_upload(file_id, digest.hexdigest(), file.filename, size)
+            if upload is None:
+                # the upload that won the race was removed before it could be read back
+                os.remove(file_path)
+                logger.error(f"Upload of {file.filename} was neither recorded nor found by its content hash")
+                return JSONResponse(
+                    status_code=500, content=make_response(success=False, error="Failed to record the upload.")
+                )
+            if upload["_id"] != file_id:
+                os.remove(file_path)
+        elif os.path.exists(os.path.join(uploads_dir, upload["_id"])):
+            os.remove(partial_path)
+        else:
+            # the file of the earlier upload was removed, restore it
+            os.replace(partial_path, os.path.join(uploads_dir, upload["_id"]))
+
+        response = make_response(success=True, file_id=upload["_id"], duplicate=upload["_id"] != file_id)
         logger.info(f"File uploaded: {file_path}, Response: {response}")
         return response
 
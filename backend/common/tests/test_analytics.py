@@ -0,0 +1,619 @@
+import asyncio
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock, patch
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from common.analytics import (
+    AGGREGATES_COLLECTION,
+    ANALYTICS_STATE_COLLECTION,
+    RECEIPTS_COLLECTION,
+    SPEND_DAILY_COLLECTION,
+    ChangeCoalescer,
+    RecalculationJobs,
+    SpendDelta,
+    add_change_to_delta,
+    aggregates_layout,
+    apply_and_checkpoint_receipt_changes,
+    apply_receipt_changes,
+    changed_years,
+    find_yearly_spend,
+    listen_for_receipt_changes,
+    rebuild_aggregates,
+    rollup_spend_rows,
+    spend_daily_documents,
+    spend_query_pipeline,
+    upgrade_aggregates,
+    write_aggregate_updates,
+    years_date_range,
+)
+
+
+def make_receipt(date, total, items):
+    return {
+        "receipt_data": {"date": date, "total": total, "place": "K-Citymarket"},
+        "items": [
+            {"total_price": price, "item_category": {"level_1": level_1, "level_2": level_2, "level_3": level_3}}
+            for price, level_1, level_2, level_3 in items
+        ],
+    }
+
+
+def updates_by_type(delta):
+    return {(aggregate_type, tuple(bucket.items())): levels for aggregate_type, bucket, levels in delta.updates()}
+
+
+class TestSpendDelta(unittest.TestCase):
+    """Test cases for the incremental analytics delta."""
+
+    def setUp(self):
+        self.receipt = make_receipt(
+            datetime(2025, 1, 2),
+            12.5,
+            [(10.0, "Food", "Dairy", "Milk"), (2.5, "Food", "Dairy", "Cheese")],
+        )
+
+    def test_insert_touches_one_bucket_per_aggregate_type(self):
+        """Test that an inserted receipt produces one update per aggregate type."""
+        delta = SpendDelta()
+        delta.add_receipt(self.receipt, 1)
+        updates = updates_by_type(delta)
+
+        self.assertEqual(
+            set(updates.keys()),
+            {
+                ("daily_spend", (("year", 2025), ("month", 1))),
+                ("weekly_spend", (("year", 2025), ("week", 1))),
+                ("monthly_spend", (("year", 2025), ("month", 1))),
+                ("yearly_spend", (("year", 2025),)),
+                ("yearly_monthly_spend", (("year", 2025), ("month", 1))),
+            },
+        )
+
+    def test_entries_use_pipeline_id_shapes(self):
+        """Test that entry ids match the shape of the $group stages."""
+        delta = SpendDelta()
+        delta.add_receipt(self.receipt, 1)
+        monthly = updates_by_type(delta)[("monthly_spend", (("year", 2025), ("month", 1)))]
+
+        self.assertEqual(monthly["overall"], [({"year": 2025, "month": 1}, {}, 12.5)])
+        self.assertEqual(monthly["level_1"], [({"year": 2025, "month": 1, "level_1": "Food"}, {}, 12.5)])
+        self.assertIn(
+            (
+                {"year": 2025, "month": 1, "level_2": "Dairy", "level_3": "Milk"},
+                {"level_2": "Dairy", "level_3": "Milk"},
+                10.0,
+            ),
+            monthly["level_3"],
+        )
+
+    def test_weekly_entries_carry_first_day_of_week(self):
+        """Test that weekly entries are keyed on ISO weeks with the first day of the week last."""
+        delta = SpendDelta()
+        delta.add_receipt(self.receipt, 1)
+        weekly = updates_by_type(delta)[("weekly_spend", (("year", 2025), ("week", 1)))]
+
+        entry_id, _, _ = weekly["level_1"][0]
+        self.assertEqual(list(entry_id.keys()), ["year", "week", "level_1", "first_day_of_week"])
+        self.assertEqual(entry_id["first_day_of_week"], datetime(2024, 12, 30))
+
+    def test_update_only_applies_net_change(self):
+        """Test that an update subtracts the pre-image and adds the post-image."""
+        updated = make_receipt(
+            datetime(2025, 1, 2),
+            14.5,
+            [(12.0, "Food", "Dairy", "Milk"), (2.5, "Food", "Dairy", "Cheese")],
+        )
+        delta = SpendDelta()
+        self.assertTrue(
+            add_change_to_delta(
+                delta, {"operationType": "update", "fullDocumentBeforeChange": self.receipt, "fullDocument": updated}
+            )
+        )
+        monthly = updates_by_type(delta)[("monthly_spend", (("year", 2025), ("month", 1)))]
+
+        self.assertEqual(monthly["overall"], [({"year": 2025, "month": 1}, {}, 2.0)])
+        # the cheese entry did not change so it must not be part of the update
+        self.assertEqual([entry_id["level_3"] for entry_id, _, _ in monthly["level_3"]], ["Milk"])
+
+    def test_unchanged_update_is_empty(self):
+        """Test that updates without spend changes produce no writes."""
+        delta = SpendDelta()
+        add_change_to_delta(
+            delta, {"operationType": "update", "fullDocumentBeforeChange": self.receipt, "fullDocument": self.receipt}
+        )
+        self.assertTrue(delta.is_empty())
+
+    def test_missing_pre_image_requires_full_recompute(self):
+        """Test that deletes without a pre-image cannot be applied incrementally."""
+        delta = SpendDelta()
+        self.assertFalse(add_change_to_delta(delta, {"operationType": "delete"}))
+        self.assertFalse(add_change_to_delta(delta, {"operationType": "drop"}))
+
+    def test_receipt_without_date_is_skipped(self):
+        """Test that receipts with unparsed dates do not produce updates."""
+        delta = SpendDelta()
+        delta.add_receipt(make_receipt("02.01.2025", 10.0, [(10.0, "Food", "Dairy", None)]), 1)
+        self.assertTrue(delta.is_empty())
+
+
+class TestSpendDailyRows(unittest.TestCase):
+    """Test cases for the per-day, per-store and per-category spend rows."""
+
+    def test_receipt_total_goes_with_the_first_line(self):
+        """Test that the delta rows match the rows of the aggregation pipeline."""
+        receipt = make_receipt(
+            datetime(2025, 1, 2, 15, 30), 12.5, [(10.0, "Food", "Dairy", "Milk"), (2.5, "Food", "Dairy", "Milk")]
+        )
+        delta = SpendDelta()
+        delta.add_receipt(receipt, 1)
+        rows = [
+            {
+                "_id": {
+                    "year": 2025,
+                    "month": 1,
+                    "day": 2,
+                    "store": "K-Citymarket",
+                    "level_1": "Food",
+                    "level_2": "Dairy",
+                    "level_3": "Milk",
+                },
+                "items_total": 12.5,
+                "receipts_total": 12.5,
+                "item_count": 2,
+            }
+        ]
+
+        (key, values), *others = delta.daily_updates()
+        self.assertEqual(others, [])
+        self.assertEqual(
+            {**key, "items_total": values[0], "receipts_total": values[1], "item_count": values[2]},
+            spend_daily_documents(rows)[0],
+        )
+
+    def test_delete_cancels_insert(self):
+        """Test that removing a receipt again leaves no row changes."""
+        receipt = make_receipt(datetime(2025, 1, 2), 3.0, [(3.0, "Household", "Laundry", None)])
+        delta = SpendDelta()
+        delta.add_receipt(receipt, 1)
+        delta.add_receipt(receipt, -1)
+        self.assertEqual(list(delta.daily_updates()), [])
+
+    def test_overall_spend_uses_receipt_totals(self):
+        """Test that only category queries sum the item totals."""
+        start, end = datetime(2021, 1, 1), datetime(2025, 12, 31)
+        overall = spend_query_pipeline(start, end, "quarter")
+        by_level = spend_query_pipeline(start, end, "week", level="level_2", store="Prisma")
+
+        self.assertEqual(overall[1]["$group"]["total_spend"], {"$sum": "$receipts_total"})
+        self.assertEqual(by_level[0]["$match"]["store"], "Prisma")
+        self.assertEqual(by_level[1]["$group"]["total_spend"], {"$sum": "$items_total"})
+        self.assertEqual(
+            by_level[1]["$group"]["_id"],
+            {
+                "period": {"$dateTrunc": {"date": "$date", "unit": "week", "startOfWeek": "monday"}},
+                "level_1": "$level_1",
+                "level_2": "$level_2",
+            },
+        )
+
+    def test_unknown_granularity_is_rejected(self):
+        """Test that unsupported granularities and levels raise errors."""
+        with self.assertRaises(ValueError):
+            spend_query_pipeline(datetime(2025, 1, 1), datetime(2025, 2, 1), "hour")
+        with self.assertRaises(ValueError):
+            spend_query_pipeline(datetime(2025, 1, 1), datetime(2025, 2, 1), "day", level="level_4")
+
+
+class TestRollupSpendRows(unittest.TestCase):
+    """Test cases for rolling the single-pass aggregation rows up into aggregate documents."""
+
+    def make_row(self, day, level_1, level_2, level_3, items_total, receipts_total, item_count=1):
+        return {
+            "_id": {"year": 2025, "month": 1, "day": day, "level_1": level_1, "level_2": level_2, "level_3": level_3},
+            "items_total": items_total,
+            "receipts_total": receipts_total,
+            "item_count": item_count,
+        }
+
+    def documents_by_type(self, totals):
+        return {(aggregate_type, tuple(bucket.items())): levels for aggregate_type, bucket, levels in totals.documents()}
+
+    def test_rollup_matches_incremental_delta(self):
+        """Test that rolling up rows gives the same buckets as adding the receipts one by one."""
+        receipts = [
+            make_receipt(datetime(2025, 1, 2), 12.5, [(10.0, "Food", "Dairy", "Milk"), (2.5, "Food", "Dairy", "Cheese")]),
+            make_receipt(datetime(2025, 1, 3), 3.0, [(3.0, "Household", "Laundry", None)]),
+        ]
+        rows = [
+            self.make_row(2, "Food", "Dairy", "Milk", 10.0, 12.5),
+            self.make_row(2, "Food", "Dairy", "Cheese", 2.5, 0),
+            self.make_row(3, "Household", "Laundry", None, 3.0, 3.0),
+        ]
+        delta = SpendDelta()
+        for receipt in receipts:
+            delta.add_receipt(receipt, 1)
+
+        self.assertEqual(self.documents_by_type(rollup_spend_rows(rows)), self.documents_by_type(delta))
+
+    def test_receipts_without_items_only_count_towards_overall(self):
+        """Test that rows of receipts without line items do not create category entries."""
+        rows = [self.make_row(2, None, None, None, 0, 7.0, item_count=0)]
+        monthly = self.documents_by_type(rollup_spend_rows(rows))[("monthly_spend", (("year", 2025), ("month", 1)))]
+
+        self.assertEqual(monthly["overall"], [({"year": 2025, "month": 1}, {}, 7.0)])
+        self.assertNotIn("level_1", monthly)
+
+    def test_entries_are_sorted_like_the_pipelines(self):
+        """Test that entries come out in _id order with nulls first."""
+        rows = [
+            self.make_row(3, "Household", "Laundry", None, 3.0, 3.0),
+            self.make_row(2, "Food", "Dairy", "Milk", 10.0, 10.0),
+            self.make_row(2, None, None, None, 1.0, 0),
+        ]
+        daily = self.documents_by_type(rollup_spend_rows(rows))[("daily_spend", (("year", 2025), ("month", 1)))]
+
+        self.assertEqual(
+            [(entry_id["day"], entry_id["level_1"]) for entry_id, _, _ in daily["level_1"]],
+            [(2, None), (2, "Food"), (3, "Household")],
+        )
+
+
+class TestYearsDateRange(unittest.TestCase):
+    """Test cases for the date range of a partial rebuild."""
+
+    def test_range_is_widened_to_whole_iso_weeks(self):
+        """Test that the weeks crossing the year boundaries are fully covered."""
+        # 2025-01-01 is a Wednesday and 2025-12-31 is a Wednesday
+        self.assertEqual(years_date_range([2025]), (datetime(2024, 12, 30), datetime(2026, 1, 5)))
+
+    def test_range_spans_all_years(self):
+        """Test that non-contiguous years produce one range from the first to the last."""
+        start, end = years_date_range([2026, 2023])
+        self.assertEqual(start, datetime(2022, 12, 26))
+        self.assertEqual(end, datetime(2027, 1, 4))
+
+
+class TestChangeCoalescer(unittest.IsolatedAsyncioTestCase):
+    """Test cases for coalescing bursts of change events."""
+
+    async def asyncSetUp(self):
+        self.bursts = []
+
+        async def apply_changes(changes):
+            self.bursts.append(changes)
+
+        self.apply_changes = apply_changes
+
+    async def test_events_within_window_are_applied_once(self):
+        """Test that a burst of events results in a single recalculation."""
+        coalescer = ChangeCoalescer(self.apply_changes, window_seconds=0.01, max_events=100)
+        for i in range(5):
+            await coalescer.submit({"operationType": "insert", "n": i})
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(len(self.bursts), 1)
+        self.assertEqual(len(self.bursts[0]), 5)
+        self.assertEqual(coalescer.stats()["events_seen"], 5)
+        self.assertEqual(coalescer.stats()["events_merged"], 4)
+        self.assertEqual(coalescer.stats()["recomputes_run"], 1)
+
+    async def test_max_events_closes_the_burst(self):
+        """Test that reaching the count threshold flushes without waiting for the window."""
+        coalescer = ChangeCoalescer(self.apply_changes, window_seconds=60, max_events=3)
+        for i in range(7):
+            await coalescer.submit({"operationType": "insert", "n": i})
+
+        self.assertEqual([len(burst) for burst in self.bursts], [3, 3])
+        await coalescer.flush()
+        self.assertEqual([len(burst) for burst in self.bursts], [3, 3, 1])
+        self.assertEqual(coalescer.stats()["pending_events"], 0)
+
+    async def test_failed_burst_is_retried_and_the_totals_converge(self):
+        """Test that a burst failing halfway is retried with a recompute, and later events are not applied before it."""
+        receipts = {}
+        totals = {"spend": 0.0}
+
+        async def apply_changes(changes):
+            for change in changes:
+                receipts[change["n"]] = change["amount"]
+                totals["spend"] += change["amount"]
+                if change["n"] == 1 and len(self.bursts) == 0:
+                    self.bursts.append("failed")
+                    raise RuntimeError("connection lost")
+            self.bursts.append(changes)
+
+        async def recover_changes(changes):
+            for change in changes:
+                receipts[change["n"]] = change["amount"]
+            totals["spend"] = sum(receipts.values())
+            self.bursts.append(["recomputed", *changes])
+
+        coalescer = ChangeCoalescer(apply_changes, window_seconds=0.01, max_events=3, recover_changes=recover_changes)
+        for i in range(3):
+            await coalescer.submit({"n": i, "amount": 10.0})
+        await coalescer.submit({"n": 3, "amount": 5.0})
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(totals["spend"], 35.0)
+        self.assertEqual(self.bursts[1][0], "recomputed")
+        self.assertEqual([change["n"] for change in self.bursts[1][1:]], [0, 1, 2, 3])
+        self.assertEqual(coalescer.stats()["failures"], 1)
+        self.assertEqual(coalescer.stats()["pending_events"], 0)
+
+    async def test_bursts_closed_during_a_failing_one_are_applied_after_it(self):
+        """Test that a burst closed while a failing one is in flight is retried with it, so checkpoints never go back."""
+        checkpoints = []
+
+        async def apply_changes(changes):
+            if not self.bursts:
+                self.bursts.append("failed")
+                await asyncio.sleep(0.01)
+                raise RuntimeError("connection lost")
+            self.bursts.append([change["n"] for change in changes])
+            checkpoints.append(changes[-1]["n"])
+
+        coalescer = ChangeCoalescer(apply_changes, window_seconds=0.01, max_events=2)
+        await coalescer.submit({"n": 0})
+        failing = asyncio.create_task(coalescer.submit({"n": 1}))
+        await asyncio.sleep(0)
+        await coalescer.submit({"n": 2})
+        await coalescer.submit({"n": 3})
+        await failing
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(self.bursts, ["failed", [0, 1, 2, 3]])
+        self.assertEqual(checkpoints, [3])
+
+    def test_changed_years_need_the_documents_of_every_change(self):
+        """Test that the years of a burst come from its pre- and post-images, and are unknown without them."""
+        receipt = make_receipt(datetime(2024, 5, 1), 10.0, [])
+        moved = make_receipt(datetime(2025, 1, 2), 10.0, [])
+        changes = [
+            {"operationType": "insert", "fullDocument": receipt},
+            {"operationType": "update", "fullDocument": moved, "fullDocumentBeforeChange": receipt},
+        ]
+
+        self.assertEqual(changed_years(changes), [2024, 2025])
+        self.assertIsNone(changed_years([{"operationType": "update", "fullDocument": moved}]))
+
+
+class TestRecalculationJobs(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the background, single-flight recalculation."""
+
+    async def test_requests_during_a_rebuild_attach_to_the_running_job(self):
+        """Test that only one rebuild runs at a time and its progress is reported."""
+        release = asyncio.Event()
+        rebuilds = []
+
+        async def rebuild(progress):
+            rebuilds.append(progress)
+            await release.wait()
+            progress("aggregation", {"rows": 3})
+            return {"rows": 3}
+
+        jobs = RecalculationJobs()
+        with patch("common.analytics.rebuild_aggregates", side_effect=rebuild):
+            job, started = jobs.start()
+            await asyncio.sleep(0)
+            same_job, started_again = jobs.start()
+
+            self.assertTrue(started)
+            self.assertFalse(started_again)
+            self.assertIs(same_job, job)
+            self.assertEqual(job.status, "running")
+
+            release.set()
+            await job.task
+
+        self.assertEqual(len(rebuilds), 1)
+        self.assertEqual(job.to_dict()["status"], "completed")
+        self.assertEqual(job.progress["aggregation"], {"status": "done", "rows": 3})
+        self.assertEqual(job.progress["daily_spend"], {"status": "pending"})
+        self.assertIsNone(jobs.current)
+
+
+class TestWriteAggregateUpdates(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the batched aggregate persistence."""
+
+    async def test_operations_are_written_in_unordered_batches(self):
+        """Test that upserts are split in batches and the counts are reported."""
+        collection = SimpleNamespace(
+            bulk_write=AsyncMock(side_effect=lambda ops, ordered: SimpleNamespace(upserted_count=len(ops), modified_count=0))
+        )
+        with patch("common.analytics.db", {AGGREGATES_COLLECTION: collection}):
+            stats = await write_aggregate_updates(list(range(5)), batch_size=2)
+
+        self.assertEqual([len(call.args[0]) for call in collection.bulk_write.call_args_list], [2, 2, 1])
+        self.assertTrue(all(call.kwargs["ordered"] is False for call in collection.bulk_write.call_args_list))
+        self.assertEqual(stats["documents"], 5)
+        self.assertEqual(stats["upserted"], 5)
+        self.assertEqual(stats["batches"], 3)
+
+
+class TestRebuildYears(unittest.IsolatedAsyncioTestCase):
+    """Test cases for recomputing the aggregates of some years."""
+
+    async def test_buckets_left_without_receipts_are_deleted(self):
+        """Test that buckets of the rebuilt years that the rebuild did not produce are deleted, and others kept."""
+        row = {"_id": {"year": 2024, "month": 5, "day": 2, "store": "Lidl"}, "receipts_total": 10.0, "item_count": 0}
+        stored = [
+            {"_id": "may", "type": "monthly_spend", "year": 2024, "month": 5},
+            {"_id": "march", "type": "monthly_spend", "year": 2024, "month": 3},
+            {"_id": "last year", "type": "monthly_spend", "year": 2023, "month": 3},
+            {"_id": "week 1", "type": "weekly_spend", "year": 2025, "week": 1},
+            {"_id": "week 2", "type": "weekly_spend", "year": 2025, "week": 2},
+        ]
+
+        def find(selector, projection):
+            documents = [document for document in stored if document["type"] == selector["type"]]
+            return SimpleNamespace(to_list=AsyncMock(return_value=documents))
+
+        aggregates = SimpleNamespace(
+            find=find,
+            bulk_write=AsyncMock(return_value=SimpleNamespace(upserted_count=0, modified_count=1)),
+            delete_many=AsyncMock(),
+        )
+        database = {
+            RECEIPTS_COLLECTION: SimpleNamespace(
+                aggregate=Mock(return_value=SimpleNamespace(to_list=AsyncMock(return_value=[row])))
+            ),
+            AGGREGATES_COLLECTION: aggregates,
+            SPEND_DAILY_COLLECTION: SimpleNamespace(delete_many=AsyncMock(), insert_many=AsyncMock()),
+        }
+        with patch("common.analytics.db", database):
+            stats = await rebuild_aggregates([2024])
+
+        deleted = [call.args[0]["_id"]["$in"] for call in aggregates.delete_many.await_args_list]
+        # the week starting on 2024-12-30 is part of the rebuild of 2024
+        self.assertEqual(deleted, [["week 1"], ["march"]])
+        self.assertEqual(stats["deleted"], 2)
+
+
+class TestFindYearlySpend(unittest.IsolatedAsyncioTestCase):
+    """Test cases for reading the per-year yearly_spend documents."""
+
+    def setUp(self):
+        documents = [
+            {"data": {"overall": [{"_id": {"year": 2024}, "total_spend": 10.0}]}},
+            {"data": {"overall": [{"_id": {"year": 2025}, "total_spend": 20.0}]}},
+        ]
+        self.cursor = SimpleNamespace(to_list=AsyncMock(return_value=documents))
+        self.cursor.sort = lambda field, direction: self.cursor
+        self.collection = SimpleNamespace(find=Mock(return_value=self.cursor))
+
+    async def test_only_requested_levels_are_projected(self):
+        """Test that the levels are pushed down as a projection and the years are concatenated."""
+        with patch("common.analytics.db", {AGGREGATES_COLLECTION: self.collection}):
+            data = await find_yearly_spend(levels=["overall"])
+
+        selector, projection = self.collection.find.call_args.args
+        self.assertEqual(selector, {"type": "yearly_spend", "year": {"$exists": True}})
+        self.assertEqual(projection, {"_id": 0, "data.overall": 1})
+        self.assertEqual([entry["total_spend"] for entry in data["overall"]], [10.0, 20.0])
+        self.assertEqual(list(data.keys()), ["overall"])
+
+    async def test_a_year_without_receipts_has_empty_entries(self):
+        """Test that a year without a document has empty entries while other years have documents."""
+        self.cursor.to_list = AsyncMock(return_value=[])
+        self.collection.find_one = AsyncMock(return_value={"type": "yearly_spend", "year": 2024})
+        with patch("common.analytics.db", {AGGREGATES_COLLECTION: self.collection}):
+            self.assertEqual(await find_yearly_spend(2023, ["overall"]), {"overall": []})
+
+            self.collection.find_one.return_value = None
+            self.assertIsNone(await find_yearly_spend(2023))
+
+
+class TestUpgradeAggregates(unittest.IsolatedAsyncioTestCase):
+    """Test cases for rebuilding aggregates of an earlier layout at startup."""
+
+    def setUp(self):
+        self.aggregates = SimpleNamespace(find_one=AsyncMock(return_value={"_id": "legacy"}))
+        self.state = SimpleNamespace(find_one=AsyncMock(return_value=None))
+        self.spend_daily = SimpleNamespace(find_one=AsyncMock(return_value={"_id": 1}))
+        self.receipts = SimpleNamespace(find_one=AsyncMock(return_value={"_id": 1}))
+        self.database = {
+            AGGREGATES_COLLECTION: self.aggregates,
+            ANALYTICS_STATE_COLLECTION: self.state,
+            SPEND_DAILY_COLLECTION: self.spend_daily,
+            RECEIPTS_COLLECTION: self.receipts,
+        }
+        patcher = patch.object(aggregates_layout, "current", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_legacy_aggregates_are_rebuilt_before_deltas_are_applied(self):
+        """Test that changes are not applied as deltas until the aggregates of the old layout are rebuilt."""
+
+        async def rebuild():
+            aggregates_layout.current = True
+
+        with (
+            patch("common.analytics.db", self.database),
+            patch("common.analytics.rebuild_aggregates", AsyncMock(side_effect=rebuild)) as rebuild_aggregates,
+            patch("common.analytics.apply_spend_delta", AsyncMock()) as apply_spend_delta,
+        ):
+            await apply_receipt_changes(
+                [{"operationType": "insert", "fullDocument": make_receipt(datetime(2025, 1, 2), 1.0, [])}]
+            )
+            apply_spend_delta.assert_not_awaited()
+
+            await upgrade_aggregates()
+
+        rebuild_aggregates.assert_awaited_once_with()
+        self.assertTrue(aggregates_layout.current)
+
+    async def test_current_aggregates_are_not_rebuilt(self):
+        """Test that aggregates of the current layout are left alone."""
+        self.aggregates.find_one.return_value = None
+        self.state.find_one.return_value = {"version": 99}
+        with (
+            patch("common.analytics.db", self.database),
+            patch("common.analytics.rebuild_aggregates", AsyncMock()) as rebuild_aggregates,
+        ):
+            await upgrade_aggregates()
+
+        rebuild_aggregates.assert_not_awaited()
+        self.assertTrue(aggregates_layout.current)
+
+    async def test_empty_spend_daily_is_filled(self):
+        """Test that spend_daily is rebuilt when it is empty while there are receipts, also in the current layout."""
+        self.aggregates.find_one.return_value = None
+        self.state.find_one.return_value = {"version": 99}
+        self.spend_daily.find_one.return_value = None
+        with (
+            patch("common.analytics.db", self.database),
+            patch("common.analytics.rebuild_aggregates", AsyncMock()) as rebuild_aggregates,
+        ):
+            await upgrade_aggregates()
+
+        rebuild_aggregates.assert_awaited_once_with()
+
+
+class TestListenForReceiptChanges(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the receipts change listener."""
+
+    async def test_failed_history_recovery_does_not_stop_the_listener(self):
+        """Test that an error while recovering lost history is logged and the listener reconnects after the backoff."""
+        receipts = SimpleNamespace(
+            watch=Mock(side_effect=[OperationFailure("history lost", code=286), asyncio.CancelledError()])
+        )
+        with (
+            patch("common.analytics.db", {RECEIPTS_COLLECTION: receipts}),
+            patch("common.analytics.load_listener_state", AsyncMock(return_value={})),
+            patch("common.analytics._watch_options", AsyncMock(return_value={})),
+            patch("common.analytics.recover_lost_history", AsyncMock(side_effect=PyMongoError("network"))) as recover,
+            patch("common.analytics.ANALYTICS_LISTENER_BACKOFF_SECONDS", 0),
+        ):
+            with self.assertRaises(asyncio.CancelledError):
+                await listen_for_receipt_changes()
+
+        recover.assert_awaited_once()
+        self.assertEqual(receipts.watch.call_count, 2)
+
+
+class TestApplyAndCheckpoint(unittest.IsolatedAsyncioTestCase):
+    """Test cases for applying and checkpointing a burst of receipt changes."""
+
+    async def test_in_memory_failures_do_not_prevent_the_checkpoint(self):
+        """Test that the checkpoint is saved once the aggregates are written, even if the cube fails."""
+        steps = []
+        cube = SimpleNamespace(apply_changes=AsyncMock(side_effect=RuntimeError("cube")), load=AsyncMock())
+        with (
+            patch("common.analytics.apply_receipt_changes", AsyncMock(side_effect=lambda c: steps.append("aggregates"))),
+            patch("common.analytics.save_listener_checkpoint", AsyncMock(side_effect=lambda c: steps.append("checkpoint"))),
+            patch("common.analytics.line_item_cube", cube),
+            patch("common.analytics.RECIPE_RECOMMENDER_ENABLED", False),
+            patch("common.analytics.db", {"receipts": None}),
+        ):
+            await apply_and_checkpoint_receipt_changes([{"_id": "token"}])
+            await asyncio.sleep(0)
+
+        self.assertEqual(steps, ["aggregates", "checkpoint"])
+        cube.load.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
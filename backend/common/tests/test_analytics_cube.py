@@ -0,0 +1,141 @@
+import unittest
+from datetime import date, datetime
+
+from common.analytics_cube import LineItemCube
+
+
+def make_receipt(receipt_date, place, items):
+    return {
+        "receipt_data": {"date": receipt_date, "place": place},
+        "items": [
+            {
+                "total_price": price,
+                "quantity": quantity,
+                "loyalty_discount": discount,
+                "item_category": {"level_1": level_1, "level_2": level_2, "level_3": None},
+            }
+            for price, quantity, discount, level_1, level_2 in items
+        ],
+    }
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __aiter__(self):
+        """Iterate the documents like a motor cursor."""
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection):
+        return FakeCursor(self.documents)
+
+
+class TestLineItemCube(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the in-memory line item cube."""
+
+    async def asyncSetUp(self):
+        self.receipts = [
+            {
+                "_id": 1,
+                **make_receipt(
+                    datetime(2025, 1, 2),
+                    "K-Citymarket",
+                    [(10.0, 1, 0.5, "Food", "Dairy"), (2.5, 2, 0, "Food", "Bakery")],
+                ),
+            },
+            {"_id": 2, **make_receipt(datetime(2025, 2, 3), "Prisma", [(4.0, 1, None, "Household", "Laundry")])},
+            {"_id": 3, **make_receipt("03.02.2025", "Prisma", [(99.0, 1, None, "Food", "Dairy")])},
+        ]
+        self.collection = FakeCollection(self.receipts)
+        self.cube = LineItemCube()
+        await self.cube.load(self.collection)
+
+    async def test_load_skips_receipts_without_dates(self):
+        """Test that only receipts with parsed dates are loaded."""
+        stats = self.cube.stats()
+        self.assertEqual(stats["rows"], 3)
+        self.assertEqual(stats["receipts"], 2)
+        self.assertEqual(stats["distinct_values"]["store"], 2)
+        self.assertGreater(stats["memory_bytes"], 0)
+
+    async def test_malformed_items_are_skipped(self):
+        """Test that line items that are not objects are skipped, and a category that is not one is left empty."""
+        receipt = make_receipt(datetime(2025, 3, 4), "Lidl", [(3.0, 1, None, "Food", "Dairy")])
+        receipt["items"] += ["Milk 1.20", {"total_price": 2.0, "item_category": "Food"}]
+        cube = LineItemCube()
+
+        await cube.load(FakeCollection([{"_id": 4, **receipt}]))
+
+        self.assertEqual(
+            cube.query(group_by=["level_1"]),
+            [{"level_1": None, "total_price": 2.0, "items": 1}, {"level_1": "Food", "total_price": 3.0, "items": 1}],
+        )
+
+    async def test_group_by_time_grain_and_category(self):
+        """Test grouping by a time grain and a category level."""
+        rows = self.cube.query(group_by=["month", "level_1"], measures=["total_price", "discount"])
+        self.assertEqual(
+            rows,
+            [
+                {"month": "2025-01", "level_1": "Food", "total_price": 12.5, "discount": 0.5, "items": 2},
+                {"month": "2025-02", "level_1": "Household", "total_price": 4.0, "discount": 0.0, "items": 1},
+            ],
+        )
+
+    async def test_weeks_are_keyed_on_monday(self):
+        """Test that weekly groups are keyed on the first day of the ISO week."""
+        rows = self.cube.query(group_by=["week"])
+        self.assertEqual([row["week"] for row in rows], ["2024-12-30", "2025-02-03"])
+
+    async def test_filters_and_date_range(self):
+        """Test filtering by dimension values and by date."""
+        self.assertEqual(self.cube.query(filters={"store": "Prisma"}), [{"total_price": 4.0, "items": 1}])
+        self.assertEqual(self.cube.query(date_to=date(2025, 1, 31), measures=["quantity"]), [{"quantity": 3.0, "items": 2}])
+        self.assertEqual(self.cube.query(filters={"level_2": ["Nothing"]}), [])
+
+    async def test_unknown_fields_are_rejected(self):
+        """Test that unknown group by fields and measures raise errors."""
+        with self.assertRaises(ValueError):
+            self.cube.query(group_by=["colour"])
+        with self.assertRaises(ValueError):
+            self.cube.query(measures=["weight"])
+        with self.assertRaises(ValueError):
+            self.cube.query(group_by=["week", "month"])
+
+    async def test_changes_replace_and_retire_rows(self):
+        """Test that updates replace the rows of a receipt and deletes retire them."""
+        updated = {"_id": 1, **make_receipt(datetime(2025, 1, 2), "K-Citymarket", [(20.0, 1, 0, "Food", "Dairy")])}
+        await self.cube.apply_changes(
+            [
+                {"operationType": "update", "documentKey": {"_id": 1}, "fullDocument": updated},
+                {"operationType": "delete", "documentKey": {"_id": 2}},
+            ],
+            self.collection,
+        )
+
+        self.assertEqual(self.cube.query(group_by=["level_2"]), [{"level_2": "Dairy", "total_price": 20.0, "items": 1}])
+        # three of the four rows were dead, so the cube was compacted
+        self.assertEqual(self.cube.stats()["rows"], 1)
+        self.assertEqual(self.cube.stats()["dead_rows"], 0)
+
+    async def test_change_without_document_reloads(self):
+        """Test that events without a post-image trigger a reload."""
+        self.receipts.append({"_id": 4, **make_receipt(datetime(2025, 3, 1), "Lidl", [(1.0, 1, 0, "Food", "Snacks")])})
+        await self.cube.apply_changes([{"operationType": "update", "documentKey": {"_id": 4}}], self.collection)
+
+        self.assertEqual(self.cube.stats()["reloads"], 2)
+        self.assertEqual(self.cube.query(filters={"store": "Lidl"}), [{"total_price": 1.0, "items": 1}])
+
+
+if __name__ == "__main__":
+    unittest.main()
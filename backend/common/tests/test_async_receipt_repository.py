@@ -0,0 +1,236 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from common.async_receipt_repository import AsyncReceiptRepository, merge_receipt_items
+from common.receipt_repository import (
+    RECEIPT_ITEMS_PIPELINE,
+    STALE_RECEIPT_ITEMS_PIPELINE,
+    decode_receipts_cursor,
+    load_receipts_export,
+    parse_receipt_dates,
+    receipt_fingerprint,
+    receipts_projection,
+)
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, limit):
+        self.documents = self.documents[:limit]
+        return self
+
+    async def to_list(self, length=None):
+        return list(self.documents)
+
+    def __aiter__(self):
+        """Iterate the documents like a motor cursor."""
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class TestAsyncReceiptRepository(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the motor-based receipt repository."""
+
+    def setUp(self):
+        self.receipts = SimpleNamespace(insert_one=AsyncMock(return_value=SimpleNamespace(inserted_id=ObjectId())))
+        self.receipt_items = SimpleNamespace(insert_many=AsyncMock(), delete_many=AsyncMock())
+        database = MagicMock(receipts=self.receipts)
+        database.__getitem__.return_value = self.receipt_items
+        self.repository = AsyncReceiptRepository()
+        self.repository.mongo_connection = SimpleNamespace(
+            initialize_collection=AsyncMock(), get_database=Mock(return_value=database)
+        )
+
+    async def test_save_receipt_parses_the_date(self):
+        """Test that receipts are saved with their date converted to a datetime."""
+        saved = await self.repository.save_receipt('{"receipt_data": {"date": "02.01.2025"}, "items": []}', {})
+
+        self.assertTrue(saved)
+        document = self.receipts.insert_one.call_args.args[0]
+        self.assertEqual(document["receipt_data"]["date"], datetime(2025, 1, 2))
+        self.repository.mongo_connection.initialize_collection.assert_awaited()
+
+    async def test_save_receipt_stores_the_content_hash_once(self):
+        """Test that the file hash is saved with the receipt and a second receipt from the same file is rejected."""
+        receipt = '{"receipt_data": {"date": "02.01.2025"}, "items": []}'
+        self.assertTrue(await self.repository.save_receipt(receipt, {"content_hash": "abc"}))
+        self.assertEqual(self.receipts.insert_one.call_args.args[0]["content_hash"], "abc")
+
+        self.receipts.insert_one.side_effect = DuplicateKeyError("E11000 duplicate key error")
+        self.assertFalse(await self.repository.save_receipt(receipt, {"content_hash": "abc"}))
+        # a receipt saved without metadata can collide on its fingerprint
+        self.assertFalse(await self.repository.save_receipt(receipt, None))
+
+    async def test_save_and_delete_receipt_keep_receipt_items_in_sync(self):
+        """Test that the line items of a receipt are written to receipt_items on save and removed on delete."""
+        receipt = '{"receipt_data": {"date": "02.01.2025", "place": "Prisma"}, "items": [{"name_en": "Milk"}]}'
+        await self.repository.save_receipt(receipt, {})
+
+        receipt_id = self.receipts.insert_one.return_value.inserted_id
+        [item] = self.receipt_items.insert_many.call_args.args[0]
+        self.assertEqual((item["receipt_id"], item["store"], item["name_en"]), (receipt_id, "Prisma", "Milk"))
+
+        self.receipts.delete_one = AsyncMock(return_value=SimpleNamespace(deleted_count=1))
+        self.assertTrue(await self.repository.delete_receipt(str(receipt_id)))
+        self.receipt_items.delete_many.assert_awaited_once_with({"receipt_id": receipt_id})
+
+    async def test_rebuild_merges_the_rows_and_removes_stale_ones(self):
+        """Test that receipt_items is rebuilt with a merge, and that only the stale rows are then deleted."""
+        stale = [ObjectId(), ObjectId()]
+        receipts = SimpleNamespace(aggregate=Mock(return_value=FakeCursor([])))
+        receipt_items = SimpleNamespace(
+            aggregate=Mock(return_value=FakeCursor([{"_id": row} for row in stale])), delete_many=AsyncMock()
+        )
+
+        removed = await merge_receipt_items({"receipts": receipts, "receipt_items": receipt_items})
+
+        self.assertEqual(removed, 2)
+        self.assertIs(receipts.aggregate.call_args.args[0], RECEIPT_ITEMS_PIPELINE)
+        self.assertIs(receipt_items.aggregate.call_args.args[0], STALE_RECEIPT_ITEMS_PIPELINE)
+        receipt_items.delete_many.assert_awaited_once_with({"_id": {"$in": stale}})
+
+    async def test_get_receipts_by_date_formats_documents(self):
+        """Test that receipts are returned in the same format as the synchronous repository."""
+        document_id = ObjectId()
+        now = datetime(2025, 1, 3, 12, 0)
+        self.receipts.find = Mock(
+            return_value=FakeCursor(
+                [
+                    {
+                        "_id": document_id,
+                        "receipt_data": {"date": datetime(2025, 1, 2)},
+                        "items": [{"name_en": "Milk"}],
+                        "created_at": now,
+                        "updated_at": now,
+                    }
+                ]
+            )
+        )
+
+        receipts = await self.repository.get_receipts_by_date("2025-01-01", "2025-01-31")
+
+        query = self.receipts.find.call_args.args[0]
+        self.assertEqual(query["receipt_data.date"]["$lte"], datetime(2025, 1, 31, 23, 59, 59))
+        self.assertEqual(
+            receipts,
+            [
+                {
+                    "id": str(document_id),
+                    "created_at": now.isoformat(),
+                    "updated_at": now.isoformat(),
+                    "data": {"receipt_data": {"date": "02.01.2025"}, "items": [{"name_en": "Milk"}]},
+                }
+            ],
+        )
+
+    async def test_get_receipts_page_returns_a_cursor_after_the_last_receipt(self):
+        """Test that a full page returns the keyset cursor of its last receipt and drops items when not requested."""
+        now = datetime(2025, 1, 3, 12, 0)
+        documents = [
+            {"_id": ObjectId(), "receipt_data": {"place": "K-Market"}, "created_at": now, "updated_at": now} for _ in range(3)
+        ]
+        self.receipts.find = Mock(return_value=FakeCursor(documents))
+
+        page = await self.repository.get_receipts_page(limit=2, fields=["receipt_data"], store="K-Market")
+
+        query, projection = self.receipts.find.call_args.args
+        self.assertEqual(query, {"$and": [{"store_keys": {"$regex": "^k market"}}]})
+        self.assertNotIn("items", projection)
+        self.assertEqual([receipt["id"] for receipt in page["receipts"]], [str(d["_id"]) for d in documents[:2]])
+        self.assertNotIn("items", page["receipts"][0]["data"])
+        self.assertEqual(
+            decode_receipts_cursor(page["next_cursor"]),
+            {"$or": [{"created_at": {"$lt": now}}, {"created_at": now, "_id": {"$lt": documents[1]["_id"]}}]},
+        )
+
+    async def test_get_receipts_page_keeps_items_for_item_sub_fields(self):
+        """Test that requesting sub-fields of the items keeps the items with those fields."""
+        now = datetime(2025, 1, 3, 12, 0)
+        documents = [{"_id": ObjectId(), "items": [{"name_en": "Milk"}], "created_at": now, "updated_at": now}]
+        self.receipts.find = Mock(return_value=FakeCursor(documents))
+
+        page = await self.repository.get_receipts_page(limit=2, fields=["items.name_en"])
+
+        self.assertEqual(page["receipts"][0]["data"]["items"], [{"name_en": "Milk"}])
+
+    async def test_get_receipts_page_ends_without_a_cursor(self):
+        """Test that the last page has no next cursor."""
+        self.receipts.find = Mock(return_value=FakeCursor([]))
+
+        page = await self.repository.get_receipts_page(limit=2)
+
+        self.assertEqual(page, {"receipts": [], "next_cursor": None})
+
+    def test_invalid_cursors_and_fields_are_rejected(self):
+        """Test that cursors and fields not produced by the listing raise ValueError."""
+        with self.assertRaises(ValueError):
+            decode_receipts_cursor("not-a-cursor")
+        with self.assertRaises(ValueError):
+            receipts_projection(["password"])
+
+    async def test_save_receipts_bulk_skips_duplicates_and_reports_failures(self):
+        """Test that a bulk import skips stored and repeated receipts and reports failed writes without aborting."""
+
+        def receipt(total):
+            return {"receipt_data": {"date": "02.01.2025", "place": "Prisma", "total": total}, "items": []}
+
+        stored = receipt(1.0)
+        parse_receipt_dates([stored])
+        self.receipts.find = Mock(return_value=FakeCursor([{"fingerprint": receipt_fingerprint(stored)}]))
+        results = [
+            SimpleNamespace(inserted_ids=[ObjectId(), ObjectId()]),
+            BulkWriteError({"nInserted": 0, "writeErrors": [{"index": 0, "errmsg": "document too large"}]}),
+        ]
+
+        async def insert_many(documents, ordered=True):
+            # like the driver, give every document an _id before writing
+            for document in documents:
+                document["_id"] = ObjectId()
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.receipts.insert_many = AsyncMock(side_effect=insert_many)
+
+        report = await self.repository.save_receipts_bulk(
+            [receipt(1.0), receipt(2.0), receipt(2.0), {"items": []}, receipt(3.0), receipt(4.0)], chunk_size=2
+        )
+
+        self.assertEqual(report["received"], 6)
+        self.assertEqual(report["inserted"], 2)
+        self.assertEqual(report["duplicates"], 2)
+        self.assertEqual(
+            report["failed"], [{"index": 3, "error": "receipt_data is missing"}, {"index": 5, "error": "document too large"}]
+        )
+        inserted = self.receipts.insert_many.call_args_list[0].args[0]
+        self.assertEqual(inserted[0]["receipt_data"]["date"], datetime(2025, 1, 2))
+        self.assertFalse(self.receipts.insert_many.call_args_list[0].kwargs["ordered"])
+
+    def test_load_receipts_export_reads_json_and_json_lines(self):
+        """Test that exports are read from a JSON list, a receipts object or JSON Lines."""
+        receipt = {"receipt_data": {}, "items": []}
+        self.assertEqual(load_receipts_export('[{"receipt_data": {}, "items": []}]'), [receipt])
+        self.assertEqual(load_receipts_export('{"receipts": [{"receipt_data": {}, "items": []}]}'), [receipt])
+        self.assertEqual(
+            load_receipts_export('{"receipt_data": {}, "items": []}\n{"receipt_data": {}, "items": []}\n'), [receipt, receipt]
+        )
+        with self.assertRaises(ValueError):
+            load_receipts_export("not json")
+
+
+if __name__ == "__main__":
+    unittest.main()
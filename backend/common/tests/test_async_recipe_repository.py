@@ -0,0 +1,58 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock, patch
+
+from bson import ObjectId
+
+from common.async_recipe_repository import AsyncRecipeRepository
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args):
+        return self
+
+    def __aiter__(self):
+        """Iterate the documents like a motor cursor."""
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class TestAsyncRecipeRepository(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the motor-based recipe repository."""
+
+    def setUp(self):
+        self.recipes = SimpleNamespace(find=Mock())
+        self.repository = AsyncRecipeRepository()
+        self.repository.mongo_connection = SimpleNamespace(
+            initialize_collection=AsyncMock(),
+            get_database=Mock(return_value=SimpleNamespace(recipes=self.recipes)),
+        )
+
+    async def test_ingredient_lookups_query_the_collection_and_rank_with_the_search_index(self):
+        """Test that recipes unknown to the search index are found, ranked after the ones it scores."""
+        known, older, unknown = ObjectId(), ObjectId(), ObjectId()
+        self.recipes.find.return_value = FakeCursor(
+            [
+                {"_id": unknown, "name": "Written elsewhere", "created_at": datetime(2025, 1, 3)},
+                {"_id": older, "name": "Older", "created_at": datetime(2025, 1, 2)},
+                {"_id": known, "name": "Best match", "created_at": datetime(2025, 1, 1)},
+            ]
+        )
+        index = SimpleNamespace(loaded=True, search_ingredients=Mock(return_value=[(known, 2.0), (older, 1.0)]))
+
+        with patch("common.async_recipe_repository.recipe_search_index", index):
+            recipes = await self.repository.get_recipes_by_ingredients(["onion"], match_all=True)
+
+        self.assertEqual(self.recipes.find.call_args.args[0], {"ingredient_keys": {"$all": ["onion"]}})
+        self.assertEqual([recipe.name for recipe in recipes], ["Best match", "Older", "Written elsewhere"])
+
+
+if __name__ == "__main__":
+    unittest.main()
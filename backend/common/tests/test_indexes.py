@@ -0,0 +1,76 @@
+import unittest
+
+from common.indexes import INDEXES, index_diff, indexes_for, winning_plan_stages
+
+
+def listed(spec, name=None):
+    """An index as reported by list_indexes for a declared IndexSpec."""
+    return {"v": 2, "key": dict(spec.keys), "name": name or spec.index_name, **spec.options}
+
+
+class TestIndexDiff(unittest.TestCase):
+    """Test cases for reconciling the indexes of a collection with the registry."""
+
+    def test_matching_indexes_are_kept_and_missing_ones_created(self):
+        """Test that declared indexes already present are left alone and the others are created."""
+        uploads = indexes_for("uploads")
+        self.assertEqual(
+            index_diff("uploads", [{"key": {"_id": 1}, "name": "_id_"}, listed(uploads[0])]),
+            {"drop": [], "create": [], "undeclared": []},
+        )
+
+        diff = index_diff("receipt_items", [listed(indexes_for("receipt_items")[0])])
+        self.assertEqual(diff["drop"], [])
+        self.assertEqual(diff["create"], indexes_for("receipt_items")[1:])
+
+    def test_undeclared_indexes_are_only_dropped_on_request(self):
+        """Test that undeclared indexes are reported unless dropping them is asked for, and changed ones recreated."""
+        [uploads] = indexes_for("uploads")
+        changed = {**listed(uploads), "unique": False}
+        undeclared = {"key": {"file_id": 1}, "name": "file_id_1"}
+
+        diff = index_diff("uploads", [changed, undeclared])
+
+        self.assertEqual(diff, {"drop": ["content_hash_1"], "create": [uploads], "undeclared": ["file_id_1"]})
+        self.assertEqual(index_diff("uploads", [listed(uploads), undeclared], drop_undeclared=True)["drop"], ["file_id_1"])
+
+    def test_declared_keys_under_another_name_are_renamed(self):
+        """Test that an index with the declared keys but another name is replaced, even when undeclared ones are kept."""
+        [aggregates] = indexes_for("aggregates")
+        diff = index_diff("aggregates", [listed(aggregates, name="type_1_year_1_month_1_week_1")])
+
+        self.assertEqual(diff, {"drop": ["type_1_year_1_month_1_week_1"], "create": [aggregates], "undeclared": []})
+
+    def test_text_indexes_are_matched_on_their_weights(self):
+        """Test that the recipes text index, reported with internal keys, is recognised."""
+        text = next(spec for spec in indexes_for("recipes") if spec.is_text())
+        info = {"key": {"_fts": "text", "_ftsx": 1}, "name": text.index_name, "weights": {"name": 1, "tags": 1}}
+
+        self.assertTrue(text.matches(info))
+        self.assertFalse(text.matches({**info, "weights": {"name": 1}}))
+
+    def test_index_names_are_unique(self):
+        """Test that no two declared indexes of a collection share a name."""
+        names = [(spec.collection, spec.index_name) for spec in INDEXES]
+        self.assertEqual(len(names), len(set(names)))
+
+
+class TestWinningPlanStages(unittest.TestCase):
+    """Test cases for reading explain() output."""
+
+    def test_stages_are_collected_from_nested_plans(self):
+        """Test that stages of the winning plan are found with their input stages, and that rejected plans are ignored."""
+        explain = {
+            "queryPlanner": {
+                "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "created_at_-1__id_-1"}},
+                "rejectedPlans": [{"stage": "COLLSCAN"}],
+            }
+        }
+        self.assertEqual(winning_plan_stages(explain), ["FETCH", "IXSCAN"])
+
+        sharded = {"queryPlanner": {"winningPlan": {"shards": [{"winningPlan": {"stage": "COLLSCAN"}}]}}}
+        self.assertIn("COLLSCAN", winning_plan_stages(sharded))
+
+
+if __name__ == "__main__":
+    unittest.main()
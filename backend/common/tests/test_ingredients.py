@@ -0,0 +1,42 @@
+import unittest
+
+from common.ingredients import canonical_ingredient, ingredient_keys, ingredient_query_keys
+from common.recipe_repository import recipes_by_ingredients_query
+
+
+class TestCanonicalIngredient(unittest.TestCase):
+    """Test cases for the ingredient normalizer."""
+
+    def test_quantities_units_and_preparation_notes_are_dropped(self):
+        """Test that quantities, units, descriptors and notes after a comma or in parentheses are dropped."""
+        self.assertEqual(canonical_ingredient("2 onions, finely chopped"), "onion")
+        self.assertEqual(canonical_ingredient("500 g minced beef (10% fat)"), "minced beef")
+        self.assertEqual(canonical_ingredient("1 cup fresh basil leaves"), "basil")
+        self.assertEqual(canonical_ingredient("3 tomatoes"), "tomato")
+        self.assertIsNone(canonical_ingredient("2 dl"))
+
+    def test_finnish_and_alternative_names_are_translated(self):
+        """Test that Finnish names, also in the partitive, and alternative names become the English name."""
+        self.assertEqual(canonical_ingredient("500 g naudan jauhelihaa"), "minced beef")
+        self.assertEqual(canonical_ingredient("400 g kikherneitä"), "chickpea")
+        self.assertEqual(canonical_ingredient("2 rkl oliiviöljyä"), "olive oil")
+        self.assertEqual(canonical_ingredient("ground beef"), "minced beef")
+        self.assertEqual(canonical_ingredient("garbanzo beans"), "chickpea")
+
+    def test_ingredient_keys_include_the_words_of_names(self):
+        """Test that the keys of a recipe are its canonical names and their words, without repeats."""
+        keys = ingredient_keys(["500 g naudan jauhelihaa", "1 sipuli", "2 onions", "2 rkl oliiviöljyä", "1 dl"])
+
+        self.assertEqual(keys, ["minced beef", "minced", "beef", "onion", "olive oil", "olive", "oil"])
+
+    def test_queries_match_any_or_all_canonical_names(self):
+        """Test that ingredient queries use $in, or $all when all ingredients are required."""
+        self.assertEqual(ingredient_query_keys(["Sipulia", "onion", "jauheliha"]), ["onion", "minced meat"])
+        self.assertEqual(recipes_by_ingredients_query(["sipuli", "beef"]), {"ingredient_keys": {"$in": ["onion", "beef"]}})
+        self.assertEqual(
+            recipes_by_ingredients_query(["sipuli", "beef"], match_all=True), {"ingredient_keys": {"$all": ["onion", "beef"]}}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from pymongo.errors import PyMongoError
+
+from common.migrations import (
+    Migration,
+    add_receipt_fingerprint,
+    canonicalize_receipt_categories,
+    canonicalize_recipe_tags,
+    normalize_receipt_date,
+    run_migration,
+)
+from common.receipt_repository import parse_receipt_date, receipt_fingerprint
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, limit):
+        self.documents = self.documents[:limit]
+        return self
+
+    async def to_list(self, length=None):
+        return list(self.documents)
+
+
+class FakeCollection:
+    """Documents with integer _ids, answering the batch queries of run_migration."""
+
+    def __init__(self, documents=None):
+        self.documents = documents or []
+        self.bulk_write = AsyncMock(side_effect=lambda updates, ordered: SimpleNamespace(modified_count=len(updates)))
+
+    def find(self, query, projection=None):
+        last_id = query["$and"][1]["_id"]["$gt"] if "$and" in query else 0
+        return FakeCursor([document for document in self.documents if document["_id"] > last_id])
+
+    async def find_one(self, query):
+        return next((document for document in self.documents if document["_id"] == query["_id"]), None)
+
+    async def replace_one(self, query, document, upsert=False):
+        self.documents = [d for d in self.documents if d["_id"] != query["_id"]] + [dict(document)]
+
+
+class TestMigrationTransforms(unittest.TestCase):
+    """Test cases for the transforms of the data migrations."""
+
+    def test_date_strings_are_parsed_and_the_fingerprint_updated(self):
+        """Test that receipt dates in the known formats become dates, and that other strings are left alone."""
+        document = {"_id": 1, "receipt_data": {"date": "02.01.2025 14:33", "total": 5.0}, "items": []}
+
+        fields = normalize_receipt_date(document)
+
+        self.assertEqual(fields["receipt_data.date"], datetime(2025, 1, 2))
+        receipt = parse_receipt_date({"receipt_data": {"date": "2025-01-02", "total": 5.0}, "items": []})
+        self.assertEqual(fields["fingerprint"], receipt_fingerprint(receipt))
+        self.assertIsNone(normalize_receipt_date({"_id": 2, "receipt_data": {"date": "yesterday"}, "items": []}))
+
+    def test_receipts_without_fingerprint_get_the_one_imports_compute(self):
+        """Test that the fingerprint stored for an old receipt is the one a bulk import computes for it."""
+        receipt = {"receipt_data": {"date": datetime(2025, 1, 2), "place": "Prisma", "total": 5.0}, "items": []}
+
+        self.assertEqual(add_receipt_fingerprint({"_id": 1, **receipt}), {"fingerprint": receipt_fingerprint(receipt)})
+
+    def test_category_values_are_canonicalized(self):
+        """Test that mixed case category values are rewritten in the taxonomy spelling, and canonical ones are not."""
+        item = {"name_en": "Salmon", "item_category": {"level_1": "food", "level_2": "FISH &  seafood", "level_3": ""}}
+
+        fields = canonicalize_receipt_categories({"_id": 1, "items": [item]})
+
+        self.assertEqual(
+            fields["items"][0]["item_category"], {"level_1": "Food", "level_2": "Fish & Seafood", "level_3": None}
+        )
+        self.assertEqual(item["item_category"]["level_1"], "food")
+        self.assertIsNone(canonicalize_receipt_categories({"_id": 1, "items": fields["items"]}))
+
+    def test_recipe_tags_are_canonicalized(self):
+        """Test that recipe tags are lowercased without repeats."""
+        self.assertEqual(
+            canonicalize_recipe_tags({"tags": ["Quick", " quick", "Main  Course"]}), {"tags": ["quick", "main course"]}
+        )
+        self.assertIsNone(canonicalize_recipe_tags({"tags": ["quick"]}))
+
+
+class TestRunMigration(unittest.IsolatedAsyncioTestCase):
+    """Test cases for running a migration in checkpointed batches."""
+
+    async def test_migration_resumes_from_its_checkpoint(self):
+        """Test that a migration failing halfway resumes after the last checkpointed batch and then completes."""
+        receipts = FakeCollection([{"_id": i, "value": "x"} for i in range(1, 6)])
+        checkpoints = FakeCollection()
+        database = MagicMock()
+        database.__getitem__.side_effect = lambda name: checkpoints if name == "migrations" else receipts
+        after = AsyncMock()
+        migration = Migration("test", "receipts", "", {}, {}, lambda document: {"value": "y"}, after=after)
+
+        receipts.bulk_write.side_effect = [SimpleNamespace(modified_count=2), PyMongoError("connection lost")]
+        state = await run_migration(migration, database, batch_size=2, pause_seconds=0)
+        self.assertEqual((state["status"], state["last_id"], state["modified"]), ("failed", 2, 2))
+        after.assert_not_awaited()
+
+        receipts.bulk_write.side_effect = lambda updates, ordered: SimpleNamespace(modified_count=len(updates))
+        state = await run_migration(migration, database, batch_size=2, pause_seconds=0)
+
+        self.assertEqual((state["status"], state["last_id"], state["scanned"], state["modified"]), ("completed", 5, 5, 5))
+        resumed = [call.args[0] for call in receipts.bulk_write.call_args_list[2:]]
+        self.assertEqual([[update._filter["_id"] for update in updates] for updates in resumed], [[3, 4], [5]])
+        self.assertEqual(set(resumed[0][0]._doc["$set"]), {"value", "updated_at"})
+        after.assert_awaited_once_with(database)
+
+        receipts.bulk_write.reset_mock()
+        await run_migration(migration, database, batch_size=2, pause_seconds=0)
+        receipts.bulk_write.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from types import SimpleNamespace
+
+from common.mongo_clients import MongoClients, PoolMetrics
+
+
+def event(duration=None):
+    return SimpleNamespace(address=("localhost", 27017), connection_id=1, duration=duration)
+
+
+class TestPoolMetrics(unittest.TestCase):
+    """Test cases for the connection pool counters."""
+
+    def test_checkouts_and_wait_times_are_counted(self):
+        """Test that checked out connections and their wait times are tracked per address."""
+        metrics = PoolMetrics()
+        metrics.connection_created(event())
+        metrics.connection_checked_out(event(0.002))
+        metrics.connection_checked_out(event(0.004))
+        metrics.connection_checked_in(event())
+        metrics.connection_check_out_failed(event(0.5))
+
+        pool = metrics.stats()["localhost:27017"]
+        self.assertEqual(pool["open_connections"], 1)
+        self.assertEqual(pool["checked_out"], 1)
+        self.assertEqual(pool["max_checked_out"], 2)
+        self.assertEqual(pool["checkouts"], 2)
+        self.assertEqual(pool["failed_checkouts"], 1)
+        self.assertEqual(pool["max_wait_seconds"], 0.5)
+        self.assertAlmostEqual(pool["average_wait_seconds"], 0.253)
+
+
+class TestMongoClients(unittest.TestCase):
+    """Test cases for the process-wide client manager."""
+
+    def test_clients_are_created_on_first_use_and_shared(self):
+        """Test that no client exists until it is used and that every user gets the same one."""
+        clients = MongoClients("mongodb://localhost:27017", "receipts")
+        self.assertFalse(clients.stats()["sync"]["started"])
+
+        client = clients.get_sync_client()
+        try:
+            self.assertIs(clients.get_sync_client(), client)
+            self.assertTrue(clients.is_shared(client))
+            self.assertEqual(clients.sync_db["receipts"].full_name, "receipts.receipts")
+            self.assertEqual(client.options.pool_options.max_pool_size, clients.stats()["options"]["maxPoolSize"])
+        finally:
+            clients.close()
+        self.assertFalse(clients.stats()["sync"]["started"])
+
+
+if __name__ == "__main__":
+    unittest.main()
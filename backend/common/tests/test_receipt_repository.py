@@ -0,0 +1,154 @@
+import unittest
+from datetime import datetime
+
+from bson import ObjectId
+
+from common.indexes import indexes_for
+from common.receipt_repository import (
+    RECEIPT_ITEMS_COLLECTION,
+    RECEIPT_ITEMS_PIPELINE,
+    add_category_tokens,
+    category_tokens,
+    is_same_place,
+    items_per_item_type_query,
+    receipt_from_document,
+    receipt_item_documents,
+    receipts_by_date_query,
+    receipts_page_query,
+    similar_receipts_query,
+    store_condition,
+    store_keys,
+)
+
+
+class TestCategoryTokens(unittest.TestCase):
+    """Test cases for the category tokens used to look up items by type."""
+
+    def test_tokens_are_the_lowercased_words_of_all_levels(self):
+        """Test that every word of every category level becomes a lowercase token."""
+        item = {"item_category": {"level_1": "Food", "level_2": "Grains & Pasta", "level_3": "Rice"}}
+        self.assertEqual(category_tokens(item), ["food", "grains", "pasta", "rice"])
+
+    def test_missing_levels_and_categories(self):
+        """Test that missing levels are skipped and items without a category dict have no tokens."""
+        self.assertEqual(category_tokens({"item_category": {"level_1": "Food", "level_2": None}}), ["food"])
+        self.assertEqual(category_tokens({"item_category": None}), [])
+        self.assertEqual(category_tokens({"item_category": "food"}), [])
+        self.assertEqual(category_tokens({}), [])
+
+    def test_tokens_are_stored_on_write_and_hidden_on_read(self):
+        """Test that tokens are added to every item of a receipt and left out of the formatted receipt."""
+        receipt = add_category_tokens(
+            {"items": [{"name_en": "Milk", "item_category": {"level_1": "Food", "level_2": "Dairy"}}]}
+        )
+        self.assertEqual(receipt["items"][0]["category_tokens"], ["food", "dairy"])
+
+        now = datetime(2025, 1, 3)
+        document = {"_id": "1", "receipt_data": {}, "items": receipt["items"], "created_at": now, "updated_at": now}
+        self.assertNotIn("category_tokens", receipt_from_document(document)["data"]["items"][0])
+
+
+class TestReceiptItems(unittest.TestCase):
+    """Test cases for the receipt_items documents and the item lookup by category."""
+
+    def test_one_document_per_line_item(self):
+        """Test that every line item becomes a document with the date, store and categories of its receipt."""
+        receipt_id = ObjectId()
+        receipt = {
+            "receipt_data": {"date": datetime(2025, 1, 2), "place": "Prisma"},
+            "items": [
+                {"name_en": "Milk", "total_price": 1.2, "item_category": {"level_1": "Food", "level_2": "Dairy"}},
+                {"name_en": "Bag", "total_price": 0.3, "item_category": None},
+            ],
+        }
+
+        documents = receipt_item_documents(receipt_id, add_category_tokens(receipt))
+
+        self.assertEqual([document["line"] for document in documents], [0, 1])
+        self.assertEqual(documents[0]["receipt_id"], receipt_id)
+        self.assertEqual(documents[0]["date"], datetime(2025, 1, 2))
+        self.assertEqual(documents[0]["store"], "Prisma")
+        self.assertEqual(documents[0]["total_price"], 1.2)
+        self.assertEqual((documents[0]["level_1"], documents[0]["level_2"], documents[0]["level_3"]), ("Food", "Dairy", None))
+        self.assertEqual(documents[0]["category_tokens"], ["food", "dairy"])
+        self.assertEqual(documents[1]["category_tokens"], [])
+
+    def test_rebuild_pipeline_projects_the_same_fields(self):
+        """Test that the rebuild pipeline writes the same fields as receipt_item_documents."""
+        receipt = {"receipt_data": {}, "items": [{"item_category": {}}]}
+        projection = RECEIPT_ITEMS_PIPELINE[2]["$project"]
+        self.assertEqual(set(projection) - {"_id"}, set(receipt_item_documents(ObjectId(), receipt)[0]))
+
+    def test_rebuild_pipeline_merges_on_the_unique_line_index(self):
+        """Test that the rebuild merges rows on receipt and line, which a unique index backs, instead of $out."""
+        merge = RECEIPT_ITEMS_PIPELINE[-1]["$merge"]
+        [spec] = [spec for spec in indexes_for(RECEIPT_ITEMS_COLLECTION) if spec.options.get("unique")]
+
+        self.assertEqual((merge["into"], merge["whenMatched"]), (RECEIPT_ITEMS_COLLECTION, "replace"))
+        self.assertEqual(merge["on"], [key for key, _ in spec.keys])
+
+    def test_every_word_must_start_a_token(self):
+        """Test that the item type is matched as anchored, escaped prefixes of the category tokens."""
+        query = items_per_item_type_query("Poultry (fresh)")
+
+        patterns = query["category_tokens"]["$all"]
+        self.assertEqual([pattern.pattern for pattern in patterns], ["^poultry", "^fresh"])
+
+    def test_empty_item_type_has_no_query(self):
+        """Test that an item type without words does not scan the collection."""
+        self.assertIsNone(items_per_item_type_query(" & "))
+
+
+class TestStoreFilter(unittest.TestCase):
+    """Test cases for the store filter of the receipt listings."""
+
+    def test_store_keys_start_at_every_word(self):
+        """Test that the keys of a place are its lowercased words from each word on, without punctuation."""
+        self.assertEqual(
+            store_keys({"receipt_data": {"place": "K-Citymarket Espoo"}}), ["k citymarket espoo", "citymarket espoo", "espoo"]
+        )
+        self.assertEqual(store_keys({"receipt_data": {}}), [])
+
+    def test_both_listings_match_a_store_the_same_way(self):
+        """Test that the listings by date and by page filter the store with the same anchored prefix of a store key."""
+        condition = store_condition("K-citymarket")
+
+        self.assertEqual(condition, {"store_keys": {"$regex": "^k citymarket"}})
+        self.assertEqual(
+            receipts_by_date_query("2025-01-01", "2025-01-31", "K-citymarket")["store_keys"], condition["store_keys"]
+        )
+        self.assertEqual(receipts_page_query(store="K-citymarket"), {"$and": [condition]})
+        self.assertEqual(store_condition("S-market (Kamppi)")["store_keys"]["$regex"], "^s market kamppi")
+        self.assertIsNone(store_condition(" - "))
+        self.assertEqual(receipts_page_query(store=" - "), {})
+
+
+class TestSimilarReceipts(unittest.TestCase):
+    """Test cases for recognising the same purchase saved twice."""
+
+    def test_same_day_and_total_within_tolerance(self):
+        """Test that similar receipts are looked up over the whole day and a cent around the total."""
+        query = similar_receipts_query({"receipt_data": {"date": datetime(2025, 1, 2, 15, 30), "total": 42.5}})
+
+        self.assertEqual(query["receipt_data.date"], {"$gte": datetime(2025, 1, 2), "$lt": datetime(2025, 1, 3)})
+        self.assertAlmostEqual(query["receipt_data.total"]["$gte"], 42.49)
+        self.assertAlmostEqual(query["receipt_data.total"]["$lte"], 42.51)
+
+    def test_receipts_without_date_or_total_are_not_compared(self):
+        """Test that receipts whose date was not parsed or without total have no similar receipts query."""
+        self.assertIsNone(similar_receipts_query({"receipt_data": {"date": "yesterday", "total": 1.0}}))
+        self.assertIsNone(similar_receipts_query({"receipt_data": {"date": datetime(2025, 1, 2), "total": None}}))
+
+    def test_same_place(self):
+        """Test that places match ignoring case and punctuation, and with one a shorter form of the other."""
+        self.assertTrue(is_same_place("K-Citymarket", "k citymarket Espoo Sello"))
+        self.assertFalse(is_same_place("Prisma", "Lidl"))
+
+    def test_unknown_place_is_not_the_same_place(self):
+        """Test that an unknown place matches no place, not even another unknown one."""
+        self.assertFalse(is_same_place("Prisma", None))
+        self.assertFalse(is_same_place("", "-"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+from datetime import date, datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from common.recipe_recommender import RecipeRecommender, item_names, recipe_names
+
+TODAY = date(2025, 3, 20)
+
+
+def receipt(day, *names):
+    """Receipt document with one line item per English name"""
+    return {"receipt_data": {"date": datetime(2025, 3, day)}, "items": [{"name_en": name} for name in names]}
+
+
+def insert(receipt_id, document):
+    return {"operationType": "insert", "documentKey": {"_id": receipt_id}, "fullDocument": document}
+
+
+class TestNames(unittest.TestCase):
+    """Test cases for the ingredient names of line items and recipes."""
+
+    def test_line_items_match_their_names_and_category(self):
+        """Test that a line item matches the canonical names of its English and Finnish names and its category."""
+        names = item_names({"name_en": "Minced beef 10%", "name_fi": "Pirkka naudan jauheliha 400g", "level_3": "Meat"})
+
+        self.assertIn("minced beef", names)
+        self.assertIn("beef", names)
+        self.assertIn("meat", names)
+
+    def test_recipes_leave_out_pantry_staples(self):
+        """Test that salt, oil and the like are not ingredients to buy."""
+        self.assertEqual(recipe_names({"ingredients": ["2 onions", "1 tl suolaa", "2 rkl oliiviöljyä", "1 onion"]}), ["onion"])
+
+
+class TestRecipeRecommender(unittest.IsolatedAsyncioTestCase):
+    """Test cases for ranking recipes by the ingredients bought recently."""
+
+    async def asyncSetUp(self):
+        self.recommender = RecipeRecommender()
+        self.recommender.loaded = True
+        self.recommender.upsert_recipe(
+            "curry", {"ingredients": ["400 g kikherneitä", "1 sipuli", "4 dl kookosmaitoa", "suolaa"]}
+        )
+        self.recommender.upsert_recipe("bolognese", {"ingredients": ["500 g minced beef", "1 onion", "pasta"]})
+        self.recommender.upsert_recipe("salad", {"ingredients": ["tomatoes", "cucumber", "feta"]})
+        await self.recommender.apply_changes(
+            [insert(1, receipt(18, "Chickpeas", "Red onions")), insert(2, receipt(1, "Cucumber"))], MagicMock()
+        )
+
+    def ranked(self, days=14):
+        return [(r["recipe_id"], r["coverage"]) for r in self.recommender.recommend(days, today=TODAY)]
+
+    async def test_recipes_are_ranked_by_coverage_within_the_days(self):
+        """Test that recipes are ranked by the share of their ingredients bought in the window, and misses left out."""
+        self.assertEqual(self.ranked(), [("curry", 0.667), ("bolognese", 0.333)])
+        self.assertEqual(self.ranked(days=30)[-1], ("salad", 0.333))
+
+        best = self.recommender.recommend(today=TODAY)[0]
+        self.assertEqual((best["matched"], best["missing"]), (["chickpea", "onion"], ["coconut milk"]))
+
+    async def test_the_last_word_of_an_ingredient_gets_partial_credit(self):
+        """Test that buying beef partly covers minced beef, and buying minced beef covers it fully."""
+        await self.recommender.apply_changes([insert(3, receipt(19, "Beef steak"))], MagicMock())
+        self.assertEqual(dict(self.ranked())["bolognese"], 0.5)
+
+        await self.recommender.apply_changes([insert(4, receipt(19, "Ground beef"))], MagicMock())
+        self.assertEqual(dict(self.ranked())["bolognese"], 0.667)
+
+    async def test_receipt_and_recipe_changes_are_applied_incrementally(self):
+        """Test that deleted receipts stop counting, updated recipes are rescored and deleted recipes dropped."""
+        await self.recommender.apply_changes([{"operationType": "delete", "documentKey": {"_id": 1}}], MagicMock())
+        self.assertEqual(self.ranked(), [])
+        self.assertEqual(self.recommender.stats()["purchases"], 1)
+
+        await self.recommender.apply_changes([insert(1, receipt(18, "Cucumber", "Feta cheese"))], MagicMock())
+        self.recommender.upsert_recipe("bolognese", {"ingredients": ["feta", "pasta"]})
+        self.recommender.remove_recipe("salad")
+
+        self.assertEqual(self.ranked(), [("bolognese", 0.5)])
+
+
+def reading_collection(documents, while_reading=None):
+    """Collection whose find cursor awaits while_reading, if given, before yielding its last document"""
+
+    async def cursor():
+        for i, document in enumerate(documents):
+            if while_reading and i == len(documents) - 1:
+                await while_reading()
+            yield document
+
+    return SimpleNamespace(find=lambda query, projection: cursor())
+
+
+class TestRecipeRecommenderLoad(unittest.IsolatedAsyncioTestCase):
+    """Test cases for loading the recommender while recipes and receipts change."""
+
+    async def test_changes_while_the_first_load_reads_are_kept(self):
+        """Test that recipe writes and receipt changes made while the first load reads are applied after it."""
+        recommender = RecipeRecommender()
+
+        async def write():
+            recommender.upsert_recipe("salad", {"ingredients": ["tomatoes", "cucumber", "feta"]})
+            recommender.remove_recipe("curry")
+            await recommender.apply_changes([insert(2, receipt(19, "Cucumber"))], MagicMock())
+
+        items = [{"receipt_id": 1, "date": datetime(2025, 3, 18), "name_en": "Onion"}]
+        recipes = [
+            {"_id": "curry", "ingredients": ["chickpeas", "onion"]},
+            {"_id": "bolognese", "ingredients": ["minced beef", "onion"]},
+        ]
+        await recommender.load(reading_collection(items), reading_collection(recipes, write))
+
+        self.assertEqual(
+            [(r["recipe_id"], r["coverage"]) for r in recommender.recommend(today=TODAY)],
+            [("bolognese", 0.5), ("salad", 0.333)],
+        )
+        self.assertEqual(recommender.queued, [])
+        self.assertIsNone(recommender.written)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from datetime import datetime
+
+from bson import ObjectId
+
+from common.recipe_repository import (
+    canonical_tags,
+    recipes_next_cursor,
+    recipes_page_query,
+    recipes_projection,
+)
+
+
+class TestRecipesListing(unittest.TestCase):
+    """Test cases for the paginated recipes listing."""
+
+    def test_summary_view_projects_the_summary_fields(self):
+        """Test that the summary view leaves out ingredients and steps, and that unknown views are rejected."""
+        projection = recipes_projection("summary")
+
+        self.assertIn("name", projection)
+        self.assertNotIn("ingredients", projection)
+        self.assertNotIn("steps", projection)
+        self.assertEqual(recipes_projection("full"), {"embedding": 0, "embedding_model": 0})
+        with self.assertRaises(ValueError):
+            recipes_projection("everything")
+
+    def test_next_cursor_continues_after_the_last_recipe(self):
+        """Test that a full page returns a cursor after its last recipe and the last page none."""
+        now = datetime(2025, 1, 3, 12, 0)
+        documents = [{"_id": ObjectId(), "created_at": now} for _ in range(3)]
+
+        cursor = recipes_next_cursor(documents, 2)
+
+        self.assertEqual(
+            recipes_page_query(cursor),
+            {"$or": [{"created_at": {"$lt": now}}, {"created_at": now, "_id": {"$lt": documents[1]["_id"]}}]},
+        )
+        self.assertIsNone(recipes_next_cursor(documents, 3))
+        self.assertEqual(recipes_page_query(None), {})
+
+    def test_tags_are_canonicalized(self):
+        """Test that tags are lowercased, trimmed and deduplicated in their original order."""
+        self.assertEqual(canonical_tags(["Easy", "quick ", "easy", "", "Main  Course"]), ["easy", "quick", "main course"])
+        self.assertEqual(canonical_tags(None), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
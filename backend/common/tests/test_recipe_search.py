@@ -0,0 +1,92 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+from common.recipe_search import RecipeSearchIndex, tokenize
+
+
+def recipe(name, ingredients=(), steps=(), tags=(), created_at=datetime(2025, 1, 1)):
+    return {"name": name, "ingredients": list(ingredients), "steps": list(steps), "tags": list(tags), "created_at": created_at}
+
+
+class TestTokenize(unittest.TestCase):
+    """Test cases for the recipe search tokenizer."""
+
+    def test_inflected_forms_share_a_term(self):
+        """Test that English plurals and Finnish case endings are stemmed to the same term."""
+        self.assertEqual(tokenize("Tomatoes"), tokenize("tomato"))
+        self.assertEqual(tokenize("sauces"), tokenize("sauce"))
+        self.assertEqual(tokenize("perunaa"), tokenize("perunassa"))
+        self.assertEqual(tokenize("berries"), tokenize("berry"))
+
+    def test_quantities_units_and_stop_words_are_dropped(self):
+        """Test that numbers, units of measure and stop words are not terms."""
+        self.assertEqual(tokenize("500 g minced beef and 2 dl cream"), tokenize("minced beef cream"))
+
+
+class TestRecipeSearchIndex(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the in-memory BM25 recipe index."""
+
+    def setUp(self):
+        self.index = RecipeSearchIndex()
+        self.index.upsert(1, recipe("Chickpea curry", ["400 g chickpeas", "1 onion"], ["Fry the onion"], ["vegan", "quick"]))
+        self.index.upsert(2, recipe("Beef stew", ["500 g beef", "2 onions", "beef stock"], ["Simmer for two hours"], ["meat"]))
+        self.index.upsert(3, recipe("Hummus", ["chickpeas", "tahini"], ["Blend"], ["vegan"], datetime(2025, 2, 1)))
+        self.index.upsert(4, recipe("Pasta", ["pasta", "minced beef"], ["Add the chickpea water"]))
+
+    def test_search_ranks_name_matches_first(self):
+        """Test that a term in the name scores higher than in the ingredients or steps, and that misses are left out."""
+        ranked = [recipe_id for recipe_id, _ in self.index.search("chickpea curry")]
+
+        self.assertEqual(ranked[0], 1)
+        self.assertEqual(set(ranked), {1, 3, 4})
+        self.assertEqual(self.index.search("lasagne"), [])
+        self.assertEqual(len(self.index.search("onion", limit=1)), 1)
+
+    def test_ingredients_match_canonical_ingredient_names(self):
+        """Test that an ingredient matches by its canonical name, not by terms spread over the recipe."""
+        self.assertEqual({recipe_id for recipe_id, _ in self.index.search_ingredients(["minced beef"])}, {4})
+        self.assertEqual({recipe_id for recipe_id, _ in self.index.search_ingredients(["beef", "tahini"])}, {2, 3, 4})
+        self.assertEqual(self.index.search_ingredients(["chickpea water"]), [])
+        self.assertEqual({recipe_id for recipe_id, _ in self.index.search_ingredients(["kikherneitä", "sipuli"])}, {1, 2, 3})
+        self.assertEqual(
+            [recipe_id for recipe_id, _ in self.index.search_ingredients(["chickpea", "onion"], match_all=True)], [1]
+        )
+
+    def test_tags_are_listed_newest_first(self):
+        """Test that tag lookups return the recipes with any of the tags, newest first."""
+        self.assertEqual(self.index.search_tags(["vegan"]), [3, 1])
+        self.assertEqual(self.index.search_tags(["meat", "unknown"]), [2])
+
+    def test_updates_and_deletes_replace_the_postings(self):
+        """Test that a recipe is reindexed on update and dropped on delete, without leaving postings behind."""
+        self.index.upsert(1, recipe("Lentil soup", ["lentils"], ["Boil"], ["vegan"]))
+
+        self.assertEqual([recipe_id for recipe_id, _ in self.index.search("curry")], [])
+        self.assertEqual([recipe_id for recipe_id, _ in self.index.search("lentil")], [1])
+
+        for recipe_id in (1, 2, 3, 4):
+            self.index.remove(recipe_id)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.stats()["terms"], 0)
+        self.assertEqual(self.index.total_length, 0)
+
+    async def test_writes_while_loading_are_kept(self):
+        """Test that recipes saved or deleted while a load reads the collection are not lost when it swaps in."""
+
+        async def cursor():
+            yield {"_id": 1, **recipe("Chickpea curry", ["chickpeas"])}
+            self.index.upsert(5, recipe("Lentil soup", ["lentils"]))
+            self.index.upsert(2, recipe("Beef burger", ["minced beef"]))
+            self.index.remove(1)
+            yield {"_id": 2, **recipe("Beef stew", ["beef"])}
+
+        await self.index.load(SimpleNamespace(find=lambda query, projection: cursor()))
+
+        self.assertEqual(sorted(self.index.lengths), [2, 5])
+        self.assertEqual([recipe_id for recipe_id, _ in self.index.search("burger")], [2])
+        self.assertIsNone(self.index.written)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from common.recipe_vectors import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    RecipeVectorIndex,
+    query_embedding,
+    recipe_embedding,
+    recipe_vector_fields,
+    stored_embedding,
+    top_k_cosine,
+)
+
+RECIPES = [
+    {
+        "_id": "a1",
+        "name": "Kikhernecurry",
+        "ingredients": ["400 g kikherneitä", "1 sipuli", "4 dl kookosmaitoa"],
+        "steps": ["Kuullota sipuli", "Lisää kikherneet ja kookosmaito"],
+        "tags": ["vegan"],
+        "cooking_time": 20,
+    },
+    {
+        "_id": "b2",
+        "name": "Beef stew",
+        "ingredients": ["500 g beef", "2 onions", "4 potatoes"],
+        "steps": ["Simmer for two hours"],
+        "tags": ["meat"],
+        "cooking_time": 120,
+    },
+    {
+        "_id": "c3",
+        "name": "Greek salad",
+        "ingredients": ["tomatoes", "cucumber", "feta"],
+        "steps": ["Chop"],
+        "tags": ["salad"],
+    },
+]
+
+
+class TestEmbeddings(unittest.TestCase):
+    """Test cases for the local recipe and query embeddings."""
+
+    def test_vectors_are_normalized_and_deterministic(self):
+        """Test that vectors have unit length and do not change between runs or processes."""
+        vector = recipe_embedding(RECIPES[0])
+
+        self.assertEqual(vector.shape, (EMBEDDING_DIMENSIONS,))
+        self.assertAlmostEqual(float(np.linalg.norm(vector)), 1.0, places=5)
+        np.testing.assert_array_equal(vector, recipe_embedding(dict(RECIPES[0])))
+        self.assertFalse(query_embedding("").any())
+
+    def test_queries_match_translated_and_related_words(self):
+        """Test that an English query finds a Finnish recipe, and that related terms and times count."""
+        curry, stew = recipe_embedding(RECIPES[0]), recipe_embedding(RECIPES[1])
+        query = query_embedding("something warm and quick with chickpeas")
+
+        self.assertGreater(float(query @ curry), float(query @ stew))
+        self.assertGreater(float(query_embedding("hearty stew") @ stew), float(query_embedding("hearty stew") @ curry))
+
+    def test_stored_vectors_of_another_model_are_recomputed(self):
+        """Test that a stored vector is used only if it was embedded with the current model."""
+        fields = recipe_vector_fields(RECIPES[2])
+        self.assertEqual(fields["embedding_model"], EMBEDDING_MODEL)
+
+        stale = {**RECIPES[2], "embedding": [1.0] * EMBEDDING_DIMENSIONS, "embedding_model": "other"}
+        np.testing.assert_allclose(stored_embedding(stale), fields["embedding"], rtol=1e-6)
+
+
+class TestTopK(unittest.TestCase):
+    """Test cases for the blocked top k cosine search."""
+
+    def test_top_k_over_blocks_matches_a_full_sort(self):
+        """Test that scanning rows block by block gives the same top k as sorting all scores, skipping dead rows."""
+        rng = np.random.default_rng(7)
+        rows = rng.normal(size=(50, 8)).astype(np.float32)
+        queries = rng.normal(size=(3, 8)).astype(np.float32)
+        labels = np.arange(50)
+        labels[[4, 17]] = -1
+
+        scores, found = top_k_cosine(queries, [(rows[i : i + 16], labels[i : i + 16]) for i in range(0, 50, 16)], 5)
+
+        expected = queries @ rows.T
+        expected[:, [4, 17]] = -np.inf
+        for query in range(3):
+            self.assertEqual(set(found[query]), set(np.argsort(-expected[query])[:5]))
+
+
+def reading_collection(documents, while_reading):
+    """Collection whose find cursor calls while_reading before yielding its last document"""
+
+    async def cursor():
+        for i, document in enumerate(documents):
+            if i == len(documents) - 1:
+                while_reading()
+            yield document
+
+    return SimpleNamespace(find=lambda query, projection: cursor())
+
+
+class TestRecipeVectorIndex(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the memory-mapped recipe vector index."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index = RecipeVectorIndex(f"{self.directory.name}/vectors")
+        self.index.build([{**recipe, **recipe_vector_fields(recipe)} for recipe in RECIPES])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_built_vectors_are_memory_mapped_and_reopened(self):
+        """Test that a build is written to disk, and that a new index opens it without the recipes."""
+        self.assertIsInstance(self.index.vectors, np.memmap)
+
+        reopened = RecipeVectorIndex(f"{self.directory.name}/vectors")
+
+        self.assertTrue(reopened.open())
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual(reopened.search("greek salad")[0][0], "c3")
+        self.assertFalse(RecipeVectorIndex(f"{self.directory.name}/missing").open())
+
+    def test_writes_since_the_build_are_searched(self):
+        """Test that saved, updated and deleted recipes are reflected before the next build."""
+        self.index.upsert("b2", recipe_embedding({"name": "Lentil soup", "ingredients": ["red lentils"]}))
+        self.index.upsert("d4", recipe_embedding({"name": "Chocolate cake", "ingredients": ["chocolate", "sugar"]}))
+        self.index.remove("c3")
+
+        self.assertEqual(len(self.index), 3)
+        soup, cake, salad = self.index.search_many(["lentil soup", "something sweet", "greek salad"], limit=2)
+        self.assertEqual(soup[0][0], "b2")
+        self.assertEqual(cake[0][0], "d4")
+        self.assertNotIn("c3", [recipe_id for recipe_id, _ in salad])
+
+    async def test_writes_while_loading_are_kept(self):
+        """Test that recipes saved or deleted while a load reads the collection are not lost when it swaps in."""
+
+        def write():
+            self.index.upsert("d4", recipe_embedding({"name": "Chocolate cake", "ingredients": ["chocolate"]}))
+            self.index.remove("a1")
+
+        documents = [{**recipe, **recipe_vector_fields(recipe)} for recipe in RECIPES]
+        await self.index.load(reading_collection(documents, write))
+
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.search("chocolate cake")[0][0], "d4")
+        self.assertNotIn("a1", [recipe_id for recipe_id, _ in self.index.search("kikhernecurry")])
+        self.assertIsNone(self.index.written)
+
+
+if __name__ == "__main__":
+    unittest.main()
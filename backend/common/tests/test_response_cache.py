@@ -0,0 +1,95 @@
+import unittest
+
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from common.analytics import AggregatesVersion
+from common.server.response_cache import ResponseCache, etag_response
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test cases for the in-process analytics response cache."""
+
+    def setUp(self):
+        self.version = AggregatesVersion()
+        self.cache = ResponseCache(self.version, ttl_seconds=60, max_entries=2)
+        self.calls = []
+        app = FastAPI()
+
+        @app.get("/spend")
+        @self.cache.cached
+        async def get_spend(request: Request, year: int = Query(None)):
+            self.calls.append(year)
+            if year is None:
+                return JSONResponse(content={"error": "year must be specified"}, status_code=400)
+            return {"year": year, "total": 100}
+
+        self.client = TestClient(app)
+
+    def test_repeated_requests_are_served_from_the_cache(self):
+        """Test that the endpoint is only computed once per set of parameters."""
+        first = self.client.get("/spend?year=2025")
+        second = self.client.get("/spend?year=2025")
+
+        self.assertEqual(first.json(), {"year": 2025, "total": 100})
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second.headers["etag"], first.headers["etag"])
+        self.assertIn("last-modified", second.headers)
+        self.assertEqual(self.calls, [2025])
+
+    def test_if_none_match_gets_not_modified(self):
+        """Test that a matching ETag is answered with a 304 without computing the response."""
+        etag = self.client.get("/spend?year=2025").headers["etag"]
+        response = self.client.get("/spend?year=2025", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, [2025])
+        self.assertEqual(self.cache.stats()["not_modified"], 1)
+
+    def test_version_change_invalidates(self):
+        """Test that bumping the aggregates version recomputes the responses."""
+        etag = self.client.get("/spend?year=2025").headers["etag"]
+        self.version.bump()
+        response = self.client.get("/spend?year=2025", headers={"If-None-Match": etag})
+
+        # same content, so the recomputed response still matches the ETag
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, [2025, 2025])
+
+    def test_errors_are_not_cached(self):
+        """Test that error responses are computed every time."""
+        self.assertEqual(self.client.get("/spend").status_code, 400)
+        self.assertEqual(self.client.get("/spend").status_code, 400)
+        self.assertEqual(self.calls, [None, None])
+
+    def test_oldest_entries_are_evicted(self):
+        """Test that the cache holds at most max_entries responses."""
+        for year in (2023, 2024, 2025, 2023):
+            self.client.get(f"/spend?year={year}")
+        self.assertEqual(self.calls, [2023, 2024, 2025, 2023])
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+
+class TestEtagResponse(unittest.TestCase):
+    """Test cases for uncached responses with an ETag."""
+
+    def test_matching_etag_gets_not_modified(self):
+        """Test that the response carries the ETag of its body and that a request with it gets a 304."""
+        app = FastAPI()
+
+        @app.get("/recipe")
+        async def get_recipe(request: Request, name: str = Query("pasta")):
+            return etag_response(request, {"name": name})
+
+        client = TestClient(app)
+        response = client.get("/recipe")
+        etag = response.headers["etag"]
+
+        self.assertEqual(response.json(), {"name": "pasta"})
+        self.assertEqual(client.get("/recipe", headers={"If-None-Match": f"W/{etag}"}).status_code, 304)
+        self.assertEqual(client.get("/recipe?name=soup", headers={"If-None-Match": etag}).status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Uploaded receipt files for the AI Agent Vision application.
+
+Every upload is recorded in the uploads collection with the SHA-256 hash of its content, so that the
+same file uploaded twice is stored once and keeps a single file id, and so that the receipt analysis
+can recognise a file whose receipt has already been extracted.
+"""
+
+import asyncio
+import hashlib
+import logging
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from common.mongo_clients import mongo_clients
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_COLLECTION = "uploads"
+
+# size of the blocks read while hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+db = mongo_clients.async_db
+
+
+def new_content_hash():
+    """Hash object for the content of uploaded files, updated block by block."""
+    return hashlib.sha256()
+
+
+def file_content_hash(path: str) -> str:
+    """Content hash of a file on disk, the same as computed by the upload router while receiving it."""
+    digest = new_content_hash()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def find_upload_by_hash(content_hash: str) -> Optional[Dict[str, Any]]:
+    return await db[UPLOADS_COLLECTION].find_one({"content_hash": content_hash})
+
+
+async def find_upload(file_id: str) -> Optional[Dict[str, Any]]:
+    return await db[UPLOADS_COLLECTION].find_one({"_id": file_id})
+
+
+async def record_upload(file_id: str, content_hash: str, filename: str, size: int) -> Optional[Dict[str, Any]]:
+    """
+    Record a new upload. Returns the upload already recorded with the same content hash instead,
+    if another request stored the same file first.
+    """
+    upload = {
+        "_id": file_id,
+        "content_hash": content_hash,
+        "filename": filename,
+        "size": size,
+        "uploaded_at": datetime.now(UTC),
+    }
+    try:
+        await db[UPLOADS_COLLECTION].insert_one(upload)
+        return upload
+    except DuplicateKeyError:
+        return await find_upload_by_hash(content_hash)
+
+
+async def upload_content_hash(path: str) -> Optional[str]:
+    """
+    Content hash of an uploaded file, given its file id or path: from the uploads collection when the
+    file was received by the upload router, otherwise computed from the file itself.
+    """
+    upload = await find_upload(Path(path).name)
+    if upload:
+        return upload["content_hash"]
+    try:
+        return await asyncio.to_thread(file_content_hash, path)
+    except OSError as e:
+        logger.warning(f"Could not hash uploaded file {path}: {str(e)}")
+        return None
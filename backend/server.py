@@ -15,10 +15,19 @@ from fastapi import FastAPI
 load_dotenv(verbose=True)
 
 from agents.langgraphapp import main_graph
-from common.analytics import listen_for_receipt_changes
+from common.analytics import keep_line_item_cube_loaded, listen_for_receipt_changes, upgrade_aggregates
+from common.indexes import reconcile_indexes
 from common.logging import configure_logging
+from common.migrations import MIGRATIONS_ENABLED, run_migrations
+from common.mongo_clients import mongo_clients
+from common.recipe_recommender import keep_recipe_recommender_loaded
+from common.recipe_search import keep_recipe_search_index_loaded
+from common.recipe_vectors import keep_recipe_vector_index_loaded
+from common.repository_factory import get_async_receipt_repository
 from common.server.analytics_router import analytics_router
+from common.server.receipts_router import receipts_router
 from common.server.recipes_router import recipes_router
+from common.server.system_router import system_router
 from common.server.upload_router import upload_router
 
 configure_logging(logging.DEBUG)
@@ -27,10 +36,24 @@ configure_logging(logging.DEBUG)
 # required for the async mongo client
 @asynccontextmanager
 async def lifespan(app):
+    mongo_clients.start()
     loop = asyncio.get_event_loop()
-    task = loop.create_task(listen_for_receipt_changes())
+    tasks = [
+        loop.create_task(upgrade_aggregates()),
+        loop.create_task(listen_for_receipt_changes()),
+        loop.create_task(keep_line_item_cube_loaded()),
+        loop.create_task(keep_recipe_search_index_loaded(mongo_clients.async_db["recipes"])),
+        loop.create_task(keep_recipe_vector_index_loaded(mongo_clients.async_db["recipes"])),
+        loop.create_task(keep_recipe_recommender_loaded(mongo_clients.async_db)),
+        loop.create_task(get_async_receipt_repository().backfill()),
+        loop.create_task(reconcile_indexes()),
+    ]
+    if MIGRATIONS_ENABLED:
+        tasks.append(loop.create_task(run_migrations()))
     yield
-    task.cancel()
+    for task in tasks:
+        task.cancel()
+    mongo_clients.close()
 
 
 # instantiate the FastAPI app with a lifespan context manager
@@ -40,6 +63,8 @@ app = FastAPI(lifespan=lifespan)
 app.include_router(upload_router, prefix="/api")
 app.include_router(analytics_router, prefix="/api")
 app.include_router(recipes_router, prefix="/api")
+app.include_router(receipts_router, prefix="/api")
+app.include_router(system_router, prefix="/api")
 
 # CopilotKit integration
 sdk = CopilotKitRemoteEndpoint(
@@ -1,22 +1,38 @@
-import React, { useEffect } from "react";
+import React from "react";
 import RecipeList from "./components/RecipeList";
 import { Recipe } from "./components/chat/RecipeCard";
 import Typography from "@mui/material/Typography";
+import Button from "@mui/material/Button";
+
+// Recipes are listed as summaries (name, tags, times), one page at a time;
+// RecipeList fetches the whole recipe when it is expanded
+const RECIPES_PAGE_SIZE = 50;
 
 export default function RecipesSection() {
   const [recipes, setRecipes] = React.useState<Recipe[]>([]);
+  const [nextCursor, setNextCursor] = React.useState<string | null>(null);
   const [loading, setLoading] = React.useState(true);
+  const [loadingMore, setLoadingMore] = React.useState(false);
   const [error, setError] = React.useState<string | null>(null);
 
+  const fetchPage = (cursor: string | null) => {
+    const params = new URLSearchParams({
+      view: "summary",
+      limit: String(RECIPES_PAGE_SIZE),
+    });
+    if (cursor) params.set("cursor", cursor);
+    return fetch(`/api/recipes?${params}`).then((res) => {
+      if (!res.ok) throw new Error("Failed to fetch recipes");
+      return res.json();
+    });
+  };
+
   React.useEffect(() => {
     setLoading(true);
-    fetch("/api/recipes")
-      .then((res) => {
-        if (!res.ok) throw new Error("Failed to fetch recipes");
-        return res.json();
-      })
+    fetchPage(null)
       .then((data) => {
         setRecipes(data.recipes || []);
+        setNextCursor(data.next_cursor || null);
         setError(null);
       })
       .catch((err) => {
@@ -26,6 +42,17 @@ export default function RecipesSection() {
       .finally(() => setLoading(false));
   }, []);
 
+  const loadMore = () => {
+    setLoadingMore(true);
+    fetchPage(nextCursor)
+      .then((data) => {
+        setRecipes((previous) => [...previous, ...(data.recipes || [])]);
+        setNextCursor(data.next_cursor || null);
+      })
+      .catch((err) => setError(err.message || "Unknown error"))
+      .finally(() => setLoadingMore(false));
+  };
+
   if (loading) {
     return <div style={{ padding: 24 }}>Loading recipes...</div>;
   }
@@ -42,7 +69,17 @@ export default function RecipesSection() {
       >
         Recipes
       </Typography>
-      <RecipeList recipes={recipes} />
+      <RecipeList
+        recipes={recipes}
+        onDeleteRecipe={(idx) =>
+          setRecipes((previous) => previous.filter((_, i) => i !== idx))
+        }
+      />
+      {nextCursor && (
+        <Button onClick={loadMore} disabled={loadingMore} sx={{ mb: 2 }}>
+          {loadingMore ? "Loading..." : "Load more recipes"}
+        </Button>
+      )}
     </div>
   );
 }
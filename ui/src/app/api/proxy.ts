@@ -0,0 +1,27 @@
+import { NextRequest, NextResponse } from "next/server";
+import { getBackendUrl } from "./getBackendUrl";
+
+const FORWARDED_RESPONSE_HEADERS = ["content-type", "etag", "last-modified", "cache-control"];
+
+// Proxy a GET request to the backend with its query string and If-None-Match header.
+// The body is passed through as is, so that streamed responses (NDJSON) stay streamed.
+export async function proxyGet(req: NextRequest, path: string) {
+  const headers: Record<string, string> = {};
+  const ifNoneMatch = req.headers.get("if-none-match");
+  if (ifNoneMatch) headers["if-none-match"] = ifNoneMatch;
+
+  const backendRes = await fetch(`${getBackendUrl()}${path}${req.nextUrl.search}`, {
+    headers,
+    cache: "no-store",
+  });
+
+  const responseHeaders = new Headers();
+  for (const name of FORWARDED_RESPONSE_HEADERS) {
+    const value = backendRes.headers.get(name);
+    if (value) responseHeaders.set(name, value);
+  }
+  return new NextResponse(backendRes.status === 304 ? null : backendRes.body, {
+    status: backendRes.status,
+    headers: responseHeaders,
+  });
+}
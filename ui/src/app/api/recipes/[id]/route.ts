@@ -1,5 +1,14 @@
 import { NextRequest, NextResponse } from "next/server";
 import { getBackendUrl } from "../../getBackendUrl";
+import { proxyGet } from "../../proxy";
+
+export async function GET(req: NextRequest) {
+  // Extract ID from URL path
+  const pathParts = req.nextUrl.pathname.split('/');
+  const id = pathParts[pathParts.length - 1];
+
+  return proxyGet(req, `/api/recipes/${id}`);
+}
 
 export async function PUT(req: NextRequest) {
   // Extract ID from URL path
@@ -1,9 +1,7 @@
-import { NextRequest, NextResponse } from "next/server";
-import { getBackendUrl } from "../getBackendUrl";
+import { NextRequest } from "next/server";
+import { proxyGet } from "../proxy";
 
-export async function GET() {
-  // Proxy GET /api/recipes to backend
-  const backendRes = await fetch(`${getBackendUrl()}/api/recipes`);
-  const data = await backendRes.json();
-  return NextResponse.json(data, { status: backendRes.status });
+export async function GET(req: NextRequest) {
+  // Proxy GET /api/recipes to backend, with the paging parameters (limit, cursor, view, format)
+  return proxyGet(req, "/api/recipes");
 }
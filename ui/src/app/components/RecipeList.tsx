@@ -1,4 +1,4 @@
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 import Box from "@mui/material/Box";
 import Typography from "@mui/material/Typography";
 import Collapse from "@mui/material/Collapse";
@@ -28,14 +28,38 @@ export default function RecipeList({
   const [deleting, setDeleting] = useState(false);
   const [error, setError] = useState<string | null>(null);
   const [localRecipes, setLocalRecipes] = useState(recipes);
+  // whole recipes by id, fetched when a recipe listed as a summary is expanded
+  const [details, setDetails] = useState<Record<string, Recipe>>({});
   const [snackbar, setSnackbar] = useState<{
     open: boolean;
     message: string;
     severity: "success" | "error";
   }>({ open: false, message: "", severity: "success" });
 
+  // more pages of recipes are appended by the parent
+  useEffect(() => {
+    setLocalRecipes(recipes);
+  }, [recipes]);
+
   const handleToggle = (idx: number) => {
     setOpenIdx(openIdx === idx ? null : idx);
+    const recipe = localRecipes[idx];
+    if (openIdx === idx || recipe.ingredients || details[recipe.id]) return;
+    fetch(`/api/recipes/${recipe.id}`)
+      .then((res) => {
+        if (!res.ok) throw new Error("Failed to fetch recipe");
+        return res.json();
+      })
+      .then((data: Recipe) =>
+        setDetails((previous) => ({ ...previous, [recipe.id]: data }))
+      )
+      .catch((e) =>
+        setSnackbar({
+          open: true,
+          message: e.message || "Failed to fetch recipe.",
+          severity: "error",
+        })
+      );
   };
 
   const handleSnackbarClose = (
@@ -167,7 +191,16 @@ export default function RecipeList({
           </Box>
           <Collapse in={openIdx === idx} timeout="auto" unmountOnExit>
             <Box sx={{ mt: 1 }}>
-              <RecipeCard recipe={recipe} height={540} />
+              {recipe.ingredients || details[recipe.id] ? (
+                <RecipeCard
+                  recipe={details[recipe.id] || recipe}
+                  height={540}
+                />
+              ) : (
+                <Typography color="text.secondary" sx={{ px: 2 }}>
+                  Loading recipe...
+                </Typography>
+              )}
             </Box>
           </Collapse>
         </Box>